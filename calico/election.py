@@ -21,6 +21,7 @@ calico.election
 Calico election code.
 """
 from greenlet import GreenletExit
+import math
 import random
 import etcd
 import eventlet
@@ -45,26 +46,46 @@ class RestartElection(Exception):
     pass
 
 
+class ElectionLost(RestartElection):
+    """
+    Exception indicating that another server is, or may be, the master, so
+    we should start our leader election over straight away, without the
+    delay that we use after errors.
+    """
+    pass
+
+
 class Elector(object):
     def __init__(self, client, server_id, election_key,
-                 interval=30, ttl=60):
+                 interval=30, ttl=60, jitter=0.1):
         """
         Class that manages elections.
 
+        A crashed master is replaced once its key expires, so failover takes
+        up to ttl seconds; a master that is stopped deletes its key, and is
+        replaced at once.
+
         :param client: etcd client object
         :param server_id: Server ID. Must be unique to this server, and should
                           take a value that is meaningful in logs (e.g.
                           hostname)
         :param election_key: The etcd key used in the election - e.g.
                              "/calico/v1/election"
-        :param interval: Interval (seconds) between checks on etcd. Must be > 0
+        :param interval: Interval (seconds) between checks on etcd, which
+                         may be fractional. Must be > 0
         :param ttl: Time to live (seconds) for etcd values. Must be > interval.
+                    etcd only supports whole seconds, so this is rounded up.
+        :param jitter: Fraction of the interval by which the master renews
+                       its key early, at random, so that renewals from
+                       different servers don't synchronise.  Must be >= 0
+                       and < 1.
         """
         self._etcd_client = client
         self._server_id = server_id
         self._key = election_key
-        self._interval = int(interval)
-        self._ttl = int(ttl)
+        self._interval = float(interval)
+        self._ttl = int(math.ceil(ttl))
+        self._jitter = float(jitter)
         self._stopped = False
 
         if self._interval <= 0:
@@ -73,6 +94,9 @@ class Elector(object):
         if self._ttl <= self._interval:
             raise ValueError("TTL %r is <= interval %r" % (ttl, interval))
 
+        if not 0 <= self._jitter < 1:
+            raise ValueError("Jitter %r is not in [0, 1)" % jitter)
+
         # Is this the master? To start with, no
         self._master = False
 
@@ -90,6 +114,10 @@ class Elector(object):
             while not self._stopped:
                 try:
                     self._vote()
+                except ElectionLost:
+                    # Another server beat us to it, or took over from us;
+                    # go straight back to watching the key.
+                    continue
                 except RestartElection:
                     # Something failed, and wants us just to go back to the
                     # beginning.
@@ -150,6 +178,11 @@ class Elector(object):
                 # without us getting the delete action, but safer to handle it.
                 _log.warning("Implausible vanished key - become master")
                 self._become_master()
+            except etcd.EtcdEventIndexCleared:
+                # We fell too far behind the renewals of the master's key;
+                # read it again.
+                _log.info("Election key index cleared, rereading it")
+                raise ElectionLost()
             except (SocketTimeout,
                     HTTPError,
                     HTTPException,
@@ -170,10 +203,10 @@ class Elector(object):
         Function to become the master. Never returns, and continually loops
         updating the key as necessary.
 
-        raises: RestartElection if it fails to become master (e.g race
-                conditions). In this case, some other process has become
-                master.
-                Any other error from etcd is not caught in this routine.
+        raises: ElectionLost if some other process has become master first, or
+                takes over from us.
+                RestartElection if it fails to become master, or to remain
+                master, for any other reason.
         """
 
         try:
@@ -182,6 +215,9 @@ class Elector(object):
                                     ttl=self._ttl,
                                     prevExist=False,
                                     timeout=self._interval)
+        except etcd.EtcdAlreadyExist:
+            _log.info("Another server became the elected master first")
+            raise ElectionLost()
         except Exception as e:
             # We could be smarter about what exceptions we allow, but any kind
             # of error means we should give up, and safer to have a broad
@@ -201,6 +237,11 @@ class Elector(object):
                                         ttl=self._ttl,
                                         prevValue=self.id_string,
                                         timeout=self._interval)
+            except (ValueError, etcd.EtcdKeyNotFound) as e:
+                # Our key has expired, or been replaced by someone else's.
+                self._master = False
+                self._log_exception("renew master role", e)
+                raise ElectionLost()
             except Exception as e:
                 # This is a pretty broad except statement, but anything going
                 # wrong means this instance gives up being the master.
@@ -208,7 +249,10 @@ class Elector(object):
                 self._log_exception("renew master role", e)
                 raise RestartElection()
 
-            eventlet.sleep(self._interval)
+            # Renew a little early, by a random amount, so that we don't fall
+            # into step with anything else.
+            eventlet.sleep(self._interval *
+                           (1 - self._jitter * random.random()))
         raise RestartElection()
 
     def _log_exception(self, failed_to, exc):
@@ -87,6 +87,15 @@ some gotchas:
   can block on a full queue and the receiving actor may be blocked on the
   queue of the sender, trying to send another message.
 
+Tracing
+~~~~~~~
+
+Messages carry the latency traces (see felix.trace) of the message that
+was being processed when they were sent.  While a message is processed,
+its traces are current for the actor's greenlet; while a batch is being
+finished, the traces of the whole batch are current.  A message's
+reference on its traces is released once its result has been set.
+
 Unhandled Exceptions
 ~~~~~~~~~~~~~~~~~~~~
 
@@ -104,6 +113,7 @@ import gevent.local
 import logging
 import os
 import sys
+import time
 import traceback
 import uuid
 import weakref
@@ -162,6 +172,7 @@ class Actor(object):
         """
         actor_storage.name = self.name
         actor_storage.msg_uuid = None
+        actor_storage.traces = ()
 
         try:
             while True:
@@ -214,11 +225,16 @@ class Actor(object):
             batch = self._start_msg_batch(batch)
             assert batch is not None, "_start_msg_batch() should return batch."
             results = []  # Will end up same length as batch.
+            batch_traces = set()
             for msg in batch:
                 _log.debug("Message %s recd by %s from %s, queue length %d",
                            msg, msg.recipient, msg.caller,
                            self._event_queue.qsize())
                 self._current_msg = msg
+                if msg.traces:
+                    actor_storage.traces = msg.traces
+                    batch_traces.update(msg.traces)
+                    msg_start = time.time()
                 try:
                     # Actually execute the per-message method and record its
                     # result.
@@ -230,10 +246,25 @@ class Actor(object):
                     results.append(ResultOrExc(result, None))
                 finally:
                     self._current_msg = None
+                    if msg.traces:
+                        actor_storage.traces = ()
+                        self.__record_stage(msg.traces, msg.name,
+                                            msg_start - msg.sent_at,
+                                            msg_start)
             try:
                 # Give subclass a chance to post-process the batch.
                 _log.debug("Finishing message batch")
-                self._finish_msg_batch(batch, results)
+                if batch_traces:
+                    actor_storage.traces = tuple(batch_traces)
+                    finish_start = time.time()
+                try:
+                    self._finish_msg_batch(batch, results)
+                finally:
+                    if batch_traces:
+                        actor_storage.traces = ()
+                        self.__record_stage(batch_traces,
+                                            "_finish_msg_batch", 0,
+                                            finish_start)
             except SplitBatchAndRetry:
                 # The subclass couldn't process the batch as is (probably
                 # because a failure occurred and it couldn't figure out which
@@ -256,10 +287,18 @@ class Actor(object):
                         future.set_exception(exc)
                     else:
                         future.set(result)
+                for trace in msg.traces:
+                    trace.decref()
         if num_splits > 0:
             _log.warn("Split batches complete. Number of splits: %s",
                       num_splits)
 
+    def __record_stage(self, traces, method_name, queued, start):
+        stage = "%s.%s" % (self.__class__.__name__, method_name)
+        run = time.time() - start
+        for trace in traces:
+            trace.record_stage(stage, queued, run)
+
     @staticmethod
     def __split_batch(current_batch, remaining_batches):
         """
@@ -368,7 +407,7 @@ class Message(object):
     Message passed to an actor.
     """
     def __init__(self, msg_id,  method, results, caller_path, recipient,
-                 needs_own_batch):
+                 needs_own_batch, traces=()):
         self.uuid = msg_id
         self.method = method
         self.results = results
@@ -376,6 +415,13 @@ class Message(object):
         self.name = method.func.__name__
         self.needs_own_batch = needs_own_batch
         self.recipient = recipient
+        # Latency traces that this message is part of; see felix.trace.
+        self.traces = traces
+        self.sent_at = None
+        if traces:
+            self.sent_at = time.time()
+            for trace in traces:
+                trace.incref()
 
     def __str__(self):
         data = ("%s (%s)" % (self.uuid, self.name))
@@ -438,7 +484,8 @@ def actor_message(needs_own_batch=False):
             result = TrackedAsyncResult((calling_path, caller,
                                          self.name, method_name))
             msg = Message(msg_id, partial, [result], caller, self.name,
-                          needs_own_batch=needs_own_batch)
+                          needs_own_batch=needs_own_batch,
+                          traces=getattr(actor_storage, "traces", ()))
 
             _log.debug("Message %s sent by %s to %s, queue length %d",
                        msg, caller, self.name, self._event_queue.qsize())
@@ -46,6 +46,18 @@ LOGLEVELS = {"none":      None,
              "crit":      logging.CRITICAL,
              "critical":  logging.CRITICAL}
 
+# Supported values of the DataplaneBackend parameter.
+DATAPLANE_BACKENDS = ("iptables", "nftables")
+
+# Supported values of the DispatchMode parameter.
+DISPATCH_MODES = ("tree", "vmap")
+
+# Supported values of the IpsetBackend parameter.
+IPSET_BACKENDS = ("command", "netlink")
+
+# Supported values of the ProcessModel parameter.
+PROCESS_MODELS = ("single", "per-ip-version")
+
 # Sources of a configuration parameter. The order is highest-priority first.
 DEFAULT = "Default"
 ENV = "Environment variable"
@@ -148,8 +160,14 @@ class Config(object):
         :raises EtcdException
         """
         self.parameters = {}
-
-        self.add_parameter("EtcdAddr", "Address and port for etcd",
+        self.config_path = config_path
+        # The (host_dict, global_dict) that were reported from etcd, so that
+        # worker processes can rebuild the same config.
+        self.etcd_config = None
+
+        self.add_parameter("EtcdAddr",
+                           "Address and port for etcd, or a comma-separated "
+                           "list of them",
                            "localhost:4001", sources=[ENV, FILE])
         self.add_parameter("FelixHostname", "Felix compute host hostname",
                            socket.gethostname(), sources=[ENV, FILE])
@@ -169,6 +187,36 @@ class Config(object):
                            "Log severity for logging to syslog", "ERROR")
         self.add_parameter("LogSeverityScreen",
                            "Log severity for logging to screen", "ERROR")
+        self.add_parameter("DataplaneBackend",
+                           "Firewall to program: iptables or nftables",
+                           "iptables")
+        self.add_parameter("DispatchMode",
+                           "Endpoint dispatch chain layout: tree or vmap",
+                           "tree")
+        self.add_parameter("IpsetBackend",
+                           "How to program ipsets: command or netlink",
+                           "command")
+        self.add_parameter("ProcessModel",
+                           "Run everything in one process (single) or the "
+                           "IPv4 and IPv6 dataplanes in worker processes "
+                           "(per-ip-version)",
+                           "single")
+        self.add_parameter("ParseWorkers",
+                           "Number of worker processes that decode and "
+                           "validate data from etcd; 0 to do it inline",
+                           0, value_is_int=True)
+        self.add_parameter("ParseCacheSize",
+                           "Approximate memory, in MB, for caching parsed "
+                           "data from etcd across full resyncs; 0 (the "
+                           "default) to disable",
+                           0, value_is_int=True)
+        self.add_parameter("TraceSampleRate",
+                           "Trace the latency of one in this many etcd "
+                           "updates; 0 to disable",
+                           0, value_is_int=True)
+        self.add_parameter("StatsReportInterval",
+                           "Seconds between logging stats; 0 to disable",
+                           60, value_is_int=True)
 
         # Read the environment variables, then the configuration file.
         self._read_env_vars()
@@ -213,6 +261,14 @@ class Config(object):
         self.LOGLEVFILE = self.parameters["LogSeverityFile"].value
         self.LOGLEVSYS = self.parameters["LogSeveritySys"].value
         self.LOGLEVSCR = self.parameters["LogSeverityScreen"].value
+        self.DATAPLANE_BACKEND = self.parameters["DataplaneBackend"].value
+        self.DISPATCH_MODE = self.parameters["DispatchMode"].value
+        self.IPSET_BACKEND = self.parameters["IpsetBackend"].value
+        self.PROCESS_MODEL = self.parameters["ProcessModel"].value
+        self.PARSE_WORKERS = self.parameters["ParseWorkers"].value
+        self.PARSE_CACHE_SIZE = self.parameters["ParseCacheSize"].value
+        self.TRACE_SAMPLE_RATE = self.parameters["TraceSampleRate"].value
+        self.STATS_REPORT_INTERVAL = self.parameters["StatsReportInterval"].value
 
         self._validate_cfg(final=final)
 
@@ -277,6 +333,7 @@ class Config(object):
         :raises ConfigException
         """
         log.debug("Configuration reported from etcd")
+        self.etcd_config = (dict(host_dict), dict(global_dict))
         for source, cfg_dict in ((LOCAL_ETCD, host_dict),
                                  (GLOBAL_ETCD, global_dict)):
             for name, parameter in self.parameters.iteritems():
@@ -295,17 +352,22 @@ class Config(object):
         :param final: Is this after final etcd config has been read?
         :raises ConfigException
         """
-        fields = self.ETCD_ADDR.split(":")
-        if len(fields) != 2:
-            raise ConfigException("Invalid format for field - must be "
-                                  "hostname:port", self.parameters["EtcdAddr"])
-        self._validate_addr("EtcdAddr", fields[0])
-
-        try:
-            int(fields[1])
-        except ValueError:
-            raise ConfigException("Invalid port in field",
-                                  self.parameters["EtcdAddr"])
+        # EtcdAddr is a comma-separated list of etcd endpoints.
+        self.ETCD_ADDRS = []
+        for etcd_addr in self.ETCD_ADDR.split(","):
+            fields = etcd_addr.strip().split(":")
+            if len(fields) != 2:
+                raise ConfigException("Invalid format for field - must be "
+                                      "hostname:port",
+                                      self.parameters["EtcdAddr"])
+            self._validate_addr("EtcdAddr", fields[0])
+
+            try:
+                port = int(fields[1])
+            except ValueError:
+                raise ConfigException("Invalid port in field",
+                                      self.parameters["EtcdAddr"])
+            self.ETCD_ADDRS.append((fields[0], port))
 
         try:
             self.LOGLEVFILE = LOGLEVELS[self.LOGLEVFILE.lower()]
@@ -325,6 +387,49 @@ class Config(object):
             raise ConfigException("Invalid log level",
                                   self.parameters["LogSeverityScreen"])
 
+        self.DATAPLANE_BACKEND = self.DATAPLANE_BACKEND.lower()
+        if self.DATAPLANE_BACKEND not in DATAPLANE_BACKENDS:
+            raise ConfigException("Invalid dataplane backend",
+                                  self.parameters["DataplaneBackend"])
+
+        self.DISPATCH_MODE = self.DISPATCH_MODE.lower()
+        if self.DISPATCH_MODE not in DISPATCH_MODES:
+            raise ConfigException("Invalid dispatch mode",
+                                  self.parameters["DispatchMode"])
+        if (self.DISPATCH_MODE == "vmap" and
+                self.DATAPLANE_BACKEND != "nftables"):
+            # iptables has no way to jump to a chain that is looked up in
+            # a set.
+            raise ConfigException("vmap dispatch requires the nftables "
+                                  "dataplane backend",
+                                  self.parameters["DispatchMode"])
+
+        self.IPSET_BACKEND = self.IPSET_BACKEND.lower()
+        if self.IPSET_BACKEND not in IPSET_BACKENDS:
+            raise ConfigException("Invalid ipset backend",
+                                  self.parameters["IpsetBackend"])
+
+        self.PROCESS_MODEL = self.PROCESS_MODEL.lower()
+        if self.PROCESS_MODEL not in PROCESS_MODELS:
+            raise ConfigException("Invalid process model",
+                                  self.parameters["ProcessModel"])
+
+        if self.PARSE_WORKERS < 0:
+            raise ConfigException("Invalid field value",
+                                  self.parameters["ParseWorkers"])
+
+        if self.PARSE_CACHE_SIZE < 0:
+            raise ConfigException("Invalid field value",
+                                  self.parameters["ParseCacheSize"])
+
+        if self.TRACE_SAMPLE_RATE < 0:
+            raise ConfigException("Invalid field value",
+                                  self.parameters["TraceSampleRate"])
+
+        if self.STATS_REPORT_INTERVAL < 0:
+            raise ConfigException("Invalid field value",
+                                  self.parameters["StatsReportInterval"])
+
         # Log file may be "None" (the literal string, case insensitive). In
         # this case no log file should be written.
         if self.LOGFILE.lower() == "none":
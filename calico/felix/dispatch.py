@@ -108,7 +108,92 @@ class DispatchChains(Actor):
 
     def _calculate_update(self, ifaces):
         """
-        Calculates the iptables update to rewrite our chains.
+        Calculates the iptables update to rewrite our chains, using
+        whichever dispatch mode is configured.
+
+        :param set[str] ifaces: The list of interfaces to generate a
+            dispatch chain for.
+        :returns Tuple: to_delete, deps, updates, new_leaf_chains; see
+            _calculate_tree_update().
+        """
+        if self.config.DISPATCH_MODE == "vmap":
+            return self._calculate_vmap_update(ifaces)
+        return self._calculate_tree_update(ifaces)
+
+    def _calculate_vmap_update(self, ifaces):
+        """
+        Calculates the update to rewrite our chains as a pair of verdict
+        maps.
+
+        Each root chain contains a single rule that looks up the interface
+        name in a map from interface to endpoint chain and jumps straight
+        to the chain it finds.  Since the lookup is a single hash lookup,
+        there's no need for the tree of leaf chains; any leaf chains that
+        we programmed previously are deleted.
+
+        Only supported by the nftables backend, which translates the
+        --vmap-in-interface/--vmap-out-interface options into an nftables
+        vmap statement.
+
+        :param set[str] ifaces: The list of interfaces to generate a
+            dispatch chain for.
+        :returns Tuple: to_delete, deps, updates, new_leaf_chains; see
+            _calculate_tree_update().
+        """
+        updates = {CHAIN_TO_ENDPOINT: [], CHAIN_FROM_ENDPOINT: []}
+        dependencies = {CHAIN_TO_ENDPOINT: set(), CHAIN_FROM_ENDPOINT: set()}
+        updates[CHAIN_FROM_ENDPOINT].extend(self._metadata_rules())
+
+        to_map = []
+        from_map = []
+        for iface in sorted(ifaces):
+            ep_suffix = interface_to_suffix(self.config, iface)
+            to_chain_name, from_chain_name = chain_names(ep_suffix)
+            to_map.append("%s=%s" % (iface, to_chain_name))
+            from_map.append("%s=%s" % (iface, from_chain_name))
+            dependencies[CHAIN_TO_ENDPOINT].add(to_chain_name)
+            dependencies[CHAIN_FROM_ENDPOINT].add(from_chain_name)
+
+        if ifaces:
+            updates[CHAIN_FROM_ENDPOINT].append(
+                "--append %s --vmap-in-interface %s" %
+                (CHAIN_FROM_ENDPOINT, ",".join(from_map))
+            )
+            updates[CHAIN_TO_ENDPOINT].append(
+                "--append %s --vmap-out-interface %s" %
+                (CHAIN_TO_ENDPOINT, ",".join(to_map))
+            )
+
+        # As with the tree, both chains end with a DROP so that interfaces
+        # that we don't know about yet can't bypass our rules.
+        updates[CHAIN_FROM_ENDPOINT].append("--append %s --jump DROP" %
+                                            CHAIN_FROM_ENDPOINT)
+        updates[CHAIN_TO_ENDPOINT].append("--append %s --jump DROP" %
+                                          CHAIN_TO_ENDPOINT)
+        return self.programmed_leaf_chains, dependencies, updates, set()
+
+    def _metadata_rules(self):
+        """
+        :returns list[str]: Rules for the root FROM chain that allow the
+            metadata IP through from all interfaces.
+        """
+        if self.config.METADATA_IP is None or self.ip_version != 4:
+            return []
+        # Need to allow outgoing Metadata requests.
+        return ["--append %s "
+                "--protocol tcp "
+                "--in-interface %s+ "
+                "--destination %s "
+                "--dport %s "
+                "--jump RETURN" %
+                (CHAIN_FROM_ENDPOINT,
+                 self.config.IFACE_PREFIX,
+                 self.config.METADATA_IP,
+                 self.config.METADATA_PORT)]
+
+    def _calculate_tree_update(self, ifaces):
+        """
+        Calculates the iptables update to rewrite our chains as a tree.
 
         To avoid traversing lots of dispatch rules to find the right one,
         we build a tree of chains.  Currently, the tree can only be
@@ -162,18 +247,7 @@ class DispatchChains(Actor):
         root_from_deps = dependencies[CHAIN_FROM_ENDPOINT]
 
         # Special case: allow the metadata IP through from all interfaces.
-        if self.config.METADATA_IP is not None and self.ip_version == 4:
-            # Need to allow outgoing Metadata requests.
-            root_from_upds.append("--append %s "
-                                  "--protocol tcp "
-                                  "--in-interface %s+ "
-                                  "--destination %s "
-                                  "--dport %s "
-                                  "--jump RETURN" %
-                                  (CHAIN_FROM_ENDPOINT,
-                                   self.config.IFACE_PREFIX,
-                                   self.config.METADATA_IP,
-                                   self.config.METADATA_PORT))
+        root_from_upds.extend(self._metadata_rules())
 
         # Separate the interface names by their prefixes so we can count them
         # and decide whether to program a leaf chain or not.
@@ -21,7 +21,7 @@ Endpoint management.
 """
 import logging
 from subprocess import CalledProcessError
-from calico.felix import devices, futils
+from calico.felix import devices, futils, trace
 from calico.felix.actor import actor_message
 from calico.felix.futils import FailedSystemCall
 from calico.felix.futils import IPV4
@@ -389,6 +389,7 @@ class LocalEndpoint(RefCountedActor):
                                self._iface_name,
                                self.endpoint["mac"],
                                reset_arp=reset_arp)
+            trace.note_commit("routes")
 
         except (IOError, FailedSystemCall, CalledProcessError):
             if not devices.interface_exists(self._iface_name):
@@ -408,6 +409,7 @@ class LocalEndpoint(RefCountedActor):
         """
         try:
             devices.set_routes(self.ip_type, set(), self._iface_name, None)
+            trace.note_commit("routes")
         except (IOError, FailedSystemCall, CalledProcessError):
             if not devices.interface_exists(self._iface_name):
                 # Deleted under our feet - so the rules are gone.
@@ -30,8 +30,10 @@ import os
 
 import gevent
 
-from calico import common
+from calico import common, stats
+from calico.felix import trace
 from calico.felix.fiptables import IptablesUpdater
+from calico.felix.fnftables import NftablesUpdater, NftSetDriver
 from calico.felix.dispatch import DispatchChains
 from calico.felix.profilerules import RulesManager
 from calico.felix.frules import install_global_rules
@@ -41,7 +43,10 @@ from calico.felix.futils import IPV4, IPV6
 from calico.felix.devices import InterfaceWatcher
 from calico.felix.endpoint import EndpointManager
 from calico.felix.fetcd import EtcdWatcher
-from calico.felix.ipsets import IpsetManager
+from calico.felix.parsepool import ParsePool
+from calico.felix.ipsets import IpsetManager, IpsetCommandDriver
+from calico.felix.nlipset import NetlinkIpsetDriver
+from calico.felix.workers import WorkerSupervisor, WorkerReceiver
 
 _log = logging.getLogger(__name__)
 
@@ -58,107 +63,178 @@ def _main_greenlet(config):
         # Ask the EtcdWatcher to fill in the global config object before we
         # proceed.  We don't yet support config updates.
         etcd_watcher.load_config(async=False)
+        trace.configure(config.TRACE_SAMPLE_RATE)
 
         _log.info("Main greenlet: Configuration loaded, starting remaining "
                   "actors...")
-        v4_filter_updater = IptablesUpdater("filter", ip_version=4)
-        v4_nat_updater = IptablesUpdater("nat", ip_version=4)
-        v4_ipset_mgr = IpsetManager(IPV4)
-        v4_rules_manager = RulesManager(4, v4_filter_updater, v4_ipset_mgr)
-        v4_dispatch_chains = DispatchChains(config, 4, v4_filter_updater)
-        v4_ep_manager = EndpointManager(config,
-                                        IPV4,
-                                        v4_filter_updater,
-                                        v4_dispatch_chains,
-                                        v4_rules_manager)
-
-        v6_filter_updater = IptablesUpdater("filter", ip_version=6)
-        v6_ipset_mgr = IpsetManager(IPV6)
-        v6_rules_manager = RulesManager(6, v6_filter_updater, v6_ipset_mgr)
-        v6_dispatch_chains = DispatchChains(config, 6, v6_filter_updater)
-        v6_ep_manager = EndpointManager(config,
-                                        IPV6,
-                                        v6_filter_updater,
-                                        v6_dispatch_chains,
-                                        v6_rules_manager)
-
-        update_splitter = UpdateSplitter(config,
-                                         [v4_ipset_mgr, v6_ipset_mgr],
-                                         [v4_rules_manager, v6_rules_manager],
-                                         [v4_ep_manager, v6_ep_manager],
-                                         [v4_filter_updater, v6_filter_updater])
-        iface_watcher = InterfaceWatcher(update_splitter)
-
-        _log.info("Starting actors.")
-        update_splitter.start()
-
-        v4_filter_updater.start()
-        v4_nat_updater.start()
-        v4_ipset_mgr.start()
-        v4_rules_manager.start()
-        v4_dispatch_chains.start()
-        v4_ep_manager.start()
-
-        v6_filter_updater.start()
-        v6_ipset_mgr.start()
-        v6_rules_manager.start()
-        v6_dispatch_chains.start()
-        v6_ep_manager.start()
+        if config.PROCESS_MODEL == "per-ip-version":
+            # The dataplane actors live in the worker processes; we just
+            # stream them updates.
+            _log.info("Running a worker process per IP version.")
+            update_splitter = WorkerSupervisor(config)
+            update_splitter.start()
+            update_splitter.start_workers(async=False)
+            monitored_items = [update_splitter.greenlet]
+        else:
+            update_splitter, monitored_items = _start_dataplane(config,
+                                                                [4, 6])
 
+        iface_watcher = InterfaceWatcher(update_splitter)
         iface_watcher.start()
+        monitored_items += [iface_watcher.greenlet, etcd_watcher.greenlet]
 
-        monitored_items = [
-            update_splitter.greenlet,
-
-            v4_nat_updater.greenlet,
-            v4_filter_updater.greenlet,
-            v4_nat_updater.greenlet,
-            v4_ipset_mgr.greenlet,
-            v4_rules_manager.greenlet,
-            v4_dispatch_chains.greenlet,
-            v4_ep_manager.greenlet,
-
-            v6_filter_updater.greenlet,
-            v6_ipset_mgr.greenlet,
-            v6_rules_manager.greenlet,
-            v6_dispatch_chains.greenlet,
-            v6_ep_manager.greenlet,
-
-            iface_watcher.greenlet,
-            etcd_watcher.greenlet
-        ]
-
-        # Install the global rules before we start polling for updates.
-        _log.info("Installing global rules.")
-        install_global_rules(config, v4_filter_updater, v6_filter_updater,
-                             v4_nat_updater)
+        if config.TRACE_SAMPLE_RATE:
+            _log.info("Tracing one in %s etcd updates.",
+                      config.TRACE_SAMPLE_RATE)
+        if config.STATS_REPORT_INTERVAL:
+            monitored_items.append(
+                gevent.spawn(_report_stats_periodically,
+                             config.STATS_REPORT_INTERVAL))
 
         # Start polling for updates. These kicks make the actors poll
         # indefinitely.
         _log.info("Starting polling for interface and etcd updates.")
         f = iface_watcher.watch_interfaces(async=True)
         monitored_items.append(f)
-        f = etcd_watcher.watch_etcd(update_splitter, async=True)
+        parse_pool = None
+        if config.PARSE_WORKERS:
+            _log.info("Parsing etcd data in %s worker processes.",
+                      config.PARSE_WORKERS)
+            parse_pool = ParsePool(config, config.PARSE_WORKERS)
+        f = etcd_watcher.watch_etcd(update_splitter, parse_pool, async=True)
         monitored_items.append(f)
 
-        # Wait for something to fail.
-        _log.info("All top-level actors started, waiting on failures...")
-        stopped_greenlets_iter = gevent.iwait(monitored_items)
+        _wait_for_failure(monitored_items)
+    except:
+        _log.exception("Exception killing main greenlet")
+        raise
 
-        stopped_greenlet = next(stopped_greenlets_iter)
-        try:
-            stopped_greenlet.get()
-        except Exception:
-            _log.exception("Greenlet failed: %s", stopped_greenlet)
-            raise
+
+def _start_dataplane(config, ip_versions):
+    """
+    Creates and starts the actors that program the dataplane for the given
+    IP versions, and the UpdateSplitter that feeds them, then installs the
+    global rules.
+
+    :returns tuple: the UpdateSplitter and a list of the greenlets that
+        should be monitored for failure.
+    """
+    if config.DATAPLANE_BACKEND == "nftables":
+        _log.info("Using the nftables dataplane backend.")
+        updater_cls = NftablesUpdater
+        ipset_driver_cls = NftSetDriver
+    else:
+        updater_cls = IptablesUpdater
+        if config.IPSET_BACKEND == "netlink":
+            _log.info("Programming ipsets over netlink.")
+            ipset_driver_cls = NetlinkIpsetDriver
         else:
-            _log.error("Greenlet %s unexpectedly returned.", stopped_greenlet)
-            raise AssertionError("Greenlet unexpectedly returned")
+            ipset_driver_cls = IpsetCommandDriver
+
+    filter_updaters = {}
+    v4_nat_updater = None
+    ipset_mgrs = []
+    rules_managers = []
+    ep_managers = []
+    actors = []
+    for ip_version in ip_versions:
+        ip_type = IPV4 if ip_version == 4 else IPV6
+        filter_updater = updater_cls("filter", ip_version=ip_version)
+        ipset_mgr = IpsetManager(ip_type, driver=ipset_driver_cls(ip_type))
+        rules_manager = RulesManager(ip_version, filter_updater, ipset_mgr)
+        dispatch_chains = DispatchChains(config, ip_version, filter_updater)
+        ep_manager = EndpointManager(config,
+                                     ip_type,
+                                     filter_updater,
+                                     dispatch_chains,
+                                     rules_manager)
+        filter_updaters[ip_version] = filter_updater
+        ipset_mgrs.append(ipset_mgr)
+        rules_managers.append(rules_manager)
+        ep_managers.append(ep_manager)
+        actors += [filter_updater, ipset_mgr, rules_manager, dispatch_chains,
+                   ep_manager]
+        if ip_version == 4:
+            v4_nat_updater = updater_cls("nat", ip_version=4)
+            actors.append(v4_nat_updater)
+
+    update_splitter = UpdateSplitter(config,
+                                     ipset_mgrs,
+                                     rules_managers,
+                                     ep_managers,
+                                     [filter_updaters[v] for v in
+                                      ip_versions])
+
+    _log.info("Starting actors.")
+    update_splitter.start()
+    for actor in actors:
+        actor.start()
+
+    # Install the global rules before we start polling for updates.
+    _log.info("Installing global rules.")
+    install_global_rules(config, filter_updaters.get(4),
+                         filter_updaters.get(6), v4_nat_updater)
+
+    monitored_items = [update_splitter.greenlet]
+    monitored_items += [actor.greenlet for actor in actors]
+    return update_splitter, monitored_items
+
+
+def _wait_for_failure(monitored_items):
+    """
+    Waits for one of the given greenlets to stop.
+
+    :raises: the greenlet's exception, or AssertionError if it returned.
+    """
+    _log.info("All top-level actors started, waiting on failures...")
+    stopped_greenlets_iter = gevent.iwait(monitored_items)
+
+    stopped_greenlet = next(stopped_greenlets_iter)
+    try:
+        stopped_greenlet.get()
+    except Exception:
+        _log.exception("Greenlet failed: %s", stopped_greenlet)
+        raise
+    else:
+        _log.error("Greenlet %s unexpectedly returned.", stopped_greenlet)
+        raise AssertionError("Greenlet unexpectedly returned")
+
+
+def _worker_greenlet(config, ip_version):
+    """
+    The root of a worker process's tree of greenlets.  Programs the
+    dataplane for one IP version with the updates that the main process
+    streams to our stdin.
+    """
+    try:
+        receiver = WorkerReceiver()
+        receiver.load_config(config)
+        trace.configure(config.TRACE_SAMPLE_RATE)
+        update_splitter, monitored_items = _start_dataplane(config,
+                                                            [ip_version])
+        monitored_items.append(gevent.spawn(receiver.receive,
+                                            update_splitter))
+        if config.STATS_REPORT_INTERVAL:
+            monitored_items.append(
+                gevent.spawn(_report_stats_periodically,
+                             config.STATS_REPORT_INTERVAL))
+        _wait_for_failure(monitored_items)
     except:
-        _log.exception("Exception killing main greenlet")
+        _log.exception("Exception killing IPv%s worker", ip_version)
         raise
 
 
+def _report_stats_periodically(interval):
+    """
+    Logs the stats every interval seconds, if any have been recorded.
+    Does not return; intended to be run in its own greenlet.
+    """
+    while True:
+        gevent.sleep(interval)
+        if stats.snapshot():
+            stats.log_report()
+
+
 def main():
     # Initialise the logging with default parameters.
     common.default_logging()
@@ -168,6 +244,9 @@ def main():
     parser.add_option('-c', '--config-file', dest='config_file',
                       help="configuration file to use",
                       default="/etc/calico/felix.cfg")
+    # Used by the WorkerSupervisor to start the worker processes.
+    parser.add_option('--worker-ip-version', dest='worker_ip_version',
+                      type="int", help=optparse.SUPPRESS_HELP)
     options, args = parser.parse_args()
 
     try:
@@ -191,8 +270,13 @@ def main():
 
     _log.info("Felix initializing")
 
+    if options.worker_ip_version:
+        root = gevent.spawn(_worker_greenlet, config,
+                            options.worker_ip_version)
+    else:
+        root = gevent.spawn(_main_greenlet, config)
     try:
-        gevent.spawn(_main_greenlet, config).join()  # Should never return
+        root.join()  # Should never return
     except Exception:
         # Make absolutely sure that we exit by asking the OS to terminate our
         # process.  We don't want to let a stray background thread keep us
@@ -200,3 +284,7 @@ def main():
         _log.exception("Felix exiting due to exception")
         os._exit(1)
         raise  # Unreachable but keeps the linter happy about the broad except.
+
+
+if __name__ == "__main__":
+    main()
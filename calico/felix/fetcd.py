@@ -23,8 +23,11 @@ from socket import timeout as SocketTimeout
 import httplib
 import json
 import logging
+import random
+import time
 
 from etcd import (EtcdException, EtcdClusterIdChanged, EtcdKeyNotFound,
+                  EtcdConnectionFailed, EtcdWatchTimedOut,
                   EtcdEventIndexCleared)
 import etcd
 import gevent
@@ -32,13 +35,15 @@ from urllib3 import Timeout
 import urllib3.exceptions
 from urllib3.exceptions import ReadTimeoutError, ConnectTimeoutError
 
-from calico import common
+from calico import common, stats
 from calico.common import ValidationFailed
 from calico.datamodel_v1 import (VERSION_DIR, READY_KEY, CONFIG_DIR,
                                  RULES_KEY_RE, TAGS_KEY_RE, ENDPOINT_KEY_RE,
                                  dir_for_per_host_config,
                                  PROFILE_DIR, HOST_DIR, EndpointId, POLICY_DIR)
-from calico.etcdutils import PathDispatcher
+from calico.etcdutils import PathDispatcher, ACTION_MAPPING
+from calico.lru import LRUCache
+from calico.felix import trace
 from calico.felix.actor import Actor, actor_message
 
 
@@ -47,6 +52,23 @@ _log = logging.getLogger(__name__)
 
 RETRY_DELAY = 5
 
+# Bounds on the delay before we reconnect after losing our connection to
+# etcd.  The delay doubles with each consecutive failure and is jittered so
+# that the Felixes that lose the same etcd server don't all reconnect at
+# once.
+RECONNECT_DELAY_MIN = 1
+RECONNECT_DELAY_MAX = 30
+
+# After a connection to an etcd server fails, we prefer the other servers in
+# EtcdAddr for this long (in seconds).
+FAILED_ADDR_HOLD_DOWN = 60
+
+# Estimates of the memory used by a parsed etcd value, for sizing the parse
+# cache: the decoded JSON is roughly ten times the size of the raw JSON, plus
+# the overhead of the cache entry.
+PARSED_BYTES_PER_JSON_BYTE = 10
+PARSE_CACHE_ENTRY_OVERHEAD = 200
+
 # Etcd paths that we care about for use with the PathDispatcher class.
 # We use angle-brackets to name parameters that we want to capture.
 PER_PROFILE_DIR = PROFILE_DIR + "/<profile_id>"
@@ -59,22 +81,47 @@ PER_WORKLOAD_DIR = PER_ORCH_DIR + "/<workload_id>"
 ENDPOINT_DIR = PER_WORKLOAD_DIR + "/endpoint"
 PER_ENDPOINT_KEY = ENDPOINT_DIR + "/<endpoint_id>"
 
+# Types of node returned by parse_node().
+NODE_RULES = "rules"
+NODE_TAGS = "tags"
+NODE_ENDPOINT = "endpoint"
+
 
 class EtcdWatcher(Actor):
     def __init__(self, config):
         super(EtcdWatcher, self).__init__()
         self.config = config
         self.client = None
+        # The (host, port) of the etcd server that the client talks to, the
+        # time of the last connection failure for each server and our
+        # current reconnect delay.
+        self.etcd_addr = None
+        self.addr_failure_times = {}
+        self.reconnect_delay = RECONNECT_DELAY_MIN
         self.my_config_dir = dir_for_per_host_config(self.config.HOSTNAME)
 
         # Initialized at poll start time.
         self.splitter = None
         self.next_etcd_index = None
+        # Optional ParsePool to offload parsing to.
+        self.parse_pool = None
+        # Optional LRUCache of parse_node() results, keyed by etcd key and
+        # modifiedIndex.  Since etcd gives every write a new modifiedIndex,
+        # a hit is a node that hasn't changed since we parsed it.  The
+        # values are shared with the rest of Felix, which never mutates
+        # them.
+        self.parse_cache = None
 
         # Cache of known endpoints, used to resolve deletions of whole
         # directory trees.
         self.endpoint_ids_per_host = defaultdict(set)
 
+        # The modifiedIndex of the value that we last sent to the splitter
+        # for each (node type, ID), and the etcd cluster that they came
+        # from; used to send only the changes when we resync.
+        self.forwarded_indexes = {}
+        self.forwarded_cluster_id = None
+
         # Program the dispatcher with the paths we care about.  Since etcd
         # gives us a single event for a recursive directory deletion, we have
         # to handle deletes for lots of directories that we otherwise wouldn't
@@ -106,8 +153,8 @@ class EtcdWatcher(Actor):
     def load_config(self):
         _log.info("Waiting for etcd to be ready and for config to be present.")
         configured = False
+        self._reconnect()
         while not configured:
-            self._reconnect()
             self.wait_for_ready()
             try:
                 global_cfg = self.client.read(CONFIG_DIR)
@@ -121,6 +168,10 @@ class EtcdWatcher(Actor):
                     # default to empty.
                     _log.info("No configuration overrides for this node")
                     host_dict = {}
+            except EtcdConnectionFailed as e:
+                self._on_connection_failed(e)
+                self._reconnect()
+                continue
             except (EtcdKeyNotFound, EtcdException) as e:
                 # Note: we don't log the stack trace because it's too spammy
                 # and adds little.
@@ -144,6 +195,10 @@ class EtcdWatcher(Actor):
                 _log.warn("Ready flag not present in etcd; felix will pause "
                           "updates until the orchestrator sets the flag.")
                 db_ready = "false"
+            except EtcdConnectionFailed as e:
+                self._on_connection_failed(e)
+                self._reconnect()
+                continue
             except EtcdException as e:
                 # Note: we don't log the
                 _log.error("Failed to retrieve ready flag from etcd (%r). "
@@ -153,6 +208,7 @@ class EtcdWatcher(Actor):
 
             if db_ready == "true":
                 _log.info("etcd is ready.")
+                self._on_connection_ok()
                 ready = True
             else:
                 _log.info("etcd not ready.  Will retry.")
@@ -160,32 +216,74 @@ class EtcdWatcher(Actor):
                 continue
 
     def _reconnect(self, copy_cluster_id=True):
-        etcd_addr = self.config.ETCD_ADDR
-        if ":" in etcd_addr:
-            host, port = etcd_addr.split(":")
-            port = int(port)
-        else:
-            host = etcd_addr
-            port = 4001
+        host, port = self.etcd_addr = self._choose_etcd_addr()
         if self.client and copy_cluster_id:
             old_cluster_id = self.client.expected_cluster_id
-            _log.info("(Re)connecting to etcd. Old etcd cluster ID was %s.",
-                      old_cluster_id)
+            _log.info("(Re)connecting to etcd at %s:%s. Old etcd cluster ID "
+                      "was %s.", host, port, old_cluster_id)
         else:
-            _log.info("(Re)connecting to etcd. No previous cluster ID.")
+            _log.info("(Re)connecting to etcd at %s:%s. No previous cluster "
+                      "ID.", host, port)
             old_cluster_id = None
         self.client = etcd.Client(host=host, port=port,
                                   expected_cluster_id=old_cluster_id)
 
+    def _choose_etcd_addr(self):
+        """
+        :returns: the (host, port) of the first etcd server in EtcdAddr
+            that hasn't failed in the last FAILED_ADDR_HOLD_DOWN seconds or,
+            if they all have, the one that failed longest ago.
+        """
+        now = time.time()
+        addrs = self.config.ETCD_ADDRS
+        for addr in addrs:
+            failure_time = self.addr_failure_times.get(addr)
+            if (failure_time is None or
+                    now - failure_time >= FAILED_ADDR_HOLD_DOWN):
+                return addr
+        return min(addrs, key=self.addr_failure_times.get)
+
+    def _on_connection_failed(self, e):
+        """
+        Records that our etcd server has failed, so that _reconnect()
+        prefers the others, and then waits before the caller reconnects.
+        The wait doubles with each consecutive failure, up to
+        RECONNECT_DELAY_MAX, and is randomised to spread out reconnection
+        attempts.
+        """
+        stats.increment("etcd.connection_failures")
+        self.addr_failure_times[self.etcd_addr] = time.time()
+        delay = random.uniform(self.reconnect_delay / 2.0,
+                               self.reconnect_delay)
+        self.reconnect_delay = min(self.reconnect_delay * 2,
+                                   RECONNECT_DELAY_MAX)
+        _log.error("Connection to etcd at %s:%s failed (%r).  Reconnecting "
+                   "in %.1fs.", self.etcd_addr[0], self.etcd_addr[1], e,
+                   delay)
+        gevent.sleep(delay)
+
+    def _on_connection_ok(self):
+        """
+        Records that our etcd server is working.
+        """
+        self.addr_failure_times.pop(self.etcd_addr, None)
+        self.reconnect_delay = RECONNECT_DELAY_MIN
+
     @actor_message()
-    def watch_etcd(self, update_splitter):
+    def watch_etcd(self, update_splitter, parse_pool=None):
         """
         Loads the snapshot from etcd and then monitors etcd for changes.
         Posts events to the UpdateSplitter.
 
+        :param parse_pool: Optional ParsePool to decode and validate the
+            data from etcd in; by default, we parse it inline.
         :returns: Does not return.
         """
         self.splitter = update_splitter
+        self.parse_pool = parse_pool
+        if self.config.PARSE_CACHE_SIZE and self.parse_cache is None:
+            self.parse_cache = LRUCache(
+                "parse_cache", self.config.PARSE_CACHE_SIZE * 1024 * 1024)
         while True:
             _log.info("Reconnecting and loading snapshot from etcd...")
             self._reconnect(copy_cluster_id=False)
@@ -200,39 +298,39 @@ class EtcdWatcher(Actor):
                 while True:
                     # Wait for something to change.
                     response = self._wait_for_etcd_event()
-                    self.dispatcher.handle_event(response)
+                    with trace.traced(_update_type(response),
+                                      response.modifiedIndex,
+                                      "EtcdWatcher.handle_event"):
+                        self.dispatcher.handle_event(response)
             except ResyncRequired:
                 _log.info("Polling aborted, doing resync.")
+            except EtcdConnectionFailed as e:
+                # Lost our etcd server while loading the snapshot.
+                self._on_connection_failed(e)
 
     def load_initial_dump(self):
         """
         Loads a snapshot from etcd and passes it to the update splitter.
 
+        The first time, we pass the whole snapshot to the splitter.  On
+        later resyncs from the same etcd cluster, the splitter already has
+        the state that we last sent it, so we only parse and send the
+        values whose modifiedIndex differs from the one that we last sent
+        for them, and deletions for the values that have gone away.
+
         :raises ResyncRequired: if the Ready flag is not set in the snapshot.
         """
         initial_dump = self.client.read(VERSION_DIR, recursive=True)
+        cluster_id = self.client.expected_cluster_id
         _log.info("Loaded snapshot from etcd cluster %s, parsing it...",
-                  self.client.expected_cluster_id)
-        rules_by_id = {}
-        tags_by_id = {}
-        endpoints_by_id = {}
-        self.endpoint_ids_per_host.clear()
+                  cluster_id)
+        delta = (self.forwarded_cluster_id is not None and
+                 self.forwarded_cluster_id == cluster_id)
+        endpoint_ids_per_host = defaultdict(set)
+        snapshot_indexes = {}
         still_ready = False
+        nodes = []
         for child in initial_dump.children:
-            profile_id, rules = parse_if_rules(child)
-            if profile_id:
-                rules_by_id[profile_id] = rules
-                continue
-            profile_id, tags = parse_if_tags(child)
-            if profile_id:
-                tags_by_id[profile_id] = tags
-                continue
-            endpoint_id, endpoint = parse_if_endpoint(self.config, child)
-            if endpoint_id and endpoint:
-                endpoints_by_id[endpoint_id] = endpoint
-                self.endpoint_ids_per_host[endpoint_id.host].add(endpoint_id)
-                continue
-
             # Double-check the flag hasn't changed since we read it before.
             if child.key == READY_KEY:
                 if child.value == "true":
@@ -241,22 +339,162 @@ class EtcdWatcher(Actor):
                     _log.warning("Aborting resync because ready flag was"
                                  "unset since we read it.")
                     raise ResyncRequired()
+                continue
+            node_type, item_id = parse_key(child.key)
+            if node_type is None:
+                continue
+            item = (node_type, item_id)
+            snapshot_indexes[item] = child.modifiedIndex
+            if node_type == NODE_ENDPOINT:
+                endpoint_ids_per_host[item_id.host].add(item_id)
+            if (not delta or
+                    self.forwarded_indexes.get(item) != child.modifiedIndex):
+                nodes.append(child)
 
         if not still_ready:
             _log.warn("Aborting resync; ready flag no longer present.")
             raise ResyncRequired()
 
+        parsed_nodes = self._parse_nodes(nodes)
+        if delta:
+            self._apply_delta(parsed_nodes, snapshot_indexes,
+                              initial_dump.etcd_index)
+        else:
+            self._apply_snapshot(parsed_nodes, initial_dump.etcd_index)
+        self.endpoint_ids_per_host = endpoint_ids_per_host
+        self.forwarded_indexes = snapshot_indexes
+        self.forwarded_cluster_id = cluster_id
+        # The etcd_index is the high-water-mark for the snapshot, record that
+        # we want to poll starting at the next index.
+        self.next_etcd_index = initial_dump.etcd_index + 1
+
+    def _apply_snapshot(self, parsed_nodes, etcd_index):
+        """
+        Passes a whole snapshot to the splitter.
+        """
+        stats.increment("resync.full")
+        rules_by_id = {}
+        tags_by_id = {}
+        endpoints_by_id = {}
+        for node_type, item_id, value in parsed_nodes:
+            if node_type == NODE_RULES:
+                rules_by_id[item_id] = value
+            elif node_type == NODE_TAGS:
+                tags_by_id[item_id] = value
+            elif value:
+                endpoints_by_id[item_id] = value
+
         # Actually apply the snapshot. This does not return anything, but
         # just sends the relevant messages to the relevant threads to make
         # all the processing occur.
         _log.info("Snapshot parsed, passing to update splitter")
-        self.splitter.apply_snapshot(rules_by_id,
-                                     tags_by_id,
-                                     endpoints_by_id,
-                                     async=True)
-        # The etcd_index is the high-water-mark for the snapshot, record that
-        # we want to poll starting at the next index.
-        self.next_etcd_index = initial_dump.etcd_index + 1
+        with trace.traced("snapshot", etcd_index,
+                          "EtcdWatcher.load_initial_dump", force=True):
+            self.splitter.apply_snapshot(rules_by_id,
+                                         tags_by_id,
+                                         endpoints_by_id,
+                                         async=True)
+
+    def _apply_delta(self, parsed_nodes, snapshot_indexes, etcd_index):
+        """
+        Sends the splitter the changes between the values that we last sent
+        it and the snapshot, as normal updates.
+
+        :param parsed_nodes: the parse_node() results for the nodes that
+            have changed.
+        :param snapshot_indexes: dict mapping (node type, ID) to
+            modifiedIndex for every item in the snapshot.
+        """
+        stats.increment("resync.delta")
+        num_changed = 0
+        num_deleted = 0
+        with trace.traced("delta_resync", etcd_index,
+                          "EtcdWatcher.load_initial_dump", force=True):
+            for node_type, item_id, value in parsed_nodes:
+                self._send_update(node_type, item_id, value)
+                num_changed += 1
+            for item in self.forwarded_indexes:
+                if item not in snapshot_indexes:
+                    self._send_update(item[0], item[1], None)
+                    num_deleted += 1
+        _log.info("Resynced with etcd: %s items changed, %s deleted, %s "
+                  "unchanged", num_changed, num_deleted,
+                  len(snapshot_indexes) - num_changed)
+        stats.increment("resync.delta.changed", num_changed)
+        stats.increment("resync.delta.deleted", num_deleted)
+
+    def _send_update(self, node_type, item_id, value):
+        if node_type == NODE_RULES:
+            self.splitter.on_rules_update(item_id, value, async=True)
+        elif node_type == NODE_TAGS:
+            self.splitter.on_tags_update(item_id, value, async=True)
+        else:
+            self.splitter.on_endpoint_update(item_id, value, async=True)
+
+    def _note_forwarded(self, node_type, item_id, modified_index):
+        """
+        Records the modifiedIndex of the value that we last sent to the
+        splitter for an item; None if we sent a deletion.
+        """
+        if modified_index is None:
+            self.forwarded_indexes.pop((node_type, item_id), None)
+        else:
+            self.forwarded_indexes[(node_type, item_id)] = modified_index
+
+    def _parse_nodes(self, nodes):
+        """
+        Parses the nodes of a snapshot, reusing the results from the parse
+        cache for any nodes that haven't changed since we last parsed them.
+
+        :returns: iterator over the non-None results of parse_node() for
+            the nodes.
+        """
+        if self.parse_cache is None:
+            to_parse = nodes
+        else:
+            to_parse = []
+            for node in nodes:
+                parsed = self.parse_cache.get((node.key, node.modifiedIndex))
+                if parsed is None:
+                    to_parse.append(node)
+                else:
+                    yield parsed
+            _log.info("Reused %s cached values, parsing %s nodes",
+                      len(nodes) - len(to_parse), len(to_parse))
+
+        if self.parse_pool:
+            parsed_nodes = self.parse_pool.parse_nodes(to_parse)
+        else:
+            parsed_nodes = ((n, parse_node(self.config, n)) for n in to_parse)
+        for node, parsed in parsed_nodes:
+            if parsed is not None:
+                self._cache_parsed(node, parsed)
+                yield parsed
+
+    def _parse_value(self, response):
+        """
+        Parses the value of a rules, tags or endpoint update.
+
+        :returns: The validated value, or None if it failed validation.
+        """
+        if self.parse_pool:
+            parsed = self.parse_pool.parse_node(response)
+        else:
+            parsed = parse_node(self.config, response)
+        self._cache_parsed(response, parsed)
+        return parsed[2]
+
+    def _cache_parsed(self, node, parsed):
+        """
+        Stores a result of parse_node() in the parse cache so that we can
+        reuse it in the next resync if the node doesn't change.
+        """
+        if self.parse_cache is not None:
+            # Estimate the memory used from the size of the JSON.
+            weight = (PARSE_CACHE_ENTRY_OVERHEAD +
+                      len(node.value) * PARSED_BYTES_PER_JSON_BYTE)
+            self.parse_cache.put((node.key, node.modifiedIndex), parsed,
+                                 weight)
 
     def _wait_for_etcd_event(self):
         """
@@ -281,50 +519,39 @@ class EtcdWatcher(Actor):
                                                             read=90),
                                             check_cluster_uuid=True)
                 _log.debug("etcd response: %r", response)
-            except (ReadTimeoutError, SocketTimeout) as e:
+            except (EtcdWatchTimedOut, ReadTimeoutError, SocketTimeout) as e:
                 # This is expected when we're doing a poll and nothing
-                # happened. socket timeout doesn't seem to be caught by
-                # urllib3 1.7.1.  Simply reconnect.
+                # happened.  urllib3 closes the connection that timed out
+                # rather than returning it to the client's pool, so we keep
+                # the client, and its pooled connections, and poll again.
                 _log.debug("Read from etcd timed out (%r), retrying.", e)
-                # Force a reconnect to ensure urllib3 doesn't recycle the
-                # connection.  (We were seeing this with urllib3 1.7.1.)
-                self._reconnect()
-            except (ConnectTimeoutError,
+            except (EtcdConnectionFailed,
+                    ConnectTimeoutError,
                     urllib3.exceptions.HTTPError,
-                    httplib.HTTPException):
-                _log.warning("Low-level HTTP error, reconnecting to "
-                             "etcd.", exc_info=True)
+                    httplib.HTTPException) as e:
+                # Our etcd server has gone away.  Since every server in the
+                # cluster has the same event history, we can carry on
+                # polling from the same index on another one.
+                self._on_connection_failed(e)
                 self._reconnect()
             except (EtcdClusterIdChanged, EtcdEventIndexCleared) as e:
                 _log.warning("Out of sync with etcd (%r).  Reconnecting "
                              "for full sync.", e)
                 raise ResyncRequired()
             except EtcdException as e:
-                # Sadly, python-etcd doesn't have a dedicated exception
-                # for the "no more machines in cluster" error. Parse the
-                # message:
-                msg = (e.message or "unknown").lower()
-                # Limit our retry rate in case etcd is down.
+                # Assume any other errors are fatal to our poll and do a
+                # full resync, limiting our retry rate in case etcd is
+                # having problems.
+                _log.exception("Unknown etcd error %r; doing resync.",
+                               e.message)
                 gevent.sleep(1)
-                if "no more machines" in msg:
-                    # This error comes from python-etcd when it can't
-                    # connect to any servers.  When we retry, it should
-                    # reconnect.
-                    # TODO: We should probably limit retries here and die
-                    # That'd recover from errors caused by resource
-                    # exhaustion/leaks.
-                    _log.error("Connection to etcd failed, will retry.")
-                else:
-                    # Assume any other errors are fatal to our poll and
-                    # do a full resync.
-                    _log.exception("Unknown etcd error %r; doing resync.",
-                                   e.message)
-                    self._reconnect()
-                    raise ResyncRequired()
+                raise ResyncRequired()
             except:
                 _log.exception("Unexpected exception during etcd poll")
                 raise
 
+        self._on_connection_ok()
+
         # Since we're polling on a subtree, we can't just increment
         # the index, we have to look at the modifiedIndex to spot
         # if we've skipped a lot of updates.
@@ -350,8 +577,10 @@ class EtcdWatcher(Actor):
                                  endpoint_id)
         _log.debug("Endpoint %s updated", combined_id)
         self.endpoint_ids_per_host[combined_id.host].add(combined_id)
-        endpoint = parse_endpoint(self.config, endpoint_id, response.value)
+        endpoint = self._parse_value(response)
         self.splitter.on_endpoint_update(combined_id, endpoint, async=True)
+        self._note_forwarded(NODE_ENDPOINT, combined_id,
+                             response.modifiedIndex)
 
     def on_endpoint_delete(self, response, hostname, orchestrator,
                            workload_id, endpoint_id):
@@ -363,28 +592,33 @@ class EtcdWatcher(Actor):
         if not self.endpoint_ids_per_host[combined_id.host]:
             del self.endpoint_ids_per_host[combined_id.host]
         self.splitter.on_endpoint_update(combined_id, None, async=True)
+        self._note_forwarded(NODE_ENDPOINT, combined_id, None)
 
     def on_rules_set(self, response, profile_id):
         """Handler for rules updates, passes the update to the splitter."""
         _log.debug("Rules for %s set", profile_id)
-        rules = parse_rules(profile_id, response.value)
+        rules = self._parse_value(response)
         self.splitter.on_rules_update(profile_id, rules, async=True)
+        self._note_forwarded(NODE_RULES, profile_id, response.modifiedIndex)
 
     def on_rules_delete(self, response, profile_id):
         """Handler for rules deletes, passes the update to the splitter."""
         _log.debug("Rules for %s deleted", profile_id)
         self.splitter.on_rules_update(profile_id, None, async=True)
+        self._note_forwarded(NODE_RULES, profile_id, None)
 
     def on_tags_set(self, response, profile_id):
         """Handler for tags updates, passes the update to the splitter."""
         _log.debug("Tags for %s set", profile_id)
-        rules = parse_tags(profile_id, response.value)
-        self.splitter.on_tags_update(profile_id, rules, async=True)
+        tags = self._parse_value(response)
+        self.splitter.on_tags_update(profile_id, tags, async=True)
+        self._note_forwarded(NODE_TAGS, profile_id, response.modifiedIndex)
 
     def on_tags_delete(self, response, profile_id):
         """Handler for tags deletes, passes the update to the splitter."""
         _log.debug("Tags for %s deleted", profile_id)
         self.splitter.on_tags_update(profile_id, None, async=True)
+        self._note_forwarded(NODE_TAGS, profile_id, None)
 
     def on_profile_delete(self, response, profile_id):
         """
@@ -396,6 +630,8 @@ class EtcdWatcher(Actor):
         _log.debug("Whole profile %s deleted", profile_id)
         self.splitter.on_rules_update(profile_id, None, async=True)
         self.splitter.on_tags_update(profile_id, None, async=True)
+        self._note_forwarded(NODE_RULES, profile_id, None)
+        self._note_forwarded(NODE_TAGS, profile_id, None)
 
     def on_host_delete(self, response, hostname):
         """
@@ -408,6 +644,7 @@ class EtcdWatcher(Actor):
                   hostname, len(ids_on_that_host))
         for endpoint_id in ids_on_that_host:
             self.splitter.on_endpoint_update(endpoint_id, None, async=True)
+            self._note_forwarded(NODE_ENDPOINT, endpoint_id, None)
 
     def on_orch_delete(self, response, hostname, orchestrator):
         """
@@ -420,6 +657,7 @@ class EtcdWatcher(Actor):
         for endpoint_id in list(self.endpoint_ids_per_host[hostname]):
             if endpoint_id.orchestrator == orchestrator:
                 self.splitter.on_endpoint_update(endpoint_id, None, async=True)
+                self._note_forwarded(NODE_ENDPOINT, endpoint_id, None)
                 self.endpoint_ids_per_host[hostname].discard(endpoint_id)
         if not self.endpoint_ids_per_host[hostname]:
             del self.endpoint_ids_per_host[hostname]
@@ -437,11 +675,31 @@ class EtcdWatcher(Actor):
             if (endpoint_id.orchestrator == orchestrator and
                     endpoint_id.workload == workload_id):
                 self.splitter.on_endpoint_update(endpoint_id, None, async=True)
+                self._note_forwarded(NODE_ENDPOINT, endpoint_id, None)
                 self.endpoint_ids_per_host[hostname].discard(endpoint_id)
         if not self.endpoint_ids_per_host[hostname]:
             del self.endpoint_ids_per_host[hostname]
 
 
+def _update_type(response):
+    """
+    Classifies an etcd event for latency tracing.  Uses cheap string tests
+    rather than the key regexes since it is called for every event.
+    """
+    key = response.key
+    if key.endswith("/rules"):
+        update_type = "rules"
+    elif key.endswith("/tags"):
+        update_type = "tags"
+    elif "/endpoint/" in key:
+        update_type = "endpoint"
+    else:
+        update_type = "other"
+    if ACTION_MAPPING.get(response.action) == "delete":
+        update_type += "_delete"
+    return update_type
+
+
 def _build_config_dict(cfg_node):
     """
     Updates the config dict provided from the given etcd node, which
@@ -461,6 +719,48 @@ def intern_dict(d):
 json_decoder = json.JSONDecoder(object_hook=intern_dict)
 
 
+def parse_key(key):
+    """
+    :returns tuple: (NODE_RULES, profile_id), (NODE_TAGS, profile_id) or
+        (NODE_ENDPOINT, EndpointId) for a key that holds rules, tags or an
+        endpoint; (None, None) for any other key.
+    """
+    m = RULES_KEY_RE.match(key)
+    if m:
+        return NODE_RULES, m.group("profile_id")
+    m = TAGS_KEY_RE.match(key)
+    if m:
+        return NODE_TAGS, m.group("profile_id")
+    m = ENDPOINT_KEY_RE.match(key)
+    if m:
+        return NODE_ENDPOINT, EndpointId(m.group("hostname"),
+                                         m.group("orchestrator"),
+                                         m.group("workload_id"),
+                                         m.group("endpoint_id"))
+    return None, None
+
+
+def parse_node(config, etcd_node):
+    """
+    Parses an etcd node holding rules, tags or an endpoint.
+
+    :returns tuple: (NODE_RULES, profile_id, rules), (NODE_TAGS, profile_id,
+        tags) or (NODE_ENDPOINT, EndpointId, endpoint), where the value is
+        None if it failed validation; or None if the node holds none of
+        those.
+    """
+    profile_id, rules = parse_if_rules(etcd_node)
+    if profile_id:
+        return NODE_RULES, profile_id, rules
+    profile_id, tags = parse_if_tags(etcd_node)
+    if profile_id:
+        return NODE_TAGS, profile_id, tags
+    endpoint_id, endpoint = parse_if_endpoint(config, etcd_node)
+    if endpoint_id:
+        return NODE_ENDPOINT, endpoint_id, endpoint
+    return None
+
+
 def parse_if_endpoint(config, etcd_node):
     m = ENDPOINT_KEY_RE.match(etcd_node.key)
     if m:
@@ -29,7 +29,7 @@ import re
 from gevent import subprocess
 import gevent
 
-from calico.felix import frules, futils
+from calico.felix import frules, futils, trace
 from calico.felix.actor import (
     Actor, actor_message, ResultOrExc, SplitBatchAndRetry
 )
@@ -334,6 +334,7 @@ class IptablesUpdater(Actor):
             else:
                 self._execute_iptables(input_lines)
                 _log.info("%s Successfully processed iptables updates.", self)
+                trace.note_commit("rules")
                 self._chains_in_dataplane.update(self._txn.affected_chains)
         except (IOError, OSError, FailedSystemCall) as e:
             if isinstance(e, FailedSystemCall):
@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.fnftables
+~~~~~~~~~~~~~~~
+
+nftables dataplane backend.
+
+The NftablesUpdater is a drop-in replacement for the IptablesUpdater.  It
+exposes the same rewrite_chains()/delete_chains()/ensure_rule_inserted() API
+and reuses all of the IptablesUpdater's batching and dependency tracking.
+Only the final step differs: rather than feeding the calculated
+iptables-restore input to ip(6)tables-restore, we translate it into an nft
+script and apply it with "nft -f", which applies the whole script as a
+single atomic transaction.
+
+Felix's chains live in their own nftables tables, "ip felix-<table>" and
+"ip6 felix-<table>".  Since nftables has no built-in chains, the rules
+that ensure_rule_inserted() would insert into the kernel's chains go into
+base chains in the same table, hooked in at the same point.  Note that,
+unlike an iptables rule at the top of the kernel's chain, an accept in
+one of our base chains does not stop other tables from seeing the packet.
+
+Tags are programmed as native nftables sets by the NftSetDriver, which is
+a drop-in replacement for the ipset-based IpsetCommandDriver.
+"""
+import logging
+import re
+import shlex
+
+from calico.felix import futils
+from calico.felix.actor import actor_message
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.frules import FELIX_PREFIX
+from calico.felix.futils import FailedSystemCall, IPV4
+
+_log = logging.getLogger(__name__)
+
+NFT_CMD = ["nft"]
+
+# Hook definitions for the base chains that stand in for the kernel's
+# built-in iptables chains, indexed by iptables table and chain.
+BASE_CHAIN_HOOKS = {
+    "filter": {
+        "INPUT": "type filter hook input priority 0;",
+        "FORWARD": "type filter hook forward priority 0;",
+        "OUTPUT": "type filter hook output priority 0;",
+    },
+    "nat": {
+        "PREROUTING": "type nat hook prerouting priority -100;",
+        "OUTPUT": "type nat hook output priority -100;",
+        "POSTROUTING": "type nat hook postrouting priority 100;",
+    },
+}
+
+# iptables targets that map directly to nftables verdicts.
+VERDICTS = {
+    "ACCEPT": "accept",
+    "DROP": "drop",
+    "RETURN": "return",
+}
+
+# Options that take a source address.  Rules that only differ in their
+# source address are merged into one rule that matches on a set.
+SOURCE_OPTS = frozenset(["--source", "--src", "-s"])
+
+
+class NftablesUpdater(IptablesUpdater):
+    """
+    Actor that owns and applies updates to one of Felix's nftables tables.
+
+    See the IptablesUpdater for the semantics of the API; this class only
+    replaces the mechanism used to program the dataplane.
+    """
+
+    def __init__(self, table, ip_version=4, nft_cmd=None):
+        self._nft_cmd = list(nft_cmd or NFT_CMD)
+        self._family = "ip" if ip_version == 4 else "ip6"
+        self._nft_table = FELIX_PREFIX + table
+        self._ip_version = ip_version
+        self._inserted_rules = {}
+        """Map from base chain name to the list of rule fragments that
+        we've inserted into it, most recent first."""
+        super(NftablesUpdater, self).__init__(table, ip_version=ip_version)
+        self._restore_cmd = " ".join(self._nft_cmd + ["-f"])
+
+    @actor_message(needs_own_batch=True)
+    def _refresh_chains_in_dataplane(self):
+        chains, _ = _parse_nft_table(self._list_table())
+        self._chains_in_dataplane = set(c for c in chains
+                                        if c.startswith(FELIX_PREFIX))
+
+    def _read_unreferenced_chains(self):
+        """
+        Read the list of chains in the dataplane which are not referenced.
+
+        nft doesn't report reference counts so we calculate them from the
+        jump/goto targets of the rules in the table.
+
+        :returns set[str]: set of chains currently in the dataplane that
+            are not referenced by other chains.
+        """
+        chains, referenced = _parse_nft_table(self._list_table())
+        return set(c for c in chains
+                   if c.startswith(FELIX_PREFIX) and c not in referenced)
+
+    def _list_table(self):
+        """
+        :returns str: the output of "nft list table" for our table, or the
+            empty string if the table doesn't exist yet.
+        """
+        try:
+            return futils.check_call(
+                self._nft_cmd + ["list", "table", self._family,
+                                 self._nft_table]
+            ).stdout
+        except FailedSystemCall:
+            _log.info("Failed to list nftables table %s %s, assuming it "
+                      "doesn't exist yet.", self._family, self._nft_table)
+            return ""
+
+    # Does direct table manipulation, forbid batching with other messages.
+    @actor_message(needs_own_batch=True)
+    def ensure_rule_inserted(self, rule_fragment):
+        """
+        Ensures that the given rule fragment is at the start of the
+        base chain that stands in for the named kernel chain.
+
+        :param rule_fragment: fragment to be inserted. For example,
+           "INPUT --jump felix-INPUT"
+        """
+        chain, _, fragment = rule_fragment.partition(" ")
+        try:
+            hook = BASE_CHAIN_HOOKS[self._table][chain]
+        except KeyError:
+            raise ValueError("No nftables base chain for %s chain %s" %
+                             (self._table, chain))
+        rules = [f for f in self._inserted_rules.get(chain, [])
+                 if f != fragment]
+        rules.insert(0, fragment)
+        prefix = "%s %s %s" % (self._family, self._nft_table, chain)
+        script = [
+            "add table %s %s" % (self._family, self._nft_table),
+            "add chain %s { %s }" % (prefix, hook),
+            "flush chain %s" % prefix,
+        ]
+        for rule in rules:
+            script.append("add rule %s %s" %
+                          (prefix, fragment_to_nft(rule, self._ip_version)))
+        self._run_nft_script(script)
+        self._inserted_rules[chain] = rules
+
+    def _execute_iptables(self, input_lines, fail_log_level=logging.ERROR):
+        """
+        Translates the given iptables-restore input into an nft script and
+        applies it atomically.
+
+        :raises FailedSystemCall: if the input can't be translated or nft
+            fails.
+        """
+        try:
+            script = restore_input_to_nft(input_lines, self._family,
+                                          self._nft_table, self._ip_version)
+        except NftTranslationError as e:
+            _log.log(fail_log_level, "Failed to translate iptables input "
+                     "to nft: %s.\nInput was:\n%s", e, "\n".join(input_lines))
+            raise FailedSystemCall("Failed to translate rules to nft",
+                                   self._nft_cmd, 1, "", str(e),
+                                   input="\n".join(input_lines))
+        try:
+            self._run_nft_script(script)
+        except FailedSystemCall as e:
+            _log.log(fail_log_level,
+                     "%s failed.\nOutput:\n%s\nError:\n%s\nInput was:\n%s",
+                     self._restore_cmd, e.stdout, e.stderr, e.input)
+            raise
+
+    def _run_nft_script(self, script_lines):
+        input_str = "\n".join(script_lines) + "\n"
+        _log.debug("nft input:\n%s", input_str)
+        futils.check_call(self._nft_cmd + ["-f", "-"], input_str=input_str)
+
+
+class NftSetDriver(object):
+    """
+    Programs Felix's tag sets as native nftables sets in Felix's filter
+    table.  Drop-in replacement for the IpsetCommandDriver.
+    """
+    def __init__(self, ip_type, nft_cmd=None):
+        self.ip_type = ip_type
+        self._nft_cmd = list(nft_cmd or NFT_CMD)
+        self._family = "ip" if ip_type == IPV4 else "ip6"
+        self._addr_type = "ipv4_addr" if ip_type == IPV4 else "ipv6_addr"
+        self._nft_table = FELIX_PREFIX + "filter"
+
+    def replace_members(self, name, tmpname, members, hashsize=None,
+                        maxelem=None):
+        """
+        Atomically replaces the contents of the named set, creating it if
+        needed.  Flush and add happen in one nft transaction so we have no
+        need for the temporary set.
+
+        The sizing parameters are ignored; our sets are not fixed-size
+        hashes and grow as needed.
+        """
+        prefix = "%s %s %s" % (self._family, self._nft_table, name)
+        script = [
+            "add table %s %s" % (self._family, self._nft_table),
+            "add set %s { type %s; }" % (prefix, self._addr_type),
+            "flush set %s" % prefix,
+        ]
+        if members:
+            script.append("add element %s { %s }" %
+                          (prefix, ", ".join(sorted(members))))
+        input_str = "\n".join(script) + "\n"
+        futils.check_call(self._nft_cmd + ["-f", "-"], input_str=input_str)
+
+    def destroy(self, name):
+        """
+        Deletes the named set.
+
+        :raises FailedSystemCall: if the set does not exist or is still
+            referenced by a rule.
+        """
+        futils.check_call(self._nft_cmd + ["delete", "set", self._family,
+                                           self._nft_table, name])
+
+    def list_names(self):
+        """
+        :returns list[str]: the names of all the sets in our table.
+        """
+        try:
+            output = futils.check_call(
+                self._nft_cmd + ["list", "table", self._family,
+                                 self._nft_table]
+            ).stdout
+        except FailedSystemCall:
+            _log.info("Failed to list nftables table, assuming no sets.")
+            return []
+        return re.findall(r"^\s*set (\S+) \{", output, re.MULTILINE)
+
+
+def restore_input_to_nft(input_lines, family, nft_table, ip_version):
+    """
+    Translates iptables-restore input, as generated by the IptablesUpdater,
+    into the equivalent nft script.
+
+    Consecutive rules in a chain that only differ by their source address
+    (as generated for the anti-spoofing rules) are merged into a single
+    rule that matches on an anonymous set of addresses.
+
+    :returns list[str]: lines of nft script.
+    :raises NftTranslationError: if the input contains something that we
+        don't know how to translate.
+    """
+    script = []
+    # Consecutive appends to the same chain that only differ by their
+    # source address: (chain, tokens-with-source-removed, [sources]).
+    pending = None
+
+    def flush_pending():
+        chain, tokens, sources = pending
+        if sources:
+            if len(sources) > 1:
+                src = "{ %s }" % ", ".join(sources)
+            else:
+                src = sources[0]
+            tokens = ["--source", src] + tokens
+        script.append("add rule %s %s %s %s" %
+                      (family, nft_table, chain,
+                       _tokens_to_nft(tokens, ip_version)))
+
+    for line in input_lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("*"):
+            script.append("add table %s %s" % (family, nft_table))
+            continue
+        if line == "COMMIT":
+            continue
+        if line.startswith(":"):
+            op, chain, rest = "--declare", line[1:].split()[0], []
+        else:
+            try:
+                tokens = shlex.split(line)
+            except ValueError as e:
+                raise NftTranslationError("Failed to parse %r: %s" %
+                                          (line, e))
+            if len(tokens) < 2:
+                raise NftTranslationError("Unexpected line %r" % line)
+            op, chain, rest = tokens[0], tokens[1], tokens[2:]
+
+        if op in ("--append", "-A"):
+            tokens, sources = _split_sources(rest)
+            if (pending is not None and pending[0] == chain and
+                    pending[1] == tokens and sources and pending[2]):
+                pending[2].extend(sources)
+                continue
+            if pending is not None:
+                flush_pending()
+            pending = (chain, tokens, sources)
+            continue
+
+        if pending is not None:
+            flush_pending()
+            pending = None
+        prefix = "%s %s %s" % (family, nft_table, chain)
+        if op == "--declare":
+            script.append("add chain %s" % prefix)
+            script.append("flush chain %s" % prefix)
+        elif op in ("--flush", "-F"):
+            script.append("flush chain %s" % prefix)
+        elif op in ("--delete-chain", "-X"):
+            script.append("delete chain %s" % prefix)
+        elif op in ("--insert", "-I"):
+            script.append("insert rule %s %s" %
+                          (prefix, _tokens_to_nft(rest, ip_version)))
+        else:
+            raise NftTranslationError("Unsupported operation in %r" % line)
+    if pending is not None:
+        flush_pending()
+    return script
+
+
+def _split_sources(tokens):
+    """
+    Splits the source address out of a list of rule tokens.
+
+    :returns tuple: (remaining tokens, list of source addresses).
+    """
+    remaining = []
+    sources = []
+    tokens = iter(tokens)
+    negated = False
+    for token in tokens:
+        if token in SOURCE_OPTS and not negated:
+            sources.append(next(tokens))
+        else:
+            remaining.append(token)
+        negated = token == "!"
+    return remaining, sources
+
+
+def fragment_to_nft(fragment, ip_version):
+    """
+    Translates a single iptables rule fragment (without the chain
+    operation), such as "--in-interface tap+ --jump felix-FROM-ENDPOINT",
+    into the equivalent nftables rule expression.
+    """
+    return _tokens_to_nft(shlex.split(fragment), ip_version)
+
+
+def _tokens_to_nft(tokens, ip_version):
+    """
+    Translates a tokenised iptables rule into an nftables rule expression.
+
+    iptables matches are order-independent so we emit the matches in the
+    order we find them, followed by the statements, then the comment.
+
+    :raises NftTranslationError: if the rule uses an option that we don't
+        support.
+    """
+    ip = "ip" if ip_version == 4 else "ip6"
+    matches = []
+    statements = []
+    comment = None
+    negate = False
+
+    # Find the protocol first since it determines the form of the port
+    # matches.
+    proto = None
+    for opt, val in zip(tokens, tokens[1:]):
+        if opt in ("--protocol", "-p"):
+            proto = val
+    if proto in ("icmpv6", "ipv6-icmp"):
+        proto = "ipv6-icmp"
+
+    def neg():
+        return "!= " if negate else ""
+
+    def expect_proto(option):
+        if proto not in ("tcp", "udp"):
+            raise NftTranslationError("%s requires tcp or udp protocol" %
+                                      option)
+
+    tokens = list(tokens)
+    i = 0
+    try:
+        while i < len(tokens):
+            opt = tokens[i]
+            i += 1
+            if opt == "!":
+                negate = True
+                continue
+            if opt in ("--match", "-m"):
+                # The match module is implied by its options.
+                i += 1
+                continue
+            arg = tokens[i]
+            i += 1
+            if opt in ("--protocol", "-p"):
+                matches.append("meta l4proto %s%s" % (neg(), proto))
+            elif opt in SOURCE_OPTS:
+                matches.append("%s saddr %s%s" % (ip, neg(), arg))
+            elif opt in ("--destination", "--dst", "-d"):
+                matches.append("%s daddr %s%s" % (ip, neg(), arg))
+            elif opt in ("--in-interface", "-i"):
+                matches.append("iifname %s%s" % (neg(), _iface(arg)))
+            elif opt in ("--out-interface", "-o"):
+                matches.append("oifname %s%s" % (neg(), _iface(arg)))
+            elif opt in ("--sport", "--source-port", "--dport",
+                         "--destination-port"):
+                expect_proto(opt)
+                dirn = "sport" if opt.startswith("--s") else "dport"
+                matches.append("%s %s %s%s" % (proto, dirn, neg(),
+                                               arg.replace(":", "-")))
+            elif opt in ("--source-ports", "--destination-ports"):
+                expect_proto(opt)
+                dirn = "sport" if opt == "--source-ports" else "dport"
+                ports = [p.replace(":", "-") for p in arg.split(",")]
+                matches.append("%s %s %s{ %s }" % (proto, dirn, neg(),
+                                                   ", ".join(ports)))
+            elif opt == "--match-set":
+                dirn = tokens[i]
+                i += 1
+                field = "saddr" if dirn == "src" else "daddr"
+                matches.append("%s %s %s@%s" % (ip, field, neg(), arg))
+            elif opt in ("--icmp-type", "--icmpv6-type"):
+                icmp = "icmp" if opt == "--icmp-type" else "icmpv6"
+                icmp_type, _, icmp_code = arg.partition("/")
+                matches.append("%s type %s%s" % (icmp, neg(), icmp_type))
+                if icmp_code:
+                    matches.append("%s code %s" % (icmp, icmp_code))
+            elif opt == "--ctstate":
+                states = arg.lower().split(",")
+                if len(states) > 1:
+                    matches.append("ct state %s{ %s }" %
+                                   (neg(), ", ".join(states)))
+                else:
+                    matches.append("ct state %s%s" % (neg(), states[0]))
+            elif opt == "--mac-source":
+                matches.append("ether saddr %s%s" % (neg(), arg.lower()))
+            elif opt == "--mark":
+                value, _, mask = arg.partition("/")
+                if mask:
+                    matches.append("meta mark & %s %s %s" %
+                                   (mask, "!=" if negate else "==", value))
+                else:
+                    matches.append("meta mark %s%s" % (neg(), value))
+            elif opt in ("--vmap-in-interface", "--vmap-out-interface"):
+                # Felix extension: dispatch to a chain per interface in one
+                # lookup.  The argument is a list of iface=chain entries.
+                key = "iifname" if opt == "--vmap-in-interface" else "oifname"
+                entries = []
+                for entry in arg.split(","):
+                    iface, chain = entry.split("=")
+                    entries.append("%s : goto %s" % (_iface(iface), chain))
+                statements.append("%s vmap { %s }" %
+                                  (key, ", ".join(entries)))
+            elif opt == "--comment":
+                comment = arg
+            elif opt in ("--jump", "-j", "--goto", "-g"):
+                if arg in VERDICTS:
+                    statements.append(VERDICTS[arg])
+                elif arg == "MARK":
+                    # Handled by the --set-mark option.
+                    pass
+                elif arg == "DNAT":
+                    # Handled by the --to-destination option.
+                    pass
+                elif opt in ("--jump", "-j"):
+                    statements.append("jump %s" % arg)
+                else:
+                    statements.append("goto %s" % arg)
+            elif opt == "--set-mark":
+                statements.insert(0, "meta mark set %s" % arg)
+            elif opt == "--to-destination":
+                statements.append("dnat to %s" % arg)
+            else:
+                raise NftTranslationError("Unsupported option %s" % opt)
+            negate = False
+    except IndexError:
+        raise NftTranslationError("Missing argument in %s" % " ".join(tokens))
+
+    expr = matches + statements
+    if comment is not None:
+        # nft limits comments to 128 characters.
+        expr.append('comment "%s"' % comment.replace('"', "'")[:128])
+    return " ".join(expr)
+
+
+def _iface(name):
+    """
+    Translates an iptables interface name, which may end with the "+"
+    wildcard, into a quoted nftables interface name.
+    """
+    if name.endswith("+"):
+        name = name[:-1] + "*"
+    return '"%s"' % name
+
+
+def _parse_nft_table(raw_nft_output):
+    """
+    Parses the output from "nft list table".
+
+    :returns tuple[set[str],set[str]]: the set of chains in the table and
+        the set of chains that are the target of a jump or goto.
+    """
+    chains = set(re.findall(r"^\s*chain (\S+) \{", raw_nft_output,
+                            re.MULTILINE))
+    referenced = set(re.findall(r"\b(?:jump|goto) ([^\s,}]+)",
+                                raw_nft_output))
+    return chains, referenced
+
+
+class NftTranslationError(Exception):
+    pass
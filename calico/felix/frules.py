@@ -69,6 +69,9 @@ def install_global_rules(config, v4_filter_updater, v6_filter_updater,
 
     - ensures that all the required global tables are present;
     - applies any changes required.
+
+    When Felix runs a worker process per IP version, each worker passes None
+    for the other IP version's updaters.
     """
 
     # The interface matching string; for example, if interfaces start "tap"
@@ -87,14 +90,18 @@ def install_global_rules(config, v4_filter_updater, v6_filter_updater,
                       "--destination 169.254.169.254/32 "
                       "--jump DNAT --to-destination %s:%s" %
                       (config.METADATA_IP, config.METADATA_PORT))
-    v4_nat_updater.rewrite_chains({CHAIN_PREROUTING: nat_pr}, {}, async=False)
-    v4_nat_updater.ensure_rule_inserted(
-        "PREROUTING --jump %s" % CHAIN_PREROUTING, async=False)
+    if v4_nat_updater is not None:
+        v4_nat_updater.rewrite_chains({CHAIN_PREROUTING: nat_pr}, {},
+                                      async=False)
+        v4_nat_updater.ensure_rule_inserted(
+            "PREROUTING --jump %s" % CHAIN_PREROUTING, async=False)
 
     # Now the filter table. This needs to have calico-filter-FORWARD and
     # calico-filter-INPUT chains, which we must create before adding any
     # rules that send to them.
     for iptables_updater in [v4_filter_updater, v6_filter_updater]:
+        if iptables_updater is None:
+            continue
         iptables_updater.rewrite_chains(
             {
                 CHAIN_FORWARD: [
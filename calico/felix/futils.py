@@ -107,6 +107,44 @@ def check_call(args, input_str=None):
     return CommandOutput(stdout, stderr)
 
 
+def check_call_lines(args):
+    """
+    Variant of check_call for commands with large output: a generator
+    that yields the lines of the command's stdout as they are read, rather
+    than reading all of it into memory.
+
+    Since the return code is only known once the output has been read,
+    the exception is raised after all of the lines have been yielded, so
+    callers should not act on the output until the generator is exhausted.
+    stderr is only read once stdout is closed so this is not suitable for
+    commands that write a lot to stderr.
+
+    :raises FailedSystemCall: if the return code of the subprocess is non-zero.
+        Its stdout is None since the output has already been consumed.
+    """
+    log.debug("Calling out to system (streaming) : %s" % args)
+
+    # Buffered, since the default of bufsize=0 reads a byte at a time.
+    proc = subprocess.Popen(args,
+                            bufsize=-1,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    try:
+        for line in iter(proc.stdout.readline, ""):
+            yield line
+    finally:
+        # Reached on exhaustion or if the caller abandons the generator.
+        # In the latter case, closing stdout makes the child exit (with
+        # SIGPIPE) rather than block.
+        proc.stdout.close()
+        stderr = proc.stderr.read()
+        proc.stderr.close()
+        retcode = proc.wait()
+    if retcode:
+        raise FailedSystemCall("Failed system call",
+                               args, retcode, None, stderr)
+
+
 def multi_call(ops):
     """
     Issue multiple ops, all of which must succeed.
@@ -19,12 +19,13 @@ felix.ipsets
 
 IP sets management functions.
 """
-from collections import defaultdict
-
 import logging
+import socket
+from array import array
 from itertools import chain
 
-from calico.felix import futils
+from calico import stats
+from calico.felix import futils, trace
 from calico.felix.futils import IPV4, IPV6, FailedSystemCall
 from calico.felix.actor import actor_message
 from calico.felix.refcount import ReferenceManager, RefCountedActor
@@ -35,32 +36,148 @@ FELIX_PFX = "felix-"
 IPSET_PREFIX = { IPV4: FELIX_PFX+"v4-", IPV6: FELIX_PFX+"v6-" }
 IPSET_TMP_PREFIX = { IPV4: FELIX_PFX+"tmp-v4-", IPV6: FELIX_PFX+"tmp-v6-" }
 
+# ipset's defaults for hash:ip sets.  A set can't hold more than maxelem
+# members; the hash table starts with hashsize buckets and is rehashed as
+# it fills.
+IPSET_DEFAULT_HASHSIZE = 1024
+IPSET_DEFAULT_MAXELEM = 65536
+# We size sets so that they can hold this many times their current
+# membership, with a hash table of one bucket per IPSET_MEMBERS_PER_BUCKET
+# members...
+IPSET_HEADROOM = 2
+IPSET_MEMBERS_PER_BUCKET = 4
+# ...and resize them once they are more than this full, or less than
+# IPSET_SHRINK_THRESHOLD full and bigger than they need to be.
+IPSET_RESIZE_THRESHOLD = 0.75
+IPSET_SHRINK_THRESHOLD = 0.125
+
+# Cleared once "ipset list -name" has failed where "ipset list" succeeded,
+# i.e. when the installed ipset is too old to support it.
+_list_name_supported = True
+
+
+class Interner(object):
+    """
+    Maps hashable keys to small integer IDs and back.
+
+    IDs are reference counted: acquire() takes a reference, creating the
+    ID if needed, and release() drops one.  Once an ID has no references
+    it is forgotten and may be handed out again for a different key, so
+    callers must not hold on to unreferenced IDs.
+    """
+    def __init__(self):
+        self._ids_by_key = {}
+        self._keys = []
+        self._ref_counts = array("L")
+        self._free_ids = []
+
+    def acquire(self, key):
+        """
+        :returns int: the ID for key, holding a new reference to it.
+        """
+        id_ = self._ids_by_key.get(key)
+        if id_ is not None:
+            self._ref_counts[id_] += 1
+            return id_
+        if self._free_ids:
+            id_ = self._free_ids.pop()
+            self._keys[id_] = key
+            self._ref_counts[id_] = 1
+        else:
+            id_ = len(self._keys)
+            self._keys.append(key)
+            self._ref_counts.append(1)
+        self._ids_by_key[key] = id_
+        return id_
+
+    def release(self, id_):
+        """
+        Drops a reference to the given ID, forgetting it if it was the last.
+        """
+        ref_count = self._ref_counts[id_] - 1
+        self._ref_counts[id_] = ref_count
+        if ref_count == 0:
+            del self._ids_by_key[self._keys[id_]]
+            self._keys[id_] = None
+            self._free_ids.append(id_)
+
+    def get(self, key):
+        """
+        :returns: the ID for key, or None if it has no references.
+        """
+        return self._ids_by_key.get(key)
+
+    def key(self, id_):
+        return self._keys[id_]
+
+    def keys(self):
+        return self._ids_by_key.keys()
+
+    @property
+    def capacity(self):
+        """
+        One more than the largest ID handed out so far.
+        """
+        return len(self._keys)
+
+    def __len__(self):
+        return len(self._ids_by_key)
+
 
 class IpsetManager(ReferenceManager):
-    def __init__(self, ip_type):
+    def __init__(self, ip_type, driver=None):
         """
         Manages all the ipsets for tags for either IPv4 or IPv6.
 
         :param ip_type: IP type (IPV4 or IPV6)
+        :param driver: Object used to program the sets into the dataplane.
+            Defaults to an IpsetCommandDriver, which uses the ipset tool.
         """
         super(IpsetManager, self).__init__(qualifier=ip_type)
 
         self.ip_type = ip_type
+        self.driver = driver or IpsetCommandDriver(ip_type)
+        self._addr_family = (socket.AF_INET if ip_type == IPV4
+                             else socket.AF_INET6)
 
         # State.
         self.tags_by_prof_id = {}
-        self.endpoints_by_ep_id = {}
 
-        # Main index.  Since an IP address can be assigned to multiple
-        # endpoints, we need to track which endpoints reference an IP.  When
-        # we find the set of endpoints with an IP is empty, we remove the
-        # ip from the tag.
-        # ip_owners_by_tag[tag][ip][profile_id] = set([endpoint_id,
-        #                                              endpoint_id2, ...])
-        self.ip_owners_by_tag = defaultdict(
-            lambda: defaultdict(lambda: defaultdict(set)))
+        # The indexes below hold one entry for every endpoint in the
+        # cluster so they are kept compact: endpoint, profile and tag IDs
+        # are interned to small ints and IP addresses are stored packed, and
+        # interned, so that each address is held once however many tags it
+        # is in.
+        self._endpoint_ids = Interner()
+        self._profile_ids = Interner()
+        self._tag_ids = Interner()
+
+        # Endpoint store, indexed by interned endpoint ID.  We only keep
+        # what the index needs: a tuple of interned profile IDs and a tuple
+        # of packed IPs for each endpoint.  Free slots hold None.
+        self._profiles_by_ep = []
+        self._ips_by_ep = []
+
+        # Maps interned profile ID to tuple of interned tag IDs; mirrors
+        # tags_by_prof_id.
+        self._tags_by_prof = {}
+        # Reverse index: maps interned tag ID to set of interned profile IDs.
+        self._profiles_by_tag = {}
+        # Maps interned profile ID to set of interned endpoint IDs.
+        self._endpoints_by_prof = {}
 
-        self.endpoint_ids_by_profile_id = defaultdict(set)
+        # Main index.  Since an IP address can be assigned to multiple
+        # endpoints, and an endpoint can be in a tag via more than one
+        # profile, we count the (profile, endpoint) pairs that put each IP
+        # in each tag.  When the count drops to zero, we remove the IP from
+        # the tag.
+        # ip_refs_by_tag[tag][packed_ip] = count
+        #
+        # Only tags with a starting or live ActiveIpset are indexed; an
+        # entry is built from the endpoint store when the ActiveIpset
+        # starts and discarded when it is unreferenced.  Updates to other
+        # tags only touch the endpoint store.
+        self._ip_refs_by_tag = {}
 
         # Set of tag IDs that may be out of sync.  Accumulated by the
         # index-update functions.  We apply the updates in _finish_msg_batch().
@@ -69,17 +186,43 @@ class IpsetManager(ReferenceManager):
 
     def _create(self, tag_id):
         active_ipset = ActiveIpset(futils.uniquely_shorten(tag_id, 16),
-                                   self.ip_type)
+                                   self.ip_type,
+                                   driver=self.driver)
         return active_ipset
 
     def _on_object_started(self, tag_id, active_ipset):
         _log.debug("ActiveIpset actor for %s started", tag_id)
+        self._start_indexing(tag_id)
         # Fill the ipset in with its members, this will trigger its first
         # programming, after which it will call us back to tell us it is ready.
         # We can't use self._dirty_tags to defer this in case the set becomes
         # unreferenced before _finish_msg_batch() is called.
         self._update_active_ipset(tag_id)
 
+    def _on_object_unreferenced(self, tag_id, active_ipset):
+        tag = self._tag_ids.get(tag_id)
+        if tag is not None and tag in self._ip_refs_by_tag:
+            _log.debug("Tag %s no longer referenced, discarding its index",
+                       tag_id)
+            del self._ip_refs_by_tag[tag]
+            self._tag_ids.release(tag)
+
+    def _start_indexing(self, tag_id):
+        """
+        Starts maintaining the members of the given tag, populating them
+        from the endpoint store.
+        """
+        # The index holds a reference to the tag.
+        tag = self._tag_ids.acquire(tag_id)
+        assert tag not in self._ip_refs_by_tag, "%s already indexed" % tag_id
+        ip_refs = self._ip_refs_by_tag[tag] = {}
+        for prof in self._profiles_by_tag.get(tag, ()):
+            for ep in self._endpoints_by_prof.get(prof, ()):
+                for ip in self._ips_by_ep[ep]:
+                    ip_refs[ip] = ip_refs.get(ip, 0) + 1
+            self._maybe_yield()
+        _log.debug("Indexed tag %s: %s members", tag_id, len(ip_refs))
+
     def _update_active_ipset(self, tag_id):
         """
         Replaces the members of the identified ActiveIpset with the
@@ -89,8 +232,9 @@ class IpsetManager(ReferenceManager):
         """
         assert self._is_starting_or_live(tag_id)
         active_ipset = self.objects_by_id[tag_id]
-        members = self.ip_owners_by_tag.get(tag_id, {}).keys()
-        active_ipset.replace_members(set(members), async=True)
+        tag = self._tag_ids.get(tag_id)
+        packed_ips = () if tag is None else self._ip_refs_by_tag.get(tag, ())
+        active_ipset.replace_members(self._unpack_ips(packed_ips), async=True)
 
     def _update_dirty_active_ipsets(self):
         """
@@ -123,7 +267,7 @@ class IpsetManager(ReferenceManager):
             self.on_tags_update(profile_id, None)
             self._maybe_yield()
         del missing_profile_ids
-        missing_endpoints = set(self.endpoints_by_ep_id.keys())
+        missing_endpoints = set(self._endpoint_ids.keys())
         for endpoint_id, endpoint in endpoints_by_id.iteritems():
             assert endpoint is not None
             self.on_endpoint_update(endpoint_id, endpoint)
@@ -142,7 +286,7 @@ class IpsetManager(ReferenceManager):
         Clean up left-over ipsets that existed at start-of-day.
         """
         _log.info("Cleaning up left-over ipsets.")
-        all_ipsets = list_ipset_names()
+        all_ipsets = self.driver.list_names()
         # only clean up our own rubbish.
         pfx = IPSET_PREFIX[self.ip_type]
         tmppfx = IPSET_TMP_PREFIX[self.ip_type]
@@ -165,7 +309,7 @@ class IpsetManager(ReferenceManager):
         # to delete.
         for ipset_name in ipsets_to_delete:
             try:
-                futils.check_call(["ipset", "destroy", ipset_name])
+                self.driver.destroy(ipset_name)
             except FailedSystemCall:
                 _log.exception("Failed to clean up dead ipset %s, will "
                                "retry on next cleanup.", ipset_name)
@@ -183,41 +327,84 @@ class IpsetManager(ReferenceManager):
         """
         _log.info("Tags for profile %s updated", profile_id)
 
+        # Take a reference to the profile for the duration of the update.
+        prof = self._profile_ids.acquire(profile_id)
+        had_tags = prof in self._tags_by_prof
+
         # General approach is to default to the empty list if the new/old
         # tag list is missing; then add/delete falls out: all the tags will
         # end up in added_tags/removed_tags.
-        old_tags = set(self.tags_by_prof_id.get(profile_id, []))
-        new_tags = set(tags or [])
+        old_tags = self._tags_by_prof.get(prof, ())
+        new_tags = tuple(self._tag_ids.acquire(t) for t in set(tags or []))
         # Find the endpoints that use these tags and work out what tags have
         # been added/removed.
-        endpoint_ids = self.endpoint_ids_by_profile_id.get(profile_id, set())
-        added_tags = new_tags - old_tags
-        removed_tags = old_tags - new_tags
-        _log.debug("Endpoint IDs with this profile: %s", endpoint_ids)
-        _log.debug("Profile %s added tags: %s", profile_id, added_tags)
-        _log.debug("Profile %s removed tags: %s", profile_id, removed_tags)
-
-        for endpoint_id in endpoint_ids:
-            endpoint = self.endpoints_by_ep_id.get(endpoint_id, {})
-            ip_addrs = self._extract_ips(endpoint)
-            for tag_id in removed_tags:
+        added_tags = set(new_tags).difference(old_tags)
+        removed_tags = set(old_tags).difference(new_tags)
+        for tag in added_tags:
+            profiles = self._profiles_by_tag.get(tag)
+            if profiles is None:
+                profiles = self._profiles_by_tag[tag] = set()
+            profiles.add(prof)
+        for tag in removed_tags:
+            profiles = self._profiles_by_tag[tag]
+            profiles.discard(prof)
+            if not profiles:
+                del self._profiles_by_tag[tag]
+
+        # Only indexed tags need their members updating.
+        indexed = self._ip_refs_by_tag
+        added_tags = [t for t in added_tags if t in indexed]
+        removed_tags = [t for t in removed_tags if t in indexed]
+        endpoints = ()
+        if added_tags or removed_tags:
+            endpoints = self._endpoints_by_prof.get(prof, ())
+            _log.debug("%s endpoints with this profile", len(endpoints))
+
+        for ep in endpoints:
+            ip_addrs = self._ips_by_ep[ep]
+            for tag in removed_tags:
                 for ip in ip_addrs:
-                    self._remove_mapping(tag_id, profile_id, endpoint_id, ip)
-            for tag_id in added_tags:
+                    self._remove_mapping(tag, ip)
+            for tag in added_tags:
                 for ip in ip_addrs:
-                    self._add_mapping(tag_id, profile_id, endpoint_id, ip)
+                    self._add_mapping(tag, ip)
+
+        # The profile's entry holds a reference to each of its tags.
+        for tag in old_tags:
+            self._tag_ids.release(tag)
 
         if tags is None:
             _log.info("Tags for profile %s deleted", profile_id)
             self.tags_by_prof_id.pop(profile_id, None)
+            self._tags_by_prof.pop(prof, None)
+            if had_tags:
+                # Drop the reference held by the entry as well as ours.
+                self._profile_ids.release(prof)
+            self._profile_ids.release(prof)
         else:
             self.tags_by_prof_id[profile_id] = tags
+            self._tags_by_prof[prof] = new_tags
+            if had_tags:
+                # The entry already holds a reference.  Otherwise, the new
+                # entry takes over ours.
+                self._profile_ids.release(prof)
 
     def _extract_ips(self, endpoint):
+        """
+        :returns tuple[str]: the endpoint's IPs of our IP version, packed
+            and interned.
+        """
         if endpoint is None:
-            return set()
-        return set(map(futils.net_to_ip,
-                       endpoint.get(self.nets_key, [])))
+            return ()
+        family = self._addr_family
+        return tuple(set(
+            intern(socket.inet_pton(family, futils.net_to_ip(net)))
+            for net in endpoint.get(self.nets_key, [])
+        ))
+
+    def _unpack_ips(self, packed_ips):
+        family = self._addr_family
+        return set(socket.inet_ntop(family, ip) for ip in packed_ips)
 
     @actor_message()
     def on_endpoint_update(self, endpoint_id, endpoint):
@@ -240,32 +427,53 @@ class IpsetManager(ReferenceManager):
         # previous endpoint then we default old_tags to the empty set.  Then,
         # when we calculate removed_tags, we'll get the empty set and the
         # removal loop will be skipped.
-        old_endpoint = self.endpoints_by_ep_id.pop(endpoint_id, {})
-        old_prof_ids = set(old_endpoint.get("profile_ids", []))
-        old_tags = set()
-        for profile_id in old_prof_ids:
-            for tag in self.tags_by_prof_id.get(profile_id, []):
-                old_tags.add((profile_id, tag))
+        ep = self._endpoint_ids.get(endpoint_id)
+        if ep is None:
+            if endpoint is None:
+                _log.debug("Deletion of unknown endpoint, nothing to do.")
+                return
+            ep = self._endpoint_ids.acquire(endpoint_id)
+            if ep == len(self._profiles_by_ep):
+                self._profiles_by_ep.append(None)
+                self._ips_by_ep.append(None)
+            old_prof_ids = ()
+            old_ips = ()
+        else:
+            old_prof_ids = self._profiles_by_ep[ep]
+            old_ips = self._ips_by_ep[ep]
 
         if endpoint is None:
             _log.debug("Deletion, setting new_tags to empty.")
-            new_prof_ids = set()
+            new_prof_ids = ()
+            new_ips = ()
         else:
             _log.debug("Add/update, setting new_tags to indexed value.")
-            new_prof_ids = set(endpoint.get("profile_ids", []))
-            self.endpoints_by_ep_id[endpoint_id] = endpoint
+            # The endpoint holds a reference to each of its profiles.
+            new_prof_ids = tuple(
+                self._profile_ids.acquire(p)
+                for p in set(endpoint.get("profile_ids", []))
+            )
+            new_ips = self._extract_ips(endpoint)
+
+        # Only indexed tags are of interest.
+        indexed = self._ip_refs_by_tag
+        old_tags = set()
+        for prof in old_prof_ids:
+            for tag in self._tags_by_prof.get(prof, ()):
+                if tag in indexed:
+                    old_tags.add((prof, tag))
         new_tags = set()
-        for profile_id in new_prof_ids:
-            for tag in self.tags_by_prof_id.get(profile_id, []):
-                new_tags.add((profile_id, tag))
+        for prof in new_prof_ids:
+            for tag in self._tags_by_prof.get(prof, ()):
+                if tag in indexed:
+                    new_tags.add((prof, tag))
 
-        if new_prof_ids != old_prof_ids:
-            # Profile ID changed, or an add/delete.  the _xxx_profile_index
-            # methods ignore profile_id == None so we'll do the right thing.
+        if set(new_prof_ids) != set(old_prof_ids):
+            # Profile ID changed, or an add/delete.
             _log.debug("Profile IDs changed from %s to %s",
                        old_prof_ids, new_prof_ids)
-            self._remove_profile_index(old_prof_ids, endpoint_id)
-            self._add_profile_index(new_prof_ids, endpoint_id)
+            self._remove_profile_index(old_prof_ids, ep)
+            self._add_profile_index(new_prof_ids, ep)
 
         # Since we've defaulted new/old_tags to set() if needed, we can
         # use set operations to calculate the tag changes.
@@ -273,78 +481,133 @@ class IpsetManager(ReferenceManager):
         unchanged_tags = new_tags & old_tags
         removed_tags = old_tags - new_tags
 
-        # _extract_ips() will default old/new_ips to set() if there are no IPs.
-        old_ips = self._extract_ips(old_endpoint)
-        new_ips = self._extract_ips(endpoint)
-
         # Add *new* IPs to new tags.  On a deletion, added_tags will be empty.
         # Do this first to avoid marking ipsets as dirty if an endpoint moves
         # from one profile to another but keeps the same tag.
-        for profile_id, tag in added_tags:
+        for _, tag in added_tags:
             for ip in new_ips:
-                self._add_mapping(tag, profile_id,  endpoint_id, ip)
+                self._add_mapping(tag, ip)
         # Change IPs in unchanged tags.
-        added_ips = new_ips - old_ips
-        removed_ips = old_ips - new_ips
-        for profile_id, tag in unchanged_tags:
+        added_ips = set(new_ips).difference(old_ips)
+        removed_ips = set(old_ips).difference(new_ips)
+        for _, tag in unchanged_tags:
             for ip in removed_ips:
-                self._remove_mapping(tag, profile_id,  endpoint_id, ip)
+                self._remove_mapping(tag, ip)
             for ip in added_ips:
-                self._add_mapping(tag, profile_id,  endpoint_id, ip)
+                self._add_mapping(tag, ip)
         # Remove *all* *old* IPs from removed tags.  For a deletion, only this
         # loop will fire.
-        for profile_id, tag in removed_tags:
+        for _, tag in removed_tags:
             for ip in old_ips:
-                self._remove_mapping(tag, profile_id, endpoint_id, ip)
+                self._remove_mapping(tag, ip)
+
+        for prof in old_prof_ids:
+            self._profile_ids.release(prof)
+        if endpoint is None:
+            self._profiles_by_ep[ep] = None
+            self._ips_by_ep[ep] = None
+            self._endpoint_ids.release(ep)
+        else:
+            self._profiles_by_ep[ep] = new_prof_ids
+            self._ips_by_ep[ep] = new_ips
 
         _log.info("Endpoint update complete")
 
-    def _add_mapping(self, tag_id, profile_id, endpoint_id, ip_address):
+    def _add_mapping(self, tag, ip_address):
         """
-        Adds the given tag->IP->profile->endpoint mapping to the index.
-        Marks the tag as dirty if the update resulted in the IP being
-        newly added.
+        Adds a reference from a (profile, endpoint) pair to the given
+        tag->IP mapping.  Marks the tag as dirty if the update resulted in
+        the IP being newly added.
+
+        :param int tag: Interned ID of an indexed tag.
+        :param str ip_address: Packed IP address.
         """
-        ip_added = not bool(self.ip_owners_by_tag[tag_id][ip_address])
-        ep_ids = self.ip_owners_by_tag[tag_id][ip_address][profile_id]
-        ep_ids.add(endpoint_id)
-        if ip_added:
-            self._dirty_tags.add(tag_id)
+        ip_refs = self._ip_refs_by_tag[tag]
+        ref_count = ip_refs.get(ip_address, 0)
+        ip_refs[ip_address] = ref_count + 1
+        if ref_count == 0:
+            self._dirty_tags.add(self._tag_ids.key(tag))
 
-    def _remove_mapping(self, tag_id, profile_id, endpoint_id, ip_address):
+    def _remove_mapping(self, tag, ip_address):
         """
-        Removes the tag->IP->profile->endpoint mapping from index.
-        Marks the tag as dirty if the update resulted in the IP being
-        removed.
+        Removes a reference to the tag->IP mapping from the index.  Marks
+        the tag as dirty if the update resulted in the IP being removed.
+
+        :param int tag: Interned ID of an indexed tag.
+        :param str ip_address: Packed IP address.
         """
-        ep_ids = self.ip_owners_by_tag[tag_id][ip_address][profile_id]
-        ep_ids.discard(endpoint_id)
-        if not ep_ids:
-            del self.ip_owners_by_tag[tag_id][ip_address][profile_id]
-            if not self.ip_owners_by_tag[tag_id][ip_address]:
-                del self.ip_owners_by_tag[tag_id][ip_address]
-                self._dirty_tags.add(tag_id)
-            if not self.ip_owners_by_tag[tag_id]:
-                del self.ip_owners_by_tag[tag_id]
+        ip_refs = self._ip_refs_by_tag[tag]
+        ref_count = ip_refs[ip_address] - 1
+        if ref_count:
+            ip_refs[ip_address] = ref_count
+        else:
+            del ip_refs[ip_address]
+            self._dirty_tags.add(self._tag_ids.key(tag))
 
-    def _add_profile_index(self, prof_ids, endpoint_id):
+    def _add_profile_index(self, prof_ids, ep):
         """
         Notes in the index that an endpoint uses the given profiles.
         """
-        for prof_id in prof_ids:
-            self.endpoint_ids_by_profile_id[prof_id].add(endpoint_id)
+        for prof in prof_ids:
+            endpoints = self._endpoints_by_prof.get(prof)
+            if endpoints is None:
+                endpoints = self._endpoints_by_prof[prof] = set()
+            endpoints.add(ep)
 
-    def _remove_profile_index(self, prof_ids, endpoint_id):
+    def _remove_profile_index(self, prof_ids, ep):
         """
         Notes in the index that an endpoint no longer uses any of the
         given profiles.
         """
-        for prof_id in prof_ids:
-            endpoints = self.endpoint_ids_by_profile_id[prof_id]
-            endpoints.discard(endpoint_id)
+        for prof in prof_ids:
+            endpoints = self._endpoints_by_prof[prof]
+            endpoints.discard(ep)
             if not endpoints:
-                _log.debug("No more endpoints use profile %s", prof_id)
-                del self.endpoint_ids_by_profile_id[prof_id]
+                _log.debug("No more endpoints use profile %s",
+                           self._profile_ids.key(prof))
+                del self._endpoints_by_prof[prof]
+
+    def _endpoints_view(self):
+        """
+        Expands the endpoint store, for diagnostics and UTs.
+
+        :returns dict: EndpointId -> (set of profile IDs, set of IPs).
+        """
+        view = {}
+        for endpoint_id in self._endpoint_ids.keys():
+            ep = self._endpoint_ids.get(endpoint_id)
+            prof_ids = set(self._profile_ids.key(prof)
+                           for prof in self._profiles_by_ep[ep])
+            view[endpoint_id] = (prof_ids,
+                                 self._unpack_ips(self._ips_by_ep[ep]))
+        return view
+
+    def _endpoint_ids_by_profile_view(self):
+        """
+        Expands the profile index, for diagnostics and UTs.
+
+        :returns dict: profile ID -> set of EndpointIds.
+        """
+        return dict(
+            (self._profile_ids.key(prof),
+             set(self._endpoint_ids.key(ep) for ep in endpoints))
+            for prof, endpoints in self._endpoints_by_prof.iteritems()
+        )
+
+    def _ip_refs_by_tag_view(self):
+        """
+        Expands the main index, for diagnostics and UTs.
+
+        :returns dict: indexed tag ID -> IP -> number of (profile, endpoint)
+            pairs that put the IP in the tag.
+        """
+        family = self._addr_family
+        return dict(
+            (self._tag_ids.key(tag),
+             dict((socket.inet_ntop(family, ip), count)
+                  for ip, count in ip_refs.iteritems()))
+            for tag, ip_refs in self._ip_refs_by_tag.iteritems()
+        )
 
     def _finish_msg_batch(self, batch, results):
         """
@@ -362,20 +625,22 @@ class IpsetManager(ReferenceManager):
 
 class ActiveIpset(RefCountedActor):
 
-    def __init__(self, tag, ip_type):
+    def __init__(self, tag, ip_type, driver=None):
         """
         Actor managing a single ipset.
 
         :param str tag: Name of tag that this ipset represents.
         :param ip_type: IPV4 or IPV6
+        :param driver: Object used to program the set into the dataplane.
+            Defaults to an IpsetCommandDriver.
         """
         super(ActiveIpset, self).__init__(qualifier=tag)
 
         self.tag = tag
         self.ip_type = ip_type
+        self.driver = driver or IpsetCommandDriver(ip_type)
         self.name = tag_to_ipset_name(ip_type, tag)
         self.tmpname = tag_to_ipset_name(ip_type, tag, tmp=True)
-        self.family = "inet" if ip_type == IPV4 else "inet6"
 
         # Members - which entries should be in the ipset.
         self.members = set()
@@ -383,6 +648,9 @@ class ActiveIpset(RefCountedActor):
         # Members which really are in the ipset.
         self.programmed_members = None
 
+        # (hashsize, maxelem) that we last programmed the set with.
+        self.sizing = None
+
         # Notified ready?
         self.notified_ready = False
         self.stopped = False
@@ -412,8 +680,11 @@ class ActiveIpset(RefCountedActor):
             # Destroy the ipsets - ignoring any errors.
             _log.debug("Delete ipsets %s and %s if they exist",
                        self.name, self.tmpname)
-            futils.call_silent(["ipset", "destroy", self.name])
-            futils.call_silent(["ipset", "destroy", self.tmpname])
+            for name in (self.name, self.tmpname):
+                try:
+                    self.driver.destroy(name)
+                except FailedSystemCall:
+                    pass
         finally:
             self._notify_cleanup_complete()
 
@@ -430,48 +701,177 @@ class ActiveIpset(RefCountedActor):
         _log.info("Rewriting %s ipset %s for tag %s with %d members.",
                   self.ip_type, self.name, self._id, len(self.members))
         _log.debug("Setting ipset %s to %s", self.name, self.members)
+        hashsize, maxelem = self._choose_sizing(len(self.members))
+        self.driver.replace_members(self.name, self.tmpname, self.members,
+                                    hashsize=hashsize, maxelem=maxelem)
+        trace.note_commit("ipset")
+
+        # We have got the set into the correct state.
+        self.programmed_members = self.members.copy()
+        self.sizing = (hashsize, maxelem)
+        stats.histogram("ipset.fill").record(
+            float(len(self.members)) / maxelem)
+
+    def _choose_sizing(self, num_members):
+        """
+        Chooses the hashsize and maxelem for the set.  We stick with the
+        current sizing until the set gets close to full, or becomes much
+        emptier, so that sets don't get resized on every change.
+
+        :returns tuple: (hashsize, maxelem)
+        """
+        ideal = ipset_sizing(num_members)
+        if self.sizing is None:
+            return ideal
+        maxelem = self.sizing[1]
+        if num_members > maxelem * IPSET_RESIZE_THRESHOLD:
+            direction = "grow"
+        elif (num_members <= maxelem * IPSET_SHRINK_THRESHOLD and
+              ideal[1] < maxelem):
+            direction = "shrink"
+        else:
+            return self.sizing
+        _log.info("Resizing ipset %s for %d members: hashsize %s->%s, "
+                  "maxelem %s->%s", self.name, num_members, self.sizing[0],
+                  ideal[0], maxelem, ideal[1])
+        stats.increment("ipset.resize.%s" % direction)
+        return ideal
 
+    def __str__(self):
+        return (
+            self.__class__.__name__ + "<queue_len=%s,live=%s,msg=%s,"
+                                      "name=%s,id=%s>" %
+            (
+                self._event_queue.qsize(),
+                bool(self.greenlet),
+                self._current_msg,
+                self.name,
+                self._id,
+            )
+        )
+
+
+class IpsetCommandDriver(object):
+    """
+    Programs ipsets using the ipset command-line tool.
+
+    ActiveIpset and IpsetManager delegate their dataplane operations to a
+    driver object so that the sets can be programmed by other means (for
+    example, as native nftables sets).  A driver provides replace_members(),
+    destroy() and list_names().
+    """
+    def __init__(self, ip_type):
+        self.ip_type = ip_type
+        self.family = "inet" if ip_type == IPV4 else "inet6"
+        # The maxelem that we last created each of our main sets with.
+        # "create --exist" fails if the set exists with a different maxelem
+        # so we need to repeat it.
+        self._maxelem_by_name = {}
+
+    def replace_members(self, name, tmpname, members, hashsize=None,
+                        maxelem=None):
+        """
+        Atomically replaces the contents of the named ipset, creating it if
+        needed.
+
+        :param str name: Name of the ipset.
+        :param str tmpname: Name of a scratch ipset that we may use to
+            build the new contents.
+        :param set[str] members: The IP addresses that should be in the set.
+        :param int hashsize: Initial hash table size for the new contents,
+            or None for ipset's default.
+        :param int maxelem: Maximum number of members for the new contents,
+            or None for ipset's default.
+        :raises FailedSystemCall: if the update fails.
+        """
+        # Resizing happens as part of the swap: the temporary set is created
+        # with the new size and swapped into place.
+        main_maxelem = self._maxelem_by_name.get(name, maxelem)
+        try:
+            self._restore(name, tmpname, members, hashsize, maxelem,
+                          create_main=self._create_cmd(name, None,
+                                                       main_maxelem))
+        except FailedSystemCall:
+            # Most likely, the main set or a left-over temporary set exists
+            # with a size that we don't know about; for example, from before
+            # a restart.  The main set only needs to exist; remove the
+            # temporary set and retry without recreating the main set.
+            _log.warning("Failed to rewrite ipset %s, retrying without "
+                         "recreating it", name)
+            futils.call_silent(["ipset", "destroy", tmpname])
+            self._restore(name, tmpname, members, hashsize, maxelem,
+                          create_main=None)
+        self._maxelem_by_name[name] = maxelem
+
+    def _create_cmd(self, name, hashsize, maxelem):
+        cmd = "create %s hash:ip family %s" % (name, self.family)
+        if hashsize is not None:
+            cmd += " hashsize %d" % hashsize
+        if maxelem is not None:
+            cmd += " maxelem %d" % maxelem
+        return cmd + " --exist"
+
+    def _restore(self, name, tmpname, members, hashsize, maxelem,
+                 create_main):
         # We use ipset restore, which processes a batch of ipset updates.
         # The only operation that we're sure is atomic is swapping two ipsets
         # so we build up the complete set of members in a temporary ipset,
         # swap it into place and then delete the old ipset.
-        create_cmd = "create %s hash:ip family %s --exist"
-        input_lines = [
-            # Ensure both the main set and the temporary set exist.
-            create_cmd % (self.name, self.family),
-            create_cmd % (self.tmpname, self.family),
+        input_lines = []
+        if create_main:
+            # Ensure the main set exists.
+            input_lines.append(create_main)
+        input_lines += [
+            # Ensure the temporary set exists.
+            self._create_cmd(tmpname, hashsize, maxelem),
 
             # Flush the temporary set.  This is a no-op unless we had a
             # left-over temporary set before.
-            "flush %s" % self.tmpname,
+            "flush %s" % tmpname,
         ]
         # Add all the members to the temporary set,
-        input_lines += ["add %s %s" % (self.tmpname, m) for m in self.members]
+        input_lines += ["add %s %s" % (tmpname, m) for m in members]
         # Then, atomically swap the temporary set into place.
-        input_lines.append("swap %s %s" % (self.name, self.tmpname))
+        input_lines.append("swap %s %s" % (name, tmpname))
         # Finally, delete the temporary set (which was the old active set).
-        input_lines.append("destroy %s" % self.tmpname)
+        input_lines.append("destroy %s" % tmpname)
         # COMMIT tells ipset restore to actually execute the changes.
         input_lines.append("COMMIT")
 
         input_str = "\n".join(input_lines) + "\n"
         futils.check_call(["ipset", "restore"], input_str=input_str)
 
-        # We have got the set into the correct state.
-        self.programmed_members = self.members.copy()
+    def destroy(self, name):
+        """
+        Destroys the named ipset.
+
+        :raises FailedSystemCall: if the set could not be destroyed, for
+            example, because it does not exist or is still referenced.
+        """
+        self._maxelem_by_name.pop(name, None)
+        futils.check_call(["ipset", "destroy", name])
+
+    def list_names(self):
+        """
+        :returns list[str]: the names of all ipsets in the dataplane.
+        """
+        return list_ipset_names()
 
-    def __str__(self):
-        return (
-            self.__class__.__name__ + "<queue_len=%s,live=%s,msg=%s,"
-                                      "name=%s,id=%s>" %
-            (
-                self._event_queue.qsize(),
-                bool(self.greenlet),
-                self._current_msg,
-                self.name,
-                self._id,
-            )
-        )
+
+def ipset_sizing(num_members):
+    """
+    Chooses the size of a hash:ip set to hold the given number of members
+    with room to grow.  Never smaller than ipset's defaults.
+
+    :returns tuple: (hashsize, maxelem), both powers of two.
+    """
+    maxelem = IPSET_DEFAULT_MAXELEM
+    while maxelem < num_members * IPSET_HEADROOM:
+        maxelem *= 2
+    hashsize = IPSET_DEFAULT_HASHSIZE
+    while hashsize * IPSET_MEMBERS_PER_BUCKET < num_members:
+        hashsize *= 2
+    return hashsize, maxelem
 
 
 def tag_to_ipset_name(ip_type, tag, tmp=False):
@@ -489,15 +889,34 @@ def list_ipset_names():
     """
     List all names of ipsets. Note that this is *not* the same as the ipset
     list command which lists contents too (hence the name change).
-    """
-    data = futils.check_call(["ipset", "list"]).stdout
-    lines = data.split("\n")
 
+    Uses "ipset list -name", which lists only the names, falling back to
+    picking the names out of the full "ipset list" output on versions of
+    ipset that don't support it.  Either way, the output is parsed as it
+    is streamed rather than read into memory, since the full listing
+    includes every member of every set.
+    """
+    global _list_name_supported
+    if _list_name_supported:
+        try:
+            return [line.strip() for line in
+                    futils.check_call_lines(["ipset", "list", "-name"])
+                    if line.strip()]
+        except FailedSystemCall as e:
+            _log.warning("ipset list -name failed, falling back to parsing "
+                         "full ipset list output: %r", e.stderr)
+            names = _list_ipset_names_from_full_listing()
+            # Only stop trying -name once we know that ipset itself works.
+            _list_name_supported = False
+            return names
+    return _list_ipset_names_from_full_listing()
+
+
+def _list_ipset_names_from_full_listing():
     names = []
-
-    for line in lines:
-        words = line.split()
-        if len(words) > 1 and words[0] == "Name:":
-            names.append(words[1])
-
+    for line in futils.check_call_lines(["ipset", "list"]):
+        if line.startswith("Name:"):
+            words = line.split()
+            if len(words) > 1:
+                names.append(words[1])
     return names
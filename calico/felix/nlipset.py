@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.nlipset
+~~~~~~~~~~~~~
+
+Programs ipsets by talking to the kernel's ipset subsystem over netlink,
+rather than by forking the ipset tool.
+
+The NetlinkIpsetDriver is a drop-in replacement for the IpsetCommandDriver.
+It builds much the same create/add/swap/destroy sequence that we feed to
+"ipset restore" but sends it as nfnetlink messages, many to a datagram,
+and adds members many to a message.  Requests are sent in stages and each
+stage must be acknowledged in full before the next one is sent so that,
+as with "ipset restore", we never swap a partially-populated set into
+place.
+
+The kernel interface is defined in linux/netfilter/ipset/ip_set.h.  Only
+the small subset of it that Felix needs (hash:ip sets of single addresses)
+is implemented here.
+"""
+import errno
+import logging
+import os
+import socket
+import struct
+
+from calico.felix.futils import FailedSystemCall, IPV4
+
+_log = logging.getLogger(__name__)
+
+# From linux/netlink.h.
+NETLINK_NETFILTER = 12
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLA_F_NESTED = 0x8000
+NLA_F_NET_BYTEORDER = 0x4000
+NLA_TYPE_MASK = ~(NLA_F_NESTED | NLA_F_NET_BYTEORDER)
+
+# From linux/netfilter/nfnetlink.h and linux/netfilter.h.
+NFNL_SUBSYS_IPSET = 6
+NFNETLINK_V0 = 0
+NFPROTO_IPV4 = 2
+NFPROTO_IPV6 = 10
+
+# From linux/netfilter/ipset/ip_set.h.
+IPSET_PROTOCOL = 6
+IPSET_MAXNAMELEN = 32
+IPSET_CMD_CREATE = 2
+IPSET_CMD_DESTROY = 3
+IPSET_CMD_FLUSH = 4
+IPSET_CMD_SWAP = 6
+IPSET_CMD_LIST = 7
+IPSET_CMD_ADD = 9
+IPSET_CMD_DEL = 10
+# Command-level attributes.
+IPSET_ATTR_PROTOCOL = 1
+IPSET_ATTR_SETNAME = 2
+IPSET_ATTR_TYPENAME = 3
+IPSET_ATTR_SETNAME2 = IPSET_ATTR_TYPENAME
+IPSET_ATTR_REVISION = 4
+IPSET_ATTR_FAMILY = 5
+IPSET_ATTR_FLAGS = 6
+IPSET_ATTR_DATA = 7
+IPSET_ATTR_ADT = 8
+IPSET_ATTR_LINENO = 9
+# Attributes nested in IPSET_ATTR_DATA.
+IPSET_ATTR_IP = 1
+IPSET_ATTR_HASHSIZE = 18
+IPSET_ATTR_MAXELEM = 19
+# Attributes nested in IPSET_ATTR_IP.
+IPSET_ATTR_IPADDR_IPV4 = 1
+IPSET_ATTR_IPADDR_IPV6 = 2
+IPSET_FLAG_LIST_SETNAME = 1 << 1
+# Errors that are specific to ipset, returned as negative errnos.
+IPSET_ERR_PROTOCOL = 4097
+IPSET_ERR_FIND_TYPE = 4098
+IPSET_ERR_MAX_SETS = 4099
+IPSET_ERR_BUSY = 4100
+IPSET_ERR_EXIST_SETNAME2 = 4101
+IPSET_ERR_TYPE_MISMATCH = 4102
+IPSET_ERR_EXIST = 4103
+IPSET_ERR_REFERENCED = 4108
+IPSET_ERR_HASH_FULL = 4352
+IPSET_ERRORS = {
+    IPSET_ERR_PROTOCOL: "Kernel error received: ipset protocol error",
+    IPSET_ERR_FIND_TYPE: "Kernel error received: set type not supported",
+    IPSET_ERR_MAX_SETS: "Kernel error received: maximal number of sets "
+                        "reached, cannot create more.",
+    IPSET_ERR_BUSY: "Set cannot be destroyed: it is in use by a kernel "
+                    "component",
+    IPSET_ERR_EXIST_SETNAME2: "The second set does not exist",
+    IPSET_ERR_TYPE_MISMATCH: "The sets cannot be swapped: their type does "
+                             "not match",
+    IPSET_ERR_EXIST: "Set cannot be created: set with the same name "
+                     "already exists",
+    IPSET_ERR_REFERENCED: "Set cannot be destroyed: it is in use by a "
+                          "kernel component",
+    IPSET_ERR_HASH_FULL: "Hash is full, cannot add more elements",
+}
+
+HASH_IP = "hash:ip"
+# Revision 0 of hash:ip is supported by every kernel that has it and has
+# all the features that we need.
+HASH_IP_REVISION = 0
+
+_NLMSGHDR = struct.Struct("=IHHII")
+_NFGENMSG = struct.Struct("=BBH")
+_NLATTR = struct.Struct("=HH")
+_NLMSGERR = struct.Struct("=i")
+
+# Maximum number of members to add or delete per message.  The members are
+# nested inside a single attribute, whose length must fit in 16 bits.
+MAX_MEMBERS_PER_MSG = 1024
+# Maximum size of datagram that we send or expect to receive.
+MAX_DATAGRAM_SIZE = 65536
+
+
+class NetlinkError(FailedSystemCall):
+    """
+    A netlink request was rejected by the kernel.  Subclass of
+    FailedSystemCall so that callers can handle it like a failure of the
+    ipset tool.
+    """
+    def __init__(self, command, error):
+        message = IPSET_ERRORS.get(error) or os.strerror(error)
+        super(NetlinkError, self).__init__(
+            "ipset netlink request failed: %s" % message,
+            ["ipset", "netlink", command], error, "", message)
+        self.errno = error
+
+
+class NetlinkSocket(object):
+    """
+    Thin wrapper around a NETLINK_NETFILTER socket.  UTs substitute a fake
+    that replays recorded traffic.
+    """
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                   NETLINK_NETFILTER)
+        self._sock.bind((0, 0))
+
+    def send(self, data):
+        self._sock.send(data)
+
+    def recv(self):
+        return self._sock.recv(MAX_DATAGRAM_SIZE)
+
+    def close(self):
+        self._sock.close()
+
+
+class NetlinkIpsetDriver(object):
+    """
+    Programs ipsets over netlink.  Drop-in replacement for the
+    IpsetCommandDriver.
+    """
+    def __init__(self, ip_type, sock_factory=NetlinkSocket):
+        """
+        :param ip_type: IPV4 or IPV6; the family of the sets we create.
+        :param sock_factory: Callable that returns a NetlinkSocket; for UTs.
+        """
+        self.ip_type = ip_type
+        if ip_type == IPV4:
+            self._family = NFPROTO_IPV4
+            self._addr_family = socket.AF_INET
+            self._ipaddr_attr = IPSET_ATTR_IPADDR_IPV4
+        else:
+            self._family = NFPROTO_IPV6
+            self._addr_family = socket.AF_INET6
+            self._ipaddr_attr = IPSET_ATTR_IPADDR_IPV6
+        self._sock_factory = sock_factory
+        self._sock = None
+        self._seq = 0
+
+    def replace_members(self, name, tmpname, members, hashsize=None,
+                        maxelem=None):
+        """
+        Atomically replaces the contents of the named ipset, creating it if
+        needed.  Same semantics as IpsetCommandDriver.replace_members().
+
+        :raises NetlinkError: if the update fails.
+        """
+        # We only need the main set to exist so that we can swap with it;
+        # we create it exclusively so that an existing set of a different
+        # size isn't an error.  The temporary set is recreated each time so
+        # that it, and hence the main set after the swap, gets the
+        # requested size.
+        self.execute([self.create_msg(name, hashsize, maxelem,
+                                      exclusive=True),
+                      self.destroy_msg(tmpname),
+                      self.create_msg(tmpname, hashsize, maxelem)],
+                     ignore=_ALREADY_DONE_ERRORS)
+        self.execute(self.add_msgs(tmpname, members))
+        self.execute([self.swap_msg(name, tmpname),
+                      self.destroy_msg(tmpname)])
+
+    def destroy(self, name):
+        """
+        Destroys the named ipset.
+
+        :raises NetlinkError: if the set could not be destroyed, for
+            example, because it does not exist or is still referenced.
+        """
+        self.execute([self.destroy_msg(name)])
+
+    def list_names(self):
+        """
+        :returns list[str]: the names of all ipsets in the dataplane.
+            Only the names are requested from the kernel, not the members.
+        """
+        request = self._message(IPSET_CMD_LIST, NLM_F_REQUEST | NLM_F_DUMP, [
+            _attr(IPSET_ATTR_FLAGS | NLA_F_NET_BYTEORDER,
+                  struct.pack("!I", IPSET_FLAG_LIST_SETNAME)),
+        ])
+        names = []
+        for msg_type, body in self._dump(request):
+            for attr_type, payload in parse_attrs(body[_NFGENMSG.size:]):
+                if attr_type == IPSET_ATTR_SETNAME:
+                    name = payload.rstrip("\0")
+                    # With IPSET_FLAG_LIST_SETNAME, each set is reported
+                    # once; without it (on old kernels) a large set may be
+                    # reported across several messages.
+                    if not names or names[-1] != name:
+                        names.append(name)
+        return names
+
+    # Message builders.  Each returns a (command, seq, data) tuple that can
+    # be passed to execute().
+
+    def create_msg(self, name, hashsize=None, maxelem=None, exclusive=False):
+        """
+        Builds a request to create a hash:ip set, if it doesn't exist.
+
+        :param exclusive: If True, fail with EEXIST if the set exists.
+            Otherwise, only fail if it exists with a different maxelem.
+        """
+        data = []
+        if hashsize is not None:
+            data.append(_attr(IPSET_ATTR_HASHSIZE | NLA_F_NET_BYTEORDER,
+                              struct.pack("!I", hashsize)))
+        if maxelem is not None:
+            data.append(_attr(IPSET_ATTR_MAXELEM | NLA_F_NET_BYTEORDER,
+                              struct.pack("!I", maxelem)))
+        # Leaving out NLM_F_EXCL is equivalent to ipset's --exist flag.
+        flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE
+        if exclusive:
+            flags |= NLM_F_EXCL
+        return self._message(
+            IPSET_CMD_CREATE, flags, [
+                _strz_attr(IPSET_ATTR_SETNAME, name),
+                _strz_attr(IPSET_ATTR_TYPENAME, HASH_IP),
+                _attr(IPSET_ATTR_REVISION, struct.pack("B",
+                                                       HASH_IP_REVISION)),
+                _attr(IPSET_ATTR_FAMILY, struct.pack("B", self._family)),
+                _attr(IPSET_ATTR_DATA | NLA_F_NESTED, "".join(data)),
+            ])
+
+    def flush_msg(self, name):
+        return self._message(IPSET_CMD_FLUSH, NLM_F_REQUEST | NLM_F_ACK,
+                             [_strz_attr(IPSET_ATTR_SETNAME, name)])
+
+    def swap_msg(self, name, name2):
+        return self._message(IPSET_CMD_SWAP, NLM_F_REQUEST | NLM_F_ACK,
+                             [_strz_attr(IPSET_ATTR_SETNAME, name),
+                              _strz_attr(IPSET_ATTR_SETNAME2, name2)])
+
+    def destroy_msg(self, name):
+        return self._message(IPSET_CMD_DESTROY, NLM_F_REQUEST | NLM_F_ACK,
+                             [_strz_attr(IPSET_ATTR_SETNAME, name)])
+
+    def add_msgs(self, name, members):
+        """
+        Builds requests to add the given members to the named set.
+        Adding a member that is already present is not an error.
+
+        :returns list: one request per MAX_MEMBERS_PER_MSG members.
+        """
+        return self._adt_msgs(IPSET_CMD_ADD, name, members)
+
+    def del_msgs(self, name, members):
+        """
+        Builds requests to delete the given members from the named set.
+        Deleting a member that is not present is not an error.
+        """
+        return self._adt_msgs(IPSET_CMD_DEL, name, members)
+
+    def _adt_msgs(self, command, name, members):
+        entries = [self._entry_attr(m) for m in members]
+        msgs = []
+        for start in xrange(0, len(entries), MAX_MEMBERS_PER_MSG):
+            chunk = entries[start:start + MAX_MEMBERS_PER_MSG]
+            # Leaving out NLM_F_EXCL makes adding an existing member (or
+            # deleting a missing one) a no-op.
+            msgs.append(self._message(command, NLM_F_REQUEST | NLM_F_ACK, [
+                _strz_attr(IPSET_ATTR_SETNAME, name),
+                _attr(IPSET_ATTR_ADT | NLA_F_NESTED, "".join(chunk)),
+                # The kernel requires a line number, for error reporting,
+                # alongside a list of members.
+                _attr(IPSET_ATTR_LINENO, struct.pack("=I", 0)),
+            ]))
+        return msgs
+
+    def _entry_attr(self, ip):
+        packed = socket.inet_pton(self._addr_family, ip)
+        ip_attr = _attr(self._ipaddr_attr | NLA_F_NET_BYTEORDER, packed)
+        return _attr(IPSET_ATTR_DATA | NLA_F_NESTED,
+                     _attr(IPSET_ATTR_IP | NLA_F_NESTED, ip_attr))
+
+    def _message(self, command, flags, attrs):
+        self._seq += 1
+        body = (_NFGENMSG.pack(socket.AF_INET, NFNETLINK_V0, 0) +
+                _attr(IPSET_ATTR_PROTOCOL, struct.pack("B", IPSET_PROTOCOL)) +
+                "".join(attrs))
+        header = _NLMSGHDR.pack(_NLMSGHDR.size + len(body),
+                                (NFNL_SUBSYS_IPSET << 8) | command,
+                                flags, self._seq, 0)
+        return command, self._seq, header + body
+
+    # Transport.
+
+    def execute(self, msgs, ignore=()):
+        """
+        Sends the given requests, packing as many into each datagram as
+        will fit, and waits for all of them to be acknowledged.
+
+        :param ignore: Collection of (command, errno) pairs for failures
+            that should not be treated as errors.
+        :raises NetlinkError: if any request failed; the remaining requests
+            in the same call may or may not have been applied.
+        """
+        first_error = None
+        batch = []
+        batch_size = 0
+        for msg in msgs:
+            if batch and batch_size + len(msg[2]) > MAX_DATAGRAM_SIZE:
+                first_error = (self._send_batch(batch, ignore) or
+                               first_error)
+                batch = []
+                batch_size = 0
+            batch.append(msg)
+            batch_size += len(msg[2])
+        if batch:
+            first_error = self._send_batch(batch, ignore) or first_error
+        if first_error is not None:
+            raise first_error
+
+    def _send_batch(self, batch, ignore=()):
+        """
+        Sends one datagram of requests and collects their acks.
+
+        :returns: a NetlinkError for the first failed request, or None.
+        """
+        sock = self._get_socket()
+        sock.send("".join(data for _, _, data in batch))
+        commands_by_seq = dict((seq, command) for command, seq, _ in batch)
+        first_error = None
+        try:
+            while commands_by_seq:
+                for msg_type, seq, body in parse_messages(sock.recv()):
+                    if msg_type != NLMSG_ERROR or seq not in commands_by_seq:
+                        _log.warning("Ignoring unexpected netlink message "
+                                     "type %s, seq %s", msg_type, seq)
+                        continue
+                    command = commands_by_seq.pop(seq)
+                    error = -_NLMSGERR.unpack_from(body)[0]
+                    if (command, error) in ignore:
+                        _log.debug("Ignoring error %s from ipset netlink "
+                                   "command %s", error, command)
+                        continue
+                    if error and first_error is None:
+                        _log.error("ipset netlink command %s failed: %s",
+                                   command, error)
+                        first_error = NetlinkError(_COMMAND_NAMES[command],
+                                                   error)
+        except socket.error:
+            # We may have lost track of which responses belong to which
+            # request; start again with a new socket.
+            self._reset_socket()
+            raise
+        return first_error
+
+    def _dump(self, request):
+        """
+        Sends a dump request and collects the responses.
+
+        :returns list[tuple]: (message type, body) for each response.
+        """
+        command, seq, data = request
+        sock = self._get_socket()
+        sock.send(data)
+        responses = []
+        try:
+            while True:
+                for msg_type, msg_seq, body in parse_messages(sock.recv()):
+                    if msg_seq != seq:
+                        continue
+                    if msg_type == NLMSG_DONE:
+                        return responses
+                    if msg_type == NLMSG_ERROR:
+                        error = -_NLMSGERR.unpack_from(body)[0]
+                        if error:
+                            raise NetlinkError(_COMMAND_NAMES[command], error)
+                        continue
+                    responses.append((msg_type, body))
+        except socket.error:
+            self._reset_socket()
+            raise
+
+    def _get_socket(self):
+        if self._sock is None:
+            self._sock = self._sock_factory()
+        return self._sock
+
+    def _reset_socket(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+# Failures of the first stage of replace_members() that mean the request
+# was unnecessary: the main set already exists, or the temporary set
+# (destroyed to be sure that we can recreate it at the right size) doesn't.
+_ALREADY_DONE_ERRORS = frozenset([
+    (IPSET_CMD_CREATE, errno.EEXIST),
+    (IPSET_CMD_CREATE, IPSET_ERR_EXIST),
+    (IPSET_CMD_DESTROY, errno.ENOENT),
+])
+
+_COMMAND_NAMES = {
+    IPSET_CMD_CREATE: "create",
+    IPSET_CMD_DESTROY: "destroy",
+    IPSET_CMD_FLUSH: "flush",
+    IPSET_CMD_SWAP: "swap",
+    IPSET_CMD_LIST: "list",
+    IPSET_CMD_ADD: "add",
+    IPSET_CMD_DEL: "del",
+}
+
+
+def _attr(attr_type, payload):
+    length = _NLATTR.size + len(payload)
+    return _NLATTR.pack(length, attr_type) + payload + _padding(length)
+
+
+def _strz_attr(attr_type, value):
+    assert len(value) < IPSET_MAXNAMELEN, "Name too long: %s" % value
+    return _attr(attr_type, value + "\0")
+
+
+def _padding(length):
+    return "\0" * (-length % 4)
+
+
+def parse_messages(data):
+    """
+    Splits a datagram into netlink messages.
+
+    :returns list[tuple]: (message type, sequence number, body) for each
+        message.
+    """
+    msgs = []
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        length, msg_type, _, seq, _ = _NLMSGHDR.unpack_from(data, offset)
+        if length < _NLMSGHDR.size:
+            _log.error("Truncated netlink message")
+            break
+        msgs.append((msg_type, seq,
+                     data[offset + _NLMSGHDR.size:offset + length]))
+        offset += length + (-length % 4)
+    return msgs
+
+
+def parse_attrs(data):
+    """
+    Splits a buffer into netlink attributes.
+
+    :returns list[tuple]: (attribute type, without flags, payload) for each
+        attribute.
+    """
+    attrs = []
+    offset = 0
+    while offset + _NLATTR.size <= len(data):
+        length, attr_type = _NLATTR.unpack_from(data, offset)
+        if length < _NLATTR.size:
+            break
+        attrs.append((attr_type & NLA_TYPE_MASK,
+                      data[offset + _NLATTR.size:offset + length]))
+        offset += length + (-length % 4)
+    return attrs
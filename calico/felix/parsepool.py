@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Metaswitch Networks
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+felix.parsepool
+~~~~~~~~~~~~~~~
+
+Decodes and validates the data that we read from etcd in worker processes.
+
+Parsing the JSON and validating it is the bulk of the EtcdWatcher's CPU
+time, and, since it runs on the EtcdWatcher's greenlet, it starves the other
+actors; loading a large snapshot holds up everything else for seconds.  With
+ParseWorkers set, the EtcdWatcher hands the etcd nodes to a ParsePool
+instead.  The pool splits the snapshot into chunks, which are parsed in
+parallel by its worker processes, and yields the results as each chunk comes
+back.  Individual updates are parsed by the first worker; the EtcdWatcher
+waits for the result cooperatively so the other actors keep running.
+
+The workers are started with "python -m calico.felix.parsepool" and talk
+to us over their stdin and stdout using the framing from felix.workers.
+Warnings that the parse functions log in a worker are passed back and
+logged by the main process.  If a worker fails, we parse its outstanding
+chunks inline and start a new worker the next time it is needed.
+"""
+import collections
+import logging
+import optparse
+import sys
+
+import gevent
+from gevent import subprocess
+from gevent.queue import Queue
+
+from calico import stats
+from calico.datamodel_v1 import EndpointId
+from calico.felix.fetcd import parse_node, NODE_ENDPOINT
+from calico.felix.workers import encode_frame, read_frame
+
+_log = logging.getLogger(__name__)
+
+# Message types.
+MSG_PARSE = "p"
+MSG_PARSED = "P"
+
+# Number of etcd nodes per chunk of the snapshot.
+CHUNK_SIZE = 500
+
+# Enough of the etcd node for parse_node().
+_Node = collections.namedtuple("_Node", ["key", "action", "value"])
+
+# Enough of the Config for parse_node().
+_WorkerConfig = collections.namedtuple("_WorkerConfig", ["IFACE_PREFIX"])
+
+
+class ParseWorkerFailed(Exception):
+    pass
+
+
+class ParsePool(object):
+    """
+    Pool of worker processes that parse etcd nodes.  Used by the
+    EtcdWatcher, on its greenlet.
+    """
+    def __init__(self, config, num_workers, chunk_size=CHUNK_SIZE,
+                 worker_cmd=None):
+        """
+        :param config: The Config.
+        :param num_workers: Number of worker processes to start.
+        :param chunk_size: Number of snapshot nodes to send to a worker at
+            a time.
+        :param list[str] worker_cmd: Command to start a worker.  Defaults to
+            running this module with the current interpreter.
+        """
+        self.config = config
+        self.chunk_size = chunk_size
+        self._worker_cmd = worker_cmd or [
+            sys.executable, "-m", "calico.felix.parsepool",
+            "--iface-prefix", config.IFACE_PREFIX,
+        ]
+        self._workers = [None] * num_workers
+
+    def parse_nodes(self, nodes):
+        """
+        Parses the nodes in the workers.  Generator; yields the results in
+        the order that the workers return them.
+
+        :param nodes: etcd nodes, which must not be deletions.
+        :returns: iterator over (node, result) pairs, where result is the
+            result of fetcd.parse_node() for the node, skipping nodes for
+            which that is None.
+        """
+        nodes = list(nodes)
+        chunks = [nodes[i:i + self.chunk_size]
+                  for i in xrange(0, len(nodes), self.chunk_size)]
+        results = Queue()
+        num_workers = len(self._workers)
+        greenlets = []
+        for index in xrange(num_workers):
+            worker_chunks = chunks[index::num_workers]
+            if worker_chunks:
+                greenlets.append(gevent.spawn(self._parse_chunks, index,
+                                              worker_chunks, results))
+        try:
+            for _ in xrange(len(chunks)):
+                chunk, chunk_results = results.get()
+                for node, parsed in zip(chunk, chunk_results):
+                    if parsed is not None:
+                        yield node, parsed
+        finally:
+            # If the caller gave up early, make sure that the workers have
+            # finished with the chunks before they are used again.
+            gevent.joinall(greenlets)
+
+    def parse_node(self, node):
+        """
+        Parses a single node, as for an update.  Since the EtcdWatcher
+        waits for each update in turn, only one update is ever outstanding.
+
+        :returns: The result of fetcd.parse_node() for the node.
+        """
+        for _, parsed in self.parse_nodes([node]):
+            return parsed
+        return None
+
+    def _parse_chunks(self, index, chunks, results):
+        """
+        Has the given worker parse the chunks, putting the results for
+        each chunk on the queue.  Never raises: if the worker fails, we
+        parse the remaining chunks inline.
+        """
+        num_done = 0
+        writer = None
+        try:
+            worker = self._get_worker(index)
+            writer = gevent.spawn(worker.send_chunks, chunks)
+            for chunk in chunks:
+                results.put((chunk, worker.read_results()))
+                num_done += 1
+        except Exception:
+            _log.exception("Parse worker %s failed, parsing %s chunks "
+                           "inline", index, len(chunks) - num_done)
+            stats.increment("parse_pool.worker_failures")
+            if writer is not None:
+                writer.kill()
+            self._kill_worker(index)
+            for chunk in chunks[num_done:]:
+                results.put((chunk, parse_chunk(self.config, _items(chunk))))
+
+    def _get_worker(self, index):
+        worker = self._workers[index]
+        if worker is None:
+            worker = _ParseWorker(self._worker_cmd)
+            self._workers[index] = worker
+        return worker
+
+    def _kill_worker(self, index):
+        worker = self._workers[index]
+        self._workers[index] = None
+        if worker is not None:
+            worker.kill()
+
+
+class _ParseWorker(object):
+    """
+    A worker process, as seen from the main process.
+    """
+    def __init__(self, cmd):
+        _log.info("Starting parse worker: %s", cmd)
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, bufsize=-1,
+                                     close_fds=True)
+
+    def send_chunks(self, chunks):
+        """
+        Writes the chunks to the worker.  Run in its own greenlet so that
+        the worker can't block on writing its results while we block on
+        writing more chunks.
+        """
+        try:
+            for chunk in chunks:
+                self.proc.stdin.write(encode_frame(MSG_PARSE,
+                                                   _items(chunk)))
+            self.proc.stdin.flush()
+        except (IOError, OSError) as e:
+            # We'll see EOF when we read the results.
+            _log.error("Failed to write to parse worker (pid %s): %r",
+                       self.proc.pid, e)
+
+    def read_results(self):
+        """
+        :returns list: the results for the next chunk, as returned by
+            parse_chunk().
+        :raises ParseWorkerFailed: if the worker has gone away.
+        """
+        msg = read_frame(self.proc.stdout)
+        if msg is None or msg[0] != MSG_PARSED:
+            raise ParseWorkerFailed("Parse worker (pid %s) returned %r" %
+                                    (self.proc.pid, msg))
+        _, results, log_records = msg
+        for level, message in log_records:
+            _log.log(level, "Parse worker: %s", message)
+        return [_convert_endpoint_id(parsed, lambda t: EndpointId(*t))
+                for parsed in results]
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except OSError:
+            pass  # Already gone.
+
+
+def parse_chunk(config, items):
+    """
+    :param items: list of (key, value) pairs.
+    :returns list: the result of fetcd.parse_node() for each item.
+    """
+    return [parse_node(config, _Node(key, None, value))
+            for key, value in items]
+
+
+def _items(chunk):
+    return [(node.key, node.value) for node in chunk]
+
+
+def _convert_endpoint_id(parsed, convert):
+    """
+    Applies convert to the endpoint ID in a parse_node() result; used to
+    convert it to and from a tuple, since marshal can't handle EndpointIds.
+    """
+    if parsed is None or parsed[0] != NODE_ENDPOINT:
+        return parsed
+    node_type, endpoint_id, endpoint = parsed
+    return node_type, convert(endpoint_id), endpoint
+
+
+class _RecordingHandler(logging.Handler):
+    """
+    Records the messages that are logged in a worker so that we can pass
+    them back to the main process.
+    """
+    def __init__(self):
+        super(_RecordingHandler, self).__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+    def pop_records(self):
+        records = self.records
+        self.records = []
+        return records
+
+
+def worker_main(config, input_file, output_file):
+    """
+    The body of a worker process: parses chunks from the input until it
+    is closed.
+    """
+    handler = _RecordingHandler()
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.WARNING)
+    root_logger.addHandler(handler)
+    while True:
+        msg = read_frame(input_file)
+        if msg is None:
+            return
+        results = [_convert_endpoint_id(parsed, tuple)
+                   for parsed in parse_chunk(config, msg[1])]
+        output_file.write(encode_frame(MSG_PARSED, results,
+                                       handler.pop_records()))
+        output_file.flush()
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--iface-prefix", dest="iface_prefix")
+    options, _ = parser.parse_args(argv)
+    worker_main(_WorkerConfig(options.iface_prefix), sys.stdin, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -125,6 +125,7 @@ class ReferenceManager(Actor):
                 self.stopping_objects_by_id[object_id].add(obj)
             self.objects_by_id.pop(object_id)
             self.pending_ref_callbacks.pop(object_id, None)
+            self._on_object_unreferenced(object_id, obj)
 
     @actor_message()
     def on_object_cleanup_complete(self, object_id, obj):
@@ -185,6 +186,14 @@ class ReferenceManager(Actor):
         """
         raise NotImplementedError()  # pragma nocover
 
+    def _on_object_unreferenced(self, obj_id, obj):
+        """
+        May be overriden by subclasses, called when the last reference to
+        an object is returned.  The object is no longer starting or live
+        but may still be cleaning up.
+        """
+        pass
+
     def _create(self, object_id):
         """
         To be overriden by subclasses.
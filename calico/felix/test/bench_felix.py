@@ -0,0 +1,697 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.bench_felix
+~~~~~~~~~~~~~~~~~~~~~~
+
+Scale benchmark for Felix.  Not a test case because it takes a while to run.
+
+Generates a synthetic etcd snapshot (N endpoints spread over a number of
+hosts, M profiles and K tags), loads it into a FakeEtcd and runs it through
+the real EtcdWatcher -> UpdateSplitter -> managers pipeline against a
+FakeDataplane.  Reports the time taken until the dataplane is fully
+programmed for this host's endpoints, peak memory, the number of commands
+that Felix ran and the bytes of input that it fed them.
+
+Run with, for example::
+
+    python -m calico.felix.test.bench_felix --endpoints 10000 --hosts 10
+
+The simulated command costs default to estimates.  Run with --calibrate as
+root on a real host to measure them and then pass the result to later runs
+with --costs.
+"""
+import json
+import logging
+import optparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import gevent
+import mock
+import netaddr
+
+from calico import stats
+from calico.datamodel_v1 import (READY_KEY, CONFIG_DIR, ENDPOINT_KEY_RE,
+                                 RULES_KEY_RE, TAGS_KEY_RE, key_for_config,
+                                 key_for_endpoint, key_for_profile_rules,
+                                 key_for_profile_tags, EndpointId)
+from calico.felix.config import Config
+from calico.felix.dispatch import DispatchChains
+from calico.felix.endpoint import EndpointManager
+from calico.felix.fetcd import EtcdWatcher
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.fnftables import NftablesUpdater, NftSetDriver
+from calico.felix.frules import (install_global_rules, interface_to_suffix,
+                                 chain_names, profile_to_chain_name)
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.ipsets import (IpsetManager, IpsetCommandDriver,
+                                 tag_to_ipset_name)
+from calico.felix.profilerules import RulesManager
+from calico.felix.splitter import UpdateSplitter
+from calico.felix import trace
+from calico.felix.test.fake_dataplane import (FakeDataplane, calibrate,
+                                              load_costs)
+from calico.felix.test.fake_etcd import FakeEtcd
+
+_log = logging.getLogger(__name__)
+
+HOSTNAME = "bench-host"
+IFACE_PREFIX = "tap"
+
+
+class EtcdModel(object):
+    """
+    Model of the Calico data in etcd, from which we work out what Felix on
+    the given host should program.
+    """
+    def __init__(self, hostname=HOSTNAME):
+        self.hostname = hostname
+        self.config = {}
+        self.rules_by_id = {}
+        self.tags_by_id = {}
+        self.endpoints = {}
+
+    @classmethod
+    def from_items(cls, items, hostname=HOSTNAME):
+        """
+        :param items: iterable of etcd (key, value) pairs.
+        """
+        model = cls(hostname=hostname)
+        for key, value in items:
+            model.apply_set(key, value)
+        return model
+
+    def apply_set(self, key, value):
+        """
+        Updates the model for a write of value to key.
+        """
+        m = ENDPOINT_KEY_RE.match(key)
+        if m:
+            endpoint_id = EndpointId(m.group("hostname"),
+                                     m.group("orchestrator"),
+                                     m.group("workload_id"),
+                                     m.group("endpoint_id"))
+            self.endpoints[endpoint_id] = json.loads(value)
+            return
+        m = RULES_KEY_RE.match(key)
+        if m:
+            self.rules_by_id[m.group("profile_id")] = json.loads(value)
+            return
+        m = TAGS_KEY_RE.match(key)
+        if m:
+            self.tags_by_id[m.group("profile_id")] = json.loads(value)
+            return
+        if key.startswith(CONFIG_DIR + "/"):
+            self.config[key[len(CONFIG_DIR) + 1:]] = value
+
+    def apply_delete(self, key):
+        """
+        Updates the model for a (possibly recursive) delete of key.
+
+        :returns dict: the endpoints that were removed, by ID.
+        """
+        prefix = key.rstrip("/") + "/"
+
+        def doomed(k):
+            return k == key or k.startswith(prefix)
+        removed = {}
+        for endpoint_id in self.endpoints.keys():
+            if doomed(key_for_endpoint(*endpoint_id)):
+                removed[endpoint_id] = self.endpoints.pop(endpoint_id)
+        for profile_id in set(self.rules_by_id) | set(self.tags_by_id):
+            if doomed(key_for_profile_rules(profile_id)):
+                self.rules_by_id.pop(profile_id, None)
+            if doomed(key_for_profile_tags(profile_id)):
+                self.tags_by_id.pop(profile_id, None)
+        for name in self.config.keys():
+            if doomed(key_for_config(name)):
+                del self.config[name]
+        return removed
+
+    def etcd_items(self):
+        """
+        :returns iterable[(str,str)]: the etcd keys and values.
+        """
+        for name, value in sorted(self.config.iteritems()):
+            yield key_for_config(name), value
+        yield READY_KEY, "true"
+        for profile_id in sorted(self.rules_by_id):
+            yield (key_for_profile_rules(profile_id),
+                   json.dumps(self.rules_by_id[profile_id]))
+        for profile_id in sorted(self.tags_by_id):
+            yield (key_for_profile_tags(profile_id),
+                   json.dumps(self.tags_by_id[profile_id]))
+        for endpoint_id in sorted(self.endpoints):
+            yield (key_for_endpoint(*endpoint_id),
+                   json.dumps(self.endpoints[endpoint_id]))
+
+    def populate(self, etcd):
+        for key, value in self.etcd_items():
+            etcd.set(key, value)
+
+    def is_local(self, endpoint_id):
+        return endpoint_id.host == self.hostname
+
+    def local_endpoints(self):
+        return dict((k, v) for k, v in self.endpoints.iteritems()
+                    if self.is_local(k))
+
+    def ip_versions(self):
+        """
+        :returns list[int]: the IP versions in use by local endpoints.
+        """
+        versions = set()
+        for endpoint in self.local_endpoints().itervalues():
+            for version in (4, 6):
+                if endpoint.get("ipv%s_nets" % version):
+                    versions.add(version)
+        return sorted(versions)
+
+    def active_tags(self):
+        """
+        :returns set[str]: the tags referenced by the rules of profiles in
+            use on this host; Felix programs an ipset for each.
+        """
+        tags = set()
+        for endpoint in self.local_endpoints().itervalues():
+            for profile_id in endpoint["profile_ids"]:
+                rules = self.rules_by_id.get(profile_id) or {}
+                for direction in rules.itervalues():
+                    for rule in direction:
+                        for tag_type in ("src_tag", "dst_tag"):
+                            if tag_type in rule:
+                                tags.add(rule[tag_type])
+        return tags
+
+    def endpoint_tags(self, endpoint):
+        tags = set()
+        for profile_id in endpoint["profile_ids"]:
+            tags.update(self.tags_by_id.get(profile_id) or [])
+        return tags
+
+    def expected_ipsets(self, ip_version):
+        """
+        :returns dict[str,set[str]]: the members of each ipset that should
+            be programmed for the local endpoints.
+        """
+        members = dict((t, set()) for t in self.active_tags())
+        for endpoint in self.endpoints.itervalues():
+            ips = endpoint_ips(endpoint, ip_version)
+            for tag in self.endpoint_tags(endpoint):
+                if tag in members:
+                    members[tag].update(ips)
+        ip_type = IPV4 if ip_version == 4 else IPV6
+        return dict((tag_to_ipset_name(ip_type, t), m)
+                    for t, m in members.iteritems())
+
+
+def endpoint_ips(endpoint, ip_version):
+    return [n.split("/")[0] for n in
+            endpoint.get("ipv%s_nets" % ip_version, [])]
+
+
+class SyntheticDeployment(EtcdModel):
+    """
+    A randomly generated but reproducible set of endpoints, profiles and
+    tags, laid out in etcd according to calico.datamodel_v1.
+    """
+    def __init__(self, num_endpoints, num_profiles, num_tags, num_hosts=1,
+                 profiles_per_endpoint=1, tags_per_profile=1,
+                 rules_per_profile=4, ipv6=False, seed=0):
+        super(SyntheticDeployment, self).__init__()
+        self.random = random.Random(seed)
+        self.hosts = [self.hostname] + ["host-%d" % i for i in
+                                        xrange(1, num_hosts)]
+        self.ipv6 = ipv6
+        self.tags = ["tag-%d" % i for i in xrange(num_tags)]
+        self.profiles_per_endpoint = profiles_per_endpoint
+        self.rules_per_profile = rules_per_profile
+        self.config = {
+            "InterfacePrefix": IFACE_PREFIX,
+            "MetadataAddr": "None",
+        }
+        for i in xrange(num_profiles):
+            profile_id = "prof-%d" % i
+            self.tags_by_id[profile_id] = self._sample(self.tags,
+                                                       tags_per_profile)
+            self.rules_by_id[profile_id] = self.make_rules()
+        self.num_endpoints_created = 0
+        for _ in xrange(num_endpoints):
+            endpoint_id, endpoint = self.new_endpoint()
+            self.endpoints[endpoint_id] = endpoint
+
+    def _sample(self, population, count):
+        return self.random.sample(population, min(count, len(population)))
+
+    def make_rules(self):
+        """
+        :returns dict: a new, random set of rules for a profile.
+        """
+        inbound = []
+        for _ in xrange(self.rules_per_profile):
+            rule = {"protocol": "tcp",
+                    "dst_ports": [self.random.randint(1, 65535)]}
+            if self.tags:
+                rule["src_tag"] = self.random.choice(self.tags)
+            inbound.append(rule)
+        return {"inbound_rules": inbound,
+                "outbound_rules": [{"action": "allow"}]}
+
+    def new_endpoint(self, host=None):
+        """
+        Generates a new endpoint, with unique ID, interface and IPs.  Does
+        not add it to the model.
+
+        :param host: The host to put the endpoint on; by default, endpoints
+            are spread evenly over the hosts.
+        :returns tuple[EndpointId,dict]: the new endpoint.
+        """
+        i = self.num_endpoints_created
+        self.num_endpoints_created += 1
+        if host is None:
+            host = self.hosts[i % len(self.hosts)]
+        endpoint_id = EndpointId(host, "openstack", "wl%08x" % i,
+                                 "ep%08x" % i)
+        endpoint = {
+            "state": "active",
+            "name": "%s%08x" % (IFACE_PREFIX, i),
+            "mac": "02:00:%02x:%02x:%02x:%02x" % (i >> 24 & 255,
+                                                  i >> 16 & 255,
+                                                  i >> 8 & 255,
+                                                  i & 255),
+            "profile_ids": self._sample(sorted(self.rules_by_id),
+                                        self.profiles_per_endpoint),
+            "ipv4_nets": ["10.%d.%d.%d/32" % (i >> 16 & 255, i >> 8 & 255,
+                                              i & 255)],
+        }
+        if self.ipv6:
+            ip = netaddr.IPAddress(netaddr.IPAddress("fd00::").value + i + 1)
+            endpoint["ipv6_nets"] = ["%s/128" % ip]
+        return endpoint_id, endpoint
+
+
+class FelixHarness(object):
+    """
+    Runs the Felix actors against a FakeEtcd and a FakeDataplane.
+
+    The actors are wired together as in felix._main_greenlet() except that
+    there is no InterfaceWatcher, since that needs a netlink socket; the
+    interfaces are expected to exist before the snapshot is loaded.
+    """
+    def __init__(self, etcd, dataplane, backend="iptables",
+                 dispatch_mode="tree", hostname=HOSTNAME,
+                 trace_sample_rate=0):
+        self.etcd = etcd
+        self.hostname = hostname
+        self.dataplane = dataplane
+        self.backend = backend
+        self.dispatch_mode = dispatch_mode
+        self.trace_sample_rate = trace_sample_rate
+        self.config = None
+        self.etcd_watcher = None
+        self.splitter = None
+        self.actors = []
+        self._patches = []
+        self._watch_result = None
+
+    def start(self):
+        self._patches = [self.dataplane.patched(),
+                         mock.patch("calico.felix.fetcd.etcd.Client",
+                                    self.etcd.client)]
+        for p in self._patches:
+            p.__enter__()
+
+        self.config = self._load_config()
+        stats.reset()
+        trace.configure(self.config.TRACE_SAMPLE_RATE)
+        if self.backend == "nftables":
+            updater_cls, driver_cls = NftablesUpdater, NftSetDriver
+        else:
+            updater_cls, driver_cls = IptablesUpdater, IpsetCommandDriver
+
+        v4_filter_updater = updater_cls("filter", ip_version=4)
+        v4_nat_updater = updater_cls("nat", ip_version=4)
+        v6_filter_updater = updater_cls("filter", ip_version=6)
+        actors = [v4_filter_updater, v4_nat_updater, v6_filter_updater]
+        ipset_mgrs = []
+        rules_mgrs = []
+        ep_mgrs = []
+        for ip_type, version, filter_updater in ((IPV4, 4, v4_filter_updater),
+                                                 (IPV6, 6, v6_filter_updater)):
+            ipset_mgr = IpsetManager(ip_type, driver=driver_cls(ip_type))
+            rules_mgr = RulesManager(version, filter_updater, ipset_mgr)
+            dispatch = DispatchChains(self.config, version, filter_updater)
+            ep_mgr = EndpointManager(self.config, ip_type, filter_updater,
+                                     dispatch, rules_mgr)
+            ipset_mgrs.append(ipset_mgr)
+            rules_mgrs.append(rules_mgr)
+            ep_mgrs.append(ep_mgr)
+            actors += [ipset_mgr, rules_mgr, dispatch, ep_mgr]
+        self.splitter = UpdateSplitter(self.config, ipset_mgrs, rules_mgrs,
+                                       ep_mgrs,
+                                       [v4_filter_updater, v6_filter_updater])
+        actors.append(self.splitter)
+        for actor in actors:
+            actor.start()
+        self.actors = [self.etcd_watcher] + actors
+        install_global_rules(self.config, v4_filter_updater,
+                             v6_filter_updater, v4_nat_updater)
+
+    def _load_config(self):
+        fd, path = tempfile.mkstemp(suffix=".cfg")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("[global]\n"
+                        "FelixHostname = %s\n"
+                        "LogFilePath = none\n"
+                        "LogSeverityScreen = none\n"
+                        "LogSeveritySys = none\n"
+                        "DataplaneBackend = %s\n"
+                        "DispatchMode = %s\n"
+                        "TraceSampleRate = %d\n" %
+                        (self.hostname, self.backend, self.dispatch_mode,
+                         self.trace_sample_rate))
+            config = Config(path)
+        finally:
+            os.unlink(path)
+        self.etcd_watcher = EtcdWatcher(config)
+        self.etcd_watcher.start()
+        self.etcd_watcher.load_config(async=False)
+        return config
+
+    def watch_etcd(self):
+        """
+        Starts the EtcdWatcher loading the snapshot and then polling.
+        """
+        self._watch_result = self.etcd_watcher.watch_etcd(self.splitter,
+                                                          async=True)
+
+    def all_actors(self):
+        """
+        :returns list[Actor]: the top-level actors and the actors that they
+            manage.
+        """
+        actors = list(self.actors)
+        for actor in self.actors:
+            actors.extend(getattr(actor, "objects_by_id", {}).itervalues())
+        return actors
+
+    def wait_for_idle(self, timeout=10):
+        """
+        Waits until no actor (other than the EtcdWatcher, which never
+        finishes its poll) has work queued or in progress.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            busy = [a for a in self.all_actors() if
+                    a is not self.etcd_watcher and
+                    (not a._event_queue.empty() or a._current_msg)]
+            if not busy:
+                return True
+            gevent.sleep(0.01)
+        return False
+
+    def stop(self):
+        """
+        Kills the actors and removes the patches.  Waits for the actors to
+        go idle first; killing an actor mid-message fails the message and
+        the actor framework treats a dropped failure as fatal.
+        """
+        self.wait_for_idle()
+        if self._watch_result is not None:
+            # The actor catches the GreenletExit that interrupts its poll
+            # and reports it via the result; collect it so that it doesn't
+            # count as leaked.
+            self.etcd_watcher.greenlet.kill(block=False)
+            try:
+                self._watch_result.get(timeout=10)
+            except gevent.GreenletExit:
+                pass
+            self._watch_result = None
+        gevent.killall([a.greenlet for a in self.all_actors()])
+        trace.configure(0)
+        for p in reversed(self._patches):
+            p.__exit__(None, None, None)
+        self._patches = []
+
+    def view(self):
+        return DataplaneView(self)
+
+    def missing_programming(self, model):
+        """
+        :returns list[str]: descriptions of the programming that is still
+            missing for the model's local endpoints.  Empty once the
+            dataplane is fully programmed.
+        """
+        view = self.view()
+        missing = []
+        for version in model.ip_versions():
+            for endpoint in model.local_endpoints().itervalues():
+                missing += view.endpoint_missing(version, endpoint)
+            for name, members in model.expected_ipsets(version).items():
+                programmed = view.set_members(version, name)
+                if programmed is None:
+                    missing.append("set %s" % name)
+                elif set(programmed) != members:
+                    missing.append("members of set %s" % name)
+        return missing
+
+
+class DataplaneView(object):
+    """
+    Read-only view of the filter tables and sets that a FelixHarness has
+    programmed, with the expensive indexes computed once per view.
+    """
+    def __init__(self, harness):
+        self.config = harness.config
+        self.backend = harness.backend
+        self.dataplane = harness.dataplane
+        self._chains = {}
+
+    def _nft_table(self, version):
+        family = "ip" if version == 4 else "ip6"
+        return self.dataplane.nft.tables.get("%s felix-filter" % family)
+
+    def chains(self, version):
+        """
+        :returns tuple[dict,set]: the rules of each chain in the filter
+            table, as strings, and the set of chains that are referenced by
+            a rule.
+        """
+        if version not in self._chains:
+            if self.backend == "nftables":
+                table = self._nft_table(version)
+                if table is None:
+                    self._chains[version] = {}, set()
+                else:
+                    self._chains[version] = (
+                        table["chains"],
+                        self.dataplane.nft._references(table))
+            else:
+                chains = self.dataplane.chains(version, "filter")
+                self._chains[version] = (
+                    dict((c, [" ".join(r) for r in rules])
+                         for c, rules in chains.iteritems()),
+                    set(self.dataplane.chain_refcounts(version, "filter")))
+        return self._chains[version]
+
+    def set_members(self, version, name):
+        """
+        :returns: the members of the named set or None if it doesn't exist.
+        """
+        if self.backend == "nftables":
+            table = self._nft_table(version)
+            return table and table["sets"].get(name)
+        ipset = self.dataplane.ipsets.get(name)
+        return ipset and ipset["members"]
+
+    def endpoint_missing(self, version, endpoint):
+        """
+        :returns list[str]: the programming that is missing for a local
+            endpoint: its chains, the dispatch rules that reference them,
+            the jumps to its profiles and its routes.
+        """
+        missing = []
+        chains, referenced = self.chains(version)
+        iface = endpoint["name"]
+        to_chain, from_chain = chain_names(interface_to_suffix(self.config,
+                                                               iface))
+        for chain in (to_chain, from_chain):
+            if chain not in chains:
+                missing.append("chain %s" % chain)
+            elif chain not in referenced:
+                missing.append("dispatch to %s" % chain)
+        if to_chain in chains:
+            rules = " ".join(chains[to_chain])
+            for profile_id in endpoint["profile_ids"]:
+                profile_chain = profile_to_chain_name("inbound", profile_id)
+                if profile_chain not in rules:
+                    missing.append("jump to %s" % profile_chain)
+        routes = self.dataplane.routes[version].get(iface, ())
+        for ip in endpoint_ips(endpoint, version):
+            if ip not in routes:
+                missing.append("route %s" % ip)
+        return missing
+
+    def endpoint_removed(self, version, endpoint):
+        """
+        :returns bool: True if the programming for a deleted local endpoint
+            has been removed.
+        """
+        chains, _ = self.chains(version)
+        iface = endpoint["name"]
+        if any(c in chains for c in
+               chain_names(interface_to_suffix(self.config, iface))):
+            return False
+        routes = self.dataplane.routes[version].get(iface, ())
+        return not any(ip in routes for ip in endpoint_ips(endpoint, version))
+
+
+def run_benchmark(deployment, dataplane=None, backend="iptables",
+                  dispatch_mode="tree", timeout=600, poll_interval=0.05,
+                  trace_sample_rate=0):
+    """
+    Loads the deployment into etcd and times Felix programming it.
+
+    :returns dict: the results.
+    :raises AssertionError: if programming doesn't finish within timeout.
+    """
+    dataplane = dataplane or FakeDataplane()
+    for endpoint in deployment.local_endpoints().itervalues():
+        dataplane.add_interface(endpoint["name"])
+    etcd = FakeEtcd()
+    deployment.populate(etcd)
+    harness = FelixHarness(etcd, dataplane, backend=backend,
+                           dispatch_mode=dispatch_mode,
+                           hostname=deployment.hostname,
+                           trace_sample_rate=trace_sample_rate)
+    rss_before = _peak_rss_kb()
+    harness.start()
+    try:
+        start = time.time()
+        harness.watch_etcd()
+        deadline = start + timeout
+        missing = harness.missing_programming(deployment)
+        while missing:
+            if time.time() > deadline:
+                raise AssertionError("Not programmed after %ss; still "
+                                     "missing %s items, e.g. %s" %
+                                     (timeout, len(missing), missing[:5]))
+            gevent.sleep(poll_interval)
+            missing = harness.missing_programming(deployment)
+        elapsed = time.time() - start
+    finally:
+        harness.stop()
+    results = {
+        "endpoints": len(deployment.endpoints),
+        "local_endpoints": len(deployment.local_endpoints()),
+        "profiles": len(deployment.rules_by_id),
+        "tags": len(set(t for tags in deployment.tags_by_id.itervalues()
+                        for t in tags)),
+        "seconds_to_programmed": elapsed,
+        "peak_rss_kb": _peak_rss_kb(),
+        "peak_rss_kb_before_start": rss_before,
+    }
+    results.update(dataplane.stats())
+    if trace_sample_rate:
+        results["trace"] = stats.snapshot()
+    return results
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def add_deployment_options(parser):
+    """
+    Adds the options that describe a SyntheticDeployment to parser.
+    """
+    parser.add_option("--endpoints", type="int", default=1000,
+                      help="total number of endpoints across all hosts")
+    parser.add_option("--hosts", type="int", default=1,
+                      help="number of hosts to spread the endpoints over")
+    parser.add_option("--profiles", type="int", default=100)
+    parser.add_option("--tags", type="int", default=100)
+    parser.add_option("--profiles-per-endpoint", type="int", default=1)
+    parser.add_option("--tags-per-profile", type="int", default=1)
+    parser.add_option("--rules-per-profile", type="int", default=4)
+    parser.add_option("--ipv6", action="store_true", default=False)
+    parser.add_option("--seed", type="int", default=0)
+
+
+def deployment_from_options(options):
+    return SyntheticDeployment(
+        options.endpoints, options.profiles, options.tags,
+        num_hosts=options.hosts,
+        profiles_per_endpoint=options.profiles_per_endpoint,
+        tags_per_profile=options.tags_per_profile,
+        rules_per_profile=options.rules_per_profile,
+        ipv6=options.ipv6,
+        seed=options.seed)
+
+
+def add_dataplane_options(parser):
+    """
+    Adds the options that control Felix and the simulated dataplane.
+    """
+    parser.add_option("--backend", default="iptables",
+                      help="iptables or nftables")
+    parser.add_option("--dispatch-mode", default="tree",
+                      help="tree or vmap")
+    parser.add_option("--costs", help="JSON file of simulated command costs")
+    parser.add_option("--no-sleep", action="store_true", default=False,
+                      help="account for command costs without sleeping")
+    parser.add_option("--trace-sample-rate", type="int", default=0,
+                      help="trace the latency of one in this many etcd "
+                           "updates")
+
+
+def dataplane_from_options(options):
+    costs = load_costs(options.costs) if options.costs else None
+    return FakeDataplane(costs=costs, realtime=not options.no_sleep)
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    add_deployment_options(parser)
+    add_dataplane_options(parser)
+    parser.add_option("--calibrate", metavar="FILE",
+                      help="measure command costs on this host (needs root) "
+                           "and write them to FILE")
+    options, _ = parser.parse_args(argv)
+
+    if options.calibrate:
+        costs = calibrate()
+        with open(options.calibrate, "w") as f:
+            json.dump(costs, f, indent=2, sort_keys=True)
+        print json.dumps(costs, indent=2, sort_keys=True)
+        return 0
+
+    results = run_benchmark(deployment_from_options(options),
+                            dataplane_from_options(options),
+                            backend=options.backend,
+                            dispatch_mode=options.dispatch_mode,
+                            trace_sample_rate=options.trace_sample_rate)
+    print json.dumps(results, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
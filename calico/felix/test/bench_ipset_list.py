@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.bench_ipset_list
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Benchmark for listing ipset names, as done by IpsetManager.cleanup().
+
+Compares three ways of getting the names of the ipsets:
+
+- legacy: reading all of the "ipset list" output into memory and
+  splitting it into lines, as list_ipset_names() used to;
+- full-stream: stream-parsing the "ipset list" output, as
+  list_ipset_names() does on versions of ipset without "-name";
+- name: stream-parsing "ipset list -name".
+
+By default, "ipset" is a stub script that prints the output that the real
+ipset would give for a synthetic set of ipsets, so the benchmark needs
+neither root nor the ipset tool.  Run with, for example::
+
+    python -m calico.felix.test.bench_ipset_list --sets 100 \\
+        --members 100000
+
+Use --real-ipset to list whatever ipsets are programmed on this host with
+the installed ipset instead.
+
+Each variant runs in a forked child; the benchmark reports the peak growth
+in resident memory and the time taken.
+"""
+import json
+import logging
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from calico.felix import futils, ipsets
+
+_log = logging.getLogger(__name__)
+
+VARIANTS = ("legacy", "full-stream", "name")
+
+_STUB_SCRIPT = """#!/bin/sh
+if [ "$2" = "-name" ]; then
+    exec cat %(dir)s/names
+fi
+exec cat %(dir)s/full
+"""
+
+
+def legacy_list_ipset_names():
+    """
+    list_ipset_names() as it was before it streamed its input.
+    """
+    data = futils.check_call(["ipset", "list"]).stdout
+    lines = data.split("\n")
+    names = []
+    for line in lines:
+        words = line.split()
+        if len(words) > 1 and words[0] == "Name:":
+            names.append(words[1])
+    return names
+
+
+def write_stub_ipset(directory, num_sets, num_members):
+    """
+    Writes an "ipset" stub script to the directory, which lists num_sets
+    ipsets with num_members members between them.
+    """
+    names = ["felix-v4-tag%d" % i for i in xrange(num_sets)]
+    with open(os.path.join(directory, "names"), "w") as f:
+        for name in names:
+            f.write(name + "\n")
+    with open(os.path.join(directory, "full"), "w") as f:
+        for i, name in enumerate(names):
+            members = xrange(i, num_members, num_sets)
+            f.write("Name: %s\n"
+                    "Type: hash:ip\n"
+                    "Revision: 2\n"
+                    "Header: family inet hashsize 1024 maxelem 1048576\n"
+                    "Size in memory: %d\n"
+                    "References: 1\n"
+                    "Members:\n" % (name, 16 * len(members) + 64))
+            for m in members:
+                f.write("10.%d.%d.%d\n" % (m >> 16, (m >> 8) & 0xff,
+                                           m & 0xff))
+            f.write("\n")
+    script = os.path.join(directory, "ipset")
+    with open(script, "w") as f:
+        f.write(_STUB_SCRIPT % {"dir": directory})
+    os.chmod(script, 0755)
+
+
+def _status_kb(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+
+def measure(variant):
+    """
+    Lists the ipset names using the given variant, in the current process.
+
+    :returns dict: the results.
+    """
+    rss_before = _status_kb("VmRSS")
+    start = time.time()
+    if variant == "legacy":
+        names = legacy_list_ipset_names()
+    else:
+        ipsets._list_name_supported = (variant == "name")
+        names = ipsets.list_ipset_names()
+    return {
+        "time": time.time() - start,
+        "peak_rss_kb": _status_kb("VmHWM") - rss_before,
+        "num_names": len(names),
+    }
+
+
+def measure_in_child(variant):
+    """
+    Runs measure() in a forked child so that the kernel's peak RSS figure
+    covers only the variant under test.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            os.write(write_fd, json.dumps(measure(variant)))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        output = pipe.read()
+    os.waitpid(pid, 0)
+    return json.loads(output)
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--sets", type="int", default=100,
+                      help="number of ipsets to list (default: %default)")
+    parser.add_option("--members", type="int", default=100000,
+                      help="total number of members across all the ipsets "
+                           "(default: %default)")
+    parser.add_option("--real-ipset", action="store_true",
+                      help="list the host's ipsets with the real ipset "
+                           "rather than a stub")
+    options, _ = parser.parse_args(argv)
+    results = {}
+    stub_dir = None
+    if not options.real_ipset:
+        stub_dir = tempfile.mkdtemp(prefix="bench-ipset-")
+        write_stub_ipset(stub_dir, options.sets, options.members)
+        os.environ["PATH"] = stub_dir + os.pathsep + os.environ["PATH"]
+        results.update({"sets": options.sets, "members": options.members})
+    try:
+        for variant in VARIANTS:
+            results[variant] = measure_in_child(variant)
+    finally:
+        if stub_dir:
+            shutil.rmtree(stub_dir)
+    if results["name"]["peak_rss_kb"] > 0:
+        results["rss_ratio"] = (float(results["legacy"]["peak_rss_kb"]) /
+                                results["name"]["peak_rss_kb"])
+    print json.dumps(results, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.bench_ipsets
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Memory benchmark for the IpsetManager's tag membership index.
+
+Loads the tags and endpoints of a SyntheticDeployment into the
+IpsetManager's index and, for comparison, into a copy of the nested-dict
+index that it used to keep (LegacyIpsetIndex), which indexed every tag
+whether or not it was referenced locally.  Each index is built in a
+forked child so that the measurements are independent; the benchmark
+reports the growth in resident memory and the time taken to build the
+index, followed by the time to churn every endpoint's IPs.
+
+Run with, for example::
+
+    python -m calico.felix.test.bench_ipsets --endpoints 200000 \\
+        --profiles 1000 --tags 1000 --referenced-tags 50
+
+The synthetic endpoint dicts are generated before the fork and are shared
+with the parent, so they are not counted against either index.  Note that
+the legacy index holds on to the endpoint dicts that it is given, so the
+figure for it is, if anything, an underestimate.
+"""
+import gc
+import json
+import logging
+import optparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+from calico.felix import futils
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.ipsets import IpsetManager
+from calico.felix.test.bench_felix import (add_deployment_options,
+                                           deployment_from_options)
+
+_log = logging.getLogger(__name__)
+
+
+class LegacyIpsetIndex(object):
+    """
+    The index maintenance of the IpsetManager as it was before the index
+    was made compact, for comparison.
+    """
+    def __init__(self, ip_type):
+        self.nets_key = "ipv4_nets" if ip_type == IPV4 else "ipv6_nets"
+        self.tags_by_prof_id = {}
+        self.endpoints_by_ep_id = {}
+        # ip_owners_by_tag[tag][ip][profile_id] = set([endpoint_id, ...])
+        self.ip_owners_by_tag = defaultdict(
+            lambda: defaultdict(lambda: defaultdict(set)))
+        self.endpoint_ids_by_profile_id = defaultdict(set)
+
+    def on_tags_update(self, profile_id, tags):
+        old_tags = set(self.tags_by_prof_id.get(profile_id, []))
+        new_tags = set(tags or [])
+        endpoint_ids = self.endpoint_ids_by_profile_id.get(profile_id, set())
+        for endpoint_id in endpoint_ids:
+            ips = self._extract_ips(self.endpoints_by_ep_id[endpoint_id])
+            for tag in old_tags - new_tags:
+                for ip in ips:
+                    self._remove_mapping(tag, profile_id, endpoint_id, ip)
+            for tag in new_tags - old_tags:
+                for ip in ips:
+                    self._add_mapping(tag, profile_id, endpoint_id, ip)
+        if tags is None:
+            self.tags_by_prof_id.pop(profile_id, None)
+        else:
+            self.tags_by_prof_id[profile_id] = tags
+
+    def _extract_ips(self, endpoint):
+        if endpoint is None:
+            return set()
+        return set(map(futils.net_to_ip, endpoint.get(self.nets_key, [])))
+
+    def on_endpoint_update(self, endpoint_id, endpoint):
+        old_endpoint = self.endpoints_by_ep_id.pop(endpoint_id, {})
+        old_prof_ids = set(old_endpoint.get("profile_ids", []))
+        if endpoint is None:
+            new_prof_ids = set()
+        else:
+            new_prof_ids = set(endpoint.get("profile_ids", []))
+            self.endpoints_by_ep_id[endpoint_id] = endpoint
+        old_tags = set((p, t) for p in old_prof_ids
+                       for t in self.tags_by_prof_id.get(p, []))
+        new_tags = set((p, t) for p in new_prof_ids
+                       for t in self.tags_by_prof_id.get(p, []))
+        if new_prof_ids != old_prof_ids:
+            for prof_id in old_prof_ids:
+                endpoints = self.endpoint_ids_by_profile_id[prof_id]
+                endpoints.discard(endpoint_id)
+                if not endpoints:
+                    del self.endpoint_ids_by_profile_id[prof_id]
+            for prof_id in new_prof_ids:
+                self.endpoint_ids_by_profile_id[prof_id].add(endpoint_id)
+        old_ips = self._extract_ips(old_endpoint)
+        new_ips = self._extract_ips(endpoint)
+        for profile_id, tag in new_tags - old_tags:
+            for ip in new_ips:
+                self._add_mapping(tag, profile_id, endpoint_id, ip)
+        for profile_id, tag in new_tags & old_tags:
+            for ip in old_ips - new_ips:
+                self._remove_mapping(tag, profile_id, endpoint_id, ip)
+            for ip in new_ips - old_ips:
+                self._add_mapping(tag, profile_id, endpoint_id, ip)
+        for profile_id, tag in old_tags - new_tags:
+            for ip in old_ips:
+                self._remove_mapping(tag, profile_id, endpoint_id, ip)
+
+    def _add_mapping(self, tag_id, profile_id, endpoint_id, ip_address):
+        self.ip_owners_by_tag[tag_id][ip_address][profile_id].add(endpoint_id)
+
+    def _remove_mapping(self, tag_id, profile_id, endpoint_id, ip_address):
+        ep_ids = self.ip_owners_by_tag[tag_id][ip_address][profile_id]
+        ep_ids.discard(endpoint_id)
+        if not ep_ids:
+            del self.ip_owners_by_tag[tag_id][ip_address][profile_id]
+            if not self.ip_owners_by_tag[tag_id][ip_address]:
+                del self.ip_owners_by_tag[tag_id][ip_address]
+            if not self.ip_owners_by_tag[tag_id]:
+                del self.ip_owners_by_tag[tag_id]
+
+
+class CompactIpsetIndex(object):
+    """
+    Drives the IpsetManager's index maintenance directly, bypassing the
+    actor machinery so that the comparison with LegacyIpsetIndex is fair.
+
+    The IpsetManager only indexes tags that are referenced by a local
+    ActiveIpset; we simulate those references.
+    """
+    def __init__(self, ip_type, referenced_tags):
+        self.mgr = IpsetManager(ip_type)
+        for tag_id in referenced_tags:
+            self.mgr._start_indexing(tag_id)
+
+    def on_tags_update(self, profile_id, tags):
+        IpsetManager.on_tags_update.func(self.mgr, profile_id, tags)
+
+    def on_endpoint_update(self, endpoint_id, endpoint):
+        IpsetManager.on_endpoint_update.func(self.mgr, endpoint_id, endpoint)
+
+
+def _make_index(variant, ip_type, referenced_tags):
+    if variant == "legacy":
+        return LegacyIpsetIndex(ip_type)
+    return CompactIpsetIndex(ip_type, referenced_tags)
+
+
+def _rss_kb():
+    with open("/proc/self/statm") as statm:
+        resident_pages = int(statm.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def measure(variant, deployment, ip_type, referenced_tags):
+    """
+    Builds the named index from the deployment, in the current process.
+
+    :param referenced_tags: The tags that are referenced locally.  Only
+        affects the compact index.
+
+    :returns dict: the results.
+    """
+    gc.collect()
+    rss_before = _rss_kb()
+    start = time.time()
+    index = _make_index(variant, ip_type, referenced_tags)
+    for profile_id, tags in deployment.tags_by_id.iteritems():
+        index.on_tags_update(profile_id, tags)
+    for endpoint_id, endpoint in deployment.endpoints.iteritems():
+        index.on_endpoint_update(endpoint_id, endpoint)
+    build_time = time.time() - start
+    gc.collect()
+    rss_kb = _rss_kb() - rss_before
+
+    # Churn: give every endpoint a new IP then put the old one back.
+    nets_key = "ipv4_nets" if ip_type == IPV4 else "ipv6_nets"
+    start = time.time()
+    for endpoint_id, endpoint in deployment.endpoints.iteritems():
+        moved = dict(endpoint)
+        # 10.x.y.z -> 11.x.y.z, fd00::x -> fd10::x.
+        moved[nets_key] = [n.replace("0", "1", 1)
+                           for n in endpoint.get(nets_key, [])]
+        index.on_endpoint_update(endpoint_id, moved)
+        index.on_endpoint_update(endpoint_id, endpoint)
+    churn_time = time.time() - start
+    return {
+        "index_rss_kb": rss_kb,
+        "build_time": build_time,
+        "churn_time": churn_time,
+    }
+
+
+def measure_in_child(variant, deployment, ip_type, referenced_tags):
+    """
+    Runs measure() in a forked child so that each variant starts from the
+    same heap.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            results = measure(variant, deployment, ip_type,
+                              referenced_tags)
+            os.write(write_fd, json.dumps(results))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        output = pipe.read()
+    os.waitpid(pid, 0)
+    return json.loads(output)
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    add_deployment_options(parser)
+    parser.add_option("--referenced-tags", type="int",
+                      help="number of tags that are referenced locally and "
+                           "so need indexing (default: all of them)")
+    options, _ = parser.parse_args(argv)
+    deployment = deployment_from_options(options)
+    ip_type = IPV6 if options.ipv6 else IPV4
+    referenced_tags = deployment.tags[:options.referenced_tags]
+    results = {"endpoints": len(deployment.endpoints),
+               "referenced_tags": len(referenced_tags)}
+    for variant in ("legacy", "compact"):
+        results[variant] = measure_in_child(variant, deployment, ip_type,
+                                            referenced_tags)
+    if results["compact"]["index_rss_kb"] > 0:
+        results["rss_ratio"] = (float(results["legacy"]["index_rss_kb"]) /
+                                results["compact"]["index_rss_kb"])
+    print json.dumps(results, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,705 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.fake_dataplane
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+An in-process simulation of the parts of the Linux dataplane that Felix
+programs.
+
+FakeDataplane stands in for the commands that Felix shells out to:
+ip(6)tables-restore, ip(6)tables-save, "ip(6)tables --list", ipset,
+"ip link/route/neigh", arp and (via FakeNft) nft.  It keeps enough state to
+enforce the same consistency rules as the kernel (jump targets and ipsets
+must exist, referenced chains and sets can't be deleted, routes need an
+interface) and to answer Felix's read-back commands in the format that
+Felix parses.
+
+Each command is charged a simulated cost, which is spent in gevent.sleep()
+so that the actors batch up work the way they would against a real
+kernel.  The default costs are rough estimates for a legacy (non-nft)
+iptables kernel; run bench_felix.py --calibrate as root on a real host to
+measure replacements.
+"""
+from collections import defaultdict
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import time
+
+import gevent
+import mock
+
+from calico.felix.futils import CommandOutput, FailedSystemCall
+from calico.felix.test.fake_nft import FakeNft
+
+_log = logging.getLogger(__name__)
+
+# Simulated costs, in seconds.  ip(6)tables-restore in legacy mode copies
+# the whole table out of the kernel and back in again for every commit,
+# hence the cost per rule already in the table.
+DEFAULT_COSTS = {
+    # Fork/exec and start-up of any command.
+    "exec": 0.001,
+    # Fixed cost of each COMMIT in ip(6)tables-restore.
+    "ipt_commit": 0.002,
+    # Per rule in the table being committed.
+    "ipt_rule_in_table": 0.000005,
+    # Per line of restore input.
+    "ipt_input_line": 0.00001,
+    # Per rule in the table, for ip(6)tables-save and --list.
+    "ipt_save_rule": 0.000002,
+    # Per line of ipset restore input.
+    "ipset_input_line": 0.000003,
+    # Per line of nft script.
+    "nft_input_line": 0.000005,
+}
+
+BUILTIN_CHAINS = {
+    "filter": ["INPUT", "FORWARD", "OUTPUT"],
+    "nat": ["PREROUTING", "INPUT", "OUTPUT", "POSTROUTING"],
+    "mangle": ["PREROUTING", "INPUT", "FORWARD", "OUTPUT", "POSTROUTING"],
+    "raw": ["PREROUTING", "OUTPUT"],
+}
+
+# Targets that are provided by iptables extensions rather than chains.
+BUILTIN_TARGETS = set(["ACCEPT", "DROP", "RETURN", "REJECT", "LOG", "MARK",
+                       "DNAT", "SNAT", "MASQUERADE", "QUEUE", "NOTRACK",
+                       "CONNMARK", "REDIRECT"])
+
+IPSET_DEFAULT_HASHSIZE = 1024
+IPSET_DEFAULT_MAXELEM = 65536
+
+
+class FakeDataplaneError(Exception):
+    pass
+
+
+class FakeDataplane(object):
+    def __init__(self, costs=None, realtime=True):
+        """
+        :param dict costs: Overrides for entries in DEFAULT_COSTS.
+        :param bool realtime: If True, each command sleeps for its
+            simulated cost.  If False, costs are only accumulated.
+        """
+        self.costs = dict(DEFAULT_COSTS)
+        self.costs.update(costs or {})
+        self.realtime = realtime
+
+        # iptables[ip_version][table][chain] = [rule, ...] where each rule
+        # is the tuple of tokens following the chain name.
+        self.iptables = {}
+        for ip_version in (4, 6):
+            self.iptables[ip_version] = {}
+            for table, chains in BUILTIN_CHAINS.iteritems():
+                self.iptables[ip_version][table] = dict((c, [])
+                                                        for c in chains)
+        # ipsets[name] = {"type", "family", "hashsize", "maxelem", "members"}
+        self.ipsets = {}
+        # interfaces[name] = True iff up.
+        self.interfaces = {}
+        # routes[ip_version][interface name] = set of IPs.
+        self.routes = {4: defaultdict(set), 6: defaultdict(set)}
+        self.arp = {}
+        self.proxy_ndp = set()
+        self.nft = FakeNft()
+        # Cache of ipset_refcount() results, invalidated by each commit.
+        self._ipset_refcounts = None
+
+        self.call_counts = defaultdict(int)
+        self.input_bytes = defaultdict(int)
+        self.simulated_seconds = 0.0
+
+    # Patching.
+
+    @contextlib.contextmanager
+    def patched(self):
+        """
+        Context manager that routes all of Felix's dataplane access to this
+        FakeDataplane.
+        """
+        patches = [
+            mock.patch("calico.felix.futils.check_call", self.check_call),
+            mock.patch("calico.felix.futils.check_call_lines",
+                       self.check_call_lines),
+            mock.patch("calico.felix.fiptables.subprocess.check_output",
+                       self.check_output),
+            mock.patch("calico.felix.devices.configure_interface_ipv4",
+                       self.configure_interface_ipv4),
+            mock.patch("calico.felix.devices.configure_interface_ipv6",
+                       self.configure_interface_ipv6),
+            mock.patch("calico.felix.devices.interface_up",
+                       self.interface_up),
+        ]
+        for p in patches:
+            p.start()
+        try:
+            yield self
+        finally:
+            for p in reversed(patches):
+                p.stop()
+
+    # Entry points.
+
+    def check_call(self, args, input_str=None):
+        """
+        Stand-in for futils.check_call().
+
+        :raises FailedSystemCall: if the command fails.
+        """
+        cmd = os.path.basename(args[0])
+        self._record_call(cmd, input_str)
+        if cmd == "nft":
+            self._charge(self.costs["nft_input_line"] *
+                         _count_lines(input_str))
+            return self.nft.check_call(args, input_str=input_str)
+        try:
+            if cmd in ("iptables-restore", "ip6tables-restore"):
+                stdout = self._iptables_restore(_ip_version(cmd), input_str)
+            elif cmd == "ipset":
+                stdout = self._ipset(args[1:], input_str)
+            elif cmd == "ip":
+                stdout = self._ip(args[1:])
+            elif cmd == "arp":
+                stdout = self._arp(args[1:])
+            else:
+                raise FailedSystemCall("Failed system call", args, 127, "",
+                                       "%s: command not found" % cmd,
+                                       input=input_str)
+        except FakeDataplaneError as e:
+            raise FailedSystemCall("Failed system call", args, 1, "",
+                                   str(e), input=input_str)
+        return CommandOutput(stdout, "")
+
+    def check_call_lines(self, args):
+        """
+        Stand-in for futils.check_call_lines().
+
+        :raises FailedSystemCall: if the command fails.
+        """
+        stdout = self.check_call(args).stdout
+        return iter(stdout.splitlines(True))
+
+    def check_output(self, args):
+        """
+        Stand-in for subprocess.check_output(), as used by the iptables
+        updater to read back the dataplane.
+        """
+        cmd = os.path.basename(args[0])
+        self._record_call(cmd, None)
+        table = args[args.index("--table") + 1]
+        if cmd in ("iptables-save", "ip6tables-save"):
+            ip_version = _ip_version(cmd)
+            self._charge_save(ip_version, table)
+            return self.iptables_save(ip_version, table)
+        elif cmd in ("iptables", "ip6tables") and "--list" in args:
+            ip_version = _ip_version(cmd)
+            self._charge_save(ip_version, table)
+            return self.iptables_list(ip_version, table)
+        raise subprocess.CalledProcessError(127, args)
+
+    def configure_interface_ipv4(self, if_name):
+        """Stand-in for devices.configure_interface_ipv4()."""
+        self._check_proc_file(if_name)
+
+    def configure_interface_ipv6(self, if_name, proxy_target):
+        """Stand-in for devices.configure_interface_ipv6()."""
+        self._check_proc_file(if_name)
+        if proxy_target:
+            self.check_call(["ip", "-6", "neigh", "add", "proxy",
+                             str(proxy_target), "dev", if_name])
+
+    def interface_up(self, if_name):
+        """Stand-in for devices.interface_up()."""
+        return self.interfaces.get(if_name, False)
+
+    # Helpers for tests and benchmarks.
+
+    def add_interface(self, name, up=True):
+        self.interfaces[name] = up
+
+    def remove_interface(self, name):
+        self.interfaces.pop(name, None)
+        for routes in self.routes.values():
+            routes.pop(name, None)
+
+    def chains(self, ip_version, table):
+        return self.iptables[ip_version][table]
+
+    def chain_refcounts(self, ip_version, table):
+        """
+        :returns dict[str,int]: the number of rules that jump or go to each
+            referenced chain.
+        """
+        counts = defaultdict(int)
+        for rules in self.iptables[ip_version][table].itervalues():
+            for rule in rules:
+                counts[_rule_target(rule)] += 1
+        return counts
+
+    def stats(self):
+        """
+        :returns dict: counters describing the work done so far.
+        """
+        return {
+            "calls": sum(self.call_counts.values()),
+            "calls_by_command": dict(self.call_counts),
+            "input_bytes": sum(self.input_bytes.values()),
+            "input_bytes_by_command": dict(self.input_bytes),
+            "simulated_seconds": self.simulated_seconds,
+        }
+
+    # Cost accounting.
+
+    def _record_call(self, cmd, input_str):
+        self.call_counts[cmd] += 1
+        if input_str:
+            self.input_bytes[cmd] += len(input_str)
+        self._charge(self.costs["exec"])
+
+    def _charge(self, seconds):
+        self.simulated_seconds += seconds
+        if self.realtime and seconds > 0:
+            gevent.sleep(seconds)
+
+    def _charge_save(self, ip_version, table):
+        num_rules = sum(len(r) for r in
+                        self.iptables[ip_version][table].itervalues())
+        self._charge(self.costs["ipt_save_rule"] * num_rules)
+
+    # ip(6)tables.
+
+    def _iptables_restore(self, ip_version, input_str):
+        """
+        Applies ip(6)tables-restore --noflush input.  Each table section is
+        applied atomically at its COMMIT.
+        """
+        lines = input_str.splitlines()
+        self._charge(self.costs["ipt_input_line"] * len(lines))
+        tables = self.iptables[ip_version]
+        pending = None
+        table_name = None
+        for line_no, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                if line.startswith("*"):
+                    table_name = line[1:]
+                    if table_name not in tables:
+                        raise FakeDataplaneError("Unknown table")
+                    pending = dict((c, list(r)) for c, r in
+                                   tables[table_name].iteritems())
+                elif pending is None:
+                    raise FakeDataplaneError("No table specified")
+                elif line == "COMMIT":
+                    num_rules = sum(len(r) for r in pending.itervalues())
+                    self._charge(self.costs["ipt_commit"] +
+                                 self.costs["ipt_rule_in_table"] * num_rules)
+                    tables[table_name] = pending
+                    self._ipset_refcounts = None
+                    pending = None
+                elif line.startswith(":"):
+                    # In --noflush mode, declaring a chain creates or
+                    # flushes it.
+                    pending[line[1:].split()[0]] = []
+                else:
+                    self._apply_rule_line(ip_version, table_name, pending,
+                                          _split_quoted(line))
+            except (FakeDataplaneError, ValueError, IndexError) as e:
+                _log.debug("Fake restore failed on line %s (%s): %s",
+                           line_no, line, e)
+                raise FakeDataplaneError(
+                    "%s: line %s failed\n" %
+                    ("iptables-restore" if ip_version == 4
+                     else "ip6tables-restore", line_no))
+        return ""
+
+    def _apply_rule_line(self, ip_version, table_name, chains, tokens):
+        op, chain = tokens[0], tokens[1]
+        rule = tuple(tokens[2:])
+        if chain not in chains:
+            raise FakeDataplaneError("No chain %s" % chain)
+        if op in ("--append", "-A", "--insert", "-I"):
+            self._check_rule(ip_version, chains, rule)
+            if op in ("--append", "-A"):
+                chains[chain].append(rule)
+            else:
+                chains[chain].insert(0, rule)
+        elif op in ("--delete", "-D"):
+            chains[chain].remove(rule)
+        elif op in ("--flush", "-F"):
+            chains[chain] = []
+        elif op in ("--delete-chain", "-X"):
+            if chain in BUILTIN_CHAINS[table_name]:
+                raise FakeDataplaneError("Can't delete built-in chain")
+            if chains[chain]:
+                raise FakeDataplaneError("Chain %s not empty" % chain)
+            for rules in chains.itervalues():
+                if any(_rule_target(r) == chain for r in rules):
+                    raise FakeDataplaneError("Chain %s in use" % chain)
+            del chains[chain]
+        else:
+            raise FakeDataplaneError("Unknown operation %s" % op)
+
+    def _check_rule(self, ip_version, chains, rule):
+        target = _rule_target(rule)
+        if (target is not None and target not in BUILTIN_TARGETS and
+                target not in chains):
+            raise FakeDataplaneError("Couldn't load target %s" % target)
+        family = "inet" if ip_version == 4 else "inet6"
+        for set_name in _rule_ipsets(rule):
+            ipset = self.ipsets.get(set_name)
+            if ipset is None or ipset["family"] != family:
+                raise FakeDataplaneError("Set %s doesn't exist" % set_name)
+
+    def iptables_save(self, ip_version, table):
+        """
+        :returns str: the table, in ip(6)tables-save format.
+        """
+        chains = self.iptables[ip_version][table]
+        lines = ["*%s" % table]
+        for chain in sorted(chains):
+            policy = "ACCEPT" if chain in BUILTIN_CHAINS[table] else "-"
+            lines.append(":%s %s [0:0]" % (chain, policy))
+        for chain in sorted(chains):
+            for rule in chains[chain]:
+                lines.append("-A %s %s" % (chain, _join(rule)))
+        lines.append("COMMIT")
+        return "\n".join(lines) + "\n"
+
+    def iptables_list(self, ip_version, table):
+        """
+        :returns str: the table, in "ip(6)tables --list" format.
+        """
+        chains = self.iptables[ip_version][table]
+        refcounts = self.chain_refcounts(ip_version, table)
+        paragraphs = []
+        for chain in sorted(chains):
+            if chain in BUILTIN_CHAINS[table]:
+                header = "Chain %s (policy ACCEPT)" % chain
+            else:
+                header = "Chain %s (%s references)" % (chain,
+                                                       refcounts[chain])
+            lines = [header, "target     prot opt source   destination"]
+            for rule in chains[chain]:
+                lines.append("%-10s all  --  anywhere anywhere %s" %
+                             (_rule_target(rule) or "", _join(rule)))
+            paragraphs.append("\n".join(lines))
+        return "\n\n".join(paragraphs) + "\n"
+
+    # ipset.
+
+    def _ipset(self, args, input_str):
+        if args[0] == "restore":
+            lines = input_str.splitlines()
+            self._charge(self.costs["ipset_input_line"] * len(lines))
+            # Unlike iptables-restore, ipset restore applies each line as
+            # it goes; there's no rollback on failure.
+            for line_no, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line == "COMMIT":
+                    continue
+                try:
+                    self._ipset_command(line.split())
+                except FakeDataplaneError as e:
+                    raise FakeDataplaneError(
+                        "ipset v6.11: Error in line %s: %s" % (line_no, e))
+            return ""
+        return self._ipset_command(args) or ""
+
+    def _ipset_command(self, words):
+        cmd = words[0]
+        words = [w for w in words[1:]]
+        exist = False
+        for flag in ("--exist", "-exist"):
+            if flag in words:
+                words.remove(flag)
+                exist = True
+        if cmd == "list":
+            return self.ipset_list(words)
+        name = words[0]
+        if cmd in ("create", "-N"):
+            options = dict(zip(words[2::2], words[3::2]))
+            ipset = {
+                "type": words[1],
+                "family": options.get("family", "inet"),
+                "hashsize": int(options.get("hashsize",
+                                            IPSET_DEFAULT_HASHSIZE)),
+                "maxelem": int(options.get("maxelem",
+                                           IPSET_DEFAULT_MAXELEM)),
+                "members": set(),
+            }
+            existing = self.ipsets.get(name)
+            if existing is not None:
+                # Like the kernel, ignore the hashsize, since that
+                # changes as the set is rehashed.
+                same = all(existing[k] == ipset[k] for k in
+                           ("type", "family", "maxelem"))
+                if not exist or not same:
+                    raise FakeDataplaneError(
+                        "Set cannot be created: set with the same name "
+                        "already exists")
+                return
+            self.ipsets[name] = ipset
+            return
+        ipset = self._get_ipset(name)
+        if cmd in ("add", "-A"):
+            member = words[1]
+            if member in ipset["members"]:
+                if not exist:
+                    raise FakeDataplaneError("Element cannot be added to the "
+                                             "set: it's already added")
+                return
+            if len(ipset["members"]) >= ipset["maxelem"]:
+                raise FakeDataplaneError("Hash is full, cannot add more "
+                                         "elements")
+            ipset["members"].add(member)
+        elif cmd in ("del", "-D"):
+            ipset["members"].discard(words[1])
+        elif cmd in ("flush", "-F"):
+            ipset["members"] = set()
+        elif cmd in ("swap", "-W"):
+            other = self._get_ipset(words[1])
+            if (other["type"], other["family"]) != (ipset["type"],
+                                                    ipset["family"]):
+                raise FakeDataplaneError("The sets cannot be swapped: their "
+                                         "type does not match")
+            self.ipsets[name], self.ipsets[words[1]] = other, ipset
+        elif cmd in ("destroy", "-X"):
+            if self.ipset_refcount(name):
+                raise FakeDataplaneError("Set cannot be destroyed: it is in "
+                                         "use by a kernel component")
+            del self.ipsets[name]
+        else:
+            raise FakeDataplaneError("Unknown ipset command %s" % cmd)
+
+    def _get_ipset(self, name):
+        try:
+            return self.ipsets[name]
+        except KeyError:
+            raise FakeDataplaneError("The set with the given name does not "
+                                     "exist")
+
+    def ipset_refcount(self, name):
+        """
+        :returns int: the number of iptables rules that use the ipset.
+        """
+        if self._ipset_refcounts is None:
+            counts = defaultdict(int)
+            for tables in self.iptables.itervalues():
+                for chains in tables.itervalues():
+                    for rules in chains.itervalues():
+                        for rule in rules:
+                            for set_name in _rule_ipsets(rule):
+                                counts[set_name] += 1
+            self._ipset_refcounts = counts
+        return self._ipset_refcounts[name]
+
+    def ipset_list(self, args=()):
+        """
+        :returns str: ipsets in the format of "ipset list", or of
+            "ipset list -name" if that option is given.
+        """
+        names_only = "-name" in args or "-n" in args
+        names = [a for a in args if not a.startswith("-")]
+        if names:
+            self._get_ipset(names[0])
+        else:
+            names = sorted(self.ipsets)
+        if names_only:
+            return "".join("%s\n" % n for n in names)
+        paragraphs = []
+        for name in names:
+            ipset = self.ipsets[name]
+            lines = ["Name: %s" % name,
+                     "Type: %s" % ipset["type"],
+                     "Revision: 2",
+                     "Header: family %s hashsize %s maxelem %s" %
+                     (ipset["family"], ipset["hashsize"], ipset["maxelem"]),
+                     "Size in memory: %s" % (16 * len(ipset["members"]) + 64),
+                     "References: %s" % self.ipset_refcount(name),
+                     "Members:"]
+            lines += sorted(ipset["members"])
+            paragraphs.append("\n".join(lines))
+        return "\n\n".join(paragraphs) + "\n"
+
+    # Interfaces, routes and ARP.
+
+    def _ip(self, args):
+        ip_version = 4
+        if args[0] == "-6":
+            ip_version = 6
+            args = args[1:]
+        obj, op = args[0], args[1]
+        if obj == "link" and op == "list":
+            self._check_iface(args[2])
+            return "1: %s: <BROADCAST,MULTICAST,UP>\n" % args[2]
+        if obj == "neigh" and op == "add":
+            self._check_iface(args[args.index("dev") + 1])
+            self.proxy_ndp.add((args[3], args[args.index("dev") + 1]))
+            return ""
+        if obj != "route":
+            raise FakeDataplaneError("Unsupported ip command")
+        routes = self.routes[ip_version]
+        if op == "list":
+            iface = args[args.index("dev") + 1]
+            self._check_iface(iface)
+            return "".join("%s scope link\n" % ip for ip in
+                           sorted(routes.get(iface, ())))
+        ip, iface = args[2], args[args.index("dev") + 1]
+        self._check_iface(iface)
+        if op == "replace":
+            for ips in routes.itervalues():
+                ips.discard(ip)
+            routes[iface].add(ip)
+        elif op == "del":
+            if ip not in routes.get(iface, ()):
+                raise FakeDataplaneError("RTNETLINK answers: No such process")
+            routes[iface].discard(ip)
+        else:
+            raise FakeDataplaneError("Unsupported ip route command")
+        return ""
+
+    def _arp(self, args):
+        iface = args[args.index("-i") + 1]
+        if iface not in self.interfaces:
+            raise FakeDataplaneError("SIOCSARP: No such device")
+        if args[0] == "-s":
+            self.arp[(args[1], iface)] = args[2]
+        elif args[0] == "-d":
+            if self.arp.pop((args[1], iface), None) is None:
+                raise FakeDataplaneError("No ARP entry for %s" % args[1])
+        else:
+            raise FakeDataplaneError("Unsupported arp command")
+        return ""
+
+    def _check_iface(self, iface):
+        if iface not in self.interfaces:
+            raise FakeDataplaneError('Device "%s" does not exist.' % iface)
+
+    def _check_proc_file(self, if_name):
+        if if_name not in self.interfaces:
+            raise IOError(2, "No such file or directory")
+
+
+def _ip_version(cmd):
+    return 6 if cmd.startswith("ip6") else 4
+
+
+def _count_lines(input_str):
+    return input_str.count("\n") if input_str else 0
+
+
+def _rule_target(rule):
+    """
+    :returns str: the jump/goto target of the rule or None.
+    """
+    for flag in ("--jump", "-j", "--goto", "-g"):
+        if flag in rule:
+            return rule[rule.index(flag) + 1]
+    return None
+
+
+def _rule_ipsets(rule):
+    return [rule[i + 1] for i, t in enumerate(rule) if t == "--match-set"]
+
+
+def _split_quoted(line):
+    """
+    Splits a line of restore input into tokens, treating a double-quoted
+    string (as used for comments) as a single token.  Much faster than
+    shlex.split() and sufficient for Felix's input.
+    """
+    tokens = []
+    for i, part in enumerate(line.split('"')):
+        if i % 2:
+            tokens.append(part)
+        else:
+            tokens.extend(part.split())
+    return tokens
+
+
+def _join(tokens):
+    return " ".join('"%s"' % t if " " in t else t for t in tokens)
+
+
+def load_costs(path):
+    """
+    Loads a cost table, as written by calibrate(), from a JSON file.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def calibrate(num_rules=2000, num_members=10000):
+    """
+    Measures the DEFAULT_COSTS entries for ip(6)tables and ipset on this
+    host.  Must be run as root on a test machine; it creates and removes a
+    scratch chain and ipset.
+
+    :returns dict: costs that may be passed to FakeDataplane.
+    """
+    chain = "felix-calibrate"
+    ipset = "felix-calibrate"
+
+    def timed(args, input_str=None, repeats=5):
+        best = None
+        for _ in xrange(repeats):
+            start = time.time()
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            proc.communicate(input_str)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    restore = ["iptables-restore", "--noflush"]
+    exec_cost = timed(["true"], repeats=20)
+    noop = "*filter\n:%s -\nCOMMIT\n" % chain
+    empty_commit = timed(restore, noop)
+    rule_lines = "".join("-A %s --source 10.%s.%s.%s --jump ACCEPT\n" %
+                         (chain, i >> 16 & 255, i >> 8 & 255, i & 255)
+                         for i in xrange(num_rules))
+    populate = timed(restore, "*filter\n:%s -\n%sCOMMIT\n" %
+                     (chain, rule_lines), repeats=1)
+    # Time a commit with the chain populated; the noop input would flush
+    # it so just re-declare a different scratch chain.
+    full_commit = timed(restore, "*filter\n:%s-2 -\nCOMMIT\n" % chain)
+    per_rule = max(0.0, (full_commit - empty_commit) / num_rules)
+    per_line = max(0.0, (populate - full_commit) / num_rules)
+    timed(restore, "*filter\n:%s -\n:%s-2 -\n-X %s\n-X %s-2\nCOMMIT\n" %
+          (chain, chain, chain, chain), repeats=1)
+
+    ipset_lines = "create %s hash:ip family inet maxelem %s\n" % (
+        ipset, num_members)
+    ipset_lines += "".join("add %s 10.%s.%s.%s\n" %
+                           (ipset, i >> 16 & 255, i >> 8 & 255, i & 255)
+                           for i in xrange(num_members))
+    ipset_time = timed(["ipset", "restore"], ipset_lines, repeats=1)
+    timed(["ipset", "destroy", ipset], repeats=1)
+
+    return {
+        "exec": exec_cost,
+        "ipt_commit": max(0.0, empty_commit - exec_cost),
+        "ipt_rule_in_table": per_rule,
+        "ipt_input_line": per_line,
+        "ipt_save_rule": per_rule / 2,
+        "ipset_input_line": max(0.0, ipset_time - exec_cost) / num_members,
+        "nft_input_line": DEFAULT_COSTS["nft_input_line"],
+    }
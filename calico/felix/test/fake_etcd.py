@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.fake_etcd
+~~~~~~~~~~~~~~~~~~~~
+
+An in-memory stand-in for an etcd server and the python-etcd client.
+
+Unlike stub_etcd, which replays canned responses, FakeEtcd keeps a real
+key/value tree with etcd's indexing semantics: every write bumps the
+cluster-wide index, recursive reads return the leaves of a subtree and
+waits return the first event at or after the requested index (or block
+until one arrives).  Only the event history window that etcd itself keeps
+is available to waiters; older indexes raise EtcdEventIndexCleared.
+
+Responses are real etcd.EtcdResult objects so the code under test sees
+exactly what it would see from python-etcd.
+"""
+import logging
+import uuid
+
+from etcd import (EtcdResult, EtcdKeyNotFound, EtcdEventIndexCleared,
+                  EtcdClusterIdChanged)
+import gevent
+from gevent.event import Event
+from urllib3.exceptions import ReadTimeoutError
+
+_log = logging.getLogger(__name__)
+
+# Number of events that etcd keeps in its history.
+HISTORY_SIZE = 1000
+
+
+class FakeEtcd(object):
+    """
+    The "server" side: a key/value tree plus its event history.  Any number
+    of FakeEtcdClients may share one FakeEtcd.
+    """
+    def __init__(self, cluster_id=None):
+        self.cluster_id = cluster_id or uuid.uuid4().hex
+        self.etcd_index = 0
+        # Maps key to (value, createdIndex, modifiedIndex).
+        self.nodes = {}
+        self.history = []
+        self._new_event = Event()
+
+    def client(self, host="127.0.0.1", port=4001, expected_cluster_id=None,
+               **kwargs):
+        """
+        Factory with the same signature as etcd.Client; suitable for
+        patching in place of it.
+        """
+        return FakeEtcdClient(self, host=host, port=port,
+                              expected_cluster_id=expected_cluster_id)
+
+    def set(self, key, value):
+        """
+        Writes a single key, recording a "set" event.
+
+        :returns int: the modifiedIndex of the write.
+        """
+        self.etcd_index += 1
+        old = self.nodes.get(key)
+        created = old[1] if old else self.etcd_index
+        self.nodes[key] = (value, created, self.etcd_index)
+        self._record("set", {"key": key,
+                             "value": value,
+                             "createdIndex": created,
+                             "modifiedIndex": self.etcd_index})
+        return self.etcd_index
+
+    def delete(self, key, recursive=False):
+        """
+        Deletes a key or, if recursive is set, a whole directory.  Like
+        etcd, a recursive delete generates a single event for the
+        directory.
+
+        :raises EtcdKeyNotFound: if there is nothing at that key.
+        """
+        prefix = key.rstrip("/") + "/"
+        if key in self.nodes:
+            is_dir = False
+            doomed = [key]
+        else:
+            doomed = [k for k in self.nodes if k.startswith(prefix)]
+            if not doomed or not recursive:
+                raise EtcdKeyNotFound("Key not found : %s" % key)
+            is_dir = True
+        for k in doomed:
+            del self.nodes[k]
+        self.etcd_index += 1
+        self._record("delete", {"key": key,
+                                "dir": is_dir,
+                                "modifiedIndex": self.etcd_index})
+        return self.etcd_index
+
+    def set_cluster_id(self, cluster_id):
+        """
+        Simulates the cluster being rebuilt: the ID changes and the event
+        history is lost.  Wakes any waiters that are checking the ID.
+        """
+        self.cluster_id = cluster_id
+        del self.history[:]
+        self._new_event.set()
+        self._new_event = Event()
+
+    def _record(self, action, node):
+        self.history.append((self.etcd_index, action, node))
+        if len(self.history) > HISTORY_SIZE:
+            del self.history[0]
+        self._new_event.set()
+        self._new_event = Event()
+
+    def read(self, key, recursive=False):
+        if key in self.nodes:
+            value, created, modified = self.nodes[key]
+            return self._result("get", {"key": key,
+                                        "value": value,
+                                        "createdIndex": created,
+                                        "modifiedIndex": modified})
+        prefix = key.rstrip("/") + "/"
+        leaves = sorted(k for k in self.nodes if k.startswith(prefix))
+        if not leaves:
+            raise EtcdKeyNotFound("Key not found : %s" % key)
+        if recursive:
+            children = [self._leaf(k) for k in leaves]
+        else:
+            children = []
+            seen_dirs = set()
+            for k in leaves:
+                rest = k[len(prefix):]
+                if "/" in rest:
+                    child_dir = prefix + rest.split("/", 1)[0]
+                    if child_dir not in seen_dirs:
+                        seen_dirs.add(child_dir)
+                        children.append({"key": child_dir, "dir": True})
+                else:
+                    children.append(self._leaf(k))
+        return self._result("get", {"key": key.rstrip("/"),
+                                    "dir": True,
+                                    "nodes": children})
+
+    def wait(self, key, wait_index, recursive=False, timeout=None,
+             cluster_id=None):
+        """
+        Returns the first event at or after wait_index that affects key,
+        blocking until one arrives.
+
+        :param cluster_id: If set, the cluster ID that the waiter expects;
+            the wait is aborted if the cluster ID changes.
+        :raises EtcdEventIndexCleared: if wait_index has already fallen
+            out of the history window.
+        :raises EtcdClusterIdChanged: if cluster_id no longer matches.
+        :raises ReadTimeoutError: if timeout expires first.
+        """
+        if wait_index is None:
+            wait_index = self.etcd_index + 1
+        with gevent.Timeout(timeout, False):
+            while True:
+                if cluster_id is not None and cluster_id != self.cluster_id:
+                    raise EtcdClusterIdChanged(
+                        "The UUID of the cluster changed from %s to %s." %
+                        (cluster_id, self.cluster_id))
+                oldest = self.history[0][0] if self.history else None
+                if oldest is not None and wait_index < oldest:
+                    raise EtcdEventIndexCleared(
+                        "The event in requested index is outdated and "
+                        "cleared")
+                for index, action, node in self.history:
+                    if index >= wait_index and self._affects(node["key"], key,
+                                                              recursive):
+                        return self._result(action, node)
+                self._new_event.wait()
+        raise ReadTimeoutError(None, None, "Read timed out.")
+
+    def _affects(self, event_key, key, recursive):
+        key = key.rstrip("/")
+        if event_key == key:
+            return True
+        if recursive and event_key.startswith(key + "/"):
+            return True
+        # Deleting a parent directory affects everything under it.
+        return key.startswith(event_key.rstrip("/") + "/")
+
+    def _leaf(self, key):
+        value, created, modified = self.nodes[key]
+        return {"key": key,
+                "value": value,
+                "createdIndex": created,
+                "modifiedIndex": modified}
+
+    def _result(self, action, node):
+        result = EtcdResult(action, node)
+        result.etcd_index = self.etcd_index
+        return result
+
+
+class FakeEtcdClient(object):
+    """
+    Stand-in for etcd.Client that talks to a FakeEtcd.
+    """
+    def __init__(self, server, host="127.0.0.1", port=4001,
+                 expected_cluster_id=None):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.expected_cluster_id = expected_cluster_id
+        self.reads = 0
+
+    def read(self, key, recursive=False, wait=False, waitIndex=None,
+             timeout=None, check_cluster_uuid=False, **kwargs):
+        self.reads += 1
+        self._check_cluster_id(check_cluster_uuid)
+        if wait:
+            cluster_id = (self.expected_cluster_id if check_cluster_uuid
+                          else None)
+            return self.server.wait(key, waitIndex, recursive=recursive,
+                                    timeout=_read_timeout(timeout),
+                                    cluster_id=cluster_id)
+        return self.server.read(key, recursive=recursive)
+
+    def write(self, key, value, **kwargs):
+        self._check_cluster_id(False)
+        self.server.set(key, value)
+        return self.server.read(key)
+
+    def set(self, key, value):
+        return self.write(key, value)
+
+    def delete(self, key, recursive=False, **kwargs):
+        self._check_cluster_id(False)
+        self.server.delete(key, recursive=recursive)
+
+    def _check_cluster_id(self, check):
+        if self.expected_cluster_id is None:
+            # Like python-etcd, adopt the ID of the first cluster we see.
+            self.expected_cluster_id = self.server.cluster_id
+        elif check and self.expected_cluster_id != self.server.cluster_id:
+            raise EtcdClusterIdChanged(
+                "The UUID of the cluster changed from %s to %s." %
+                (self.expected_cluster_id, self.server.cluster_id))
+
+
+def _read_timeout(timeout):
+    """
+    Extracts the read timeout from either a number or a urllib3 Timeout.
+    """
+    return getattr(timeout, "read_timeout", timeout)
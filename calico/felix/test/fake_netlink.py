@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.fake_netlink
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Record and replay of netlink traffic for testing the NetlinkIpsetDriver.
+
+The fixtures in data/nlipset_fixtures.json were recorded against a real
+kernel by running, as root on a host with the ip_set module loaded::
+
+    python -m calico.felix.test.fake_netlink > \\
+        calico/felix/test/data/nlipset_fixtures.json
+
+Each fixture is a list of exchanges: a datagram that the driver sent and
+the datagrams that the kernel sent back.
+"""
+import json
+import os
+import struct
+import sys
+
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.nlipset import (NetlinkIpsetDriver, NetlinkSocket,
+                                  NLMSG_ERROR, parse_messages)
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "data",
+                             "nlipset_fixtures.json")
+
+
+def load_fixtures():
+    with open(FIXTURES_PATH) as f:
+        return json.load(f)
+
+
+class ReplaySocket(object):
+    """
+    Stands in for a NetlinkSocket.  Checks that the driver sends exactly
+    the recorded requests and replays the recorded responses.
+    """
+    def __init__(self, exchanges, test_case):
+        self._exchanges = list(exchanges)
+        self._test_case = test_case
+        self._responses = []
+        self.closed = False
+
+    def send(self, data):
+        self._test_case.assertTrue(self._exchanges,
+                                   "Unexpected request %s" %
+                                   data.encode("hex"))
+        exchange = self._exchanges.pop(0)
+        self._test_case.assertEqual(data.encode("hex"), exchange["sent"])
+        self._responses.extend(r.decode("hex") for r in exchange["received"])
+
+    def recv(self):
+        self._test_case.assertTrue(self._responses, "Unexpected recv()")
+        return self._responses.pop(0)
+
+    def close(self):
+        self.closed = True
+
+    def assert_finished(self):
+        self._test_case.assertEqual(self._exchanges, [])
+        self._test_case.assertEqual(self._responses, [])
+
+
+class AckingSocket(object):
+    """
+    Stands in for a NetlinkSocket.  Acknowledges every request, one
+    datagram per ack as the kernel does, and records what was sent.
+    """
+    def __init__(self, errors=None):
+        """
+        :param errors: Optional callable taking (command, body) and
+            returning an errno with which to fail the request, or 0.
+        """
+        self.errors = errors or (lambda command, body: 0)
+        self.sent = []
+        self._responses = []
+        self.closed = False
+
+    def send(self, data):
+        self.sent.append(data)
+        for msg_type, seq, body in parse_messages(data):
+            error = self.errors(msg_type & 0xff, body)
+            header = struct.pack("=IHHII", 16 + len(body), msg_type, 0, seq,
+                                 0)
+            payload = struct.pack("=i", -error) + header
+            self._responses.append(
+                struct.pack("=IHHII", 16 + len(payload), NLMSG_ERROR, 0, seq,
+                            0) + payload)
+
+    def recv(self):
+        return self._responses.pop(0)
+
+    def close(self):
+        self.closed = True
+
+    def sent_messages(self):
+        """
+        :returns list[tuple]: (command, body) of each request sent.
+        """
+        return [(msg_type & 0xff, body) for data in self.sent
+                for msg_type, _, body in parse_messages(data)]
+
+
+class RecordingSocket(NetlinkSocket):
+    """
+    NetlinkSocket that records the traffic that passes through it.
+    """
+    def __init__(self):
+        super(RecordingSocket, self).__init__()
+        self.exchanges = []
+
+    def send(self, data):
+        self.exchanges.append({"sent": data.encode("hex"), "received": []})
+        super(RecordingSocket, self).send(data)
+
+    def recv(self):
+        data = super(RecordingSocket, self).recv()
+        self.exchanges[-1]["received"].append(data.encode("hex"))
+        return data
+
+
+def _record(ip_type, fn):
+    socks = []
+
+    def sock_factory():
+        socks.append(RecordingSocket())
+        return socks[-1]
+
+    driver = NetlinkIpsetDriver(ip_type, sock_factory=sock_factory)
+    try:
+        fn(driver)
+    except Exception as e:
+        print >> sys.stderr, "Recorded error: %r" % e
+    return socks[0].exchanges
+
+
+def record_all():
+    """
+    Runs each of the scenarios used by the UTs against the kernel.
+    """
+    fixtures = {}
+    fixtures["replace_v4"] = _record(
+        IPV4, lambda d: d.replace_members("felix-v4-rec", "felix-tmp-v4-rec",
+                                          set(["10.0.0.1", "10.0.0.2"])))
+    fixtures["list_names"] = _record(IPV4, lambda d: d.list_names())
+    fixtures["destroy"] = _record(IPV4, lambda d: d.destroy("felix-v4-rec"))
+    fixtures["replace_v6"] = _record(
+        IPV6, lambda d: d.replace_members("felix-v6-rec", "felix-tmp-v6-rec",
+                                          set(["dead::1"])))
+    fixtures["add_missing_set"] = _record(
+        IPV6, lambda d: d.execute(d.add_msgs("felix-v6-missing",
+                                             ["dead::2"])))
+    fixtures["destroy_v6"] = _record(IPV6,
+                                     lambda d: d.destroy("felix-v6-rec"))
+    return fixtures
+
+
+if __name__ == "__main__":
+    print json.dumps(record_all(), indent=2, sort_keys=True)
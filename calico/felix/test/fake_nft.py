@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.fake_nft
+~~~~~~~~~~~~~~~~~~~
+
+A fake "nft" for testing the nftables backend.
+
+FakeNft understands the subset of the nft command language that Felix
+generates.  It models tables, chains, rules and sets and enforces the
+same consistency rules as the kernel: jump targets and sets must exist,
+chains and sets can only be deleted when nothing references them and
+scripts are applied atomically.
+
+The module can also be run as a script, in which case it behaves like the
+nft binary, persisting its state in the JSON file named by the
+FAKE_NFT_STATE environment variable.
+"""
+import copy
+import json
+import os
+import re
+import sys
+
+from calico.felix.futils import CommandOutput, FailedSystemCall
+
+
+class FakeNftError(Exception):
+    pass
+
+
+class FakeNft(object):
+    def __init__(self, state=None):
+        # tables[(family, table)] = {"chains": {name: [rules]},
+        #                            "hooks": {name: hook},
+        #                            "sets": {name: [elements]}}
+        self.tables = state or {}
+        self.scripts = []
+
+    def check_call(self, args, input_str=None):
+        """
+        Stand-in for futils.check_call() that runs the given nft command.
+        """
+        try:
+            return CommandOutput(self.run(args[1:], input_str), "")
+        except FakeNftError as e:
+            raise FailedSystemCall("Failed system call", args, 1, "",
+                                   str(e), input=input_str)
+
+    def run(self, args, input_str=None):
+        if args[:2] == ["-f", "-"]:
+            self.apply_script(input_str)
+            return ""
+        elif args[:2] == ["list", "table"]:
+            return self.list_table(args[2], args[3])
+        else:
+            self.apply_script(" ".join(args))
+            return ""
+
+    def apply_script(self, script):
+        """
+        Applies the given script atomically: if any line fails, none of
+        the changes are made.
+        """
+        self.scripts.append(script)
+        tables = copy.deepcopy(self.tables)
+        for line_no, line in enumerate(script.splitlines()):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                self._apply_line(tables, line)
+            except FakeNftError as e:
+                raise FakeNftError("Error on line %s (%s): %s" %
+                                   (line_no + 1, line, e))
+        self.tables = tables
+
+    def _apply_line(self, tables, line):
+        words = line.split(" ")
+        op, obj = words[0], words[1]
+        if obj == "table":
+            if op != "add":
+                raise FakeNftError("Unsupported table operation")
+            tables.setdefault(self._key(words[2], words[3]),
+                              {"chains": {}, "hooks": {}, "sets": {}})
+            return
+        table = self._table(tables, words[2], words[3])
+        name = words[4]
+        rest = " ".join(words[5:])
+        if obj == "chain":
+            chains = table["chains"]
+            if op == "add":
+                chains.setdefault(name, [])
+                if rest:
+                    table["hooks"][name] = rest.strip("{} ")
+            elif name not in chains:
+                raise FakeNftError("No such chain %s" % name)
+            elif op == "flush":
+                chains[name] = []
+            elif op == "delete":
+                if chains[name]:
+                    raise FakeNftError("Chain %s is not empty" % name)
+                if name in self._references(table):
+                    raise FakeNftError("Chain %s is in use" % name)
+                del chains[name]
+                table["hooks"].pop(name, None)
+            else:
+                raise FakeNftError("Unsupported chain operation")
+        elif obj == "rule":
+            if name not in table["chains"]:
+                raise FakeNftError("No such chain %s" % name)
+            for target in re.findall(r"\b(?:jump|goto) ([^\s,}]+)", rest):
+                if target not in table["chains"]:
+                    raise FakeNftError("Could not find chain %s" % target)
+            for set_name in re.findall(r"@(\S+)", rest):
+                if set_name not in table["sets"]:
+                    raise FakeNftError("Could not find set %s" % set_name)
+            if op == "add":
+                table["chains"][name].append(rest)
+            elif op == "insert":
+                table["chains"][name].insert(0, rest)
+            else:
+                raise FakeNftError("Unsupported rule operation")
+        elif obj == "set":
+            sets = table["sets"]
+            if op == "add":
+                sets.setdefault(name, [])
+            elif name not in sets:
+                raise FakeNftError("No such set %s" % name)
+            elif op == "flush":
+                sets[name] = []
+            elif op == "delete":
+                for rules in table["chains"].values():
+                    if any(("@%s" % name) in r.split() for r in rules):
+                        raise FakeNftError("Set %s is in use" % name)
+                del sets[name]
+            else:
+                raise FakeNftError("Unsupported set operation")
+        elif obj == "element":
+            if op != "add" or name not in table["sets"]:
+                raise FakeNftError("No such set %s" % name)
+            elements = [e.strip() for e in rest.strip("{} ").split(",")]
+            members = table["sets"][name]
+            members.extend(e for e in elements if e and e not in members)
+        else:
+            raise FakeNftError("Unsupported object %s" % obj)
+
+    def _references(self, table):
+        refs = set()
+        for rules in table["chains"].values():
+            for rule in rules:
+                refs.update(re.findall(r"\b(?:jump|goto) ([^\s,}]+)", rule))
+        return refs
+
+    def _key(self, family, table):
+        return "%s %s" % (family, table)
+
+    def _table(self, tables, family, table):
+        try:
+            return tables[self._key(family, table)]
+        except KeyError:
+            raise FakeNftError("No such table %s %s" % (family, table))
+
+    def list_table(self, family, table_name):
+        """
+        :returns str: the table in the same format as "nft list table".
+        """
+        table = self._table(self.tables, family, table_name)
+        lines = ["table %s %s {" % (family, table_name)]
+        for name in sorted(table["sets"]):
+            lines.append("\tset %s {" % name)
+            members = table["sets"][name]
+            if members:
+                lines.append("\t\telements = { %s }" % ", ".join(members))
+            lines.append("\t}")
+        for name in sorted(table["chains"]):
+            lines.append("\tchain %s {" % name)
+            if name in table["hooks"]:
+                lines.append("\t\t%s" % table["hooks"][name])
+            for rule in table["chains"][name]:
+                lines.append("\t\t%s" % rule)
+            lines.append("\t}")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def chain(self, family, table_name, chain):
+        return self.tables[self._key(family, table_name)]["chains"][chain]
+
+    def set_members(self, family, table_name, set_name):
+        return self.tables[self._key(family, table_name)]["sets"][set_name]
+
+
+def main(argv):
+    state_file = os.environ["FAKE_NFT_STATE"]
+    state = None
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+    nft = FakeNft(state)
+    input_str = sys.stdin.read() if argv[:2] == ["-f", "-"] else None
+    try:
+        sys.stdout.write(nft.run(argv, input_str))
+    except FakeNftError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    with open(state_file, "w") as f:
+        json.dump(nft.tables, f)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -77,6 +77,7 @@ class TestConfig(unittest.TestCase):
 
             # Test defaulting.
             self.assertEqual(config.ETCD_ADDR, "localhost:4001")
+            self.assertEqual(config.ETCD_ADDRS, [("localhost", 4001)])
             self.assertEqual(config.HOSTNAME, socket.gethostname())
             self.assertEqual(config.IFACE_PREFIX, "blah")
             self.assertEqual(config.METADATA_PORT, 123)
@@ -95,6 +96,20 @@ class TestConfig(unittest.TestCase):
                                          data[filename]):
                 config = Config("calico/felix/test/data/%s" % filename)
 
+    def test_multiple_etcd_addrs(self):
+        env = {"FELIX_ETCDADDR": "9.9.9.9:1234, localhost:4001"}
+        with mock.patch.dict("os.environ", env):
+            with mock.patch('calico.common.complete_logging'):
+                config = Config("calico/felix/test/data/felix_missing.cfg")
+        self.assertEqual(config.ETCD_ADDRS,
+                         [("9.9.9.9", 1234), ("localhost", 4001)])
+
+        with mock.patch.dict("os.environ",
+                             {"FELIX_ETCDADDR": "9.9.9.9:1234,localhost"}):
+            with self.assertRaisesRegexp(ConfigException,
+                                         "Invalid format for field"):
+                Config("calico/felix/test/data/felix_missing.cfg")
+
     def test_no_logfile(self):
         # Logging to file can be excluded by explicitly saying "none" -
         # but if in etcd config the file is still created.
@@ -173,6 +188,146 @@ class TestConfig(unittest.TestCase):
                                          "Invalid log level.*%s" % field):
                 config.report_etcd_config({}, cfg_dict)
 
+    def test_dataplane_backend(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        self.assertEqual(config.DATAPLANE_BACKEND, "iptables")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "DataplaneBackend": "NFTables" }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+        self.assertEqual(config.DATAPLANE_BACKEND, "nftables")
+
+    def test_bad_dataplane_backend(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "DataplaneBackend": "ebtables" }
+        with self.assertRaisesRegexp(ConfigException,
+                                     "Invalid dataplane backend"):
+            config.report_etcd_config({}, cfg_dict)
+
+    def test_dispatch_mode(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        self.assertEqual(config.DISPATCH_MODE, "tree")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "DataplaneBackend": "nftables",
+                     "DispatchMode": "vmap" }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+        self.assertEqual(config.DISPATCH_MODE, "vmap")
+
+    def test_bad_dispatch_mode(self):
+        for mode, msg in (("list", "Invalid dispatch mode"),
+                          ("vmap", "vmap dispatch requires the nftables")):
+            with mock.patch('calico.common.complete_logging'):
+                config = Config("calico/felix/test/data/felix_missing.cfg")
+            cfg_dict = { "InterfacePrefix": "blah",
+                         "DispatchMode": mode }
+            with self.assertRaisesRegexp(ConfigException, msg):
+                config.report_etcd_config({}, cfg_dict)
+
+    def test_ipset_backend(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        self.assertEqual(config.IPSET_BACKEND, "command")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "IpsetBackend": "Netlink" }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+        self.assertEqual(config.IPSET_BACKEND, "netlink")
+
+    def test_bad_ipset_backend(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "IpsetBackend": "ioctl" }
+        with self.assertRaisesRegexp(ConfigException,
+                                     "Invalid ipset backend"):
+            config.report_etcd_config({}, cfg_dict)
+
+    def test_process_model(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        self.assertEqual(config.PROCESS_MODEL, "single")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "ProcessModel": "Per-IP-Version" }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+        self.assertEqual(config.PROCESS_MODEL, "per-ip-version")
+        # The etcd config is kept for the worker processes.
+        self.assertEqual(config.etcd_config,
+                         ({}, { "InterfacePrefix": "blah",
+                                "ProcessModel": "Per-IP-Version" }))
+
+    def test_bad_process_model(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "ProcessModel": "threads" }
+        with self.assertRaisesRegexp(ConfigException,
+                                     "Invalid process model"):
+            config.report_etcd_config({}, cfg_dict)
+
+    def test_parse_workers(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        self.assertEqual(config.PARSE_WORKERS, 0)
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "ParseWorkers": "4" }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+        self.assertEqual(config.PARSE_WORKERS, 4)
+
+    def test_parse_cache_size(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        self.assertEqual(config.PARSE_CACHE_SIZE, 0)
+        for value, valid in (("0", True), ("128", True), ("-1", False)):
+            with mock.patch('calico.common.complete_logging'):
+                config = Config("calico/felix/test/data/felix_missing.cfg")
+            cfg_dict = { "InterfacePrefix": "blah",
+                         "ParseCacheSize": value }
+            with mock.patch('calico.common.complete_logging'):
+                if valid:
+                    config.report_etcd_config({}, cfg_dict)
+                    self.assertEqual(config.PARSE_CACHE_SIZE, int(value))
+                else:
+                    self.assertRaises(ConfigException,
+                                      config.report_etcd_config,
+                                      {}, cfg_dict)
+
+    def test_bad_parse_workers(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "ParseWorkers": "-1" }
+        with self.assertRaisesRegexp(ConfigException,
+                                     "Invalid field value.*ParseWorkers"):
+            config.report_etcd_config({}, cfg_dict)
+
+    def test_tracing(self):
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "TraceSampleRate": "100" }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+        self.assertEqual(config.TRACE_SAMPLE_RATE, 100)
+        self.assertEqual(config.STATS_REPORT_INTERVAL, 60)
+
+    def test_bad_tracing(self):
+        for name, value in (("TraceSampleRate", "-1"),
+                            ("StatsReportInterval", "-1")):
+            with mock.patch('calico.common.complete_logging'):
+                config = Config("calico/felix/test/data/felix_missing.cfg")
+            cfg_dict = { "InterfacePrefix": "blah",
+                         name: value }
+            with self.assertRaisesRegexp(ConfigException,
+                                         "Invalid field value"):
+                config.report_etcd_config({}, cfg_dict)
+
     def test_blank_metadata_addr(self):
         with mock.patch('calico.common.complete_logging'):
             config = Config("calico/felix/test/data/felix_missing.cfg")
@@ -30,7 +30,8 @@ from calico.felix.dispatch import (
 
 
 # A mocked config object for use with interface_to_suffix.
-Config = collections.namedtuple('Config', ['IFACE_PREFIX', 'METADATA_IP', 'METADATA_PORT'])
+Config = collections.namedtuple('Config', ['IFACE_PREFIX', 'METADATA_IP',
+                                           'METADATA_PORT', 'DISPATCH_MODE'])
 
 
 class TestDispatchChains(BaseTestCase):
@@ -40,7 +41,7 @@ class TestDispatchChains(BaseTestCase):
     def setUp(self):
         super(TestDispatchChains, self).setUp()
         self.iptables_updater = mock.MagicMock()
-        self.config = Config('tap', None, 8775)
+        self.config = Config('tap', None, 8775, 'tree')
 
     def getDispatchChain(self):
         return DispatchChains(
@@ -77,7 +78,7 @@ class TestDispatchChains(BaseTestCase):
         """
         Tests that a snapshot with metadata works OK.
         """
-        self.config = Config('tap', '127.0.0.1', 8775)
+        self.config = Config('tap', '127.0.0.1', 8775, 'tree')
         d = self.getDispatchChain()
 
         ifaces = ['tapabcdef', 'tap123456', 'tapb7d849']
@@ -169,6 +170,45 @@ class TestDispatchChains(BaseTestCase):
                 '--append felix-TO-EP-PFX-b --jump DROP']
         })
 
+    def test_vmap_building(self):
+        self.config = Config('tap', '127.0.0.1', 8775, 'vmap')
+        d = self.getDispatchChain()
+        d.programmed_leaf_chains.add("felix-FROM-EP-PFX-a")
+        ifaces = ['tapa1', 'tapa2', 'tapb1']
+        to_delete, deps, updates, new_leaf_chains = d._calculate_update(ifaces)
+        # Leaf chains from the tree mode are no longer needed.
+        self.assertEqual(to_delete, set(["felix-FROM-EP-PFX-a"]))
+        self.assertEqual(new_leaf_chains, set())
+        self.assertEqual(deps, {
+            'felix-TO-ENDPOINT': set(['felix-to-a1', 'felix-to-a2',
+                                      'felix-to-b1']),
+            'felix-FROM-ENDPOINT': set(['felix-from-a1', 'felix-from-a2',
+                                        'felix-from-b1']),
+        })
+        self.assertEqual(updates, {
+            'felix-TO-ENDPOINT': [
+                '--append felix-TO-ENDPOINT --vmap-out-interface '
+                'tapa1=felix-to-a1,tapa2=felix-to-a2,tapb1=felix-to-b1',
+                '--append felix-TO-ENDPOINT --jump DROP'],
+            'felix-FROM-ENDPOINT': [
+                '--append felix-FROM-ENDPOINT --protocol tcp '
+                '--in-interface tap+ --destination 127.0.0.1 --dport 8775 '
+                '--jump RETURN',
+                '--append felix-FROM-ENDPOINT --vmap-in-interface '
+                'tapa1=felix-from-a1,tapa2=felix-from-a2,tapb1=felix-from-b1',
+                '--append felix-FROM-ENDPOINT --jump DROP'],
+        })
+
+    def test_vmap_building_empty(self):
+        self.config = Config('tap', None, 8775, 'vmap')
+        d = self.getDispatchChain()
+        _, deps, updates, _ = d._calculate_update([])
+        self.assertEqual(updates, {
+            'felix-TO-ENDPOINT': ['--append felix-TO-ENDPOINT --jump DROP'],
+            'felix-FROM-ENDPOINT': [
+                '--append felix-FROM-ENDPOINT --jump DROP'],
+        })
+
     def test_applying_snapshot_clean(self):
         """
         Tests that a snapshot can be applied to a previously unused actor.
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fake_dataplane
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the simulated dataplane and the benchmark harness that uses it.
+"""
+import logging
+import unittest
+
+from calico.felix import devices, futils
+from calico.felix.fiptables import (_extract_our_chains,
+                                    _extract_our_unreffed_chains,
+                                    _parse_ipt_restore_error)
+from calico.felix.futils import FailedSystemCall, IPV4
+from calico.felix.ipsets import IpsetCommandDriver, list_ipset_names
+from calico.felix.test.base import BaseTestCase
+from calico.felix.test.bench_felix import SyntheticDeployment, run_benchmark
+from calico.felix.test.fake_dataplane import FakeDataplane
+
+_log = logging.getLogger(__name__)
+
+
+class TestFakeDataplane(unittest.TestCase):
+    def setUp(self):
+        self.dp = FakeDataplane(realtime=False)
+
+    def restore(self, *lines):
+        return self.dp.check_call(["iptables-restore", "--noflush",
+                                   "--verbose"],
+                                  input_str="\n".join(lines) + "\n")
+
+    def test_restore_and_save(self):
+        self.restore("*filter",
+                     ":felix-a -",
+                     ":felix-b -",
+                     "--append felix-a --jump felix-b",
+                     '--append felix-b --match comment --comment "a b" '
+                     '--jump DROP',
+                     "COMMIT")
+        self.assertEqual(self.dp.chains(4, "filter")["felix-b"],
+                         [("--match", "comment", "--comment", "a b",
+                           "--jump", "DROP")])
+        save = self.dp.check_output(["iptables-save", "--table", "filter"])
+        self.assertEqual(_extract_our_chains("filter", save),
+                         set(["felix-a", "felix-b"]))
+        listing = self.dp.check_output(["iptables", "--wait", "--list",
+                                        "--table", "filter"])
+        self.assertEqual(_extract_our_unreffed_chains(listing),
+                         set(["felix-a"]))
+
+    def test_restore_is_atomic_per_table(self):
+        self.restore("*filter", ":felix-a -", "COMMIT")
+        self.assertRaises(FailedSystemCall, self.restore,
+                          "*filter",
+                          "--append felix-a --jump DROP",
+                          "--append felix-a --jump felix-missing",
+                          "COMMIT")
+        self.assertEqual(self.dp.chains(4, "filter")["felix-a"], [])
+
+    def test_restore_error_format(self):
+        lines = ["*filter", "--delete INPUT --jump felix-INPUT", "COMMIT"]
+        try:
+            self.restore(*lines)
+        except FailedSystemCall as e:
+            retryable, _ = _parse_ipt_restore_error(lines, e.stderr)
+            self.assertFalse(retryable)
+            self.assertTrue("line 2 failed" in e.stderr)
+        else:
+            self.fail("Expected failure")
+
+    def test_delete_chain_in_use(self):
+        self.restore("*filter", ":felix-a -", ":felix-b -",
+                     "--append felix-a --goto felix-b", "COMMIT")
+        self.assertRaises(FailedSystemCall, self.restore,
+                          "*filter", "--delete-chain felix-b", "COMMIT")
+        self.restore("*filter", ":felix-a -", ":felix-b -",
+                     "--delete-chain felix-a", "--delete-chain felix-b",
+                     "COMMIT")
+        self.assertFalse("felix-b" in self.dp.chains(4, "filter"))
+
+    def test_ipset_driver(self):
+        with self.dp.patched():
+            driver = IpsetCommandDriver(IPV4)
+            driver.replace_members("felix-v4-a", "felix-tmp-v4-a",
+                                   set(["10.0.0.1", "10.0.0.2"]))
+            driver.replace_members("felix-v4-a", "felix-tmp-v4-a",
+                                   set(["10.0.0.3"]))
+            self.assertEqual(list_ipset_names(), ["felix-v4-a"])
+            self.assertEqual(self.dp.ipsets["felix-v4-a"]["members"],
+                             set(["10.0.0.3"]))
+            self.restore("*filter", ":felix-a -",
+                         "--append felix-a --match set --match-set "
+                         "felix-v4-a src --jump ACCEPT",
+                         "COMMIT")
+            self.assertRaises(FailedSystemCall, driver.destroy, "felix-v4-a")
+
+    def test_ipset_driver_resize(self):
+        with self.dp.patched():
+            driver = IpsetCommandDriver(IPV4)
+            driver.replace_members("felix-v4-a", "felix-tmp-v4-a",
+                                   set(["10.0.0.1"]))
+            driver.replace_members("felix-v4-a", "felix-tmp-v4-a",
+                                   set(["10.0.0.2"]), hashsize=2048,
+                                   maxelem=131072)
+            self.assertEqual(self.dp.ipsets["felix-v4-a"]["maxelem"], 131072)
+            self.assertEqual(self.dp.ipsets["felix-v4-a"]["hashsize"], 2048)
+            self.assertEqual(self.dp.call_counts["ipset"], 2)
+            driver.replace_members("felix-v4-a", "felix-tmp-v4-a",
+                                   set(["10.0.0.3"]), hashsize=1024,
+                                   maxelem=65536)
+            self.assertEqual(self.dp.ipsets["felix-v4-a"]["maxelem"], 65536)
+            self.assertEqual(self.dp.call_counts["ipset"], 3)
+
+            # A new driver (as after a restart) doesn't know the size of the
+            # existing set so it has to retry without recreating it.
+            driver = IpsetCommandDriver(IPV4)
+            driver.replace_members("felix-v4-a", "felix-tmp-v4-a",
+                                   set(["10.0.0.4"]), hashsize=2048,
+                                   maxelem=131072)
+            self.assertEqual(self.dp.ipsets["felix-v4-a"],
+                             {"type": "hash:ip", "family": "inet",
+                              "hashsize": 2048, "maxelem": 131072,
+                              "members": set(["10.0.0.4"])})
+            self.assertEqual(sorted(self.dp.ipsets), ["felix-v4-a"])
+
+    def test_ipset_create_mismatch(self):
+        self.dp.check_call(["ipset", "restore"],
+                           input_str="create s hash:ip family inet\n")
+        self.dp.check_call(["ipset", "restore"],
+                           input_str="create s hash:ip family inet --exist\n")
+        self.assertRaises(FailedSystemCall, self.dp.check_call,
+                          ["ipset", "restore"],
+                          input_str="create s hash:ip family inet "
+                                    "maxelem 1 --exist\n")
+
+    def test_ipset_maxelem(self):
+        self.assertRaises(FailedSystemCall, self.dp.check_call,
+                          ["ipset", "restore"],
+                          input_str="create s hash:ip maxelem 1\n"
+                                    "add s 10.0.0.1\n"
+                                    "add s 10.0.0.2\n")
+        # ipset restore isn't transactional.
+        self.assertEqual(self.dp.ipsets["s"]["members"], set(["10.0.0.1"]))
+
+    def test_interfaces_and_routes(self):
+        with self.dp.patched():
+            self.assertFalse(devices.interface_exists("tap1"))
+            self.assertRaises(IOError, devices.configure_interface_ipv4,
+                              "tap1")
+            self.dp.add_interface("tap1")
+            self.assertTrue(devices.interface_exists("tap1"))
+            self.assertTrue(devices.interface_up("tap1"))
+            devices.set_routes(futils.IPV4, set(["10.0.0.1"]), "tap1",
+                               "01:02:03:04:05:06")
+            self.assertEqual(devices.list_interface_ips(futils.IPV4, "tap1"),
+                             set(["10.0.0.1"]))
+            devices.set_routes(futils.IPV4, set(), "tap1")
+            self.assertEqual(devices.list_interface_ips(futils.IPV4, "tap1"),
+                             set())
+
+    def test_stats(self):
+        self.dp.costs["exec"] = 1.0
+        self.restore("*filter", "COMMIT")
+        self.assertRaises(FailedSystemCall, self.dp.check_call, ["foo"])
+        stats = self.dp.stats()
+        self.assertEqual(stats["calls"], 2)
+        self.assertEqual(stats["calls_by_command"],
+                         {"iptables-restore": 1, "foo": 1})
+        self.assertEqual(stats["input_bytes"], len("*filter\nCOMMIT\n"))
+        self.assertTrue(stats["simulated_seconds"] >= 2.0)
+
+
+class TestBenchmark(BaseTestCase):
+    def test_small_run(self):
+        deployment = SyntheticDeployment(20, 4, 4, num_hosts=2, ipv6=True)
+        results = run_benchmark(deployment, FakeDataplane(realtime=False),
+                                timeout=30, poll_interval=0.01,
+                                trace_sample_rate=1)
+        self.assertEqual(results["local_endpoints"], 10)
+        self.assertTrue(results["calls_by_command"]["iptables-restore"] > 0)
+        self.assertTrue(results["input_bytes"] > 0)
+        self.assertTrue(results["peak_rss_kb"] > 0)
+        snapshot_trace = results["trace"]["trace.snapshot.total"]
+        self.assertEqual(snapshot_trace["count"], 1)
+        self.assertTrue(results["trace"]["trace.snapshot.commit.rules"])
+
+    def test_small_run_nftables(self):
+        deployment = SyntheticDeployment(10, 2, 2)
+        results = run_benchmark(deployment, FakeDataplane(realtime=False),
+                                backend="nftables", dispatch_mode="vmap",
+                                timeout=30, poll_interval=0.01)
+        self.assertTrue(results["calls_by_command"]["nft"] > 0)
+        self.assertFalse("iptables-restore" in results["calls_by_command"])
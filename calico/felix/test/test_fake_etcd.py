@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fake_etcd
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the in-memory etcd stand-in.
+"""
+import logging
+import unittest
+
+from etcd import (EtcdKeyNotFound, EtcdEventIndexCleared,
+                  EtcdClusterIdChanged)
+import gevent
+from urllib3.exceptions import ReadTimeoutError
+
+from calico.felix.test import fake_etcd
+from calico.felix.test.fake_etcd import FakeEtcd
+
+_log = logging.getLogger(__name__)
+
+
+class TestFakeEtcd(unittest.TestCase):
+    def setUp(self):
+        self.etcd = FakeEtcd(cluster_id="cluster-1")
+        self.client = self.etcd.client()
+
+    def test_read_leaf_and_dirs(self):
+        self.etcd.set("/a/b/c", "1")
+        self.etcd.set("/a/d", "2")
+        self.assertEqual(self.client.read("/a/d").value, "2")
+        leaves = self.client.read("/a", recursive=True).children
+        self.assertEqual([(n.key, n.value) for n in leaves],
+                         [("/a/b/c", "1"), ("/a/d", "2")])
+        result = self.client.read("/a")
+        self.assertEqual(result.etcd_index, 2)
+        self.assertEqual([(n.key, n.dir) for n in result.children],
+                         [("/a/b", True), ("/a/d", False)])
+        self.assertRaises(EtcdKeyNotFound, self.client.read, "/x")
+
+    def test_recursive_delete(self):
+        self.etcd.set("/a/b/c", "1")
+        self.assertRaises(EtcdKeyNotFound, self.etcd.delete, "/a/b")
+        self.etcd.delete("/a/b", recursive=True)
+        event = self.client.read("/a", wait=True, waitIndex=2,
+                                 recursive=True)
+        self.assertEqual((event.action, event.key, event.dir),
+                         ("delete", "/a/b", True))
+        self.assertRaises(EtcdKeyNotFound, self.client.read, "/a/b/c")
+
+    def test_wait_blocks_for_event(self):
+        self.etcd.set("/a/b", "1")
+        gevent.spawn_later(0.01, self.etcd.set, "/a/c", "2")
+        event = self.client.read("/a", wait=True, waitIndex=2,
+                                 recursive=True)
+        self.assertEqual((event.key, event.value, event.modifiedIndex),
+                         ("/a/c", "2", 2))
+
+    def test_wait_timeout(self):
+        self.assertRaises(ReadTimeoutError, self.client.read, "/a",
+                          wait=True, waitIndex=1, timeout=0.01)
+
+    def test_history_cleared(self):
+        for i in xrange(fake_etcd.HISTORY_SIZE + 1):
+            self.etcd.set("/a", str(i))
+        self.assertRaises(EtcdEventIndexCleared, self.client.read, "/a",
+                          wait=True, waitIndex=1)
+
+    def test_cluster_id_change(self):
+        self.etcd.set("/a", "1")
+        self.client.read("/a")
+        self.etcd.set_cluster_id("cluster-2")
+        self.assertRaises(EtcdClusterIdChanged, self.client.read, "/a",
+                          wait=True, waitIndex=2, check_cluster_uuid=True)
+
+    def test_cluster_id_change_wakes_waiter(self):
+        self.etcd.set("/a", "1")
+        self.client.read("/a")
+        gevent.spawn_later(0.01, self.etcd.set_cluster_id, "cluster-2")
+        self.assertRaises(EtcdClusterIdChanged, self.client.read, "/a",
+                          wait=True, waitIndex=2, check_cluster_uuid=True)
@@ -50,6 +50,10 @@ class TestBasic(BaseTestCase):
         else:
             sys.modules['etcd'] = self._real_etcd
 
+    def _stats_reporter_started(self, m_start):
+        return any(c[0][0]._run == felix._report_stats_periodically
+                   for c in m_start.call_args_list)
+
     @mock.patch("calico.felix.fetcd.EtcdWatcher.load_config")
     @mock.patch("gevent.Greenlet.start", autospec=True)
     @mock.patch("calico.felix.felix.IptablesUpdater", autospec=True)
@@ -60,6 +64,62 @@ class TestBasic(BaseTestCase):
         m_config.HOSTNAME = "myhost"
         m_config.IFACE_PREFIX = "tap"
         m_config.METADATA_IP = None
+        m_config.DATAPLANE_BACKEND = "iptables"
+        m_config.IPSET_BACKEND = "command"
+        m_config.PROCESS_MODEL = "single"
+        m_config.PARSE_WORKERS = 0
+        m_config.TRACE_SAMPLE_RATE = 0
+        m_config.STATS_REPORT_INTERVAL = 60
         self.assertRaises(TestException,
                           felix._main_greenlet, m_config)
         m_load.assert_called_once_with(async=False)
+        # Stats are reported even though tracing is off.
+        self.assertTrue(self._stats_reporter_started(m_start))
+
+    @mock.patch("calico.felix.fetcd.EtcdWatcher.load_config")
+    @mock.patch("gevent.Greenlet.start", autospec=True)
+    @mock.patch("calico.felix.felix.IptablesUpdater", autospec=True)
+    @mock.patch("calico.felix.felix.WorkerSupervisor", autospec=True)
+    @mock.patch("calico.felix.felix.ParsePool", autospec=True)
+    @mock.patch("gevent.iwait", autospec=True, side_effect=TestException())
+    def test_main_greenlet_per_ip_version(self, m_iwait, m_ParsePool,
+                                          m_WorkerSupervisor,
+                                          m_IptablesUpdater, m_start,
+                                          m_load):
+        m_config = mock.Mock(spec=config.Config)
+        m_config.HOSTNAME = "myhost"
+        m_config.PROCESS_MODEL = "per-ip-version"
+        m_config.PARSE_WORKERS = 2
+        m_config.TRACE_SAMPLE_RATE = 0
+        m_config.STATS_REPORT_INTERVAL = 0
+        m_supervisor = m_WorkerSupervisor.return_value
+        m_supervisor.greenlet = mock.Mock()
+        self.assertRaises(TestException,
+                          felix._main_greenlet, m_config)
+        m_supervisor.start_workers.assert_called_once_with(async=False)
+        # The dataplane is left to the workers.
+        self.assertFalse(m_IptablesUpdater.called)
+        m_ParsePool.assert_called_once_with(m_config, 2)
+        self.assertFalse(self._stats_reporter_started(m_start))
+
+    @mock.patch("calico.felix.felix.WorkerReceiver", autospec=True)
+    @mock.patch("gevent.Greenlet.start", autospec=True)
+    @mock.patch("calico.felix.felix.IptablesUpdater", autospec=True)
+    @mock.patch("gevent.iwait", autospec=True, side_effect=TestException())
+    def test_worker_greenlet(self, m_iwait, m_IptablesUpdater, m_start,
+                             m_WorkerReceiver):
+        m_IptablesUpdater.return_value.greenlet = mock.Mock()
+        m_config = mock.Mock(spec=config.Config)
+        m_config.IFACE_PREFIX = "tap"
+        m_config.METADATA_IP = None
+        m_config.DATAPLANE_BACKEND = "iptables"
+        m_config.IPSET_BACKEND = "command"
+        m_config.TRACE_SAMPLE_RATE = 0
+        m_config.STATS_REPORT_INTERVAL = 60
+        self.assertRaises(TestException,
+                          felix._worker_greenlet, m_config, 6)
+        self.assertTrue(self._stats_reporter_started(m_start))
+        m_receiver = m_WorkerReceiver.return_value
+        m_receiver.load_config.assert_called_once_with(m_config)
+        # Only the IPv6 filter table.
+        m_IptablesUpdater.assert_called_once_with("filter", ip_version=6)
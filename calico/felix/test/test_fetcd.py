@@ -2,12 +2,17 @@
 import json
 
 import logging
-from etcd import EtcdResult
-from mock import Mock, call
+from etcd import EtcdResult, EtcdConnectionFailed, EtcdWatchTimedOut
+from mock import Mock, call, patch
+from calico import stats
 from calico.datamodel_v1 import EndpointId
-from calico.felix.fetcd import EtcdWatcher, ResyncRequired
+from calico.felix import fetcd
+from calico.felix.fetcd import (EtcdWatcher, ResyncRequired, _update_type,
+                                parse_node)
+from calico.felix.parsepool import ParsePool
 from calico.felix.splitter import UpdateSplitter
 from calico.felix.test.base import BaseTestCase
+from calico.lru import LRUCache
 
 _log = logging.getLogger(__name__)
 
@@ -42,9 +47,11 @@ class TestExcdWatcher(BaseTestCase):
         super(TestExcdWatcher, self).setUp()
         m_config = Mock()
         m_config.IFACE_PREFIX = "tap"
+        m_config.ETCD_ADDRS = [("etcd1", 4001), ("etcd2", 4001)]
         self.watcher = EtcdWatcher(m_config)
         self.m_splitter = Mock(spec=UpdateSplitter)
         self.watcher.splitter = self.m_splitter
+        stats.reset()
 
     def test_ready_flag_set(self):
         self.dispatch("/calico/v1/Ready", "set", value="true")
@@ -179,7 +186,277 @@ class TestExcdWatcher(BaseTestCase):
             async=True,
         )
 
-    def dispatch(self, key, action, value=None):
+    def test_load_initial_dump(self):
+        self.watcher.client = Mock()
+        self.watcher.client.read.return_value = self.snapshot()
+        self.watcher.load_initial_dump()
+        self.assert_snapshot_applied()
+
+    def test_load_initial_dump_parse_pool(self):
+        self.watcher.client = Mock()
+        self.watcher.client.read.return_value = self.snapshot()
+        m_pool = Mock(spec=ParsePool)
+        m_pool.parse_nodes.side_effect = (
+            lambda nodes: [(n, parse_node(self.watcher.config, n))
+                           for n in nodes]
+        )
+        self.watcher.parse_pool = m_pool
+        self.watcher.load_initial_dump()
+        self.assert_snapshot_applied()
+        # The Ready flag is checked by the watcher itself.
+        nodes = m_pool.parse_nodes.call_args[0][0]
+        self.assertEqual(len(nodes), 4)
+
+    def test_load_initial_dump_not_ready(self):
+        self.watcher.client = Mock()
+        self.watcher.client.read.return_value = self.snapshot(ready="false")
+        self.assertRaises(ResyncRequired, self.watcher.load_initial_dump)
+
+    def test_updates_parse_pool(self):
+        m_pool = Mock(spec=ParsePool)
+        m_pool.parse_node.side_effect = (
+            lambda n: parse_node(self.watcher.config, n)[:2] + ("parsed",)
+        )
+        self.watcher.parse_pool = m_pool
+        self.dispatch("/calico/v1/host/h1/workload/o1/w1/endpoint/e1",
+                      "set", value=ENDPOINT_STR)
+        self.dispatch("/calico/v1/policy/profile/prof1/rules", "set",
+                      value=RULES_STR)
+        self.dispatch("/calico/v1/policy/profile/prof1/tags", "set",
+                      value=TAGS_STR)
+        self.assertEqual(m_pool.parse_node.call_count, 3)
+        self.m_splitter.on_endpoint_update.assert_called_once_with(
+            EndpointId("h1", "o1", "w1", "e1"), "parsed", async=True)
+        self.m_splitter.on_rules_update.assert_called_once_with(
+            "prof1", "parsed", async=True)
+        self.m_splitter.on_tags_update.assert_called_once_with(
+            "prof1", "parsed", async=True)
+
+    def test_parse_cache(self):
+        self.watcher.parse_cache = LRUCache("parse_cache", 1024 * 1024)
+        self.watcher.client = Mock()
+        self.watcher.client.read.return_value = self.snapshot()
+        self.watcher.load_initial_dump()
+        self.assert_snapshot_applied()
+        self.assertEqual(len(self.watcher.parse_cache), 4)
+
+        # Resync with one changed endpoint, from a different cluster to
+        # force a full resync.
+        self.watcher.client.expected_cluster_id = "other-cluster"
+        self.m_splitter.reset_mock()
+        snapshot = self.snapshot()
+        changed = snapshot.children[3]
+        changed.value = json.dumps(dict(VALID_ENDPOINT, name="tap5678"))
+        changed.modifiedIndex = 50
+        self.watcher.client.read.return_value = snapshot
+        with patch("calico.felix.fetcd.json_decoder") as m_decoder:
+            m_decoder.decode.side_effect = json.loads
+            self.watcher.load_initial_dump()
+        # Only the changed node was parsed.
+        m_decoder.decode.assert_called_once_with(changed.value)
+        endpoints = self.m_splitter.apply_snapshot.call_args[0][2]
+        self.assertEqual(endpoints[EndpointId("h1", "o1", "w1", "e1")]["name"],
+                         "tap5678")
+        self.assertEqual(stats.counter("parse_cache.hits"), 3)
+
+        # Updates are cached too.
+        self.dispatch("/calico/v1/policy/profile/prof2/rules", "set",
+                      value=RULES_STR, modified_index=60)
+        self.assertEqual(
+            self.watcher.parse_cache.get(
+                ("/calico/v1/policy/profile/prof2/rules", 60)),
+            ("rules", "prof2", RULES))
+
+    def test_delta_resync(self):
+        self.watcher.client = Mock()
+        self.watcher.client.expected_cluster_id = "cluster"
+        self.watcher.client.read.return_value = self.snapshot()
+        self.watcher.load_initial_dump()
+        self.assert_snapshot_applied()
+        self.m_splitter.reset_mock()
+
+        # Updates while we're polling are tracked.
+        self.dispatch("/calico/v1/policy/profile/prof2/tags", "set",
+                      value=TAGS_STR, modified_index=20)
+        self.dispatch("/calico/v1/policy/profile/prof3/tags", "set",
+                      value=TAGS_STR, modified_index=21)
+        self.dispatch("/calico/v1/policy/profile/prof3", "delete")
+        self.m_splitter.reset_mock()
+
+        # Resync: prof1's rules change, prof1's tags are deleted, a new
+        # endpoint appears and prof2's tags, which we only learned about
+        # from an update, are unchanged.
+        snapshot = self.snapshot()
+        rules_node, tags_node = snapshot.children[1:3]
+        snapshot.children.remove(tags_node)
+        rules_node.modifiedIndex = 30
+        rules_node.value = json.dumps({"inbound_rules": [],
+                                       "outbound_rules": [{}]})
+        snapshot.children.append(self.node(
+            "/calico/v1/host/h2/workload/o1/w1/endpoint/e3", ENDPOINT_STR,
+            31))
+        snapshot.children.append(self.node(
+            "/calico/v1/policy/profile/prof2/tags", TAGS_STR, 20))
+        self.watcher.client.read.return_value = snapshot
+        self.watcher.load_initial_dump()
+
+        self.assertFalse(self.m_splitter.apply_snapshot.called)
+        self.m_splitter.on_rules_update.assert_called_once_with(
+            "prof1", {"inbound_rules": [], "outbound_rules": [{}]},
+            async=True)
+        self.m_splitter.on_tags_update.assert_called_once_with(
+            "prof1", None, async=True)
+        self.m_splitter.on_endpoint_update.assert_called_once_with(
+            EndpointId("h2", "o1", "w1", "e3"), VALID_ENDPOINT, async=True)
+        self.assertEqual(stats.counter("resync.delta.changed"), 2)
+        self.assertEqual(stats.counter("resync.delta.deleted"), 1)
+        self.assertEqual(self.watcher.endpoint_ids_per_host["h2"],
+                         set([EndpointId("h2", "o1", "w1", "e3")]))
+
+        # Resyncing again with no changes sends nothing.
+        self.m_splitter.reset_mock()
+        self.watcher.load_initial_dump()
+        self.assertEqual(self.m_splitter.method_calls, [])
+        self.assertEqual(stats.counter("resync.delta"), 2)
+
+    def test_resync_other_cluster(self):
+        self.watcher.client = Mock()
+        self.watcher.client.expected_cluster_id = "cluster"
+        self.watcher.client.read.return_value = self.snapshot()
+        self.watcher.load_initial_dump()
+        self.m_splitter.reset_mock()
+        # A different cluster's modifiedIndexes mean nothing.
+        self.watcher.client.expected_cluster_id = "other-cluster"
+        self.watcher.load_initial_dump()
+        self.assert_snapshot_applied()
+        self.assertEqual(stats.counter("resync.full"), 2)
+
+    def node(self, key, value, modified_index=10):
+        node = Mock(spec=EtcdResult)
+        node.key = key
+        node.action = "get"
+        node.value = value
+        node.modifiedIndex = modified_index
+        return node
+
+    def snapshot(self, ready="true"):
+        children = []
+        for key, value in [
+            ("/calico/v1/Ready", ready),
+            ("/calico/v1/policy/profile/prof1/rules", RULES_STR),
+            ("/calico/v1/policy/profile/prof1/tags", TAGS_STR),
+            ("/calico/v1/host/h1/workload/o1/w1/endpoint/e1", ENDPOINT_STR),
+            ("/calico/v1/host/h1/workload/o1/w1/endpoint/e2",
+             json.dumps(dict(VALID_ENDPOINT, name="eth0"))),
+        ]:
+            children.append(self.node(key, value))
+        m_snapshot = Mock(spec=EtcdResult)
+        m_snapshot.children = children
+        m_snapshot.etcd_index = 100
+        return m_snapshot
+
+    def assert_snapshot_applied(self):
+        endpoint_id = EndpointId("h1", "o1", "w1", "e1")
+        self.m_splitter.apply_snapshot.assert_called_once_with(
+            {"prof1": RULES},
+            {"prof1": TAGS},
+            {endpoint_id: VALID_ENDPOINT},
+            async=True,
+        )
+        # The endpoint that failed validation is left out of the snapshot
+        # but, as for an update, we still track it.
+        self.assertEqual(self.watcher.endpoint_ids_per_host,
+                         {"h1": set([endpoint_id,
+                                     EndpointId("h1", "o1", "w1", "e2")])})
+        self.assertEqual(self.watcher.next_etcd_index, 101)
+
+    @patch("calico.felix.fetcd.gevent.sleep")
+    @patch("calico.felix.fetcd.etcd.Client")
+    def test_watch_timeout_keeps_client(self, m_client_cls, m_sleep):
+        self.watcher._reconnect()
+        m_client = m_client_cls.return_value
+        m_response = Mock(spec=EtcdResult)
+        m_response.modifiedIndex = 10
+        m_client.read.side_effect = [EtcdWatchTimedOut("timed out"),
+                                     m_response]
+        self.watcher.next_etcd_index = 5
+        self.assertEqual(self.watcher._wait_for_etcd_event(), m_response)
+        self.assertEqual(m_client.read.call_count, 2)
+        # The client, and its connections, survive the timeout.
+        self.assertEqual(m_client_cls.call_count, 1)
+        self.assertFalse(m_sleep.called)
+        self.assertEqual(self.watcher.next_etcd_index, 11)
+
+    @patch("calico.felix.fetcd.gevent.sleep")
+    @patch("calico.felix.fetcd.etcd.Client")
+    def test_connection_failover(self, m_client_cls, m_sleep):
+        self.watcher._reconnect()
+        m_client = m_client_cls.return_value
+        m_response = Mock(spec=EtcdResult)
+        m_response.modifiedIndex = 10
+        m_client.read.side_effect = [EtcdConnectionFailed("failed"),
+                                     EtcdConnectionFailed("failed"),
+                                     m_response]
+        self.watcher.next_etcd_index = 5
+        with patch("calico.felix.fetcd.time.time", return_value=1000):
+            self.assertEqual(self.watcher._wait_for_etcd_event(), m_response)
+        # We failed over to the second server and then, since it failed too,
+        # back to the first, continuing from the same index.
+        self.assertEqual([c[1]["host"] for c in m_client_cls.call_args_list],
+                         ["etcd1", "etcd2", "etcd1"])
+        for c in m_client.read.call_args_list:
+            self.assertEqual(c[1]["waitIndex"], 5)
+        self.assertEqual(self.watcher.next_etcd_index, 11)
+        # Jittered, exponential backoff.
+        (delay1,), _ = m_sleep.call_args_list[0]
+        (delay2,), _ = m_sleep.call_args_list[1]
+        self.assertTrue(0.5 <= delay1 <= 1)
+        self.assertTrue(1 <= delay2 <= 2)
+        self.assertEqual(stats.counter("etcd.connection_failures"), 2)
+        # Success resets the backoff and the health of the server.
+        self.assertEqual(self.watcher.reconnect_delay,
+                         fetcd.RECONNECT_DELAY_MIN)
+        self.assertEqual(self.watcher.addr_failure_times,
+                         {("etcd2", 4001): 1000})
+
+    def test_reconnect_delay_limit(self):
+        self.watcher.etcd_addr = ("etcd1", 4001)
+        with patch("calico.felix.fetcd.gevent.sleep") as m_sleep:
+            for _ in xrange(10):
+                self.watcher._on_connection_failed(Exception())
+        (delay,), _ = m_sleep.call_args
+        self.assertTrue(fetcd.RECONNECT_DELAY_MAX / 2.0 <= delay <=
+                        fetcd.RECONNECT_DELAY_MAX)
+
+    def test_choose_etcd_addr(self):
+        watcher = self.watcher
+        hold_down = fetcd.FAILED_ADDR_HOLD_DOWN
+        with patch("calico.felix.fetcd.time.time", return_value=1000):
+            self.assertEqual(watcher._choose_etcd_addr(), ("etcd1", 4001))
+            watcher.addr_failure_times[("etcd1", 4001)] = 1000 - hold_down
+            self.assertEqual(watcher._choose_etcd_addr(), ("etcd1", 4001))
+            watcher.addr_failure_times[("etcd1", 4001)] = 990
+            self.assertEqual(watcher._choose_etcd_addr(), ("etcd2", 4001))
+            # If they've all failed, use the one that failed longest ago.
+            watcher.addr_failure_times[("etcd2", 4001)] = 980
+            self.assertEqual(watcher._choose_etcd_addr(), ("etcd2", 4001))
+
+    def test_update_type(self):
+        for key, action, expected in [
+            ("/calico/v1/host/h1/workload/o1/w1/endpoint/e1", "set",
+             "endpoint"),
+            ("/calico/v1/host/h1/workload/o1/w1/endpoint/e1", "expire",
+             "endpoint_delete"),
+            ("/calico/v1/policy/profile/p/rules", "compareAndSwap", "rules"),
+            ("/calico/v1/policy/profile/p/tags", "delete", "tags_delete"),
+            ("/calico/v1/Ready", "set", "other"),
+        ]:
+            m_response = Mock(spec=EtcdResult)
+            m_response.key = key
+            m_response.action = action
+            self.assertEqual(_update_type(m_response), expected)
+
+    def dispatch(self, key, action, value=None, modified_index=None):
         """
         Send an EtcdResult to the watcher's dispatcher.
         """
@@ -187,4 +464,5 @@ class TestExcdWatcher(BaseTestCase):
         m_response.key = key
         m_response.action = action
         m_response.value = value
+        m_response.modifiedIndex = modified_index
         self.watcher.dispatcher.handle_event(m_response)
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fnftables
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the nftables backend.
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from mock import patch
+
+from calico.felix import fnftables
+from calico.felix.fnftables import (
+    NftablesUpdater, NftSetDriver, fragment_to_nft, restore_input_to_nft,
+    NftTranslationError
+)
+from calico.felix.futils import IPV4, IPV6, FailedSystemCall
+from calico.felix.test import fake_nft
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+MISSING_CHAIN_DROP = 'drop comment "WARNING Missing chain DROP:"'
+
+
+class TestTranslation(BaseTestCase):
+    def test_endpoint_fragments(self):
+        for fragment, expected in [
+            ("--match conntrack --ctstate INVALID --jump DROP",
+             "ct state invalid drop"),
+            ("--match conntrack --ctstate RELATED,ESTABLISHED --jump RETURN",
+             "ct state { related, established } return"),
+            ("--protocol udp --sport 68 --dport 67 --jump RETURN",
+             "meta l4proto udp udp sport 68 udp dport 67 return"),
+            ("--jump MARK --set-mark 0", "meta mark set 0"),
+            ('--match mark ! --mark 1/1 --match comment --comment '
+             '"No mark means profile accepted packet" --jump RETURN',
+             'meta mark & 1 != 1 return '
+             'comment "No mark means profile accepted packet"'),
+            ("--src 10.0.0.1/32 --match mac --mac-source AA:BB:CC:DD:EE:FF "
+             "--jump felix-p-prof-o",
+             "ip saddr 10.0.0.1/32 ether saddr aa:bb:cc:dd:ee:ff "
+             "jump felix-p-prof-o"),
+            ("--jump felix-INPUT", "jump felix-INPUT"),
+        ]:
+            self.assertEqual(fragment_to_nft(fragment, 4), expected)
+
+    def test_ipv6_fragments(self):
+        self.assertEqual(
+            fragment_to_nft("--jump RETURN --protocol ipv6-icmp "
+                            "--icmpv6-type 130", 6),
+            "meta l4proto ipv6-icmp icmpv6 type 130 return")
+        self.assertEqual(
+            fragment_to_nft("--protocol icmpv6 --match icmp6 "
+                            "--icmpv6-type 1/2 --jump DROP", 6),
+            "meta l4proto ipv6-icmp icmpv6 type 1 icmpv6 code 2 drop")
+        self.assertEqual(
+            fragment_to_nft("--destination fd00::/64 --jump ACCEPT", 6),
+            "ip6 daddr fd00::/64 accept")
+
+    def test_profile_fragments(self):
+        self.assertEqual(
+            fragment_to_nft("--protocol tcp --match set --match-set "
+                            "felix-v4-tag src --match multiport "
+                            "--destination-ports 80,1000:2000 "
+                            "--jump RETURN", 4),
+            "meta l4proto tcp ip saddr @felix-v4-tag "
+            "tcp dport { 80, 1000-2000 } return")
+        self.assertEqual(
+            fragment_to_nft("--protocol icmp --match icmp --icmp-type 8/0 "
+                            "--jump DROP", 4),
+            "meta l4proto icmp icmp type 8 icmp code 0 drop")
+
+    def test_global_fragments(self):
+        self.assertEqual(
+            fragment_to_nft("--jump felix-FROM-ENDPOINT --in-interface tap+",
+                            4),
+            'iifname "tap*" jump felix-FROM-ENDPOINT')
+        self.assertEqual(
+            fragment_to_nft("--protocol tcp --dport 80 "
+                            "--destination 169.254.169.254/32 "
+                            "--jump DNAT --to-destination 127.0.0.1:8775", 4),
+            "meta l4proto tcp tcp dport 80 ip daddr 169.254.169.254/32 "
+            "dnat to 127.0.0.1:8775")
+        self.assertEqual(
+            fragment_to_nft("--out-interface tapabcd --goto felix-to-abcd",
+                            4),
+            'oifname "tapabcd" goto felix-to-abcd')
+
+    def test_vmap(self):
+        self.assertEqual(
+            fragment_to_nft("--vmap-in-interface "
+                            "tapa1=felix-from-a1,tapb2=felix-from-b2", 4),
+            'iifname vmap { "tapa1" : goto felix-from-a1, '
+            '"tapb2" : goto felix-from-b2 }')
+        self.assertEqual(
+            fragment_to_nft("--vmap-out-interface tapa1=felix-to-a1", 6),
+            'oifname vmap { "tapa1" : goto felix-to-a1 }')
+
+    def test_unsupported(self):
+        self.assertRaises(NftTranslationError, fragment_to_nft,
+                          "--match foo --foo-opt 1 --jump DROP", 4)
+        self.assertRaises(NftTranslationError, fragment_to_nft,
+                          "--dport 80 --jump DROP", 4)
+        self.assertRaises(NftTranslationError, fragment_to_nft,
+                          "--jump", 4)
+
+    def test_restore_input(self):
+        script = restore_input_to_nft([
+            "*filter",
+            ":felix-from-abcd -",
+            "--flush felix-from-abcd",
+            "--append felix-from-abcd --jump MARK --set-mark 0",
+            "--append felix-from-abcd --src 10.0.0.1/32 --match mac "
+            "--mac-source AA:BB:CC:DD:EE:FF --jump felix-p-prof-o",
+            "--append felix-from-abcd --src 10.0.0.2/32 --match mac "
+            "--mac-source AA:BB:CC:DD:EE:FF --jump felix-p-prof-o",
+            "--append felix-from-abcd --jump DROP",
+            ":felix-old -",
+            "--delete-chain felix-old",
+            "COMMIT",
+        ], "ip", "felix-filter", 4)
+        self.assertEqual(script, [
+            "add table ip felix-filter",
+            "add chain ip felix-filter felix-from-abcd",
+            "flush chain ip felix-filter felix-from-abcd",
+            "flush chain ip felix-filter felix-from-abcd",
+            "add rule ip felix-filter felix-from-abcd meta mark set 0",
+            # Anti-spoofing rules merged into one rule with a set.
+            "add rule ip felix-filter felix-from-abcd "
+            "ip saddr { 10.0.0.1/32, 10.0.0.2/32 } "
+            "ether saddr aa:bb:cc:dd:ee:ff jump felix-p-prof-o",
+            "add rule ip felix-filter felix-from-abcd drop",
+            "add chain ip felix-filter felix-old",
+            "flush chain ip felix-filter felix-old",
+            "delete chain ip felix-filter felix-old",
+        ])
+
+    def test_restore_input_no_merge_different_rules(self):
+        script = restore_input_to_nft([
+            "*filter",
+            "--append felix-a --src 10.0.0.1/32 --jump felix-b",
+            "--append felix-a --src 10.0.0.2/32 --jump felix-c",
+            "--append felix-a ! --src 10.0.0.3/32 --jump felix-c",
+            "COMMIT",
+        ], "ip", "felix-filter", 4)
+        self.assertEqual(script, [
+            "add table ip felix-filter",
+            "add rule ip felix-filter felix-a ip saddr 10.0.0.1/32 "
+            "jump felix-b",
+            "add rule ip felix-filter felix-a ip saddr 10.0.0.2/32 "
+            "jump felix-c",
+            "add rule ip felix-filter felix-a ip saddr != 10.0.0.3/32 "
+            "jump felix-c",
+        ])
+
+    def test_restore_input_unsupported(self):
+        self.assertRaises(NftTranslationError, restore_input_to_nft,
+                          ["*filter", "--zero felix-a", "COMMIT"],
+                          "ip", "felix-filter", 4)
+
+
+class TestNftablesUpdater(BaseTestCase):
+    def setUp(self):
+        super(TestNftablesUpdater, self).setUp()
+        self.nft = fake_nft.FakeNft()
+        self.check_call_patch = patch("calico.felix.futils.check_call",
+                                      autospec=True)
+        self.m_check_call = self.check_call_patch.start()
+        self.m_check_call.side_effect = self.nft.check_call
+        self.ipt = NftablesUpdater("filter", 4)
+        self.step_actor(self.ipt)
+
+    def tearDown(self):
+        self.check_call_patch.stop()
+        super(TestNftablesUpdater, self).tearDown()
+
+    def chain(self, name):
+        return self.nft.chain("ip", "felix-filter", name)
+
+    def test_rewrite_chains_stub(self):
+        self.ipt.rewrite_chains(
+            {"felix-foo": ["--append felix-foo --jump felix-bar"]},
+            {"felix-foo": set(["felix-bar"])},
+            async=True,
+        )
+        self.step_actor(self.ipt)
+        self.assertEqual(self.chain("felix-foo"), ["jump felix-bar"])
+        self.assertEqual(self.chain("felix-bar"), [MISSING_CHAIN_DROP])
+        # The whole batch was applied with a single nft transaction.
+        self.assertEqual(len(self.nft.scripts), 1)
+
+    def test_delete_and_cleanup(self):
+        # Exit the graceful restart period, during which we do not stub out
+        # chains.
+        self.ipt.cleanup(async=True)
+        self.ipt.rewrite_chains(
+            {"felix-foo": ["--append felix-foo --jump felix-bar"],
+             "felix-bar": ["--append felix-bar --jump ACCEPT"],
+             "felix-baz": ["--append felix-baz --jump ACCEPT"]},
+            {"felix-foo": set(["felix-bar"])},
+            async=True,
+        )
+        self.step_actor(self.ipt)
+        self.assertEqual(self.chain("felix-bar"), ["accept"])
+
+        # Deleting bar should stub it out instead, deleting baz should
+        # remove it.
+        self.ipt.delete_chains(["felix-bar", "felix-baz"], async=True)
+        self.step_actor(self.ipt)
+        self.assertEqual(self.chain("felix-bar"), [MISSING_CHAIN_DROP])
+        self.assertRaises(KeyError, self.chain, "felix-baz")
+
+        # Add an orphan chain behind Felix's back, cleanup should remove it.
+        self.nft.apply_script("add chain ip felix-filter felix-orphan\n"
+                              "add rule ip felix-filter felix-orphan drop")
+        self.ipt.cleanup(async=True)
+        self.step_actor(self.ipt)
+        self.assertRaises(KeyError, self.chain, "felix-orphan")
+        self.assertEqual(self.chain("felix-foo"), ["jump felix-bar"])
+
+    def test_vmap_dispatch(self):
+        self.ipt.rewrite_chains(
+            {"felix-FROM-ENDPOINT": [
+                "--append felix-FROM-ENDPOINT --vmap-in-interface "
+                "tapa1=felix-from-a1",
+                "--append felix-FROM-ENDPOINT --jump DROP"]},
+            {"felix-FROM-ENDPOINT": set(["felix-from-a1"])},
+            async=True,
+        )
+        self.step_actor(self.ipt)
+        self.assertEqual(self.chain("felix-FROM-ENDPOINT"),
+                         ['iifname vmap { "tapa1" : goto felix-from-a1 }',
+                          'drop'])
+        # The vmap counts as a reference to the endpoint chain.
+        self.assertEqual(self.ipt._read_unreferenced_chains(),
+                         set(["felix-FROM-ENDPOINT"]))
+
+    def test_failure_reported(self):
+        result = self.ipt.rewrite_chains(
+            {"felix-foo": ["--append felix-foo --bad-option --jump DROP"]},
+            {}, async=True,
+        )
+        self.step_actor(self.ipt)
+        self.assertRaises(FailedSystemCall, result.get)
+        self.assertEqual(self.nft.scripts, [])
+
+    def test_ensure_rule_inserted(self):
+        self.ipt.rewrite_chains({"felix-INPUT": []}, {}, async=True)
+        self.ipt.ensure_rule_inserted("INPUT --jump felix-INPUT", async=True)
+        self.ipt.ensure_rule_inserted("INPUT --jump felix-INPUT", async=True)
+        self.step_actor(self.ipt)
+        self.assertEqual(self.chain("INPUT"), ["jump felix-INPUT"])
+        listing = self.nft.list_table("ip", "felix-filter")
+        self.assertTrue("type filter hook input priority 0;" in listing)
+        result = self.ipt.ensure_rule_inserted(
+            "PREROUTING --jump felix-PREROUTING", async=True)
+        self.step_actor(self.ipt)
+        self.assertRaises(ValueError, result.get)
+
+
+class TestNftSetDriver(BaseTestCase):
+    def setUp(self):
+        super(TestNftSetDriver, self).setUp()
+        self.nft = fake_nft.FakeNft()
+        self.check_call_patch = patch("calico.felix.futils.check_call",
+                                      autospec=True)
+        self.m_check_call = self.check_call_patch.start()
+        self.m_check_call.side_effect = self.nft.check_call
+        self.driver = NftSetDriver(IPV4)
+
+    def tearDown(self):
+        self.check_call_patch.stop()
+        super(TestNftSetDriver, self).tearDown()
+
+    def test_replace_members(self):
+        self.driver.replace_members("felix-v4-a", "felix-tmp-v4-a",
+                                    set(["10.0.0.2", "10.0.0.1"]))
+        self.assertEqual(self.nft.set_members("ip", "felix-filter",
+                                              "felix-v4-a"),
+                         ["10.0.0.1", "10.0.0.2"])
+        self.driver.replace_members("felix-v4-a", "felix-tmp-v4-a", set())
+        self.assertEqual(self.nft.set_members("ip", "felix-filter",
+                                              "felix-v4-a"), [])
+        self.assertEqual(self.driver.list_names(), ["felix-v4-a"])
+        self.driver.destroy("felix-v4-a")
+        self.assertEqual(self.driver.list_names(), [])
+
+    def test_destroy_referenced(self):
+        self.driver.replace_members("felix-v4-a", "felix-tmp-v4-a",
+                                    set(["10.0.0.1"]))
+        self.nft.apply_script("add chain ip felix-filter felix-c\n"
+                              "add rule ip felix-filter felix-c "
+                              "ip saddr @felix-v4-a accept")
+        self.assertRaises(FailedSystemCall, self.driver.destroy,
+                          "felix-v4-a")
+
+    def test_list_names_no_table(self):
+        self.assertEqual(NftSetDriver(IPV6).list_names(), [])
+
+
+class TestFakeNftBinary(BaseTestCase):
+    """
+    Runs the updater against the fake nft as a real subprocess.
+    """
+    def setUp(self):
+        super(TestFakeNftBinary, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        script = os.path.splitext(fake_nft.__file__)[0] + ".py"
+        self.nft_cmd = [sys.executable, script]
+        pkg_root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(fnftables.__file__))))
+        self.env_patch = patch.dict(os.environ, {
+            "FAKE_NFT_STATE": os.path.join(self.tmpdir, "state.json"),
+            "PYTHONPATH": pkg_root,
+        })
+        self.env_patch.start()
+
+    def tearDown(self):
+        self.env_patch.stop()
+        shutil.rmtree(self.tmpdir)
+        super(TestFakeNftBinary, self).tearDown()
+
+    def test_rewrite_and_sets(self):
+        driver = NftSetDriver(IPV4, nft_cmd=self.nft_cmd)
+        driver.replace_members("felix-v4-a", "felix-tmp-v4-a",
+                               set(["10.0.0.1"]))
+        ipt = NftablesUpdater("filter", 4, nft_cmd=self.nft_cmd)
+        ipt.rewrite_chains(
+            {"felix-foo": ["--append felix-foo --match set --match-set "
+                           "felix-v4-a src --jump ACCEPT"]},
+            {}, async=True,
+        )
+        self.step_actor(ipt)
+        listing = ipt._list_table()
+        self.assertTrue("chain felix-foo {" in listing)
+        self.assertTrue("ip saddr @felix-v4-a accept" in listing)
+        self.assertTrue("elements = { 10.0.0.1 }" in listing)
+        self.assertEqual(ipt._chains_in_dataplane, set(["felix-foo"]))
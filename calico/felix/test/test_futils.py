@@ -86,6 +86,27 @@ class TestFutils(unittest.TestCase):
             self.assertNotEqual(e.stderr, None)
             self.assertTrue("wibble_wobble" in str(e))
 
+    def test_good_check_call_lines(self):
+        lines = list(futils.check_call_lines(["ls"]))
+        self.assertTrue("calico\n" in lines)
+
+    def test_bad_check_call_lines(self):
+        args = ["ls", "wibble_wobble"]
+        lines = futils.check_call_lines(args)
+        try:
+            list(lines)
+            self.assertTrue(False)
+        except futils.FailedSystemCall as e:
+            self.assertNotEqual(e.retcode, 0)
+            self.assertEqual(list(e.args), args)
+            self.assertTrue("wibble_wobble" in e.stderr)
+
+    def test_check_call_lines_abandoned(self):
+        # Abandoning the generator part way through must not hang.
+        lines = futils.check_call_lines(["seq", "1000000"])
+        self.assertEqual(next(lines), "1\n")
+        lines.close()
+
     def test_good_call_silent(self):
         # Test a command. Result must include "calico" given where it is run from.
         args = ["ls"]
@@ -23,8 +23,12 @@ from collections import defaultdict
 import logging
 from mock import *
 from calico.datamodel_v1 import EndpointId
-from calico.felix.futils import IPV4, FailedSystemCall
-from calico.felix.ipsets import IpsetManager, ActiveIpset
+from calico.felix.futils import IPV4, IPV6, FailedSystemCall
+from calico import stats
+from calico.felix import ipsets
+from calico.felix.ipsets import (IpsetManager, ActiveIpset, Interner,
+                                 list_ipset_names, ipset_sizing,
+                                 IpsetCommandDriver)
 from calico.felix.refcount import CREATED
 from calico.felix.test.base import BaseTestCase
 
@@ -59,10 +63,10 @@ class TestIpsetManager(BaseTestCase):
         super(TestIpsetManager, self).setUp()
         self.reset()
 
-    def reset(self):
+    def reset(self, ip_type=IPV4):
         self.created_refs = defaultdict(list)
         self.acquired_refs = {}
-        self.mgr = IpsetManager(IPV4)
+        self.mgr = IpsetManager(ip_type)
         self.m_create = Mock(spec=self.mgr._create,
                              side_effect = self.m_create)
         self.mgr._create = self.m_create
@@ -81,7 +85,19 @@ class TestIpsetManager(BaseTestCase):
         self.created_refs[tag_id].append(ipset)
         return ipset
 
+    def reference_tags(self, tags):
+        """
+        Takes references to the given tags so that the manager indexes
+        them.
+        """
+        for tag in tags:
+            self.mgr.get_and_incref(tag, callback=self.on_ref_acquired,
+                                    async=True)
+        self.step_mgr()
+        self._notify_ready(tags)
+
     def test_tag_then_endpoint(self):
+        self.reference_tags(["tag1"])
         # Send in the messages.
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
@@ -90,6 +106,7 @@ class TestIpsetManager(BaseTestCase):
         self.assert_one_ep_one_tag()
 
     def test_endpoint_then_tag(self):
+        self.reference_tags(["tag1"])
         # Send in the messages.
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
@@ -98,6 +115,7 @@ class TestIpsetManager(BaseTestCase):
         self.assert_one_ep_one_tag()
 
     def test_endpoint_then_tag_idempotent(self):
+        self.reference_tags(["tag1"])
         for _ in xrange(3):
             # Send in the messages.
             self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
@@ -107,20 +125,17 @@ class TestIpsetManager(BaseTestCase):
             self.assert_one_ep_one_tag()
 
     def assert_one_ep_one_tag(self):
-        self.assertEqual(self.mgr.endpoints_by_ep_id, {
-            EP_ID_1_1: EP_1_1,
+        self.assertEqual(self.mgr._endpoints_view(), {
+            EP_ID_1_1: (set(["prof1", "prof2"]), set(["10.0.0.1"])),
         })
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
             "tag1": {
-                "10.0.0.1": {
-                    "prof1": set([
-                        EP_ID_1_1
-                    ])
-                }
+                "10.0.0.1": 1,
             }
         })
 
     def test_change_ip(self):
+        self.reference_tags(["tag1"])
         # Initial set-up.
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
@@ -129,22 +144,15 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_IP, async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
             "tag1": {
-                "10.0.0.2": {
-                    "prof1": set([
-                        EP_ID_1_1
-                    ])
-                },
-                "10.0.0.3": {
-                    "prof1": set([
-                        EP_ID_1_1
-                    ])
-                }
+                "10.0.0.2": 1,
+                "10.0.0.3": 1,
             }
         })
 
     def test_tag_updates(self):
+        self.reference_tags(["tag1", "tag2"])
         # Initial set-up.
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
@@ -153,20 +161,12 @@ class TestIpsetManager(BaseTestCase):
         # Add a tag, keep a tag.
         self.mgr.on_tags_update("prof1", ["tag1", "tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
             "tag1": {
-                "10.0.0.1": {
-                    "prof1": set([
-                        EP_ID_1_1
-                    ])
-                }
+                "10.0.0.1": 1,
             },
             "tag2": {
-                "10.0.0.1": {
-                    "prof1": set([
-                        EP_ID_1_1
-                    ])
-                }
+                "10.0.0.1": 1,
             }
         })
         self.assertEqual(self.mgr.tags_by_prof_id, {"prof1": ["tag1", "tag2"]})
@@ -174,20 +174,20 @@ class TestIpsetManager(BaseTestCase):
         # Remove a tag.
         self.mgr.on_tags_update("prof1", ["tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
+            "tag1": {},
             "tag2": {
-                "10.0.0.1": {
-                    "prof1": set([
-                        EP_ID_1_1
-                    ])
-                }
+                "10.0.0.1": 1,
             }
         })
 
         # Delete the tags:
         self.mgr.on_tags_update("prof1", None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.ip_owners_by_tag, {})
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
+            "tag1": {},
+            "tag2": {},
+        })
         self.assertEqual(self.mgr.tags_by_prof_id, {})
 
     def step_mgr(self):
@@ -195,6 +195,7 @@ class TestIpsetManager(BaseTestCase):
         self.assertEqual(self.mgr._dirty_tags, set())
 
     def test_update_profile_and_ips(self):
+        self.reference_tags(["tag1", "tag3"])
         # Initial set-up.
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
@@ -204,96 +205,172 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_PROF_IP, async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
+            "tag1": {},
             "tag3": {
-                "10.0.0.3": {
-                    "prof3": set([
-                        EP_ID_1_1
-                    ])
-                }
+                "10.0.0.3": 1,
             }
         })
-        self.assertEqual(self.mgr.endpoint_ids_by_profile_id, {
+        self.assertEqual(self.mgr._endpoint_ids_by_profile_view(), {
             "prof3": set([EP_ID_1_1])
         })
 
     def test_duplicate_ips(self):
+        self.reference_tags(["tag1", "tag2"])
         # Add in two endpoints with the same IP.
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_endpoint_update(EP_ID_2_1, EP_2_1, async=True)
         self.step_mgr()
         # Index should contain both:
-        self.assertEqual(self.mgr.endpoints_by_ep_id, {
-            EP_ID_1_1: EP_1_1,
-            EP_ID_2_1: EP_2_1,
+        self.assertEqual(self.mgr._endpoints_view(), {
+            EP_ID_1_1: (set(["prof1", "prof2"]), set(["10.0.0.1"])),
+            EP_ID_2_1: (set(["prof1"]), set(["10.0.0.1"])),
         })
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        # One reference for each (profile, endpoint) pair.
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
             "tag1": {
-                "10.0.0.1": {
-                    "prof1": set([
-                        EP_ID_1_1,
-                        EP_ID_2_1,
-                    ])
-                }
-            }
+                "10.0.0.1": 2,
+            },
+            "tag2": {},
         })
 
         # Second profile tags arrive:
         self.mgr.on_tags_update("prof2", ["tag1", "tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
             "tag1": {
-                "10.0.0.1": {
-                    "prof1": set([
-                        EP_ID_1_1,
-                        EP_ID_2_1,
-                    ]),
-                    "prof2": set([
-                        EP_ID_1_1,
-                    ])
-                }
+                "10.0.0.1": 3,
             },
             "tag2": {
-                "10.0.0.1": {
-                    "prof2": set([
-                        EP_ID_1_1,
-                    ])
-                }
+                "10.0.0.1": 1,
             },
         })
 
         # Remove one, check the index gets updated.
         self.mgr.on_endpoint_update(EP_ID_2_1, None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.endpoints_by_ep_id, {
-            EP_ID_1_1: EP_1_1,
+        self.assertEqual(self.mgr._endpoints_view(), {
+            EP_ID_1_1: (set(["prof1", "prof2"]), set(["10.0.0.1"])),
         })
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
             "tag1": {
-                "10.0.0.1": {
-                    "prof1": set([
-                        EP_ID_1_1,
-                    ]),
-                    "prof2": set([
-                        EP_ID_1_1,
-                    ])
-                }
+                "10.0.0.1": 2,
             },
             "tag2": {
-                "10.0.0.1": {
-                    "prof2": set([
-                        EP_ID_1_1,
-                    ])
-                }
+                "10.0.0.1": 1,
             },
         })
 
         # Remove the other, index should get completely cleaned up.
         self.mgr.on_endpoint_update(EP_ID_1_1, None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.endpoints_by_ep_id, {})
-        self.assertEqual(self.mgr.ip_owners_by_tag, {})
+        self.assertEqual(self.mgr._endpoints_view(), {})
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
+            "tag1": {},
+            "tag2": {},
+        })
+
+    def test_interned_ids_released(self):
+        self.mgr.on_tags_update("prof1", ["tag1"], async=True)
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        self.mgr.on_endpoint_update(EP_ID_2_1, EP_2_1, async=True)
+        self.step_mgr()
+        self.assertEqual(len(self.mgr._endpoint_ids), 2)
+        self.assertEqual(set(self.mgr._profile_ids.keys()),
+                         set(["prof1", "prof2"]))
+        self.assertEqual(set(self.mgr._tag_ids.keys()), set(["tag1"]))
+
+        # Deleting everything should release all the interned IDs.
+        self.mgr.on_endpoint_update(EP_ID_1_1, None, async=True)
+        self.mgr.on_endpoint_update(EP_ID_2_1, None, async=True)
+        self.mgr.on_tags_update("prof1", None, async=True)
+        self.step_mgr()
+        self.assertEqual(len(self.mgr._endpoint_ids), 0)
+        self.assertEqual(len(self.mgr._profile_ids), 0)
+        self.assertEqual(len(self.mgr._tag_ids), 0)
+        self.assertEqual(self.mgr._endpoint_ids_by_profile_view(), {})
+
+        # Deleting an unknown endpoint is a no-op.
+        self.mgr.on_endpoint_update(EP_ID_1_2, None, async=True)
+        self.step_mgr()
+        self.assertEqual(len(self.mgr._endpoint_ids), 0)
+
+        # IDs and endpoint store slots get reused.
+        self.mgr.on_endpoint_update(EP_ID_1_2, EP_2_1, async=True)
+        self.step_mgr()
+        self.assertEqual(self.mgr._endpoint_ids.capacity, 2)
+        self.assertEqual(self.mgr._endpoints_view(), {
+            EP_ID_1_2: (set(["prof1"]), set(["10.0.0.1"])),
+        })
+
+    def test_only_referenced_tags_indexed(self):
+        self.mgr.on_tags_update("prof1", ["tag1", "tag2"], async=True)
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        self.mgr.on_endpoint_update(EP_ID_2_1, EP_2_1, async=True)
+        self.step_mgr()
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {})
+
+        # Index is built from the endpoint store on first reference.
+        self.reference_tags(["tag1"])
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
+            "tag1": {
+                "10.0.0.1": 2,
+            }
+        })
+        ipset = self.created_refs["tag1"][0]
+        ipset.replace_members.assert_called_once_with(set(["10.0.0.1"]),
+                                                      async=True)
+
+        # Then maintained.
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_IP, async=True)
+        self.step_mgr()
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
+            "tag1": {
+                "10.0.0.1": 1,
+                "10.0.0.2": 1,
+                "10.0.0.3": 1,
+            }
+        })
+
+        # And discarded when the last reference goes.
+        self.mgr.decref("tag1", async=True)
+        self.step_mgr()
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {})
+        self.mgr.on_tags_update("prof1", None, async=True)
+        self.step_mgr()
+        self.assertEqual(len(self.mgr._tag_ids), 0)
+
+    def test_active_ipset_members(self):
+        self.mgr.get_and_incref("tag1", callback=self.on_ref_acquired,
+                                async=True)
+        self.step_mgr()
+        self._notify_ready(["tag1"])
+        ipset = self.created_refs["tag1"][0]
+        ipset.replace_members.assert_called_once_with(set(), async=True)
+
+        self.mgr.on_tags_update("prof1", ["tag1"], async=True)
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_IP, async=True)
+        self.step_mgr()
+        ipset.replace_members.assert_called_with(
+            set(["10.0.0.2", "10.0.0.3"]), async=True)
+
+    def test_ipv6(self):
+        self.reset(IPV6)
+        self.reference_tags(["tag1"])
+        self.mgr.on_tags_update("prof1", ["tag1"], async=True)
+        self.mgr.on_endpoint_update(EP_ID_1_1, {
+            "profile_ids": ["prof1"],
+            "ipv4_nets": ["10.0.0.1/32"],
+            "ipv6_nets": ["dead::beef/128", "dead::1/128"],
+        }, async=True)
+        self.step_mgr()
+        self.assertEqual(self.mgr._ip_refs_by_tag_view(), {
+            "tag1": {
+                "dead::beef": 1,
+                "dead::1": 1,
+            }
+        })
 
     def on_ref_acquired(self, tag_id, ipset):
         self.acquired_refs[tag_id] = ipset
@@ -354,3 +431,124 @@ class TestIpsetManager(BaseTestCase):
             self.mgr.on_object_startup_complete(tag, self.created_refs[tag][0],
                                                 async=True)
         self.step_mgr()
+
+
+class TestActiveIpset(BaseTestCase):
+    def setUp(self):
+        super(TestActiveIpset, self).setUp()
+        stats.reset()
+        self.driver = Mock(spec=IpsetCommandDriver)
+        self.ipset = ActiveIpset("tag", IPV4, driver=self.driver)
+
+    def tearDown(self):
+        stats.reset()
+        super(TestActiveIpset, self).tearDown()
+
+    def sync(self, num_members):
+        self.ipset.members = set("10.%d.%d.%d" % (i >> 16, (i >> 8) & 0xff,
+                                                  i & 0xff)
+                                 for i in xrange(num_members))
+        self.ipset._sync_to_ipset()
+        _, kwargs = self.driver.replace_members.call_args
+        return kwargs["hashsize"], kwargs["maxelem"]
+
+    def test_ipset_sizing(self):
+        self.assertEqual(ipset_sizing(0), (1024, 65536))
+        self.assertEqual(ipset_sizing(4096), (1024, 65536))
+        self.assertEqual(ipset_sizing(32768), (8192, 65536))
+        self.assertEqual(ipset_sizing(32769), (16384, 131072))
+        self.assertEqual(ipset_sizing(100000), (32768, 262144))
+
+    def test_sync_sizing(self):
+        self.assertEqual(self.sync(10), (1024, 65536))
+        self.driver.replace_members.assert_called_once_with(
+            "felix-v4-tag", "felix-tmp-v4-tag", self.ipset.members,
+            hashsize=1024, maxelem=65536)
+        # Stays the same size until 75% full.
+        self.assertEqual(self.sync(49152), (1024, 65536))
+        self.assertEqual(stats.counter("ipset.resize.grow"), 0)
+        self.assertEqual(self.sync(49153), (16384, 131072))
+        self.assertEqual(stats.counter("ipset.resize.grow"), 1)
+        # Only shrinks once it is an eighth full.
+        self.assertEqual(self.sync(16385), (16384, 131072))
+        self.assertEqual(self.sync(16384), (4096, 65536))
+        self.assertEqual(stats.counter("ipset.resize.shrink"), 1)
+        self.assertEqual(stats.histogram("ipset.fill").count, 5)
+
+    def test_sync_failure(self):
+        self.driver.replace_members.side_effect = FailedSystemCall(
+            "Dummy", [], 1, "", "")
+        self.assertRaises(FailedSystemCall, self.sync, 10)
+        self.assertEqual(self.ipset.sizing, None)
+        self.assertEqual(self.ipset.programmed_members, None)
+
+
+class TestListIpsetNames(BaseTestCase):
+    def setUp(self):
+        super(TestListIpsetNames, self).setUp()
+        ipsets._list_name_supported = True
+
+    def tearDown(self):
+        ipsets._list_name_supported = True
+        super(TestListIpsetNames, self).tearDown()
+
+    @patch("calico.felix.futils.check_call_lines", autospec=True)
+    def test_list_name(self, m_lines):
+        m_lines.return_value = iter(["felix-v4-a\n", "felix-v6-b\n", "\n"])
+        self.assertEqual(list_ipset_names(), ["felix-v4-a", "felix-v6-b"])
+        m_lines.assert_called_once_with(["ipset", "list", "-name"])
+
+    @patch("calico.felix.futils.check_call_lines", autospec=True)
+    def test_fallback(self, m_lines):
+        def lines(args):
+            if "-name" in args:
+                raise FailedSystemCall("Dummy", args, 1, None,
+                                       "ipset v6.11: Unknown argument: "
+                                       "`-name'")
+            return iter(["Name: felix-v4-a\n",
+                         "Type: hash:ip\n",
+                         "Members:\n",
+                         "10.0.0.1\n",
+                         "\n",
+                         "Name: felix-v4-b\n",
+                         "Type: hash:ip\n",
+                         "Members:\n"])
+        m_lines.side_effect = lines
+        self.assertEqual(list_ipset_names(), ["felix-v4-a", "felix-v4-b"])
+        # Once we know that -name isn't supported, we stop trying it.
+        self.assertEqual(list_ipset_names(), ["felix-v4-a", "felix-v4-b"])
+        self.assertEqual(m_lines.mock_calls, [
+            call(["ipset", "list", "-name"]),
+            call(["ipset", "list"]),
+            call(["ipset", "list"]),
+        ])
+
+    @patch("calico.felix.futils.check_call_lines", autospec=True)
+    def test_fallback_fails(self, m_lines):
+        m_lines.side_effect = FailedSystemCall("Dummy", [], 1, None, "")
+        self.assertRaises(FailedSystemCall, list_ipset_names)
+        # We can't tell whether -name is the problem so we keep trying it.
+        self.assertTrue(ipsets._list_name_supported)
+
+
+class TestInterner(BaseTestCase):
+    def test_acquire_release(self):
+        interner = Interner()
+        a = interner.acquire("a")
+        b = interner.acquire("b")
+        self.assertNotEqual(a, b)
+        self.assertEqual(interner.acquire("a"), a)
+        self.assertEqual(interner.key(a), "a")
+        self.assertEqual(interner.get("b"), b)
+        self.assertEqual(len(interner), 2)
+
+        # "a" has two references.
+        interner.release(a)
+        self.assertEqual(interner.get("a"), a)
+        interner.release(a)
+        self.assertEqual(interner.get("a"), None)
+        self.assertEqual(interner.keys(), ["b"])
+
+        # Freed IDs are reused.
+        self.assertEqual(interner.acquire("c"), a)
+        self.assertEqual(interner.capacity, 2)
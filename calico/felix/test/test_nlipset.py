@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_nlipset
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the netlink ipset driver.
+"""
+import errno
+import logging
+import socket
+import unittest
+
+from calico.felix import nlipset
+from calico.felix.futils import IPV4, IPV6, FailedSystemCall
+from calico.felix.nlipset import (NetlinkIpsetDriver, NetlinkError,
+                                  parse_attrs, IPSET_CMD_CREATE,
+                                  IPSET_CMD_FLUSH, IPSET_CMD_ADD,
+                                  IPSET_CMD_SWAP, IPSET_CMD_DESTROY,
+                                  IPSET_CMD_DEL, IPSET_ATTR_ADT,
+                                  IPSET_ATTR_DATA, IPSET_ATTR_HASHSIZE,
+                                  IPSET_ATTR_MAXELEM)
+from calico.felix.test.fake_netlink import (load_fixtures, ReplaySocket,
+                                            AckingSocket)
+
+_log = logging.getLogger(__name__)
+
+
+class TestNetlinkIpsetDriverFixtures(unittest.TestCase):
+    """
+    Replays traffic recorded against a real kernel.
+    """
+    def setUp(self):
+        self.fixtures = load_fixtures()
+
+    def replay(self, ip_type, fixture):
+        sock = ReplaySocket(self.fixtures[fixture], self)
+        driver = NetlinkIpsetDriver(ip_type, sock_factory=lambda: sock)
+        return driver, sock
+
+    def test_replace_v4(self):
+        driver, sock = self.replay(IPV4, "replace_v4")
+        driver.replace_members("felix-v4-rec", "felix-tmp-v4-rec",
+                               set(["10.0.0.1", "10.0.0.2"]))
+        sock.assert_finished()
+
+    def test_replace_v6(self):
+        driver, sock = self.replay(IPV6, "replace_v6")
+        driver.replace_members("felix-v6-rec", "felix-tmp-v6-rec",
+                               set(["dead::1"]))
+        sock.assert_finished()
+
+    def test_list_names(self):
+        driver, sock = self.replay(IPV4, "list_names")
+        self.assertEqual(driver.list_names(), ["felix-v4-rec"])
+        sock.assert_finished()
+
+    def test_destroy(self):
+        driver, sock = self.replay(IPV4, "destroy")
+        driver.destroy("felix-v4-rec")
+        sock.assert_finished()
+
+    def test_error(self):
+        driver, sock = self.replay(IPV6, "add_missing_set")
+        with self.assertRaises(FailedSystemCall) as cm:
+            driver.execute(driver.add_msgs("felix-v6-missing", ["dead::2"]))
+        self.assertTrue(isinstance(cm.exception, NetlinkError))
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+        sock.assert_finished()
+
+
+class TestNetlinkIpsetDriver(unittest.TestCase):
+    def setUp(self):
+        self.sock = AckingSocket()
+        self.driver = NetlinkIpsetDriver(IPV4, sock_factory=self.get_sock)
+        self.num_socks = 0
+
+    def get_sock(self):
+        self.num_socks += 1
+        return self.sock
+
+    def members_of(self, body):
+        attrs = dict(parse_attrs(body[4:]))
+        return len(parse_attrs(attrs[IPSET_ATTR_ADT]))
+
+    def test_batching(self):
+        members = set("10.0.%d.%d" % (i // 256, i % 256) for i in xrange(2500))
+        self.driver.replace_members("a", "b", members)
+        commands = [c for c, _ in self.sock.sent_messages()]
+        self.assertEqual(commands, [
+            IPSET_CMD_CREATE, IPSET_CMD_DESTROY, IPSET_CMD_CREATE,
+            IPSET_CMD_ADD, IPSET_CMD_ADD, IPSET_CMD_ADD,
+            IPSET_CMD_SWAP, IPSET_CMD_DESTROY,
+        ])
+        adds = [b for c, b in self.sock.sent_messages() if c == IPSET_CMD_ADD]
+        self.assertEqual([self.members_of(b) for b in adds],
+                         [1024, 1024, 452])
+        # One datagram per stage.
+        self.assertEqual(len(self.sock.sent), 3)
+        self.assertEqual(self.num_socks, 1)
+
+    def test_datagram_limit(self):
+        driver = NetlinkIpsetDriver(IPV6, sock_factory=self.get_sock)
+        members = ["fd00::%x" % i for i in xrange(5000)]
+        driver.execute(driver.del_msgs("a", members))
+        commands = [c for c, _ in self.sock.sent_messages()]
+        self.assertEqual(commands, [IPSET_CMD_DEL] * 5)
+        self.assertTrue(len(self.sock.sent) > 1)
+        for datagram in self.sock.sent:
+            self.assertTrue(len(datagram) <= nlipset.MAX_DATAGRAM_SIZE)
+
+    def test_create_sizing(self):
+        self.driver.execute([self.driver.create_msg("a", hashsize=2048,
+                                                    maxelem=100000)])
+        (command, body), = self.sock.sent_messages()
+        attrs = dict(parse_attrs(body[4:]))
+        data = dict(parse_attrs(attrs[IPSET_ATTR_DATA]))
+        self.assertEqual(data, {IPSET_ATTR_HASHSIZE: "\0\0\x08\0",
+                                IPSET_ATTR_MAXELEM: "\0\x01\x86\xa0"})
+
+    def test_failed_add_prevents_swap(self):
+        def errors(command, body):
+            return errno.ENOMEM if command == IPSET_CMD_ADD else 0
+        self.sock.errors = errors
+        self.assertRaises(NetlinkError, self.driver.replace_members,
+                          "a", "b", set(["10.0.0.1"]))
+        commands = [c for c, _ in self.sock.sent_messages()]
+        self.assertEqual(commands, [IPSET_CMD_CREATE, IPSET_CMD_DESTROY,
+                                    IPSET_CMD_CREATE, IPSET_CMD_ADD])
+
+    def test_replace_existing_sets(self):
+        # The main set exists, possibly with a different size, and the
+        # temporary set doesn't.
+        responses = {IPSET_CMD_CREATE: [errno.EEXIST],
+                     IPSET_CMD_DESTROY: [errno.ENOENT]}
+
+        def errors(command, body):
+            return (responses.get(command) or [0]).pop(0)
+        self.sock.errors = errors
+        self.driver.replace_members("a", "b", set(["10.0.0.1"]),
+                                    hashsize=2048, maxelem=131072)
+        creates = [b for c, b in self.sock.sent_messages()
+                   if c == IPSET_CMD_CREATE]
+        for body in creates:
+            attrs = dict(parse_attrs(body[4:]))
+            data = dict(parse_attrs(attrs[IPSET_ATTR_DATA]))
+            self.assertEqual(data[IPSET_ATTR_MAXELEM], "\0\x02\0\0")
+
+    def test_replace_other_errors(self):
+        def errors(command, body):
+            return errno.ENOMEM if command == IPSET_CMD_CREATE else 0
+        self.sock.errors = errors
+        self.assertRaises(NetlinkError, self.driver.replace_members,
+                          "a", "b", set(["10.0.0.1"]))
+
+    def test_socket_error_resets_socket(self):
+        def recv():
+            raise socket.error(errno.ENOBUFS, "No buffer space")
+        self.sock.recv = recv
+        self.assertRaises(socket.error, self.driver.destroy, "a")
+        self.assertTrue(self.sock.closed)
+        self.sock = AckingSocket()
+        self.driver.destroy("a")
+        self.assertEqual(self.num_socks, 2)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_parsepool
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the etcd parse pool.
+"""
+import json
+import logging
+from StringIO import StringIO
+
+from mock import Mock
+
+from calico import stats
+from calico.datamodel_v1 import EndpointId
+from calico.felix.fetcd import parse_node
+from calico.felix.parsepool import (ParsePool, worker_main, encode_frame,
+                                    read_frame, MSG_PARSE, MSG_PARSED,
+                                    _Node, _WorkerConfig)
+from calico.felix.test.base import BaseTestCase
+from calico.felix.test.test_fetcd import (VALID_ENDPOINT, ENDPOINT_STR, RULES,
+                                          RULES_STR, TAGS, TAGS_STR)
+
+_log = logging.getLogger(__name__)
+
+EP_KEY = "/calico/v1/host/h1/workload/o1/w%s/endpoint/e1"
+RULES_KEY = "/calico/v1/policy/profile/prof%s/rules"
+TAGS_KEY = "/calico/v1/policy/profile/prof%s/tags"
+
+BAD_ENDPOINT_STR = json.dumps(dict(VALID_ENDPOINT, name="eth0"))
+
+
+def ep_id(i):
+    return EndpointId("h1", "o1", "w%s" % i, "e1")
+
+
+class TestParsePool(BaseTestCase):
+    def setUp(self):
+        super(TestParsePool, self).setUp()
+        stats.reset()
+        self.config = Mock()
+        self.config.IFACE_PREFIX = "tap"
+        self.nodes = [
+            _Node(RULES_KEY % 1, "set", RULES_STR),
+            _Node(TAGS_KEY % 1, "set", TAGS_STR),
+            _Node("/calico/v1/config/LogSeverityFile", "set", "DEBUG"),
+            _Node(EP_KEY % 1, "set", ENDPOINT_STR),
+            _Node(EP_KEY % 2, "set", BAD_ENDPOINT_STR),
+            _Node(EP_KEY % 3, "set", ENDPOINT_STR),
+        ]
+        self.expected = sorted([
+            ("rules", "prof1", RULES),
+            ("tags", "prof1", TAGS),
+            ("endpoint", ep_id(1), VALID_ENDPOINT),
+            ("endpoint", ep_id(2), None),
+            ("endpoint", ep_id(3), VALID_ENDPOINT),
+        ])
+
+    def tearDown(self):
+        for index in xrange(len(self.pool._workers)):
+            self.pool._kill_worker(index)
+        super(TestParsePool, self).tearDown()
+
+    def parse(self):
+        results = list(self.pool.parse_nodes(self.nodes))
+        for node, parsed in results:
+            # Results are paired with their nodes.
+            self.assertEqual(parse_node(self.config, node), parsed)
+        return sorted(parsed for _, parsed in results)
+
+    def test_parse_nodes(self):
+        self.pool = ParsePool(self.config, 2, chunk_size=2)
+        self.assertEqual(self.parse(), self.expected)
+        # Giving up part way through is OK.
+        self.assertTrue(self.pool.parse_nodes(self.nodes).next()[1]
+                        in self.expected)
+        # The workers are reused.
+        procs = [w.proc for w in self.pool._workers]
+        self.assertEqual(self.parse(), self.expected)
+        self.assertEqual([w.proc for w in self.pool._workers], procs)
+        self.assertEqual(stats.counter("parse_pool.worker_failures"), 0)
+
+    def test_parse_node(self):
+        self.pool = ParsePool(self.config, 2)
+        self.assertEqual(self.pool.parse_node(self.nodes[3]),
+                         ("endpoint", ep_id(1), VALID_ENDPOINT))
+        self.assertEqual(self.pool.parse_node(self.nodes[4]),
+                         ("endpoint", ep_id(2), None))
+        self.assertEqual(self.pool.parse_node(self.nodes[0]),
+                         ("rules", "prof1", RULES))
+        self.assertEqual(self.pool.parse_node(self.nodes[2]), None)
+        # Updates all go to the first worker.
+        self.assertEqual(self.pool._workers[1], None)
+
+    def test_worker_failure(self):
+        self.pool = ParsePool(self.config, 2, chunk_size=2,
+                              worker_cmd=["false"])
+        self.assertEqual(self.parse(), self.expected)
+        self.assertEqual(self.pool._workers, [None, None])
+        self.assertEqual(stats.counter("parse_pool.worker_failures"), 2)
+
+
+class TestWorkerMain(BaseTestCase):
+    def test_worker_main(self):
+        input_file = StringIO(
+            encode_frame(MSG_PARSE, [(EP_KEY % 1, ENDPOINT_STR),
+                                     ("/calico/v1/Ready", "true"),
+                                     (TAGS_KEY % 2, TAGS_STR)]) +
+            encode_frame(MSG_PARSE, [(EP_KEY % 2, BAD_ENDPOINT_STR)])
+        )
+        output_file = StringIO()
+        root_logger = logging.getLogger()
+        handlers = root_logger.handlers[:]
+        level = root_logger.level
+        try:
+            worker_main(_WorkerConfig("tap"), input_file, output_file)
+        finally:
+            root_logger.handlers[:] = handlers
+            root_logger.setLevel(level)
+        output_file.seek(0)
+        self.assertEqual(read_frame(output_file), (
+            MSG_PARSED,
+            [("endpoint", tuple(ep_id(1)), VALID_ENDPOINT),
+             None,
+             ("tags", "prof2", TAGS)],
+            [],
+        ))
+        msg_type, results, log_records = read_frame(output_file)
+        self.assertEqual(results, [("endpoint", tuple(ep_id(2)), None)])
+        (level, message), = log_records
+        self.assertEqual(level, logging.WARNING)
+        self.assertTrue("Validation failed for endpoint e1" in message)
+        self.assertEqual(read_frame(output_file), None)
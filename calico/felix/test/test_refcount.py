@@ -60,6 +60,7 @@ class TestReferenceManager(BaseTestCase):
             ("rm", "activate 0"),
             (0, 'on_referenced'),
             # Then it gets told about its demise.
+            ("rm", "unreferenced 0"),
             (0, 'on_unreferenced'),
             # RefMgr waits until it hears about the completion before
             # activating new one.
@@ -95,11 +96,14 @@ class TestReferenceManager(BaseTestCase):
         self.assertEqual(self._rm.ref_actions, [
             # No object to start with so immediately gets started.
             ("rm", "activate 0"),
-            (0, 'on_referenced'),
             # Then gets removed again.  No callbacks to record_get because
             # the decref is ahead of the startup_complete callback.
+            ("rm", "unreferenced 0"),
             # Actor 1-2 is created and deleted without ever being started
             # because it's blocked behind the cleanup of 0.
+            ("rm", "unreferenced 1"),
+            ("rm", "unreferenced 2"),
+            (0, 'on_referenced'),
             (0, 'on_unreferenced'),
             # Actor 2 gets created.
             ('rm', 'recv cleanup complete'),
@@ -187,6 +191,9 @@ class RefMgrForTesting(ReferenceManager):
         obj.active = True
         obj.on_referenced(async=True)
 
+    def _on_object_unreferenced(self, object_id, obj):
+        self.ref_actions.append(("rm", "unreferenced %s" % obj.idx))
+
     @actor_message()
     def on_object_cleanup_complete(self, *args, **kwargs):
         self.ref_actions.append(("rm", "recv cleanup complete"))
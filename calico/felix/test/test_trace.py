@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_trace
+~~~~~~~~~~~~~~~~~~~~~
+
+Tests of update latency tracing.
+"""
+import logging
+
+from calico import stats
+from calico.felix import trace
+from calico.felix.actor import Actor, actor_message
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class Forwarder(Actor):
+    """
+    Passes messages on to the next actor, like the UpdateSplitter.
+    """
+    def __init__(self, committer):
+        super(Forwarder, self).__init__()
+        self.committer = committer
+
+    @actor_message()
+    def on_update(self, value):
+        self.committer.on_update(value, async=True)
+
+
+class Committer(Actor):
+    """
+    Commits in its batch finish, like the IptablesUpdater.
+    """
+    def __init__(self):
+        super(Committer, self).__init__()
+        self.values = []
+
+    @actor_message()
+    def on_update(self, value):
+        self.values.append(value)
+
+    def _finish_msg_batch(self, batch, results):
+        trace.note_commit("rules")
+
+
+class TestTrace(BaseTestCase):
+    def setUp(self):
+        super(TestTrace, self).setUp()
+        stats.reset()
+        self.committer = Committer()
+        self.forwarder = Forwarder(self.committer)
+
+    def tearDown(self):
+        trace.configure(0)
+        stats.reset()
+        super(TestTrace, self).tearDown()
+
+    def send(self, index):
+        with trace.traced("endpoint", index, "EtcdWatcher.handle_event"):
+            self.forwarder.on_update(index, async=True)
+
+    def test_trace_follows_messages(self):
+        trace.configure(1)
+        self.send(10)
+        self.assertEqual(stats.counter("trace.endpoint.count"), 0)
+        self.step_actor(self.forwarder)
+        self.assertEqual(stats.counter("trace.endpoint.count"), 0)
+        self.step_actor(self.committer)
+        self.assertEqual(self.committer.values, [10])
+        self.assertEqual(stats.counter("trace.endpoint.count"), 1)
+        snap = stats.snapshot()
+        self.assertEqual(snap["trace.endpoint.total"]["count"], 1)
+        self.assertEqual(snap["trace.endpoint.commit.rules"]["count"], 1)
+        for stage in ("EtcdWatcher.handle_event",
+                      "Forwarder.on_update",
+                      "Committer.on_update",
+                      "Committer._finish_msg_batch"):
+            self.assertEqual(snap["trace.stage.%s.run" % stage]["count"], 1,
+                             stage)
+        self.assertEqual(trace.current_traces(), ())
+
+    def test_batched_traces(self):
+        trace.configure(1)
+        self.send(1)
+        self.send(2)
+        self.step_actor(self.forwarder)
+        self.step_actor(self.committer)
+        self.assertEqual(self.committer.values, [1, 2])
+        self.assertEqual(stats.counter("trace.endpoint.count"), 2)
+        self.assertEqual(
+            stats.snapshot()["trace.endpoint.commit.rules"]["count"], 2)
+
+    def test_sampling(self):
+        trace.configure(3)
+        for index in xrange(6):
+            self.send(index)
+        self.step_actor(self.forwarder)
+        self.step_actor(self.committer)
+        self.assertEqual(stats.counter("trace.endpoint.count"), 2)
+
+    def test_disabled(self):
+        self.send(1)
+        self.step_actor(self.forwarder)
+        self.step_actor(self.committer)
+        self.assertEqual(self.committer.values, [1])
+        self.assertEqual(stats.snapshot(), {})
+
+    def test_no_commit(self):
+        trace.configure(1)
+        with trace.traced("other", 1, "EtcdWatcher.handle_event"):
+            pass
+        self.assertEqual(stats.counter("trace.other.no_commit"), 1)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_workers
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the worker process support.
+"""
+import logging
+from StringIO import StringIO
+
+import mock
+
+from calico.datamodel_v1 import EndpointId
+from calico.felix import workers
+from calico.felix.config import Config
+from calico.felix.splitter import UpdateSplitter
+from calico.felix.test.base import BaseTestCase
+from calico.felix.workers import (WorkerSupervisor, WorkerReceiver,
+                                  WorkerFailed, encode_frame, read_frame,
+                                  worker_log_file, MSG_CONFIG, MSG_RULES,
+                                  MSG_ENDPOINT)
+
+_log = logging.getLogger(__name__)
+
+EP_ID = EndpointId("host", "orch", "wl", "ep")
+ENDPOINT = {"state": "active", "name": "tapabcdef",
+            "mac": "aa:bb:cc:dd:ee:ff", "profile_ids": ["prof1"],
+            "ipv4_nets": ["10.0.0.1/32"], "ipv6_nets": []}
+
+
+def read_all(data):
+    input_file = StringIO(data)
+    msgs = []
+    while True:
+        msg = read_frame(input_file)
+        if msg is None:
+            return msgs
+        msgs.append(msg)
+
+
+class TestFrames(BaseTestCase):
+    def test_roundtrip(self):
+        data = (encode_frame(MSG_ENDPOINT, tuple(EP_ID), ENDPOINT) +
+                encode_frame(MSG_RULES, u"prof1", None))
+        self.assertEqual(read_all(data), [
+            (MSG_ENDPOINT, tuple(EP_ID), ENDPOINT),
+            (MSG_RULES, u"prof1", None),
+        ])
+
+    def test_truncated(self):
+        data = encode_frame(MSG_RULES, "prof1", None)
+        self.assertEqual(read_all(data[:-1]), [])
+        self.assertEqual(read_all(data[:2]), [])
+
+    def test_worker_log_file(self):
+        self.assertEqual(worker_log_file("/var/log/calico/felix.log", 4),
+                         "/var/log/calico/felix-v4.log")
+        self.assertEqual(worker_log_file("/tmp/felix", 6), "/tmp/felix-v6")
+
+
+class TestWorkerSupervisor(BaseTestCase):
+    def setUp(self):
+        super(TestWorkerSupervisor, self).setUp()
+        self.config = mock.Mock(spec=Config)
+        self.config.config_path = "/etc/calico/felix.cfg"
+        self.config.etcd_config = ({}, {"InterfacePrefix": "tap"})
+        self.config.LOGFILE = "/var/log/calico/felix.log"
+        self.procs = []
+        popen_patch = mock.patch("calico.felix.workers.subprocess.Popen",
+                                 side_effect=self.popen)
+        self.m_popen = popen_patch.start()
+        self.addCleanup(popen_patch.stop)
+        spawn_patch = mock.patch("calico.felix.workers.gevent.spawn")
+        spawn_patch.start()
+        self.addCleanup(spawn_patch.stop)
+        self.supervisor = WorkerSupervisor(self.config,
+                                           worker_cmd=["felix"])
+        self.supervisor.start_workers(async=True)
+        self.step_actor(self.supervisor)
+
+    def popen(self, cmd, **kwargs):
+        proc = mock.Mock()
+        proc.pid = 1000 + len(self.procs)
+        proc.stdin = StringIO()
+        self.procs.append(proc)
+        return proc
+
+    def sent(self, proc):
+        return read_all(proc.stdin.getvalue())
+
+    def test_start(self):
+        self.assertEqual(
+            [c[0][0] for c in self.m_popen.call_args_list],
+            [["felix", "--config-file", "/etc/calico/felix.cfg",
+              "--worker-ip-version", "4"],
+             ["felix", "--config-file", "/etc/calico/felix.cfg",
+              "--worker-ip-version", "6"]])
+        env = self.m_popen.call_args[1]["env"]
+        self.assertEqual(env["FELIX_LOGFILEPATH"],
+                         "/var/log/calico/felix-v6.log")
+        for proc in self.procs:
+            self.assertEqual(self.sent(proc), [
+                (MSG_CONFIG, {}, {"InterfacePrefix": "tap"})
+            ])
+
+    def test_updates(self):
+        sup = self.supervisor
+        sup.apply_snapshot({"prof1": []}, {"prof1": ["tag1"]},
+                           {EP_ID: ENDPOINT}, async=True)
+        sup.on_rules_update("prof2", {"inbound_rules": []}, async=True)
+        sup.on_tags_update("prof1", None, async=True)
+        sup.on_endpoint_update(EP_ID, None, async=True)
+        sup.on_interface_update("tapabcdef", async=True)
+        self.step_actor(sup)
+        expected = [
+            ("c", {}, {"InterfacePrefix": "tap"}),
+            ("s",),
+            ("r", "prof1", []),
+            ("t", "prof1", ["tag1"]),
+            ("e", tuple(EP_ID), ENDPOINT),
+            ("S",),
+            ("r", "prof2", {"inbound_rules": []}),
+            ("t", "prof1", None),
+            ("e", tuple(EP_ID), None),
+            ("i", "tapabcdef"),
+        ]
+        self.assertEqual(self.sent(self.procs[0]), expected)
+        self.assertEqual(self.sent(self.procs[1]), expected)
+
+    def test_restart_resyncs(self):
+        sup = self.supervisor
+        sup.apply_snapshot({"prof1": []}, {}, {EP_ID: ENDPOINT}, async=True)
+        sup.on_rules_update("prof1", None, async=True)
+        sup.on_rules_update("prof2", [], async=True)
+        self.step_actor(sup)
+
+        sup.on_worker_exit(6, self.procs[1], async=True)
+        self.step_actor(sup)
+        self.assertEqual(len(self.procs), 3)
+        self.assertEqual(self.m_popen.call_args[0][0][-1], "6")
+        # The replacement gets the current state as a snapshot.
+        self.assertEqual(self.sent(self.procs[2]), [
+            ("c", {}, {"InterfacePrefix": "tap"}),
+            ("s",),
+            ("r", "prof2", []),
+            ("e", tuple(EP_ID), ENDPOINT),
+            ("S",),
+        ])
+        # And subsequent updates.
+        sup.on_interface_update("tapabcdef", async=True)
+        self.step_actor(sup)
+        self.assertEqual(self.sent(self.procs[2])[-1], ("i", "tapabcdef"))
+
+        # Exit of the old process is ignored once it has been replaced.
+        sup.on_worker_exit(6, self.procs[1], async=True)
+        self.step_actor(sup)
+        self.assertEqual(len(self.procs), 3)
+
+    def test_send_failure(self):
+        self.procs[0].stdin = mock.Mock()
+        self.procs[0].stdin.write.side_effect = IOError(32, "Broken pipe")
+        self.supervisor.on_interface_update("tapabcdef", async=True)
+        self.step_actor(self.supervisor)
+        # The other worker still gets the update.
+        self.assertEqual(self.sent(self.procs[1])[-1], ("i", "tapabcdef"))
+
+    def test_too_many_restarts(self):
+        sup = self.supervisor
+        results = []
+        with mock.patch("calico.felix.workers.time.time", return_value=1000):
+            for _ in xrange(workers.MAX_RESTARTS + 1):
+                results.append(sup.on_worker_exit(4, sup._procs[4],
+                                                  async=True))
+                self.step_actor(sup)
+        for result in results[:-1]:
+            result.get()
+        self.assertRaises(WorkerFailed, results[-1].get)
+
+    def test_restarts_forgotten(self):
+        sup = self.supervisor
+        for i in xrange(workers.MAX_RESTARTS + 1):
+            with mock.patch("calico.felix.workers.time.time",
+                            return_value=1000 + i * workers.RESTART_WINDOW):
+                sup.on_worker_exit(6, sup._procs[6], async=True)
+                self.step_actor(sup)
+        self.assertEqual(len(self.procs), 2 + workers.MAX_RESTARTS + 1)
+
+
+class TestWorkerReceiver(BaseTestCase):
+    def test_load_config(self):
+        receiver = WorkerReceiver(StringIO(
+            encode_frame(MSG_CONFIG, {"a": "b"}, {"c": "d"})))
+        config = mock.Mock(spec=Config)
+        receiver.load_config(config)
+        config.report_etcd_config.assert_called_once_with({"a": "b"},
+                                                          {"c": "d"})
+
+    def test_load_config_missing(self):
+        receiver = WorkerReceiver(StringIO(""))
+        self.assertRaises(WorkerFailed, receiver.load_config,
+                          mock.Mock(spec=Config))
+
+    def test_receive(self):
+        data = "".join([
+            encode_frame("s"),
+            encode_frame("r", "prof1", []),
+            encode_frame("t", "prof1", ["tag1"]),
+            encode_frame("e", tuple(EP_ID), ENDPOINT),
+            encode_frame("i", "tapabcdef"),
+            encode_frame("S"),
+            encode_frame("r", "prof1", None),
+            encode_frame("t", "prof1", None),
+            encode_frame("e", tuple(EP_ID), None),
+            encode_frame("i", "tapabcdef"),
+        ])
+        splitter = mock.Mock(spec=UpdateSplitter)
+        receiver = WorkerReceiver(StringIO(data))
+        self.assertRaises(WorkerFailed, receiver.receive, splitter)
+        self.assertEqual(splitter.mock_calls, [
+            mock.call.on_interface_update("tapabcdef", async=True),
+            mock.call.apply_snapshot({"prof1": []}, {"prof1": ["tag1"]},
+                                     {EP_ID: ENDPOINT}, async=True),
+            mock.call.on_rules_update("prof1", None, async=True),
+            mock.call.on_tags_update("prof1", None, async=True),
+            mock.call.on_endpoint_update(EP_ID, None, async=True),
+            mock.call.on_interface_update("tapabcdef", async=True),
+        ])
+        endpoint_id = splitter.apply_snapshot.call_args[0][2].keys()[0]
+        self.assertTrue(isinstance(endpoint_id, EndpointId))
+
+    def test_unexpected_message(self):
+        receiver = WorkerReceiver(StringIO(encode_frame("x")))
+        self.assertRaises(WorkerFailed, receiver.receive,
+                          mock.Mock(spec=UpdateSplitter))
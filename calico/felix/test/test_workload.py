@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_workload
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the etcd workload generator and replay tool.
+"""
+import logging
+from StringIO import StringIO
+
+from calico.felix.test.base import BaseTestCase
+from calico.felix.test.bench_felix import SyntheticDeployment
+from calico.felix.test.fake_dataplane import FakeDataplane
+from calico.felix.test.workload import (WorkloadGenerator, write_stream,
+                                        read_stream, run_replay, _percentile)
+
+_log = logging.getLogger(__name__)
+
+
+class TestWorkload(BaseTestCase):
+    def generate(self):
+        deployment = SyntheticDeployment(12, 4, 3, num_hosts=3, ipv6=True)
+        generator = WorkloadGenerator(deployment)
+        generator.boot_storm(6)
+        generator.sg_edit(2)
+        generator.tag_edit(2)
+        generator.host_evacuation("host-1")
+        generator.host_evacuation(deployment.hostname)
+        generator.resync()
+        return generator
+
+    def test_stream_round_trip(self):
+        generator = self.generate()
+        f = StringIO()
+        write_stream(f, "bench-host", generator.snapshot, generator.events)
+        f.seek(0)
+        hostname, snapshot, events = read_stream(f)
+        self.assertEqual(hostname, "bench-host")
+        self.assertEqual(snapshot, generator.snapshot)
+        self.assertEqual(events, generator.events)
+        labels = set(e.label for e in events)
+        self.assertEqual(labels, set(["boot_storm", "sg_edit", "tag_edit",
+                                      "host_evacuation", "resync"]))
+
+    def test_replay(self):
+        generator = self.generate()
+        results = run_replay(generator.deployment.hostname,
+                             generator.snapshot, generator.events,
+                             FakeDataplane(realtime=False), timeout=60)
+        latency = results["latency"]
+        for kind in ("local_endpoint", "local_endpoint_delete", "rules",
+                     "resync"):
+            self.assertTrue(latency[kind]["count"] > 0, kind)
+        self.assertFalse(any(v.get("timed_out") for v in latency.values()))
+        self.assertEqual(results["events"], len(generator.events))
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(_percentile(values, 50), 50)
+        self.assertEqual(_percentile(values, 99), 99)
+        self.assertEqual(_percentile([3], 90), 3)
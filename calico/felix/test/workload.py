@@ -0,0 +1,647 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.workload
+~~~~~~~~~~~~~~~~~~~
+
+Generates, records and replays streams of etcd events for benchmarking
+Felix's etcd handling and managers.
+
+A stream is a snapshot of the Calico etcd tree plus a list of events, each
+of which is a write or delete of a datamodel_v1 key or a "resync" (the etcd
+cluster being rebuilt, which forces Felix to reload the snapshot).  Streams
+are stored as JSON lines: the first line holds the hostname of the Felix
+under test and the snapshot, each later line holds one event.
+
+Replaying a stream loads the snapshot into a FakeEtcd, starts the real
+Felix actors against it and a FakeDataplane (see bench_felix), waits for
+the snapshot to be programmed and then injects the events at a controlled
+rate.  For each event, we work out which parts of the dataplane it affects
+and poll until they match the model again; the report gives the event-to-programmed latency
+percentiles by kind of event.  Latencies are only as accurate as the poll
+interval and events that don't change anything that we can observe (for
+example, an endpoint on another host with no tags in use here) are counted
+but not timed.
+
+Examples::
+
+    python -m calico.felix.test.workload generate --endpoints 2000 \\
+        --hosts 4 --boot-storm 500 --sg-edits 5 --evacuate host-1 \\
+        --resync --output stream.json
+    python -m calico.felix.test.workload record --etcd-addr 10.0.0.1:4001 \\
+        --hostname compute1 --duration 600 --output recorded.json
+    python -m calico.felix.test.workload replay stream.json --rate 200
+"""
+from collections import defaultdict, namedtuple
+import json
+import logging
+import math
+import optparse
+import re
+import sys
+import time
+import uuid
+
+import etcd
+from etcd import EtcdEventIndexCleared
+import gevent
+from urllib3.exceptions import ReadTimeoutError
+
+from calico import stats
+from calico.datamodel_v1 import (VERSION_DIR, ENDPOINT_KEY_RE, RULES_KEY_RE,
+                                 TAGS_KEY_RE, key_for_endpoint,
+                                 key_for_profile_rules, key_for_profile_tags,
+                                 EndpointId)
+from calico.felix.frules import profile_to_chain_name
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.ipsets import tag_to_ipset_name
+from calico.felix.test.bench_felix import (EtcdModel, FelixHarness,
+                                           endpoint_ips,
+                                           add_deployment_options,
+                                           deployment_from_options,
+                                           add_dataplane_options,
+                                           dataplane_from_options)
+from calico.felix.test.fake_etcd import FakeEtcd
+
+_log = logging.getLogger(__name__)
+
+SET = "set"
+DELETE = "delete"
+RESYNC = "resync"
+
+# One event in a stream.  offset is the time, in seconds from the start of
+# the stream, at which the event was recorded (0 for generated streams);
+# label names the scenario that generated it.  For a resync, value is the
+# new cluster ID.
+WorkloadEvent = namedtuple("WorkloadEvent",
+                           ["action", "key", "value", "offset", "label"])
+
+
+def write_stream(f, hostname, snapshot, events):
+    """
+    Writes a stream to the file-like object f.
+
+    :param snapshot: iterable of etcd (key, value) pairs.
+    :param events: iterable of WorkloadEvents.
+    """
+    f.write(json.dumps({"hostname": hostname,
+                        "snapshot": [list(kv) for kv in snapshot]}) + "\n")
+    for event in events:
+        f.write(json.dumps(event._asdict()) + "\n")
+
+
+def read_stream(f):
+    """
+    Reads a stream written by write_stream.
+
+    :returns tuple[str,list,list[WorkloadEvent]]: the hostname, snapshot and
+        events.
+    """
+    header = json.loads(f.readline())
+    events = [WorkloadEvent(**json.loads(line)) for line in f if
+              line.strip()]
+    return header["hostname"], [tuple(kv) for kv in header["snapshot"]], events
+
+
+class WorkloadGenerator(object):
+    """
+    Generates event streams against a SyntheticDeployment.  Each scenario
+    updates the deployment as it goes so that later scenarios see the
+    results of earlier ones.
+    """
+    def __init__(self, deployment):
+        self.deployment = deployment
+        self.snapshot = list(deployment.etcd_items())
+        self.events = []
+
+    def _set(self, key, value, label):
+        self.deployment.apply_set(key, value)
+        self.events.append(WorkloadEvent(SET, key, value, 0, label))
+
+    def _delete(self, key, label):
+        self.deployment.apply_delete(key)
+        self.events.append(WorkloadEvent(DELETE, key, None, 0, label))
+
+    def boot_storm(self, count, host=None):
+        """
+        Many VMs booting at once: count new endpoints, spread over the hosts
+        unless host is given.
+        """
+        for _ in xrange(count):
+            endpoint_id, endpoint = self.deployment.new_endpoint(host=host)
+            self._set(key_for_endpoint(*endpoint_id), json.dumps(endpoint),
+                      "boot_storm")
+
+    def sg_edit(self, count):
+        """
+        Security group edits: new rules for the count profiles that are used
+        by the most endpoints.
+        """
+        usage = defaultdict(int)
+        for endpoint in self.deployment.endpoints.itervalues():
+            for profile_id in endpoint["profile_ids"]:
+                usage[profile_id] += 1
+        profile_ids = sorted(self.deployment.rules_by_id,
+                             key=lambda p: (-usage[p], p))[:count]
+        for profile_id in profile_ids:
+            self._set(key_for_profile_rules(profile_id),
+                      json.dumps(self.deployment.make_rules()), "sg_edit")
+
+    def tag_edit(self, count):
+        """
+        Changes the tags of count randomly-chosen profiles, moving their
+        endpoints between ipsets.
+        """
+        rand = self.deployment.random
+        profile_ids = sorted(self.deployment.tags_by_id)
+        for profile_id in rand.sample(profile_ids,
+                                      min(count, len(profile_ids))):
+            tags = [rand.choice(self.deployment.tags)]
+            self._set(key_for_profile_tags(profile_id), json.dumps(tags),
+                      "tag_edit")
+
+    def host_evacuation(self, host):
+        """
+        Moves every endpoint off host: each is deleted and then recreated,
+        with its IPs and profiles, on one of the other hosts.
+        """
+        others = [h for h in self.deployment.hosts if h != host]
+        evacuated = sorted((endpoint_id, endpoint) for
+                           endpoint_id, endpoint in
+                           self.deployment.endpoints.iteritems() if
+                           endpoint_id.host == host)
+        for i, (endpoint_id, endpoint) in enumerate(evacuated):
+            self._delete(key_for_endpoint(*endpoint_id), "host_evacuation")
+            if not others:
+                continue
+            new_id, new_endpoint = self.deployment.new_endpoint(
+                host=others[i % len(others)])
+            for field in ("profile_ids", "ipv4_nets", "ipv6_nets"):
+                if field in endpoint:
+                    new_endpoint[field] = endpoint[field]
+            self._set(key_for_endpoint(*new_id), json.dumps(new_endpoint),
+                      "host_evacuation")
+
+    def resync(self):
+        """
+        The etcd cluster being rebuilt, forcing Felix to resync.
+        """
+        self.events.append(WorkloadEvent(RESYNC, None, uuid.uuid4().hex, 0,
+                                         "resync"))
+
+
+def record_stream(client, duration):
+    """
+    Records a stream from a real etcd: the current snapshot and then the
+    events for the following duration seconds.  If etcd's event history
+    overflows, records a resync and carries on from the current index.
+
+    :returns tuple[list,list[WorkloadEvent]]: the snapshot and events.
+    """
+    initial = client.read(VERSION_DIR, recursive=True)
+    snapshot = [(n.key, n.value) for n in initial.children if not n.dir]
+    next_index = initial.etcd_index + 1
+    events = []
+    start = time.time()
+    deadline = start + duration
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            response = client.read(VERSION_DIR, wait=True,
+                                   waitIndex=next_index, recursive=True,
+                                   timeout=remaining)
+        except ReadTimeoutError:
+            continue
+        except EtcdEventIndexCleared:
+            events.append(WorkloadEvent(RESYNC, None, None,
+                                        time.time() - start, "recorded"))
+            next_index = client.read(VERSION_DIR).etcd_index + 1
+            continue
+        next_index = response.modifiedIndex + 1
+        if response.action in ("delete", "expire", "compareAndDelete"):
+            action, value = DELETE, None
+        else:
+            action, value = SET, response.value
+        events.append(WorkloadEvent(action, response.key, value,
+                                    time.time() - start, "recorded"))
+    return snapshot, events
+
+
+class LatencyTracker(object):
+    """
+    Injects events into a FakeEtcd and tracks how long it takes for their
+    effects to show up in the dataplane programmed by a FelixHarness.
+
+    Each event is reduced to the things in the dataplane that it affects:
+    ipset entries, local endpoints and profile chains.  An event counts as
+    programmed once all of those match the *current* model, so an event
+    that is overtaken by a later one (say, an endpoint that is created and
+    then deleted) completes when the later state is programmed.
+    """
+    def __init__(self, harness, model, etcd, timeout=60):
+        self.harness = harness
+        self.model = model
+        self.etcd = etcd
+        self.timeout = timeout
+        # List of (kind, inject time, affected items).
+        self.pending = []
+        self.latencies = defaultdict(list)
+        self.timed_out = defaultdict(int)
+        self.unobservable = defaultdict(int)
+        # Last-known copy of each local endpoint, for spotting its removal.
+        self.local_endpoints = model.local_endpoints()
+        self.endpoint_ids_by_ip = defaultdict(set)
+        for endpoint_id, endpoint in model.endpoints.iteritems():
+            self._index_ips(endpoint_id, endpoint, add=True)
+
+    def _index_ips(self, endpoint_id, endpoint, add):
+        for version in (4, 6):
+            for ip in endpoint_ips(endpoint, version):
+                if add:
+                    self.endpoint_ids_by_ip[ip].add(endpoint_id)
+                else:
+                    self.endpoint_ids_by_ip[ip].discard(endpoint_id)
+
+    def inject(self, event):
+        """
+        Applies the event to the model and to etcd and starts tracking it.
+        """
+        kind, affected = self._prepare(event)
+        if event.action == SET:
+            self.etcd.set(event.key, event.value)
+        elif event.action == DELETE:
+            self.etcd.delete(event.key, recursive=True)
+        else:
+            self.etcd.set_cluster_id(event.value or uuid.uuid4().hex)
+        if affected:
+            self.pending.append((kind, time.time(), affected))
+        else:
+            self.unobservable[kind] += 1
+
+    def _prepare(self, event):
+        """
+        Updates the model for the event and works out what it affects.
+
+        :returns tuple[str,list]: the kind of event and the affected items:
+            ("entry", version, tag, ip), ("endpoint", endpoint_id),
+            ("rules", profile_id) or ("resync",).
+        """
+        model = self.model
+        if event.action == RESYNC:
+            return "resync", [("resync",)]
+
+        if event.action == DELETE:
+            removed = model.apply_delete(event.key)
+            affected = []
+            kind = "delete"
+            for endpoint_id, endpoint in removed.iteritems():
+                self._index_ips(endpoint_id, endpoint, add=False)
+                affected += self._entries(endpoint,
+                                          model.endpoint_tags(endpoint))
+                if model.is_local(endpoint_id):
+                    kind = "local_endpoint_delete"
+                    affected.append(("endpoint", endpoint_id))
+            return kind, affected
+
+        m = ENDPOINT_KEY_RE.match(event.key)
+        if m:
+            endpoint_id = EndpointId(m.group("hostname"),
+                                     m.group("orchestrator"),
+                                     m.group("workload_id"),
+                                     m.group("endpoint_id"))
+            affected = []
+            old = model.endpoints.get(endpoint_id)
+            if old is not None:
+                self._index_ips(endpoint_id, old, add=False)
+                affected += self._entries(old, model.endpoint_tags(old))
+            model.apply_set(event.key, event.value)
+            endpoint = model.endpoints[endpoint_id]
+            self._index_ips(endpoint_id, endpoint, add=True)
+            affected += self._entries(endpoint, model.endpoint_tags(endpoint))
+            if model.is_local(endpoint_id):
+                self.local_endpoints[endpoint_id] = endpoint
+                self.harness.dataplane.add_interface(endpoint["name"])
+                affected.append(("endpoint", endpoint_id))
+                return "local_endpoint", affected
+            return "remote_endpoint", affected
+
+        m = RULES_KEY_RE.match(event.key)
+        if m:
+            profile_id = m.group("profile_id")
+            model.apply_set(event.key, event.value)
+            if not self._profile_in_use(profile_id):
+                return "rules", []
+            return "rules", [("rules", profile_id)]
+
+        m = TAGS_KEY_RE.match(event.key)
+        if m:
+            profile_id = m.group("profile_id")
+            old_tags = set(model.tags_by_id.get(profile_id) or [])
+            model.apply_set(event.key, event.value)
+            changed = old_tags ^ set(model.tags_by_id.get(profile_id) or [])
+            affected = []
+            for endpoint in model.endpoints.itervalues():
+                if profile_id in endpoint["profile_ids"]:
+                    affected += self._entries(endpoint, changed)
+            return "tags", affected
+
+        model.apply_set(event.key, event.value)
+        return "other", []
+
+    def _entries(self, endpoint, tags):
+        """
+        :returns list[tuple]: the ipset entries that the endpoint
+            contributes to, or is removed from, for those of the tags that
+            are in use on this host.
+        """
+        active = self.model.active_tags()
+        return [("entry", version, tag, ip) for tag in tags if tag in active
+                for version in (4, 6)
+                for ip in endpoint_ips(endpoint, version)]
+
+    def _profile_in_use(self, profile_id):
+        return any(profile_id in e["profile_ids"] for e in
+                   self.model.local_endpoints().itervalues())
+
+    def _programmed(self, item, view, active_tags):
+        """
+        :returns bool: True if the dataplane matches the model for the item.
+        """
+        model = self.model
+        if item[0] == "entry":
+            _, version, tag, ip = item
+            expected = tag in active_tags and any(
+                tag in model.endpoint_tags(model.endpoints[endpoint_id])
+                for endpoint_id in self.endpoint_ids_by_ip[ip])
+            ip_type = IPV4 if version == 4 else IPV6
+            members = view.set_members(version,
+                                       tag_to_ipset_name(ip_type, tag))
+            return (ip in (members or ())) == expected
+        versions = model.ip_versions() or [4]
+        if item[0] == "endpoint":
+            endpoint_id = item[1]
+            endpoint = model.endpoints.get(endpoint_id)
+            if endpoint is None:
+                endpoint = self.local_endpoints[endpoint_id]
+                return all(view.endpoint_removed(v, endpoint)
+                           for v in versions)
+            return not any(view.endpoint_missing(v, endpoint)
+                           for v in versions)
+        if item[0] == "rules":
+            profile_id = item[1]
+            if not self._profile_in_use(profile_id):
+                return True
+            ports = set()
+            rules = model.rules_by_id.get(profile_id) or {}
+            for rule in rules.get("inbound_rules", []):
+                ports.update(str(p) for p in rule.get("dst_ports", []))
+            chain = profile_to_chain_name("inbound", profile_id)
+            for version in versions:
+                chains, _ = view.chains(version)
+                words = set(re.split(r"[\s,{}]+",
+                                     " ".join(chains.get(chain, ()))))
+                if not ports <= words:
+                    return False
+            return True
+        # Resync: Felix must have reconnected to the new cluster and
+        # reprogrammed everything.
+        client = self.harness.etcd_watcher.client
+        return (client.expected_cluster_id == self.etcd.cluster_id and
+                not self.harness.missing_programming(model))
+
+    def poll(self):
+        """
+        Checks the pending events against the current dataplane, recording
+        the latency of any that have now been programmed.
+        """
+        if not self.pending:
+            return
+        view = self.harness.view()
+        active_tags = self.model.active_tags()
+        now = time.time()
+        still_pending = []
+        for kind, injected, affected in self.pending:
+            if all(self._programmed(i, view, active_tags) for i in affected):
+                self.latencies[kind].append(now - injected)
+            elif now - injected > self.timeout:
+                _log.warning("Timed out waiting for %s event", kind)
+                self.timed_out[kind] += 1
+            else:
+                still_pending.append((kind, injected, affected))
+        self.pending = still_pending
+
+    def report(self):
+        """
+        :returns dict: latency percentiles, in seconds, by kind of event,
+            plus counts of the events that timed out or couldn't be
+            observed.
+        """
+        kinds = (set(self.latencies) | set(self.timed_out) |
+                 set(self.unobservable))
+        results = {}
+        all_latencies = []
+        for kind in kinds:
+            latencies = self.latencies[kind]
+            all_latencies += latencies
+            results[kind] = _summarise(latencies)
+            results[kind]["timed_out"] = self.timed_out[kind]
+            results[kind]["unobservable"] = self.unobservable[kind]
+        results["all"] = _summarise(all_latencies)
+        return results
+
+
+def _summarise(latencies):
+    latencies = sorted(latencies)
+    summary = {"count": len(latencies)}
+    if latencies:
+        summary.update({"p50": _percentile(latencies, 50),
+                        "p90": _percentile(latencies, 90),
+                        "p99": _percentile(latencies, 99),
+                        "max": latencies[-1]})
+    return summary
+
+
+def _percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of a non-empty, sorted list.
+    """
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def run_replay(hostname, snapshot, events, dataplane, backend="iptables",
+               dispatch_mode="tree", rate=None, speed=None, timeout=600,
+               event_timeout=60, poll_interval=0.01, trace_sample_rate=0):
+    """
+    Replays a stream into Felix and measures its latency.
+
+    :param rate: If set, inject events at this many per second.
+    :param speed: If set (and rate isn't), inject events at their recorded
+        offsets, sped up by this factor.  Otherwise, events are injected as
+        fast as possible.
+    :returns dict: the results.
+    :raises AssertionError: if the snapshot isn't programmed or the events
+        don't finish within timeout.
+    """
+    model = EtcdModel.from_items(snapshot, hostname=hostname)
+    for endpoint in model.local_endpoints().itervalues():
+        dataplane.add_interface(endpoint["name"])
+    fake_etcd = FakeEtcd()
+    for key, value in snapshot:
+        fake_etcd.set(key, value)
+    harness = FelixHarness(fake_etcd, dataplane, backend=backend,
+                           dispatch_mode=dispatch_mode, hostname=hostname,
+                           trace_sample_rate=trace_sample_rate)
+    tracker = LatencyTracker(harness, model, fake_etcd,
+                             timeout=event_timeout)
+    harness.start()
+    injector = None
+    try:
+        start = time.time()
+        harness.watch_etcd()
+        deadline = start + timeout
+        while harness.missing_programming(model):
+            if time.time() > deadline:
+                raise AssertionError("Snapshot not programmed after %ss" %
+                                     timeout)
+            gevent.sleep(poll_interval)
+        snapshot_seconds = time.time() - start
+
+        def inject_all():
+            inject_start = time.time()
+            for i, event in enumerate(events):
+                if rate:
+                    due = inject_start + i / float(rate)
+                elif speed:
+                    due = inject_start + event.offset / float(speed)
+                else:
+                    due = 0
+                gevent.sleep(max(0, due - time.time()))
+                tracker.inject(event)
+        injector = gevent.spawn(inject_all)
+        replay_start = time.time()
+        while not injector.ready() or tracker.pending:
+            if time.time() > deadline:
+                raise AssertionError("Replay not finished after %ss; %s "
+                                     "events pending, e.g. %s" %
+                                     (timeout, len(tracker.pending),
+                                      [k for k, _, _ in tracker.pending[:5]]))
+            gevent.sleep(poll_interval)
+            tracker.poll()
+        injector.get()
+        replay_seconds = time.time() - replay_start
+    finally:
+        if injector is not None:
+            injector.kill()
+        harness.stop()
+    results = {
+        "events": len(events),
+        "seconds_to_program_snapshot": snapshot_seconds,
+        "replay_seconds": replay_seconds,
+        "latency": tracker.report(),
+    }
+    results.update(dataplane.stats())
+    if trace_sample_rate:
+        results["trace"] = stats.snapshot()
+    return results
+
+
+def main(argv):
+    usage = ("%prog generate [options]\n"
+             "       %prog record [options]\n"
+             "       %prog replay [options] STREAM")
+    parser = optparse.OptionParser(usage=usage)
+    add_deployment_options(parser)
+    add_dataplane_options(parser)
+    parser.add_option("--output", "-o", help="file to write the stream to")
+    parser.add_option("--boot-storm", type="int", default=0,
+                      help="(generate) number of endpoints to boot")
+    parser.add_option("--boot-host",
+                      help="(generate) host to boot them on; by default "
+                           "they are spread over all hosts")
+    parser.add_option("--sg-edits", type="int", default=0,
+                      help="(generate) number of profiles to edit the rules "
+                           "of, most-used first")
+    parser.add_option("--tag-edits", type="int", default=0,
+                      help="(generate) number of profiles to retag")
+    parser.add_option("--evacuate", action="append", default=[],
+                      help="(generate) host to evacuate; may be repeated")
+    parser.add_option("--resync", action="store_true", default=False,
+                      help="(generate) finish with a resync")
+    parser.add_option("--etcd-addr", default="localhost:4001",
+                      help="(record) etcd to record from")
+    parser.add_option("--hostname",
+                      help="(record) hostname of the Felix to replay for")
+    parser.add_option("--duration", type="float", default=60,
+                      help="(record) seconds to record for")
+    parser.add_option("--rate", type="float",
+                      help="(replay) events per second to inject")
+    parser.add_option("--speed", type="float",
+                      help="(replay) speed-up factor for recorded offsets")
+    parser.add_option("--timeout", type="float", default=600)
+    options, args = parser.parse_args(argv)
+    if not args or args[0] not in ("generate", "record", "replay"):
+        parser.error("Expected generate, record or replay")
+    command = args[0]
+
+    if command == "replay":
+        if len(args) != 2:
+            parser.error("replay needs a stream file")
+        with open(args[1]) as f:
+            hostname, snapshot, events = read_stream(f)
+        results = run_replay(hostname, snapshot, events,
+                             dataplane_from_options(options),
+                             backend=options.backend,
+                             dispatch_mode=options.dispatch_mode,
+                             rate=options.rate, speed=options.speed,
+                             timeout=options.timeout,
+                             trace_sample_rate=options.trace_sample_rate)
+        print json.dumps(results, indent=2, sort_keys=True)
+        return 0
+
+    if command == "generate":
+        generator = WorkloadGenerator(deployment_from_options(options))
+        if options.boot_storm:
+            generator.boot_storm(options.boot_storm, host=options.boot_host)
+        if options.sg_edits:
+            generator.sg_edit(options.sg_edits)
+        if options.tag_edits:
+            generator.tag_edit(options.tag_edits)
+        for host in options.evacuate:
+            generator.host_evacuation(host)
+        if options.resync:
+            generator.resync()
+        hostname = generator.deployment.hostname
+        snapshot, events = generator.snapshot, generator.events
+    else:
+        if not options.hostname:
+            parser.error("record needs --hostname")
+        host, _, port = options.etcd_addr.partition(":")
+        client = etcd.Client(host=host, port=int(port or 4001))
+        hostname = options.hostname
+        snapshot, events = record_stream(client, options.duration)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            write_stream(f, hostname, snapshot, events)
+    else:
+        write_stream(sys.stdout, hostname, snapshot, events)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
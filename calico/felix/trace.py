@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Metaswitch Networks
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+felix.trace
+~~~~~~~~~~~
+
+End-to-end latency tracing of etcd updates.
+
+The EtcdWatcher opens a Trace for a sample of the etcd events that it
+receives.  While an actor is handling a traced message, the trace is the
+"current" trace for that actor's greenlet and any messages that the actor
+sends are tagged with it, so the trace follows the update through the
+UpdateSplitter, the managers and their child actors down to the
+IptablesUpdater.  Each actor records how long the traced messages waited
+in its queue and how long it spent on them.  The points where Felix
+commits to the dataplane (iptables/nft, ipsets and routes) call
+note_commit() to timestamp the commit against every current trace.
+
+A Trace is reference counted by the messages that carry it; when the last
+of them has been processed, all the work that the update caused is done
+and the trace is closed.  Its timings are then recorded in calico.stats
+histograms, keyed by update type (endpoint, rules, tags, ...):
+
+* trace.<type>.total: from receipt of the etcd event to the trace closing.
+* trace.<type>.commit.<kind>: to the last commit of each kind.
+* trace.stage.<Actor>.<method>.queued/.run: per-actor queueing delay and
+  processing time.
+
+Tracing is off unless TraceSampleRate is set, in which case one in that
+many events is traced.  Untraced messages pay only for an empty-tuple
+check.
+"""
+import contextlib
+import logging
+import time
+
+from calico import stats
+from calico.felix.actor import actor_storage
+
+_log = logging.getLogger(__name__)
+
+# Trace one in this many events; 0 disables tracing.
+_sample_rate = 0
+_events_seen = 0
+
+
+def configure(sample_rate):
+    """
+    Sets the sampling rate.
+
+    :param int sample_rate: Trace one in this many events; 0 to disable.
+    """
+    global _sample_rate, _events_seen
+    _sample_rate = sample_rate
+    _events_seen = 0
+
+
+class Trace(object):
+    """
+    Timings for one etcd update as it passes through Felix.
+    """
+    __slots__ = ("update_type", "etcd_index", "start", "pending", "stages",
+                 "commits")
+
+    def __init__(self, update_type, etcd_index):
+        self.update_type = update_type
+        self.etcd_index = etcd_index
+        self.start = time.time()
+        self.pending = 0
+        # Maps stage name to [messages, total queued time, total run time].
+        self.stages = {}
+        # Maps commit kind to time of last commit, relative to start.
+        self.commits = {}
+
+    def incref(self):
+        self.pending += 1
+
+    def decref(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self._close()
+
+    def record_stage(self, stage, queued, run):
+        totals = self.stages.get(stage)
+        if totals is None:
+            self.stages[stage] = [1, queued, run]
+        else:
+            totals[0] += 1
+            totals[1] += queued
+            totals[2] += run
+
+    def record_commit(self, kind, now):
+        self.commits[kind] = now - self.start
+
+    def _close(self):
+        total = time.time() - self.start
+        prefix = "trace.%s" % self.update_type
+        stats.increment(prefix + ".count")
+        stats.histogram(prefix + ".total").record(total)
+        for kind, latency in self.commits.iteritems():
+            stats.histogram("%s.commit.%s" % (prefix, kind)).record(latency)
+        if not self.commits:
+            stats.increment(prefix + ".no_commit")
+        for stage, (_, queued, run) in self.stages.iteritems():
+            stats.histogram("trace.stage.%s.queued" % stage).record(queued)
+            stats.histogram("trace.stage.%s.run" % stage).record(run)
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("Trace of %s update at etcd index %s closed after "
+                       "%.4fs; commits: %s; stages: %s", self.update_type,
+                       self.etcd_index, total, self.commits, self.stages)
+
+    def __str__(self):
+        return "Trace<%s,%s>" % (self.update_type, self.etcd_index)
+
+
+def start_trace(update_type, etcd_index, force=False):
+    """
+    Starts a trace, subject to sampling.
+
+    :param force: If True, always trace if tracing is enabled at all.
+    :returns: a Trace, holding one reference for the caller, or None if
+        this event isn't being traced.
+    """
+    global _events_seen
+    if not _sample_rate:
+        return None
+    _events_seen += 1
+    if not force and _events_seen % _sample_rate != 0:
+        return None
+    trace = Trace(update_type, etcd_index)
+    trace.incref()
+    return trace
+
+
+def current_traces():
+    """
+    :returns tuple[Trace]: the traces of the message that the current
+        greenlet is processing.
+    """
+    return getattr(actor_storage, "traces", ())
+
+
+@contextlib.contextmanager
+def traced(update_type, etcd_index, stage, force=False):
+    """
+    Context manager that makes a new (sampled) trace current for the
+    duration of the block.  The block's run time is recorded against stage.
+    """
+    trace = start_trace(update_type, etcd_index, force=force)
+    if trace is None:
+        yield None
+        return
+    previous = current_traces()
+    actor_storage.traces = (trace,)
+    try:
+        yield trace
+    finally:
+        actor_storage.traces = previous
+        trace.record_stage(stage, 0, time.time() - trace.start)
+        trace.decref()
+
+
+def note_commit(kind):
+    """
+    Records a successful dataplane commit against the current traces.
+
+    :param str kind: The kind of commit, "rules", "ipset" or "routes".
+    """
+    traces = current_traces()
+    if traces:
+        now = time.time()
+        for trace in traces:
+            trace.record_commit(kind, now)
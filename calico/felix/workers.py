@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Metaswitch Networks
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+felix.workers
+~~~~~~~~~~~~~
+
+Runs the IPv4 and IPv6 dataplanes in separate worker processes.
+
+With ProcessModel set to per-ip-version, the main Felix process only runs
+the EtcdWatcher and the InterfaceWatcher.  They feed a WorkerSupervisor,
+which takes the place of the UpdateSplitter.  The supervisor starts a worker
+process per IP version (calico-felix --worker-ip-version N) and streams
+every update to the workers' stdin.  In each worker, a WorkerReceiver
+decodes the updates and passes them to a normal UpdateSplitter.  That
+splitter feeds the dataplane actors for the worker's IP version.
+
+Each update is serialised with marshal, which is compact and quick to
+decode, and framed with a length prefix.  Snapshots are streamed as a
+start marker, one frame per key and an end marker, rather than as one huge
+message.  The supervisor keeps the encoded frame for the latest value of
+every key.  If a worker dies, it starts a replacement and resyncs it from
+those frames without going back to etcd.  If a worker fails more than
+MAX_RESTARTS times in RESTART_WINDOW seconds, the supervisor gives up and
+takes Felix down.
+"""
+import logging
+import marshal
+import os
+import struct
+import sys
+import time
+from collections import defaultdict
+
+import gevent
+from gevent import subprocess
+from gevent.fileobject import FileObject
+
+from calico import stats
+from calico.datamodel_v1 import EndpointId
+from calico.felix.actor import Actor, actor_message
+
+_log = logging.getLogger(__name__)
+
+# Message types.
+MSG_CONFIG = "c"
+MSG_SNAPSHOT_START = "s"
+MSG_SNAPSHOT_END = "S"
+MSG_RULES = "r"
+MSG_TAGS = "t"
+MSG_ENDPOINT = "e"
+MSG_INTERFACE = "i"
+
+_FRAME_HEADER = struct.Struct("!I")
+
+# Give up if a worker fails more than this many times in this many seconds.
+MAX_RESTARTS = 3
+RESTART_WINDOW = 60
+
+
+class WorkerFailed(Exception):
+    pass
+
+
+def encode_frame(msg_type, *args):
+    """
+    :returns str: a length-prefixed frame carrying the message.
+    """
+    payload = marshal.dumps((msg_type,) + args)
+    return _FRAME_HEADER.pack(len(payload)) + payload
+
+
+def read_frame(input_file):
+    """
+    Reads a frame written by encode_frame().
+
+    :returns tuple: (message type, arg, ...) or None at end of file.
+    """
+    header = input_file.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+        return None
+    length, = _FRAME_HEADER.unpack(header)
+    payload = input_file.read(length)
+    if len(payload) < length:
+        return None
+    return marshal.loads(payload)
+
+
+def worker_log_file(log_file, ip_version):
+    """
+    :returns str: the log file for the worker for the given IP version;
+        for example /var/log/calico/felix-v4.log.
+    """
+    root, ext = os.path.splitext(log_file)
+    return "%s-v%s%s" % (root, ip_version, ext)
+
+
+class WorkerSupervisor(Actor):
+    """
+    Actor that takes the role of the UpdateSplitter in the main process,
+    streaming the updates to the worker processes, and restarts the
+    workers if they fail.
+    """
+    def __init__(self, config, ip_versions=(4, 6), worker_cmd=None):
+        """
+        :param config: The Config, which must have been loaded from etcd.
+        :param ip_versions: The IP versions to start workers for.
+        :param list[str] worker_cmd: Command to start a worker, to which we
+            append the options.  Defaults to running calico-felix with the
+            current interpreter.
+        """
+        super(WorkerSupervisor, self).__init__()
+        self.config = config
+        self.ip_versions = ip_versions
+        self._worker_cmd = worker_cmd or [sys.executable, "-m",
+                                          "calico.felix.felix"]
+        self._procs = {}
+        self._restart_times = defaultdict(list)
+
+        # The encoded frame for the latest value of each key, used to
+        # resync replacement workers.  None until we receive a snapshot.
+        self._rules_frames = None
+        self._tags_frames = None
+        self._endpoint_frames = None
+
+    @actor_message()
+    def start_workers(self):
+        for ip_version in self.ip_versions:
+            self._start_worker(ip_version)
+
+    def _start_worker(self, ip_version):
+        cmd = self._worker_cmd + ["--config-file", self.config.config_path,
+                                  "--worker-ip-version", str(ip_version)]
+        env = dict(os.environ)
+        if self.config.LOGFILE:
+            env["FELIX_LOGFILEPATH"] = worker_log_file(self.config.LOGFILE,
+                                                       ip_version)
+        _log.info("Starting IPv%s worker: %s", ip_version, cmd)
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=-1,
+                                close_fds=True, env=env)
+        self._procs[ip_version] = proc
+        waiter = gevent.spawn(proc.wait)
+        waiter.link(lambda _: self.on_worker_exit(ip_version, proc,
+                                                  async=True))
+
+        host_dict, global_dict = self.config.etcd_config
+        frames = [encode_frame(MSG_CONFIG, host_dict, global_dict)]
+        self._send(ip_version, frames)
+        if self._endpoint_frames is not None:
+            _log.info("Resyncing IPv%s worker", ip_version)
+            self._send(ip_version, self._snapshot_frames())
+
+    @actor_message()
+    def on_worker_exit(self, ip_version, proc):
+        """
+        Called when a worker process exits.  Starts a replacement.
+
+        :raises WorkerFailed: if the worker has failed too often.
+        """
+        if self._procs.get(ip_version) is not proc:
+            _log.debug("Worker %s has already been replaced", proc.pid)
+            return
+        _log.error("IPv%s worker (pid %s) exited with %s", ip_version,
+                   proc.pid, proc.returncode)
+        stats.increment("workers.v%s.restarts" % ip_version)
+        now = time.time()
+        restart_times = [t for t in self._restart_times[ip_version]
+                         if now - t < RESTART_WINDOW]
+        restart_times.append(now)
+        self._restart_times[ip_version] = restart_times
+        if len(restart_times) > MAX_RESTARTS:
+            raise WorkerFailed("IPv%s worker failed %s times in %s seconds" %
+                               (ip_version, len(restart_times),
+                                RESTART_WINDOW))
+        self._start_worker(ip_version)
+
+    @actor_message()
+    def apply_snapshot(self, rules_by_prof_id, tags_by_prof_id,
+                       endpoints_by_id):
+        """
+        Replaces the whole cache state with the input and sends it to the
+        workers.  Same semantics as UpdateSplitter.apply_snapshot().
+        """
+        self._rules_frames = dict(
+            (profile_id, encode_frame(MSG_RULES, profile_id, rules))
+            for profile_id, rules in rules_by_prof_id.iteritems()
+        )
+        self._tags_frames = dict(
+            (profile_id, encode_frame(MSG_TAGS, profile_id, tags))
+            for profile_id, tags in tags_by_prof_id.iteritems()
+        )
+        self._endpoint_frames = dict(
+            (endpoint_id, encode_frame(MSG_ENDPOINT, tuple(endpoint_id),
+                                       endpoint))
+            for endpoint_id, endpoint in endpoints_by_id.iteritems()
+        )
+        _log.info("Sending snapshot to workers. %s rules, %s tags, "
+                  "%s endpoints", len(self._rules_frames),
+                  len(self._tags_frames), len(self._endpoint_frames))
+        for ip_version in self.ip_versions:
+            self._send(ip_version, self._snapshot_frames())
+
+    def _snapshot_frames(self):
+        yield encode_frame(MSG_SNAPSHOT_START)
+        for frames in (self._rules_frames, self._tags_frames,
+                       self._endpoint_frames):
+            for frame in frames.itervalues():
+                yield frame
+        yield encode_frame(MSG_SNAPSHOT_END)
+
+    @actor_message()
+    def on_rules_update(self, profile_id, rules):
+        frame = encode_frame(MSG_RULES, profile_id, rules)
+        self._update_cache(self._rules_frames, profile_id, rules, frame)
+        self._broadcast(frame)
+
+    @actor_message()
+    def on_tags_update(self, profile_id, tags):
+        frame = encode_frame(MSG_TAGS, profile_id, tags)
+        self._update_cache(self._tags_frames, profile_id, tags, frame)
+        self._broadcast(frame)
+
+    @actor_message()
+    def on_endpoint_update(self, endpoint_id, endpoint):
+        frame = encode_frame(MSG_ENDPOINT, tuple(endpoint_id), endpoint)
+        self._update_cache(self._endpoint_frames, endpoint_id, endpoint,
+                           frame)
+        self._broadcast(frame)
+
+    @actor_message()
+    def on_interface_update(self, name):
+        self._broadcast(encode_frame(MSG_INTERFACE, name))
+
+    def _update_cache(self, frames, key, value, frame):
+        if frames is None:
+            # Before the first snapshot; the snapshot will replace the
+            # whole cache.
+            return
+        if value is None:
+            frames.pop(key, None)
+        else:
+            frames[key] = frame
+
+    def _broadcast(self, frame):
+        for ip_version in self.ip_versions:
+            self._send(ip_version, [frame])
+
+    def _send(self, ip_version, frames):
+        """
+        Writes the frames to the worker's stdin.  If the worker has died,
+        we log and carry on; on_worker_exit() will replace it and resync
+        the replacement from the cache.
+        """
+        proc = self._procs[ip_version]
+        try:
+            for frame in frames:
+                proc.stdin.write(frame)
+            proc.stdin.flush()
+        except (IOError, OSError) as e:
+            _log.error("Failed to send update to IPv%s worker (pid %s): %r",
+                       ip_version, proc.pid, e)
+
+
+class WorkerReceiver(object):
+    """
+    Reads the updates that the WorkerSupervisor streams to a worker
+    process and passes them to the worker's UpdateSplitter.
+    """
+    def __init__(self, input_file=None):
+        """
+        :param input_file: File to read from; defaults to a cooperative
+            wrapper around stdin.
+        """
+        self._input = input_file or FileObject(sys.stdin.fileno(), "rb",
+                                               close=False)
+
+    def load_config(self, config):
+        """
+        Reads the etcd configuration that the supervisor sends first and
+        completes the config with it.
+        """
+        msg = read_frame(self._input)
+        if msg is None or msg[0] != MSG_CONFIG:
+            raise WorkerFailed("Expected config from main process, got %r" %
+                               (msg,))
+        _, host_dict, global_dict = msg
+        config.report_etcd_config(host_dict, global_dict)
+
+    def receive(self, splitter):
+        """
+        Passes updates to the splitter until the main process goes away.
+
+        :raises WorkerFailed: when the main process closes our input.
+        """
+        snapshot = None
+        while True:
+            msg = read_frame(self._input)
+            if msg is None:
+                raise WorkerFailed("Main process closed our input")
+            msg_type = msg[0]
+            if msg_type == MSG_SNAPSHOT_START:
+                snapshot = ({}, {}, {})
+            elif msg_type == MSG_SNAPSHOT_END:
+                rules_by_id, tags_by_id, endpoints_by_id = snapshot
+                _log.info("Received snapshot. %s rules, %s tags, "
+                          "%s endpoints", len(rules_by_id), len(tags_by_id),
+                          len(endpoints_by_id))
+                splitter.apply_snapshot(rules_by_id, tags_by_id,
+                                        endpoints_by_id, async=True)
+                snapshot = None
+            elif msg_type == MSG_RULES:
+                _, profile_id, rules = msg
+                if snapshot is not None:
+                    snapshot[0][profile_id] = rules
+                else:
+                    splitter.on_rules_update(profile_id, rules, async=True)
+            elif msg_type == MSG_TAGS:
+                _, profile_id, tags = msg
+                if snapshot is not None:
+                    snapshot[1][profile_id] = tags
+                else:
+                    splitter.on_tags_update(profile_id, tags, async=True)
+            elif msg_type == MSG_ENDPOINT:
+                _, endpoint_id, endpoint = msg
+                endpoint_id = EndpointId(*endpoint_id)
+                if snapshot is not None:
+                    snapshot[2][endpoint_id] = endpoint
+                else:
+                    splitter.on_endpoint_update(endpoint_id, endpoint,
+                                                async=True)
+            elif msg_type == MSG_INTERFACE:
+                splitter.on_interface_update(msg[1], async=True)
+            else:
+                raise WorkerFailed("Unexpected message %r" % (msg,))
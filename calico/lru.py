@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Metaswitch Networks
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+calico.lru
+~~~~~~~~~~
+
+Least-recently-used cache, bounded by the total weight of its entries.
+
+The caller gives each entry a weight, normally an estimate of the memory
+that it uses, and the cache evicts the least recently used entries to keep
+the total weight within its limit.  Hits, misses and evictions are counted
+in calico.stats under the cache's name.
+"""
+from collections import OrderedDict
+import logging
+
+from calico import stats
+
+_log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    def __init__(self, name, max_weight):
+        """
+        :param name: Name of the cache, used as the prefix of its stats.
+        :param max_weight: Limit on the total weight of the entries.
+        """
+        self.name = name
+        self.max_weight = max_weight
+        self.weight = 0
+        # Maps key to (value, weight), least recently used first.
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        :returns: the value for key, marking it as recently used, or default
+            if it is not in the cache.
+        """
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            stats.increment(self.name + ".misses")
+            return default
+        self._entries[key] = entry
+        stats.increment(self.name + ".hits")
+        return entry[0]
+
+    def put(self, key, value, weight=1):
+        """
+        Adds or replaces the value for key, then evicts the least recently
+        used entries until the cache is within its weight limit.  A value
+        heavier than the whole limit is not cached.
+        """
+        self.discard(key)
+        if weight > self.max_weight:
+            _log.debug("Not caching %s; too heavy (%s)", key, weight)
+            return
+        self._entries[key] = (value, weight)
+        self.weight += weight
+        while self.weight > self.max_weight:
+            _, (_, evicted_weight) = self._entries.popitem(last=False)
+            self.weight -= evicted_weight
+            stats.increment(self.name + ".evictions")
+
+    def discard(self, key):
+        """
+        Removes key from the cache, if present.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[1]
+
+    def items(self):
+        """
+        :returns: a list of the (key, value) pairs in the cache, least
+            recently used first, without marking them as used.
+        """
+        return [(key, entry[0]) for key, entry in self._entries.iteritems()]
+
+    def clear(self):
+        self._entries.clear()
+        self.weight = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -24,9 +24,10 @@
 #
 # It is implemented as a Neutron/ML2 mechanism driver.
 import os
+import time
 import eventlet
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from functools import wraps
 
 # OpenStack imports.
@@ -35,6 +36,7 @@ from neutron.plugins.ml2 import driver_api as api
 from neutron.plugins.ml2.drivers import mech_agent
 from neutron import context as ctx
 from neutron import manager
+from oslo.config import cfg
 
 try:  # Icehouse, Juno
     from neutron.openstack.common import log
@@ -43,6 +45,8 @@ except ImportError:  # Kilo
 
 # Calico imports.
 import etcd
+from calico import stats
+from calico.openstack import t_etcd
 from calico.openstack.t_etcd import CalicoTransportEtcd
 
 LOG = log.getLogger(__name__)
@@ -54,6 +58,21 @@ AGENT_TYPE_FELIX = 'Felix (Calico agent)'
 # The interval between period resyncs, in seconds.
 # TODO: Increase this to a longer interval for product code.
 RESYNC_INTERVAL_SECS = 60
+# The number of ports or security groups that we read from the Neutron DB at a
+# time when resyncing.
+RESYNC_CHUNK_SIZE = 500
+# The fraction of the interval between resyncs over which we spread the
+# reads of each resync.
+RESYNC_SPREAD_FRACTION = 0.5
+# When writing a port with compare-and-swap, the number of times we try before
+# falling back to holding a database transaction across the write.
+MAX_PORT_CAS_ATTEMPTS = 3
+# When writing security group updates to etcd fails, the number of times we
+# try each group before leaving it to be repaired by the periodic resync, and
+# the longest that we wait between tries; the wait doubles after each failure,
+# starting from sg_update_delay.
+MAX_SG_UPDATE_ATTEMPTS = 5
+MAX_SG_UPDATE_RETRY_DELAY_SECS = 10
 # When we're not the master, how often we check if we have become the master.
 MASTER_CHECK_INTERVAL_SECS = 5
 
@@ -138,6 +157,19 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         self._periodic_resync_greenlet = None
         self._epoch = 0
 
+        # The number of pauses between reading chunks from the DB in the
+        # current resync, and the length of each pause.
+        self._resync_pauses = 0
+        self._resync_pause_secs = 0
+
+        # Security groups with changes that we haven't yet written to etcd,
+        # whether a greenthread is scheduled to write them, and, for each
+        # group that we're retrying, the number of times in a row that
+        # writing it has failed.
+        self._pending_sgids = set()
+        self._sg_updates_scheduled = False
+        self._sg_update_failures = {}
+
         # Make sure we initialise even if we don't see any API calls.
         eventlet.spawn_after(STARTUP_DELAY_SECS, self._init_state)
 
@@ -166,6 +198,8 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         # with the process.
         self._epoch += 1
         eventlet.spawn(self.periodic_resync_thread, self._epoch)
+        if cfg.CONF.calico.stats_report_interval:
+            eventlet.spawn(self.stats_report_thread, self._epoch)
 
         # (Re)init the DB.
         self.db = None
@@ -250,10 +284,9 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         Called after Neutron has committed a port creation event to the
         database.
 
-        Process this event by taking and holding a database transaction and
-        re-reading the port. Once we do that, we know the port will remain
-        unchanged while we hold the transaction. We can then write the port to
-        etcd, along with any other information we may need (security profiles).
+        Process this event by re-reading the port and writing it to etcd,
+        along with any other information we may need (security profiles); see
+        _write_port().
         """
         LOG.info('CREATE_PORT_POSTCOMMIT: %s', context)
         port = context._port
@@ -268,40 +301,122 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
             LOG.info("Creating unbound port: no work required.")
             return
 
-        with context._plugin_context.session.begin(subtransactions=True):
-            # First, regain the current port. This protects against concurrent
-            # writes breaking our state.
-            port = self.db.get_port(context._plugin_context, port['id'])
+        self._write_port(context._plugin_context, port)
 
-            # Next, fill out other information we need on the port.
-            self.add_port_gateways(port, context._plugin_context)
-            self.add_port_interface_name(port)
-            port['security_groups'] = self.get_security_groups_for_port(
-                context._plugin_context, port
-            )
+    def _write_port(self, plugin_context, port):
+        """
+        Re-reads a bound port from the database and writes it to etcd, along
+        with its security profiles, then marks it active.
+
+        By default, we do this holding a database transaction.  Once we have
+        re-read the port, we know that it will remain unchanged while we hold
+        the transaction, so we can write it without worrying about concurrent
+        updates.  However, that holds the transaction across the etcd
+        round-trips, which serialises the Neutron API workers.  With the
+        cas_port_writes option, we write the port with compare-and-swap
+        after the transaction instead; see _cas_write_port().
+
+        The caller decided that the port is bound from an earlier read, so
+        if the re-read port has since been unbound we don't write it; the
+        update that unbound it deletes the endpoint.
+        """
+        if (cfg.CONF.calico.cas_port_writes and
+                self._cas_write_port(plugin_context, port)):
+            return
 
-            # Next, we need to work out what security profiles apply to this
-            # port and grab information about it.
-            profiles = self.get_security_profiles(
-                context._plugin_context, port
-            )
+        with plugin_context.session.begin(subtransactions=True):
+            # First, regain the current port. This protects against concurrent
+            # writes breaking our state.
+            port, profiles = self._read_port(plugin_context, port['id'])
+            if not port_bound(port):
+                LOG.info("Port %s was unbound before we wrote it: no action.",
+                         port['id'])
+                return
 
             # Pass this to the transport layer.
-            # Implementation note: we could arguably avoid holding the
-            # transaction for this length and instead release it here, then
-            # use atomic CAS. The problem there is that we potentially have to
-            # repeatedly respin and regain the transaction. Let's not do that
-            # for now, and performance test to see if it's a problem later.
             self.transport.endpoint_created(port)
 
+            # The transport skips any profiles that are unchanged since it
+            # last wrote them, which is most of them when many ports share a
+            # security group.
             for profile in profiles:
                 self.transport.write_profile_to_etcd(profile)
 
             # Update Neutron that we succeeded.
-            self.db.update_port_status(context._plugin_context,
+            self.db.update_port_status(plugin_context,
                                        port['id'],
                                        constants.PORT_STATUS_ACTIVE)
 
+    def _cas_write_port(self, plugin_context, port):
+        """
+        Writes a port to etcd as _write_port() does, without holding a
+        database transaction across the etcd writes.
+
+        We read the etcd index of the port's endpoint, then read a snapshot
+        of the port in a short transaction, then write the endpoint only if
+        it hasn't been written since we read its index.  If another worker
+        wrote it in between, our snapshot may be older than theirs, so we
+        go round again, up to MAX_PORT_CAS_ATTEMPTS times.
+
+        Security profiles are written unconditionally, as they are when
+        holding the transaction; the resync repairs any that lose a race.
+
+        :returns: True if the port was written, or has been unbound and so
+            should not be written, or False if we ran out of attempts, in
+            which case the caller should write it holding the transaction.
+        """
+        for _ in xrange(MAX_PORT_CAS_ATTEMPTS):
+            prev_index = self.transport.get_endpoint_index(port)
+            prev_key = t_etcd.port_etcd_key(port)
+            with plugin_context.session.begin(subtransactions=True):
+                port, profiles = self._read_port(plugin_context, port['id'])
+
+            if not port_bound(port):
+                LOG.info("Port %s was unbound before we wrote it: no action.",
+                         port['id'])
+                return True
+            if t_etcd.port_etcd_key(port) != prev_key:
+                # The port has moved since we read the index, so we read the
+                # index of the wrong endpoint.
+                LOG.info("Port %s moved while writing it", port['id'])
+                continue
+            if not self.transport.cas_write_port_to_etcd(port, prev_index):
+                continue
+
+            for profile in profiles:
+                self.transport.write_profile_to_etcd(profile)
+            self.db.update_port_status(plugin_context,
+                                       port['id'],
+                                       constants.PORT_STATUS_ACTIVE)
+            return True
+
+        LOG.warning("Failed to write port %s with compare-and-swap after %s "
+                    "attempts", port['id'], MAX_PORT_CAS_ATTEMPTS)
+        return False
+
+    def _read_port(self, plugin_context, port_id):
+        """
+        Reads a port and fills out the other information that we need to
+        write it to etcd.
+
+        This method assumes it's being called from within a database
+        transaction and does not take out another one.
+
+        :returns: A tuple of the port dict and its ``SecurityProfile``
+            objects.
+        """
+        port = self.db.get_port(plugin_context, port_id)
+        self.add_port_gateways(port, plugin_context)
+        self.add_port_interface_name(port)
+        port['security_groups'] = self.get_security_groups_for_port(
+            plugin_context, port
+        )
+
+        # Work out what security profiles apply to this port and grab
+        # information about them.
+        profiles = self.get_security_profiles(plugin_context, port)
+        return port, profiles
+
     @retry_on_cluster_id_change
     @requires_state
     def update_port_postcommit(self, context):
@@ -327,6 +442,7 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
             return
 
         # Now, re-read the port.
+        write_port = False
         with context._plugin_context.session.begin(subtransactions=True):
             port = self.db.get_port(context._plugin_context, port['id'])
 
@@ -340,7 +456,8 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
             # - a change to an unbound port (which we don't care about, because
             #   we do nothing with unbound ports).
             if port_bound(port) and not port_bound(original):
-                self._port_bound_update(context, port)
+                LOG.info("Port becoming bound: create.")
+                write_port = True
             elif port_bound(original) and not port_bound(port):
                 self._port_unbound_update(context, original)
             elif original['binding:host_id'] != port['binding:host_id']:
@@ -348,11 +465,17 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
                 self._icehouse_migration_step(context, port, original)
             elif port_bound(original) and port_bound(port):
                 LOG.info("Port update")
-                self._update_port(context, port)
+                write_port = True
             else:
                 LOG.info("Update on unbound port: no action")
                 pass
 
+        if write_port:
+            # _write_port() re-reads the port.  We call it after releasing the
+            # transaction so that, with cas_port_writes, it doesn't hold a
+            # transaction across the etcd writes.
+            self._write_port(context._plugin_context, port)
+
     @retry_on_cluster_id_change
     @requires_state
     def delete_port_postcommit(self, context):
@@ -372,32 +495,103 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         # Pass this to the transport layer.
         self.transport.endpoint_deleted(port)
 
+    def queue_sg_updates(self, sgids):
+        """
+        Called whenever security group rules or membership change.
+
+        Rather than rewriting the groups for every change, we note the
+        changed groups and, sg_update_delay seconds after the first change,
+        write all the groups that have changed in the meantime in one go.
+        """
+        LOG.info("Queueing updates for security group IDs %s", sgids)
+        self._pending_sgids.update(sgids)
+        if not self._sg_updates_scheduled:
+            self._sg_updates_scheduled = True
+            eventlet.spawn_after(cfg.CONF.calico.sg_update_delay,
+                                 self._send_pending_sg_updates)
+
+    def _send_pending_sg_updates(self):
+        """
+        Writes the queued security group changes to etcd.  Runs in its own
+        greenthread.
+
+        If the writes fail, we try again after a delay that doubles with
+        each failure, up to MAX_SG_UPDATE_RETRY_DELAY_SECS.  Failures are
+        counted per group: once a group has failed MAX_SG_UPDATE_ATTEMPTS
+        times in a row we give up on it, and leave it to be repaired by the
+        periodic resync, while still retrying groups that were queued later.
+        """
+        self._sg_updates_scheduled = False
+        sgids = self._pending_sgids
+        self._pending_sgids = set()
+        try:
+            self.send_sg_updates(sgids, ctx.get_admin_context())
+        except Exception as e:
+            retry_sgids = set()
+            abandoned_sgids = set()
+            for sgid in sgids:
+                failures = self._sg_update_failures.get(sgid, 0) + 1
+                if failures >= MAX_SG_UPDATE_ATTEMPTS:
+                    self._sg_update_failures.pop(sgid, None)
+                    abandoned_sgids.add(sgid)
+                else:
+                    self._sg_update_failures[sgid] = failures
+                    retry_sgids.add(sgid)
+            if abandoned_sgids:
+                LOG.error("Failed to update security groups %s %s times, "
+                          "leaving them to the periodic resync: %r",
+                          abandoned_sgids, MAX_SG_UPDATE_ATTEMPTS, e)
+            if not retry_sgids:
+                return
+
+            failures = max(self._sg_update_failures[sgid]
+                           for sgid in retry_sgids)
+            delay = min(cfg.CONF.calico.sg_update_delay * 2 ** failures,
+                        MAX_SG_UPDATE_RETRY_DELAY_SECS)
+            if failures == 1:
+                LOG.exception("Failed to update security groups %s, will "
+                              "retry in %ss.", retry_sgids, delay)
+            else:
+                LOG.warning("Failed to update security groups %s again, "
+                            "will retry in %ss: %r", retry_sgids, delay, e)
+            self._pending_sgids.update(retry_sgids)
+            if not self._sg_updates_scheduled:
+                self._sg_updates_scheduled = True
+                eventlet.spawn_after(delay, self._send_pending_sg_updates)
+        else:
+            for sgid in sgids:
+                self._sg_update_failures.pop(sgid, None)
+
     @retry_on_cluster_id_change
     @requires_state
     def send_sg_updates(self, sgids, context):
         """
-        Called whenever security group rules or membership change.
+        Called with the security groups whose rules or membership have
+        changed.
 
-        When a security group rule is added, we need to do the following steps:
+        For the changed security groups, we need to do the following steps:
 
         1. Reread the security rules from the Neutron DB.
         2. Write the profile to etcd.
         """
         LOG.info("Updating security group IDs %s", sgids)
         with context.session.begin(subtransactions=True):
+            # Read the rules for all the groups in a single query.
             rules = self.db.get_security_group_rules(
-                context, filters={'security_group_id': sgids}
+                context, filters={'security_group_id': list(sgids)}
             )
 
-            # For each profile, build its object and send it down.
-            # TODO: Sending this to etcd could legitimately fail because of a
-            # CAS problem. Come back to handle retries.
-            profiles = (
-                profile_from_neutron_rules(sgid, rules) for sgid in sgids
-            )
+        # For each profile, build its object and send it down.  The rules
+        # were read in a single query, so there's no need to hold the
+        # transaction while we write them to etcd.
+        profiles = profiles_from_neutron_rules(sgids, rules)
 
-            for profile in profiles:
-                self.transport.write_profile_to_etcd(profile)
+        batch = self.transport.writer_pool.batch()
+        for profile in profiles:
+            batch.submit(profile.id,
+                         self.transport.write_profile_to_etcd,
+                         profile)
+        batch.wait()
 
     def _port_unbound_update(self, context, port):
         """
@@ -415,19 +609,10 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         This method expects to be called from within a database transaction,
         and does not create one itself.
         """
-        # TODO: Can we avoid re-writing the security profile here? Put another
-        # way, does the security profile change during migration steps, or does
-        # a separate port update event occur?
+        # Note: the transport only rewrites the security profiles if they have
+        # changed since it last wrote them.
         LOG.info("Port becoming bound: create.")
-        port = self.db.get_port(context._plugin_context, port['id'])
-        self.add_port_gateways(port, context._plugin_context)
-        self.add_port_interface_name(port)
-        port['security_groups'] = self.get_security_groups_for_port(
-            context._plugin_context, port
-        )
-        profiles = self.get_security_profiles(
-            context._plugin_context, port
-        )
+        port, profiles = self._read_port(context._plugin_context, port['id'])
         self.transport.endpoint_created(port)
 
         for profile in profiles:
@@ -447,53 +632,10 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         This method expects to be called from within a database transaction,
         and does not create one itself.
         """
-        # TODO: Can we avoid re-writing the security profile here? Put another
-        # way, does the security profile change during migration steps, or does
-        # a separate port update event occur?
         LOG.info("Migration as implemented in Icehouse")
         self._port_unbound_update(context, original)
         self._port_bound_update(context, port)
 
-    def _update_port(self, context, port):
-        """
-        Called during port updates that have nothing to do with migration.
-        """
-        # TODO: There's a lot of redundant code in these methods, with the only
-        # key difference being taking out transactions. Come back and shorten
-        # these.
-        LOG.info("Updating port %s", port)
-
-        # If the binding VIF type is unbound, we consider this port 'disabled',
-        # and should attempt to delete it. Otherwise, the port is enabled:
-        # re-process it.
-        port_disabled = port['binding:vif_type'] == 'unbound'
-        if not port_disabled:
-            LOG.info("Port enabled, attempting to update.")
-
-            with context._plugin_context.session.begin(subtransactions=True):
-                port = self.db.get_port(context._plugin_context, port['id'])
-                self.add_port_gateways(port, context._plugin_context)
-                self.add_port_interface_name(port)
-                port['security_groups'] = self.get_security_groups_for_port(
-                    context._plugin_context, port
-                )
-                profiles = self.get_security_profiles(
-                    context._plugin_context, port
-                )
-                self.transport.endpoint_created(port)
-
-                for profile in profiles:
-                    self.transport.write_profile_to_etcd(profile)
-
-                # Update Neutron that we succeeded.
-                self.db.update_port_status(context._plugin_context,
-                                           port['id'],
-                                           constants.PORT_STATUS_ACTIVE)
-        else:
-            # Port unbound, attempt to delete.
-            LOG.info("Port disabled, attempting delete if needed.")
-            self.transport.endpoint_deleted(port)
-
     def add_port_gateways(self, port, context):
         """
         Determine the gateway IP addresses for a given port's IP addresses, and
@@ -502,9 +644,55 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         This method assumes it's being called from within a database
         transaction and does not take out another one.
         """
-        for ip in port['fixed_ips']:
-            subnet = self.db.get_subnet(context, ip['subnet_id'])
-            ip['gateway'] = subnet['gateway_ip']
+        self.add_ports_gateways([port], context)
+
+    def add_ports_gateways(self, ports, context, gateways=None,
+                           ignore_missing_subnets=False):
+        """
+        As add_port_gateways(), for a list of ports, reading all the subnets
+        that they need in a single query.
+
+        This method assumes it's being called from within a database
+        transaction and does not take out another one.
+
+        :param gateways: Optional cache of the gateway IP for each subnet ID,
+            which is used and updated so that a resync only reads each subnet
+            once.
+        :param ignore_missing_subnets: If True, a port whose subnet doesn't
+            exist is given no gateway for that subnet.  Otherwise, the DB's
+            usual error for a missing subnet is raised.
+        """
+        if gateways is None:
+            gateways = {}
+        subnet_ids = set(ip['subnet_id']
+                         for port in ports
+                         for ip in port['fixed_ips']
+                         if ip['subnet_id'] not in gateways)
+        if subnet_ids:
+            subnets = self.db.get_subnets(
+                context,
+                filters={'id': list(subnet_ids)},
+                fields=['id', 'gateway_ip']
+            )
+            for subnet in subnets:
+                gateways[subnet['id']] = subnet['gateway_ip']
+
+        for port in ports:
+            for ip in port['fixed_ips']:
+                try:
+                    ip['gateway'] = gateways[ip['subnet_id']]
+                except KeyError:
+                    if not ignore_missing_subnets:
+                        # Read the subnet on its own, so that the DB raises
+                        # its usual error if it really is missing.
+                        subnet = self.db.get_subnet(context, ip['subnet_id'])
+                        ip['gateway'] = subnet['gateway_ip']
+                        continue
+                    # The subnet has been deleted under our feet; we'll
+                    # hear about the port changing shortly.
+                    LOG.warning("Subnet %s of port %s not found",
+                                ip['subnet_id'], port['id'])
+                    ip['gateway'] = None
 
     def get_security_profiles(self, context, port):
         """
@@ -526,11 +714,8 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
             context, filters={'security_group_id': sgids}
         )
 
-        # Now, return a generator that provides profile objects for each
-        # profile.
-        return (
-            profile_from_neutron_rules(sgid, rules) for sgid in sgids
-        )
+        # Now, return the profile objects for each profile.
+        return profiles_from_neutron_rules(sgids, rules)
 
     def periodic_resync_thread(self, expected_epoch):
         """
@@ -548,6 +733,8 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
                 if self.transport.is_master:
                     LOG.info("I am master: doing periodic resync")
                     context = ctx.get_admin_context()
+                    start_time = time.time()
+                    self._resync_pauses = 0
 
                     try:
                         # First, resync endpoints.
@@ -560,9 +747,24 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
                         self.transport.provide_felix_config()
                     except Exception:
                         LOG.exception("Error in periodic resync thread.")
-                    # Reschedule ourselves.
-                    eventlet.sleep(RESYNC_INTERVAL_SECS)
+
+                    # Spread the next resync over the interval, assuming
+                    # that it will be as big as this one.
+                    self._resync_pause_secs = (
+                        RESYNC_INTERVAL_SECS * RESYNC_SPREAD_FRACTION /
+                        max(self._resync_pauses, 1)
+                    )
+                    # Reschedule ourselves, RESYNC_INTERVAL_SECS after the
+                    # start of this resync.
+                    elapsed = time.time() - start_time
+                    LOG.info("Periodic resync took %.2fs", elapsed)
+                    eventlet.sleep(max(RESYNC_INTERVAL_SECS - elapsed, 0))
                 else:
+                    # Another node is checking the profiles and endpoints
+                    # that we've written against etcd, so we can't tell
+                    # whether they've been changed.  Forget them so that we
+                    # rewrite them.
+                    self.transport.forget_writes()
                     # Shorter sleep interval before we check if we've become
                     # the master.  Avoids waiting a whole RESYNC_INTERVAL_SECS
                     # if we just miss the master update.
@@ -577,141 +779,244 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         else:
             LOG.warning("Periodic resync thread exiting.")
 
+    def stats_report_thread(self, expected_epoch):
+        """
+        Logs the plugin's stats, such as the etcd writer pool's latencies,
+        every stats_report_interval seconds.  Runs on every server, not just
+        the master, because they all write to etcd.
+        """
+        LOG.info("Stats report thread started")
+        while self._epoch == expected_epoch:
+            eventlet.sleep(cfg.CONF.calico.stats_report_interval)
+            if stats.snapshot():
+                stats.log_report(LOG)
+        LOG.warning("Stats report thread exiting.")
+
     def resync_endpoints(self, context):
         """
         Handles periodic resynchronization for endpoints.
+
+        Compares every endpoint port in Neutron, read a chunk at a time, with
+        its endpoint in etcd, rewriting it if it is missing, on the wrong
+        host or has the wrong data, and then deletes any endpoints in etcd
+        that don't have a port.
         """
         LOG.info("Resyncing endpoints")
+        start_time = time.time()
 
         # Work out all the endpoints in etcd. Do this outside a database
         # transaction to try to ensure that anything that gets created is in
         # our Neutron snapshot.
-        endpoints = list(self.transport.get_endpoints())
-        endpoint_ids = set(ep.id for ep in endpoints)
-
-        # Then, grab all the ports from Neutron. Quickly work out whether
-        # a given port is missing from etcd, or if etcd has too many ports.
-        # Then, add all missing ports and remove all extra ones.
-        # This explicit with statement is technically unnecessary, but it helps
-        # keep our transaction scope really clear.
-        with context.session.begin(subtransactions=True):
-            ports = dict((port['id'], port)
-                         for port in self.db.get_ports(context)
-                         if self._port_is_endpoint_port(port))
-
-        port_ids = set(ports.keys())
-        missing_ports = port_ids - endpoint_ids
-        extra_ports = endpoint_ids - port_ids
-
-        # We need to do one more check: are any ports in the wrong place? The
-        # way we handle this is to treat this as a port that is both missing
-        # and extra, where the old version is extra and the new version is
-        # missing.
-        for endpoint in endpoints:
-            try:
-                port = ports[endpoint.id]
-            except KeyError:
-                # Port already in extra_ports.
-                continue
+        endpoints = dict(
+            (ep.id, ep) for ep in self.transport.get_endpoints()
+        )
 
-            if endpoint.host != port['binding:host_id']:
-                LOG.info(
-                    "Port %s is incorrectly on %s, should be %s",
-                    endpoint.id,
-                    endpoint.host,
-                    port['binding:host_id']
-                )
-                missing_ports.add(endpoint.id)
-                extra_ports.add(endpoint.id)
-
-        if missing_ports or extra_ports:
+        # Make sure that we rewrite any endpoints that have changed in etcd
+        # since we wrote them.
+        self.transport.refresh_written_endpoints(endpoints.values())
+
+        # The repairs are made concurrently by the transport's writer pool.
+        batch = self.transport.writer_pool.batch()
+        port_ids = set()
+        missing_ports = set()
+        moved_ports = set()
+        stale_ports = set()
+        gateways = {}
+
+        def read_ports(ports):
+            ports = [p for p in ports if self._port_is_endpoint_port(p)]
+            self._add_resync_port_info(context, ports, gateways)
+            return ports
+
+        for ports in self._resync_chunks(context, self.db.get_ports,
+                                         read_ports):
+            for port in ports:
+                port_ids.add(port['id'])
+                endpoint = endpoints.get(port['id'])
+                if endpoint is None:
+                    missing_ports.add(port['id'])
+                elif endpoint.host != port['binding:host_id']:
+                    # The port is in the wrong place.  Delete the old
+                    # version before writing the new one.
+                    LOG.info(
+                        "Port %s is incorrectly on %s, should be %s",
+                        endpoint.id,
+                        endpoint.host,
+                        port['binding:host_id']
+                    )
+                    moved_ports.add(port['id'])
+                    batch.submit(port['id'],
+                                 self._atomic_delete_endpoint,
+                                 endpoint)
+                elif endpoint.data != t_etcd.port_etcd_data(port):
+                    LOG.info("Port %s has the wrong data in etcd",
+                             port['id'])
+                    stale_ports.add(port['id'])
+                else:
+                    continue
+                batch.submit(port['id'],
+                             self.transport.endpoint_created,
+                             port)
+
+        # Finally, atomically delete the endpoints that don't have a port.
+        extra_ports = set(endpoints.keys()) - port_ids
+        for port_id in extra_ports:
+            batch.submit(port_id,
+                         self._atomic_delete_endpoint,
+                         endpoints[port_id])
+        batch.wait()
+
+        LOG.info("Resynced endpoints in %.2fs: %s ports, %s missing, "
+                 "%s moved, %s stale, %s extra",
+                 time.time() - start_time, len(port_ids),
+                 len(missing_ports), len(moved_ports), len(stale_ports),
+                 len(extra_ports))
+        if missing_ports or moved_ports or stale_ports or extra_ports:
             LOG.info("Missing ports: %s", missing_ports)
+            LOG.info("Moved ports: %s", moved_ports)
+            LOG.info("Stale ports: %s", stale_ports)
             LOG.info("Extra ports: %s", extra_ports)
 
-        # First, handle the extra ports. Each of them needs to be atomically
-        # deleted.
-        eps_to_delete = (e for e in endpoints if e.id in extra_ports)
+    def _atomic_delete_endpoint(self, endpoint):
+        try:
+            self.transport.atomic_delete_endpoint(endpoint)
+        except (ValueError, etcd.EtcdKeyNotFound):
+            # If the atomic CAD doesn't successfully delete, that's ok, it
+            # means the endpoint was created or updated elsewhere.
+            pass
 
-        for endpoint in eps_to_delete:
-            try:
-                self.transport.atomic_delete_endpoint(endpoint)
-            except (ValueError, etcd.EtcdKeyNotFound):
-                # If the atomic CAD doesn't successfully delete, that's ok, it
-                # means the endpoint was created or updated elsewhere.
-                continue
+    def _atomic_delete_profile(self, profile):
+        try:
+            self.transport.atomic_delete_profile(profile)
+        except (ValueError, etcd.EtcdKeyNotFound):
+            # If the atomic CAD doesn't successfully delete, that's ok, it
+            # means the profile was created or updated elsewhere.
+            pass
 
-        # Next, for each missing port, do a quick port creation. This takes out
-        # a db transaction and regains all the ports. Note that this
-        # transaction is potentially held for quite a while.
-        with context.session.begin(subtransactions=True):
-            missing_ports = self.db.get_ports(
-                context, filters={'id': missing_ports}
-            )
+    def _add_resync_port_info(self, context, ports, gateways):
+        """
+        Fills out the information that we need to write the ports to etcd,
+        reading the subnets and security groups for all the ports in two
+        queries.  A port whose subnet has been deleted is written without a
+        gateway for it, rather than failing the resync.
 
-            for port in missing_ports:
-                # Fill out other information we need on the port and write to
-                # etcd.
-                self.add_port_gateways(port, context)
-                self.add_port_interface_name(port)
-                port['security_groups'] = self.get_security_groups_for_port(
-                    context, port
-                )
-                self.transport.endpoint_created(port)
+        This method assumes it's being called from within a database
+        transaction and does not take out another one.
+
+        :param gateways: Cache of the gateway IP for each subnet ID, shared
+            by the calls for a resync.
+        """
+        self.add_ports_gateways(ports, context, gateways,
+                                ignore_missing_subnets=True)
+        sgids = self.get_security_groups_for_ports(context, ports)
+        for port in ports:
+            self.add_port_interface_name(port)
+            port['security_groups'] = sgids[port['id']]
 
     def resync_profiles(self, context):
         """
         Resynchronize security profiles.
+
+        Compares every security group in Neutron, read a chunk at a time,
+        with its profile in etcd, rewriting the profile if it is missing or
+        has the wrong rules or tags, and then deletes any profiles in etcd
+        that don't have a security group.
         """
         LOG.info("Resyncing profiles")
+        start_time = time.time()
+
         # Work out all the security groups in etcd. Do this outside a database
         # transaction to try to ensure that anything that gets created is in
         # our Neutron snapshot.
-        profiles = list(self.transport.get_profiles())
-        profile_ids = set(profile.id for profile in profiles)
-
-        # Next, grab all the security groups from Neutron. Quickly work out
-        # whether a given group is missing from etcd, or if etcd has too many
-        # groups. Then, add all missing groups and remove all extra ones.
-        # This explicit with statement is technically unnecessary, but it helps
-        # keep our transaction scope really clear.
-        with context.session.begin(subtransactions=True):
-            sgs = self.db.get_security_groups(context)
+        profiles = dict(
+            (profile.id, profile) for profile in self.transport.get_profiles()
+        )
 
-        sgids = set(sg['id'] for sg in sgs)
-        missing_groups = sgids - profile_ids
-        extra_groups = profile_ids - sgids
+        # Make sure that we rewrite any profiles that have changed in etcd
+        # since we wrote them.
+        self.transport.refresh_written_profiles(profiles.values())
 
-        if missing_groups or extra_groups:
-            LOG.info("Missing groups: %s", missing_groups)
-            LOG.info("Extra groups: %s", extra_groups)
+        # The repairs are made concurrently by the transport's writer pool.
+        batch = self.transport.writer_pool.batch()
+        sgids = set()
+        missing_groups = set()
+        stale_groups = set()
 
-        # For each missing profile, do a quick profile creation. This takes out
-        # a db transaction and regains all the rules. Note that this
-        # transaction is potentially held for quite a while.
-        with context.session.begin(subtransactions=True):
+        def read_rules(sgs):
+            chunk_sgids = [sg['id'] for sg in sgs]
             rules = self.db.get_security_group_rules(
-                context, filters={'security_group_id': missing_groups}
+                context, filters={'security_group_id': chunk_sgids}
             )
-
-            profiles_to_write = (
-                profile_from_neutron_rules(sgid, rules)
-                for sgid in missing_groups
-            )
-
-            for profile in profiles_to_write:
-                self.transport.write_profile_to_etcd(profile)
+            return chunk_sgids, rules
+
+        for chunk_sgids, rules in self._resync_chunks(
+                context, self.db.get_security_groups, read_rules):
+            sgids.update(chunk_sgids)
+            for profile in profiles_from_neutron_rules(chunk_sgids, rules):
+                etcd_profile = profiles.get(profile.id)
+                if etcd_profile is None:
+                    missing_groups.add(profile.id)
+                elif (etcd_profile.rules != t_etcd.profile_rules(profile) or
+                        etcd_profile.tags != t_etcd.profile_tags(profile)):
+                    LOG.info("Security group %s has the wrong profile in "
+                             "etcd", profile.id)
+                    stale_groups.add(profile.id)
+                else:
+                    continue
+                batch.submit(profile.id,
+                             self.transport.write_profile_to_etcd,
+                             profile)
 
         # Next, handle the extra profiles. Each of them needs to be atomically
         # deleted.
-        profiles_to_delete = (p for p in profiles if p.id in extra_groups)
+        extra_groups = set(profiles.keys()) - sgids
+        for profile_id in extra_groups:
+            batch.submit(profile_id,
+                         self._atomic_delete_profile,
+                         profiles[profile_id])
+        batch.wait()
+
+        LOG.info("Resynced profiles in %.2fs: %s groups, %s missing, "
+                 "%s stale, %s extra",
+                 time.time() - start_time, len(sgids), len(missing_groups),
+                 len(stale_groups), len(extra_groups))
+        if missing_groups or stale_groups or extra_groups:
+            LOG.info("Missing groups: %s", missing_groups)
+            LOG.info("Stale groups: %s", stale_groups)
+            LOG.info("Extra groups: %s", extra_groups)
 
-        for profile in profiles_to_delete:
-            try:
-                self.transport.atomic_delete_profile(profile)
-            except (ValueError, etcd.EtcdKeyNotFound):
-                # If the atomic CAD doesn't successfully delete, that's ok, it
-                # means the profile was created or updated elsewhere.
-                continue
+    def _resync_chunks(self, context, get_objects, read_chunk):
+        """
+        Generator: reads all the objects of one type from the Neutron DB,
+        RESYNC_CHUNK_SIZE at a time, in ID order.  Each chunk, and anything
+        else that read_chunk reads for it, is read in its own database
+        transaction; we yield read_chunk's result after leaving the
+        transaction, so that the caller's etcd writes, which may block
+        while the writer pool is busy, don't hold it open.
+
+        To spread the load of a resync across the resync interval, we pause
+        between chunks, for long enough that the pauses of a resync as big
+        as the last one add up to RESYNC_SPREAD_FRACTION of the interval.
+
+        :param get_objects: DB method to read the objects, such as
+            get_ports; called with Neutron's sorting and paging parameters.
+        :param read_chunk: called with each chunk, inside its transaction;
+            returns the value to yield for the chunk.
+        """
+        marker = None
+        while True:
+            with context.session.begin(subtransactions=True):
+                chunk = get_objects(context,
+                                    sorts=[('id', True)],
+                                    limit=RESYNC_CHUNK_SIZE,
+                                    marker=marker)
+                result = read_chunk(chunk)
+            yield result
+            if len(chunk) < RESYNC_CHUNK_SIZE:
+                return
+            marker = chunk[-1]['id']
+            self._resync_pauses += 1
+            eventlet.sleep(self._resync_pause_secs)
 
     def add_port_interface_name(self, port):
         port['interface_name'] = 'tap' + port['id'][:11]
@@ -737,11 +1042,24 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         actually be out of date, and I don't know why. This change ensures that
         we get the most recent information.
         """
-        filters = {'port_id': [port['id']]}
+        return self.get_security_groups_for_ports(context, [port])[port['id']]
+
+    def get_security_groups_for_ports(self, context, ports):
+        """
+        As get_security_groups_for_port(), for a list of ports, in a single
+        query.
+
+        :returns: A dict mapping each port ID to the list of IDs of its
+            security groups.
+        """
+        filters = {'port_id': [port['id'] for port in ports]}
         bindings = self.db._get_port_security_group_bindings(
             context, filters=filters
         )
-        return [binding['security_group_id'] for binding in bindings]
+        sgids = dict((port['id'], []) for port in ports)
+        for binding in bindings:
+            sgids[binding['port_id']].append(binding['security_group_id'])
+        return sgids
 
 
 class CalicoNotifierProxy(object):
@@ -758,7 +1076,7 @@ class CalicoNotifierProxy(object):
 
     def security_groups_rule_updated(self, context, sgids):
         LOG.info("security_groups_rule_updated: %s %s" % (context, sgids))
-        self.calico_driver.send_sg_updates(sgids, context)
+        self.calico_driver.queue_sg_updates(sgids)
         self.ml2_notifier.security_groups_rule_updated(context, sgids)
 
 
@@ -766,20 +1084,36 @@ def profile_from_neutron_rules(profile_id, rules):
     """
     Given a set of Neutron rules, build them into a ``SecurityProfile`` object.
     """
-    # Split the rules based on direction.
-    inbound_rules = []
-    outbound_rules = []
+    return profiles_from_neutron_rules([profile_id], rules)[0]
 
-    # Only use the rules that have the right profile id.
-    sg_rules = (r for r in rules if r['security_group_id'] == profile_id)
 
-    for rule in sg_rules:
+def profiles_from_neutron_rules(profile_ids, rules):
+    """
+    Given a set of Neutron rules, build the ``SecurityProfile`` object for
+    each of the given profile IDs.  This makes a single pass over the rules,
+    so building many profiles at once is much cheaper than building them one
+    at a time.
+
+    :returns: A list of ``SecurityProfile`` objects, in the order of
+        profile_ids.
+    """
+    # Split the rules based on profile id and direction, ignoring those for
+    # other profiles.
+    profiles = OrderedDict(
+        (profile_id, SecurityProfile(profile_id, [], []))
+        for profile_id in profile_ids
+    )
+
+    for rule in rules:
+        profile = profiles.get(rule['security_group_id'])
+        if profile is None:
+            continue
         if rule['direction'] == 'ingress':
-            inbound_rules.append(rule)
+            profile.inbound_rules.append(rule)
         else:
-            outbound_rules.append(rule)
+            profile.outbound_rules.append(rule)
 
-    return SecurityProfile(profile_id, inbound_rules, outbound_rules)
+    return profiles.values()
 
 
 def port_status_change(port, original):
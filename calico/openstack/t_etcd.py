@@ -20,10 +20,12 @@
 # Standard Python library imports.
 from collections import namedtuple
 import functools
+import hashlib
 import httplib
 import json
 import re
 import socket
+import time
 import weakref
 
 # OpenStack imports.
@@ -35,6 +37,8 @@ except ImportError:  # Kilo
     from oslo_log import log
 
 # Calico imports.
+import eventlet
+from eventlet.event import Event
 from eventlet.semaphore import Semaphore
 import etcd
 import urllib3.exceptions
@@ -44,6 +48,8 @@ from calico.datamodel_v1 import (READY_KEY, CONFIG_DIR, TAGS_KEY_RE, HOST_DIR,
                                  key_for_profile_tags, key_for_config,
                                  NEUTRON_ELECTION_KEY)
 from calico.election import Elector
+from calico import stats
+from calico.lru import LRUCache
 
 
 # The node hostname is used as the default identity for leader election
@@ -57,9 +63,40 @@ calico_opts = [
                help="The port to use for the etcd node/proxy"),
     cfg.StrOpt('elector_name', default=hostname,
                help="A unique name to identify this node in leader election"),
+    cfg.FloatOpt('election_interval', default=30,
+                 help="Time in seconds between renewals of the leader "
+                      "election key by the master, which may be fractional"),
+    cfg.IntOpt('election_ttl', default=60,
+               help="Time in seconds for which the leader election key "
+                    "outlives the master if it fails, and so the longest "
+                    "time before another node takes over; must be greater "
+                    "than election_interval"),
+    cfg.FloatOpt('sg_update_delay', default=0.5,
+                 help="Time in seconds to wait after a security group "
+                      "change before writing the changed groups to etcd, so "
+                      "that a burst of changes is written once"),
+    cfg.IntOpt('etcd_write_concurrency', default=10,
+               help="The maximum number of concurrent writes to etcd when "
+                    "resyncing or updating many security groups"),
+    cfg.BoolOpt('cas_port_writes', default=False,
+                help="Read each port from the Neutron DB in a short "
+                     "transaction and then write it to etcd with "
+                     "compare-and-swap, rather than holding the transaction "
+                     "across the etcd writes"),
+    cfg.IntOpt('stats_report_interval', default=60,
+               help="Time in seconds between logging the plugin's stats, "
+                    "such as etcd write latencies; 0 disables"),
 ]
 cfg.CONF.register_opts(calico_opts, 'calico')
 
+# The number of endpoints for which we remember what we last wrote to etcd.
+ENDPOINT_CACHE_SIZE = 10000
+
+# When scanning etcd for all the endpoints or profiles, the number of hosts'
+# or profiles' subtrees that we read at once, and the timeout for each read.
+SCAN_CONCURRENCY = 10
+SCAN_READ_TIMEOUT = 5
+
 OPENSTACK_ENDPOINT_RE = re.compile(
     r'^' + HOST_DIR +
     r'/(?P<hostname>[^/]+)/.*openstack.*/endpoint/(?P<endpoint_id>[^/]+)')
@@ -68,12 +105,26 @@ LOG = log.getLogger(__name__)
 
 
 # Objects for lightly wrapping etcd return values for use in the mechanism
-# driver.
-Endpoint = namedtuple('Endpoint', ['id', 'key', 'modified_index', 'host'])
+# driver.  The data, tags and rules are the decoded JSON values, or None if
+# the values aren't valid JSON.
+Endpoint = namedtuple('Endpoint', ['id', 'key', 'modified_index', 'host',
+                                   'data'])
 Profile = namedtuple(
-    'Profile', ['id', 'tags_modified_index', 'rules_modified_index']
+    'Profile', ['id', 'tags_modified_index', 'rules_modified_index', 'tags',
+                'rules']
+)
+
+# What we last wrote to etcd for a profile: a hash of its rules and tags, and
+# the modifiedIndex of each of the writes.
+WrittenProfile = namedtuple(
+    'WrittenProfile',
+    ['content_hash', 'tags_modified_index', 'rules_modified_index']
 )
 
+# What we last wrote to etcd for an endpoint.
+WrittenEndpoint = namedtuple('WrittenEndpoint', ['key', 'data',
+                                                 'modified_index'])
+
 
 def _handling_etcd_exceptions(fn):
     """
@@ -95,6 +146,116 @@ def _handling_etcd_exceptions(fn):
     return wrapped
 
 
+class EtcdWriterPool(object):
+    """
+    Bounded pool of green threads that make etcd writes concurrently, so
+    that a batch of writes runs at the pace of etcd rather than at one
+    round-trip per write.
+
+    Callers make their writes through a batch of their own (see batch()),
+    so that each waits only for its own writes and sees only its own
+    failures; the batches share the pool's green threads.
+
+    Writes with the same key (normally a port or profile ID) are made in the
+    order that they were submitted, even if from different batches; writes
+    with different keys may be made in any order.  Submitting a write
+    blocks while the pool is full, so a caller submitting many writes is
+    held to the pace of the pool.
+
+    The time that each write takes is recorded in the etcd_writer.latency
+    stat, and the number of writes in the pool when each is submitted in
+    etcd_writer.in_flight.
+    """
+    def __init__(self, size):
+        self._pool = eventlet.GreenPool(size)
+        # Maps each key to an Event that is sent when the last write
+        # submitted for that key has finished.
+        self._last_writes = {}
+
+    @property
+    def in_flight(self):
+        """
+        The number of writes that have been submitted but not finished.
+        """
+        return self._pool.running()
+
+    def batch(self):
+        """
+        :returns: a new, empty EtcdWriteBatch for a caller's writes.
+        """
+        return EtcdWriteBatch(self)
+
+    def _submit(self, key, fn, args, errors):
+        """
+        Submits a write, to be made by calling fn(*args) once all previous
+        writes for key have finished.  Exceptions from fn are logged and
+        appended to errors.
+
+        :returns: the GreenThread that makes the write.
+        """
+        stats.histogram("etcd_writer.in_flight").record(self.in_flight)
+        previous = self._last_writes.get(key)
+        done = Event()
+        self._last_writes[key] = done
+        return self._pool.spawn(self._write, key, previous, done, fn, args,
+                                errors)
+
+    def _write(self, key, previous, done, fn, args, errors):
+        try:
+            if previous is not None:
+                previous.wait()
+            start_time = time.time()
+            try:
+                fn(*args)
+            except Exception as e:
+                LOG.warning("etcd write for %s failed: %r", key, e)
+                errors.append(e)
+            stats.histogram("etcd_writer.latency").record(
+                time.time() - start_time
+            )
+        finally:
+            if self._last_writes.get(key) is done:
+                del self._last_writes[key]
+            done.send()
+
+
+class EtcdWriteBatch(object):
+    """
+    One caller's writes through an EtcdWriterPool.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+        # Green threads making the writes submitted since the last wait().
+        self._threads = []
+        # Exceptions raised by those writes.
+        self._errors = []
+
+    def submit(self, key, fn, *args):
+        """
+        Submits a write, to be made by calling fn(*args) once all previous
+        writes for key, from this batch or any other, have finished.
+        Exceptions from fn are logged and saved to be raised by wait().
+        """
+        self._threads.append(
+            self._pool._submit(key, fn, args, self._errors)
+        )
+
+    def wait(self):
+        """
+        Waits for the writes submitted to this batch to finish.
+
+        :raises: the first exception raised by one of this batch's writes
+            since the last call, if any failed.
+        """
+        threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.wait()
+        errors, self._errors = self._errors, []
+        if errors:
+            LOG.error("%s etcd writes failed", len(errors))
+            raise errors[0]
+
+
 class CalicoTransportEtcd(object):
     """Calico transport implementation based on etcd."""
 
@@ -110,6 +271,20 @@ class CalicoTransportEtcd(object):
         # Elector, for performing leader election.
         self.elector = None
 
+        # The profiles that we have written to etcd, as WrittenProfile
+        # objects keyed by profile ID, and the most recently written
+        # endpoints, as WrittenEndpoint objects keyed by port ID, so that we
+        # can skip rewriting those that haven't changed.  Checked against
+        # etcd by refresh_written_profiles() and refresh_written_endpoints().
+        self.written_profiles = {}
+        self.written_endpoints = LRUCache("written_endpoints",
+                                          ENDPOINT_CACHE_SIZE)
+
+        # Pool for making batches of writes concurrently.
+        self.writer_pool = EtcdWriterPool(
+            cfg.CONF.calico.etcd_write_concurrency
+        )
+
         # Lock prevents concurrent re-initialisations which could leave us with
         # inconsistent client and elector.
         self._init_lock = Semaphore()
@@ -140,13 +315,17 @@ class CalicoTransportEtcd(object):
             elector = Elector(
                 client=client,
                 server_id=cfg.CONF.calico.elector_name,
-                election_key=NEUTRON_ELECTION_KEY
+                election_key=NEUTRON_ELECTION_KEY,
+                interval=cfg.CONF.calico.election_interval,
+                ttl=cfg.CONF.calico.election_ttl
             )
             # Since normal reading threads don't take the lock, save the
             # client and elector off together atomically.  This is atomic
             # because we're in a green thread.
             self.client = client
             self.elector = elector
+            # We may be talking to a different etcd now.
+            self.forget_writes()
 
     @property
     def is_master(self):
@@ -158,17 +337,80 @@ class CalicoTransportEtcd(object):
     @_handling_etcd_exceptions
     def write_profile_to_etcd(self, profile):
         """
-        Write a single security profile into etcd.
+        Write a single security profile into etcd, unless it is unchanged
+        since we last wrote it.
         """
+        rules = profile_rules(profile)
+        tags = profile_tags(profile)
+        content_hash = hashlib.sha1(
+            json.dumps([rules, tags], sort_keys=True)
+        ).hexdigest()
+        written = self.written_profiles.get(profile.id)
+        if written is not None and written.content_hash == content_hash:
+            LOG.debug("Profile %s unchanged, not rewriting it", profile.id)
+            return
+
         LOG.debug("Writing profile %s", profile)
-        self.client.write(
+        # Forget the old version first, in case only one write succeeds.
+        self.written_profiles.pop(profile.id, None)
+        rules_result = self.client.write(
             key_for_profile_rules(profile.id),
-            json.dumps(profile_rules(profile))
+            json.dumps(rules)
         )
-        self.client.write(
+        tags_result = self.client.write(
             key_for_profile_tags(profile.id),
-            json.dumps(profile_tags(profile))
+            json.dumps(tags)
+        )
+        self.written_profiles[profile.id] = WrittenProfile(
+            content_hash,
+            tags_result.modifiedIndex,
+            rules_result.modifiedIndex
+        )
+
+    def refresh_written_profiles(self, profiles):
+        """
+        Forgets the profiles that we wrote but that have since been changed
+        or deleted in etcd, so that we will rewrite them.
+
+        :param profiles: ``Profile`` objects for every profile in etcd, as
+            returned by get_profiles().
+        """
+        etcd_indices = dict(
+            (p.id, (p.tags_modified_index, p.rules_modified_index))
+            for p in profiles
         )
+        for profile_id, written in self.written_profiles.items():
+            written_indices = (written.tags_modified_index,
+                               written.rules_modified_index)
+            if etcd_indices.get(profile_id) != written_indices:
+                LOG.info("Profile %s changed in etcd since we wrote it",
+                         profile_id)
+                del self.written_profiles[profile_id]
+
+    def refresh_written_endpoints(self, endpoints):
+        """
+        Forgets the endpoints that we wrote but that have since been changed
+        or deleted in etcd, so that we will rewrite them.
+
+        :param endpoints: ``Endpoint`` objects for every endpoint in etcd, as
+            returned by get_endpoints().
+        """
+        etcd_indices = dict((ep.id, (ep.key, ep.modified_index))
+                            for ep in endpoints)
+        for port_id, written in self.written_endpoints.items():
+            if (etcd_indices.get(port_id) !=
+                    (written.key, written.modified_index)):
+                LOG.info("Endpoint %s changed in etcd since we wrote it",
+                         port_id)
+                self.written_endpoints.discard(port_id)
+
+    def forget_writes(self):
+        """
+        Forgets all the profiles and endpoints that we have written, so that
+        we will rewrite them.
+        """
+        self.written_profiles = {}
+        self.written_endpoints.clear()
 
     @_handling_etcd_exceptions
     def endpoint_created(self, port):
@@ -187,6 +429,7 @@ class CalicoTransportEtcd(object):
         # TODO: What do we do about profiles here?
         # Delete the etcd key for this endpoint.
         key = port_etcd_key(port)
+        self.written_endpoints.discard(port['id'])
         try:
             self.client.delete(key)
         except etcd.EtcdKeyNotFound:
@@ -198,11 +441,75 @@ class CalicoTransportEtcd(object):
     @_handling_etcd_exceptions
     def write_port_to_etcd(self, port):
         """
-        Writes a given port dictionary to etcd.
+        Writes a given port dictionary to etcd, unless we have already
+        written the same data for it.
         """
+        key = port_etcd_key(port)
+        data = port_etcd_data(port)
+        written = self.written_endpoints.get(port['id'])
+        if (written is not None and written.key == key and
+                written.data == data):
+            LOG.info("Port %s unchanged, not rewriting it", port['id'])
+            return
+
         LOG.info("Write port %s to etcd", port)
+        # Forget the old version first, in case the write fails.
+        self.written_endpoints.discard(port['id'])
+        result = self.client.write(key, json.dumps(data))
+        self.written_endpoints.put(
+            port['id'], WrittenEndpoint(key, data, result.modifiedIndex)
+        )
+
+    @_handling_etcd_exceptions
+    def get_endpoint_index(self, port):
+        """
+        Reads the modifiedIndex of the endpoint for a port from etcd, for use
+        with cas_write_port_to_etcd().
+
+        :returns: The modifiedIndex, or None if the endpoint doesn't exist.
+        """
+        try:
+            return self.client.read(port_etcd_key(port)).modifiedIndex
+        except etcd.EtcdKeyNotFound:
+            return None
+
+    @_handling_etcd_exceptions
+    def cas_write_port_to_etcd(self, port, prev_index):
+        """
+        Writes a given port dictionary to etcd, as write_port_to_etcd(), but
+        only if its endpoint hasn't been written since prev_index was read.
+
+        :param prev_index: The modifiedIndex returned by get_endpoint_index()
+            for the port, or None if the endpoint should not exist.
+        :returns: True if the endpoint is now up to date, or False if it has
+            been written by someone else.
+        """
+        key = port_etcd_key(port)
         data = port_etcd_data(port)
-        self.client.write(port_etcd_key(port), json.dumps(data))
+        written = self.written_endpoints.get(port['id'])
+        if (written is not None and written.key == key and
+                written.data == data and
+                written.modified_index == prev_index):
+            LOG.info("Port %s unchanged, not rewriting it", port['id'])
+            return True
+
+        LOG.info("Write port %s to etcd, previous index %s", port, prev_index)
+        self.written_endpoints.discard(port['id'])
+        if prev_index is None:
+            kwargs = {'prevExist': False}
+        else:
+            kwargs = {'prevIndex': prev_index}
+        try:
+            result = self.client.write(key, json.dumps(data), **kwargs)
+        except (ValueError, etcd.EtcdKeyNotFound, etcd.EtcdAlreadyExist):
+            # Someone else got there first.
+            LOG.info("Endpoint for port %s changed under our feet",
+                     port['id'])
+            return False
+        self.written_endpoints.put(
+            port['id'], WrittenEndpoint(key, data, result.modifiedIndex)
+        )
+        return True
 
     @_handling_etcd_exceptions
     def provide_felix_config(self):
@@ -242,16 +549,7 @@ class CalicoTransportEtcd(object):
         """
         LOG.info("Scanning etcd for all endpoints")
 
-        try:
-            result = self.client.read(HOST_DIR, recursive=True, timeout=5)
-        except etcd.EtcdKeyNotFound:
-            # No key yet, which is totally fine: just exit.
-            LOG.info("No endpoint key present.")
-            return
-
-        nodes = result.children
-
-        for node in nodes:
+        for node in self._scan_subtrees(HOST_DIR, '/workload'):
             match = OPENSTACK_ENDPOINT_RE.match(node.key)
             if match is None:
                 continue
@@ -260,7 +558,49 @@ class CalicoTransportEtcd(object):
             host = match.group('hostname')
 
             LOG.debug("Found endpoint %s", endpoint_id)
-            yield Endpoint(endpoint_id, node.key, node.modifiedIndex, host)
+            yield Endpoint(endpoint_id, node.key, node.modifiedIndex, host,
+                           _decode_json(node.value))
+
+    def _scan_subtrees(self, dir_key, sub_key=''):
+        """
+        Generator: lists the directories in dir_key, such as the hosts, and
+        then reads the subtree of each of them recursively, yielding the
+        nodes of each subtree in turn.
+
+        Reading each subtree separately, rather than reading the whole of
+        dir_key in one request, keeps each response small enough to read
+        within the timeout however big the deployment.  The reads are made
+        SCAN_CONCURRENCY at a time, and only that many subtrees are held in
+        memory at once.
+
+        :param sub_key: Suffix to add to the key of each directory to give
+            the subtree to read, such as '/workload'.
+        """
+        try:
+            result = self.client.read(dir_key, timeout=SCAN_READ_TIMEOUT)
+        except etcd.EtcdKeyNotFound:
+            # No key yet, which is totally fine: just exit.
+            LOG.info("No %s key present", dir_key)
+            return
+
+        subtree_keys = [node.key + sub_key for node in result.children
+                        if node.dir and node.key != dir_key]
+        LOG.info("Reading %s subtrees of %s", len(subtree_keys), dir_key)
+
+        def read_subtree(key):
+            try:
+                result = self.client.read(key,
+                                          recursive=True,
+                                          timeout=SCAN_READ_TIMEOUT)
+            except etcd.EtcdKeyNotFound:
+                # Deleted since we listed it, or it has no subtree.
+                return []
+            return list(result.children)
+
+        pool = eventlet.GreenPool(SCAN_CONCURRENCY)
+        for nodes in pool.imap(read_subtree, subtree_keys):
+            for node in nodes:
+                yield node
 
     @_handling_etcd_exceptions
     def atomic_delete_endpoint(self, endpoint):
@@ -276,6 +616,7 @@ class CalicoTransportEtcd(object):
             endpoint.id,
             endpoint.modified_index
         )
+        self.written_endpoints.discard(endpoint.id)
         self.client.delete(
             endpoint.key, prevIndex=endpoint.modified_index, timeout=5
         )
@@ -290,47 +631,41 @@ class CalicoTransportEtcd(object):
         """
         LOG.info("Scanning etcd for all profiles")
 
-        try:
-            result = self.client.read(PROFILE_DIR, recursive=True, timeout=5)
-        except etcd.EtcdKeyNotFound:
-            # No key yet, which is totally fine: just exit.
-            LOG.info("No profiles key present")
-            return
-
-        nodes = result.children
-
-        tag_indices = {}
-        rules_indices = {}
+        # Maps from profile ID to (modifiedIndex, value).
+        tag_nodes = {}
+        rules_nodes = {}
 
-        for node in nodes:
+        for node in self._scan_subtrees(PROFILE_DIR):
             # All groups have both tags and rules, and we need the
             # modifiedIndex for both.
             tags_match = TAGS_KEY_RE.match(node.key)
             rules_match = RULES_KEY_RE.match(node.key)
             if tags_match:
                 profile_id = tags_match.group('profile_id')
-                tag_indices[profile_id] = node.modifiedIndex
+                tag_nodes[profile_id] = (node.modifiedIndex, node.value)
             elif rules_match:
                 profile_id = rules_match.group('profile_id')
-                rules_indices[profile_id] = node.modifiedIndex
+                rules_nodes[profile_id] = (node.modifiedIndex, node.value)
             else:
                 continue
 
             # Check whether we have a complete set. If we do, remove them and
             # yield.
-            if profile_id in tag_indices and profile_id in rules_indices:
-                tag_modified = tag_indices.pop(profile_id)
-                rules_modified = rules_indices.pop(profile_id)
+            if profile_id in tag_nodes and profile_id in rules_nodes:
+                tag_modified, tags = tag_nodes.pop(profile_id)
+                rules_modified, rules = rules_nodes.pop(profile_id)
 
                 LOG.debug("Found profile id %s", profile_id)
-                yield Profile(profile_id, tag_modified, rules_modified)
+                yield Profile(profile_id, tag_modified, rules_modified,
+                              _decode_json(tags), _decode_json(rules))
 
         # Quickly confirm that the tag and rule indices are empty (they should
         # be).
-        if tag_indices or rules_indices:
+        if tag_nodes or rules_nodes:
             LOG.warning(
                 "Imbalanced profile tags and rules! "
-                "Extra tags %s, extra rules %s" % tag_indices, rules_indices
+                "Extra tags %s, extra rules %s",
+                tag_nodes.keys(), rules_nodes.keys()
             )
 
     @_handling_etcd_exceptions
@@ -349,6 +684,7 @@ class CalicoTransportEtcd(object):
             profile.tags_modified_index,
             profile.rules_modified_index
         )
+        self.written_profiles.pop(profile.id, None)
         self.client.delete(
             key_for_profile_tags(profile.id),
             prevIndex=profile.tags_modified_index,
@@ -462,6 +798,16 @@ def _neutron_rule_to_etcd_rule(rule):
     return etcd_rule
 
 
+def _decode_json(value):
+    """
+    Decodes a JSON value read from etcd, returning None if it is invalid.
+    """
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return None
+
+
 def port_etcd_key(port):
     """
     Determine what the etcd key is for a port.
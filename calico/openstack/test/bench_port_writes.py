@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+openstack.test.bench_port_writes
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Benchmark for the throughput of port creations through the mechanism
+driver, with and without the cas_port_writes option.
+
+Several green threads, standing in for Neutron API workers, each call
+create_port_postcommit() for their share of the ports.  The Neutron DB and
+etcd are simulated: each DB query and each etcd request sleeps for a
+configurable latency.  All the ports share a security group, so the
+transactions that read them contend for the same rows; we model that as a
+single lock that each transaction holds until it finishes.  Run with, for
+example::
+
+    python -m calico.openstack.test.bench_port_writes --ports 500 \\
+        --workers 20 --db-latency 0.001 --etcd-latency 0.005
+
+The benchmark reports the time taken and the ports written per second in
+each mode.
+"""
+import json
+import logging
+import optparse
+import os
+import sys
+import time
+
+# Import the real etcd exceptions before the test lib replaces the etcd
+# module with a mock.
+import etcd as real_etcd
+import eventlet
+from eventlet.semaphore import Semaphore
+import mock
+
+from calico.openstack.test import lib
+from calico.openstack import mech_calico, t_etcd
+
+_log = logging.getLogger(__name__)
+
+SGID = "SGID-bench"
+
+for _name in ("EtcdException", "EtcdKeyNotFound", "EtcdAlreadyExist",
+              "EtcdClusterIdChanged"):
+    setattr(lib.m_etcd, _name, getattr(real_etcd, _name))
+
+
+class SimulatedSession(object):
+    """
+    DB session whose outermost transaction holds the shared row lock.
+    """
+    def __init__(self, lock):
+        self._lock = lock
+        self._depth = 0
+
+    def begin(self, subtransactions=False):
+        return _Transaction(self)
+
+
+class _Transaction(object):
+    def __init__(self, session):
+        self._session = session
+
+    def __enter__(self):
+        if self._session._depth == 0:
+            self._session._lock.acquire()
+        self._session._depth += 1
+
+    def __exit__(self, *args):
+        self._session._depth -= 1
+        if self._session._depth == 0:
+            self._session._lock.release()
+        return False
+
+
+class SimulatedDB(object):
+    """
+    Enough of the Neutron DB for create_port_postcommit().
+    """
+    def __init__(self, ports, latency):
+        self.ports = dict((port['id'], port) for port in ports)
+        self.latency = latency
+
+    def _query(self):
+        eventlet.sleep(self.latency)
+
+    def get_port(self, context, port_id):
+        self._query()
+        return json.loads(json.dumps(self.ports[port_id]))
+
+    def get_subnets(self, context, filters=None, fields=None):
+        self._query()
+        return [{'id': id, 'gateway_ip': '10.65.0.1'}
+                for id in filters['id']]
+
+    def _get_port_security_group_bindings(self, context, filters=None):
+        self._query()
+        return [{'port_id': id, 'security_group_id': SGID}
+                for id in filters['port_id']]
+
+    def get_security_group_rules(self, context, filters=None):
+        self._query()
+        return [{'security_group_id': SGID,
+                 'remote_group_id': SGID,
+                 'remote_ip_prefix': None,
+                 'protocol': -1,
+                 'direction': 'ingress',
+                 'ethertype': 'IPv4',
+                 'port_range_min': -1}]
+
+    def update_port_status(self, context, port_id, status):
+        self._query()
+
+
+class SimulatedEtcdClient(object):
+    """
+    In-memory etcd client supporting the compare-and-swap writes that the
+    transport uses.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.data = {}
+        self.index = 0
+
+    def read(self, key, **kwargs):
+        eventlet.sleep(self.latency)
+        if key not in self.data:
+            raise real_etcd.EtcdKeyNotFound()
+        value, index = self.data[key]
+        return mock.Mock(key=key, value=value, modifiedIndex=index)
+
+    def write(self, key, value, prevIndex=None, prevExist=None, **kwargs):
+        eventlet.sleep(self.latency)
+        if prevExist is False and key in self.data:
+            raise real_etcd.EtcdAlreadyExist()
+        if prevIndex is not None:
+            if key not in self.data:
+                raise real_etcd.EtcdKeyNotFound()
+            if self.data[key][1] != prevIndex:
+                raise real_etcd.EtcdCompareFailed()
+        self.index += 1
+        self.data[key] = (value, self.index)
+        return mock.Mock(key=key, modifiedIndex=self.index)
+
+
+def make_ports(num_ports):
+    return [{'binding:vif_type': 'tap',
+             'binding:host_id': 'host-%s' % (i % 10),
+             'id': 'PORT-%08d' % i,
+             'device_id': 'instance-%s' % i,
+             'device_owner': 'compute:nova',
+             'fixed_ips': [{'subnet_id': '10.65.0/24',
+                            'ip_address': '10.65.%s.%s' % (i // 250,
+                                                           i % 250)}],
+             'mac_address': '00:11:22:33:44:55',
+             'admin_state_up': True,
+             'status': 'ACTIVE'}
+            for i in xrange(num_ports)]
+
+
+def measure(cas_port_writes, options):
+    """
+    Creates the ports through a fresh driver.
+
+    :returns: dict of results.
+    """
+    conf = lib.m_oslo.config.cfg.CONF.calico
+    conf.cas_port_writes = cas_port_writes
+    conf.etcd_write_concurrency = 10
+    conf.sg_update_delay = 0.5
+    conf.stats_report_interval = 0
+
+    ports = make_ports(options.ports)
+    client = SimulatedEtcdClient(options.etcd_latency)
+    lib.m_etcd.Client.return_value = client
+    with mock.patch.object(t_etcd, "Elector"):
+        driver = mech_calico.CalicoMechanismDriver()
+        driver._my_pid = os.getpid()
+        driver.db = SimulatedDB(ports, options.db_latency)
+        driver.transport = t_etcd.CalicoTransportEtcd(driver)
+
+    lock = Semaphore()
+
+    def worker(worker_ports):
+        for port in worker_ports:
+            context = mock.Mock()
+            context._port = port
+            context._plugin_context.session = SimulatedSession(lock)
+            driver.create_port_postcommit(context)
+
+    start_time = time.time()
+    pool = eventlet.GreenPool(options.workers)
+    for index in xrange(options.workers):
+        pool.spawn(worker, ports[index::options.workers])
+    pool.waitall()
+    elapsed = time.time() - start_time
+
+    endpoints = [key for key in client.data if "/endpoint/" in key]
+    assert len(endpoints) == options.ports, "Not all ports were written"
+    return {
+        "time": elapsed,
+        "ports_per_sec": options.ports / elapsed,
+    }
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--ports", type="int", default=500,
+                      help="number of ports to create (default: %default)")
+    parser.add_option("--workers", type="int", default=20,
+                      help="number of concurrent API workers "
+                           "(default: %default)")
+    parser.add_option("--db-latency", type="float", default=0.001,
+                      help="seconds per DB query (default: %default)")
+    parser.add_option("--etcd-latency", type="float", default=0.005,
+                      help="seconds per etcd request (default: %default)")
+    options, _ = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    mech_calico.LOG = logging.getLogger(mech_calico.__name__)
+    t_etcd.LOG = logging.getLogger(t_etcd.__name__)
+
+    results = {
+        "ports": options.ports,
+        "workers": options.workers,
+        "db_latency": options.db_latency,
+        "etcd_latency": options.etcd_latency,
+        "transaction": measure(False, options),
+        "cas": measure(True, options),
+    }
+    results["speedup"] = (results["cas"]["ports_per_sec"] /
+                          results["transaction"]["ports_per_sec"])
+    print json.dumps(results, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -110,10 +110,25 @@ t_etcd.Elector = GrandDukeOfSalzburg
 
 REAL_EVENTLET_SLEEP_TIME = 0.01
 
+SG_UPDATE_DELAY = 0.5
+
 # Value used to indicate 'timeout' in poll and sleep processing.
 TIMEOUT_VALUE = object()
 
 
+def page(objects, sorts, limit, marker):
+    """Returns a page of objects, as for Neutron's sorting and paging
+    parameters; we only support sorting by ascending ID.
+    """
+    if sorts is None:
+        return objects
+    assert sorts == [('id', True)]
+    objects = sorted(objects, key=lambda o: o['id'])
+    if marker is not None:
+        objects = [o for o in objects if o['id'] > marker]
+    return objects[:limit]
+
+
 class Lib(object):
 
     # Ports to return when the driver asks the OpenStack database for all
@@ -130,6 +145,22 @@ class Lib(object):
         # Hook logging.
         self.setUp_logging()
 
+        # Configure the delay before security group updates are sent.
+        m_oslo.config.cfg.CONF.calico.sg_update_delay = SG_UPDATE_DELAY
+
+        # Configure the number of concurrent etcd writes.
+        m_oslo.config.cfg.CONF.calico.etcd_write_concurrency = 10
+
+        # By default, hold DB transactions across etcd writes.
+        m_oslo.config.cfg.CONF.calico.cas_port_writes = False
+
+        # Configure the leader election timers.
+        m_oslo.config.cfg.CONF.calico.election_interval = 30
+        m_oslo.config.cfg.CONF.calico.election_ttl = 60
+
+        # Configure the interval between stats reports.
+        m_oslo.config.cfg.CONF.calico.stats_report_interval = 60
+
         # If an arg mismatch occurs, we want to see the complete diff of it.
         self.maxDiff = None
 
@@ -144,12 +175,14 @@ class Lib(object):
         self.db.get_ports.side_effect = self.get_ports
         self.db.get_port.side_effect = self.get_port
 
-        # Arrange DB's get_subnet call.
+        # Arrange DB's get_subnet and get_subnets calls.
         self.db.get_subnet.side_effect = self.get_subnet
+        self.db.get_subnets.side_effect = self.get_subnets
 
         # Arrange what the DB's get_security_groups query will return (the
         # default SG).
-        self.db.get_security_groups.return_value = [
+        self.db.get_security_groups.side_effect = self.get_security_groups
+        self.security_groups = [
             {'id': 'SGID-default',
              'security_group_rules': [
                  {'remote_group_id': 'SGID-default',
@@ -370,21 +403,31 @@ class Lib(object):
     def get_port(self, context, port_id):
         return self.get_ports(context, filters={'id': [port_id]})[0]
 
-    def get_ports(self, context, filters=None):
+    def get_ports(self, context, filters=None, sorts=None, limit=None,
+                  marker=None):
         if filters is None:
-            return self.osdb_ports
+            return page(self.osdb_ports, sorts, limit, marker)
 
         assert filters.keys() == ['id']
         allowed_ids = set(filters['id'])
 
         return [p for p in self.osdb_ports if p['id'] in allowed_ids]
 
+    def get_security_groups(self, context, sorts=None, limit=None,
+                            marker=None):
+        return page(self.security_groups, sorts, limit, marker)
+
     def get_subnet(self, context, id):
         if ':' in id:
             return {'gateway_ip': '2001:db8:a41:2::1'}
         else:
             return {'gateway_ip': '10.65.0.1'}
 
+    def get_subnets(self, context, filters=None, fields=None):
+        assert filters.keys() == ['id']
+        return [dict(self.get_subnet(context, id), id=id)
+                for id in filters['id']]
+
     def notify_security_group_update(self, id, rules, port, type):
         """Notify a new or changed security group definition.
         """
@@ -403,10 +446,13 @@ class Lib(object):
             self.db.get_port.return_value = port
 
         if type == 'rule':
-            # Call security_groups_rule_updated with the new or changed ID.
+            # Call security_groups_rule_updated with the new or changed ID,
+            # and allow time for the driver to send the update.
             self.db.notifier.security_groups_rule_updated(
                 mock.MagicMock(), [id]
             )
+            self.give_way()
+            self.simulated_time_advance(SG_UPDATE_DELAY)
         else:
             # Call security_groups_member_updated with the new or changed ID.
             self.db.notifier.security_groups_member_updated(
@@ -22,8 +22,12 @@ import copy
 import eventlet
 import json
 import mock
+import sys
 import unittest
+from eventlet.event import Event
+
 from calico import common
+from calico import stats
 
 import calico.openstack.test.lib as lib
 import calico.openstack.mech_calico as mech_calico
@@ -37,8 +41,13 @@ class EtcdException(Exception):
 class EtcdKeyNotFound(EtcdException):
     pass
 
+
+class EtcdAlreadyExist(EtcdException):
+    pass
+
 lib.m_etcd.EtcdException = EtcdException
 lib.m_etcd.EtcdKeyNotFound = EtcdKeyNotFound
+lib.m_etcd.EtcdAlreadyExist = EtcdAlreadyExist
 
 
 class TestPluginEtcd(lib.Lib, unittest.TestCase):
@@ -52,17 +61,32 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
                 print "etcd reset"
                 self.assert_etcd_writes_deletes = False
 
-    def check_etcd_write(self, key, value):
+    def check_etcd_write(self, key, value, prevIndex=None, prevExist=None):
         """Print each etcd write as it occurs, and save into the accumulated etcd
         database.
         """
         self.maybe_reset_etcd()
         print "etcd write: %s\n%s" % (key, value)
+        if prevExist is False and key in self.etcd_data:
+            raise EtcdAlreadyExist()
+        if prevIndex is not None:
+            if key not in self.etcd_data:
+                raise EtcdKeyNotFound()
+            if self.etcd_modified_indices[key] != prevIndex:
+                raise ValueError("Compare failed")
+        if self.in_transaction:
+            self.writes_in_transaction.add(key)
         self.etcd_data[key] = value
+        self.etcd_index += 1
+        self.etcd_modified_indices[key] = self.etcd_index
         try:
             self.recent_writes[key] = json.loads(value)
         except ValueError:
             self.recent_writes[key] = value
+        write_result = mock.Mock()
+        write_result.key = key
+        write_result.modifiedIndex = self.etcd_index
+        return write_result
 
     def check_etcd_delete(self, key, **kwargs):
         """Print each etcd delete as it occurs."""
@@ -102,12 +126,29 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
 
         # Set the object's value - i.e. the value, if any, of exactly the
         # specified key.
+        keylen = len(key) + 1
         if key in self.etcd_data:
             read_result.value = self.etcd_data[key]
+            read_result.modifiedIndex = self.etcd_modified_indices[key]
         else:
             read_result.value = None
             if not recursive:
-                raise lib.m_etcd.EtcdKeyNotFound()
+                # If this is a directory, list its immediate children.
+                child_keys = set(k[:keylen] + k[keylen:].split('/')[0]
+                                 for k in self.etcd_data.keys()
+                                 if k[:keylen] == key + '/')
+                if not child_keys:
+                    raise lib.m_etcd.EtcdKeyNotFound()
+                read_result.children = []
+                for k in sorted(child_keys):
+                    child = mock.Mock()
+                    child.key = k
+                    child.dir = k not in self.etcd_data
+                    read_result.children.append(child)
+                print "etcd read: %s\nchildren: %s" % (
+                    key, [child.key for child in read_result.children]
+                )
+                return read_result
 
         # Print and return the result object.
         print "etcd read: %s\nvalue: %s" % (key, read_result.value)
@@ -115,12 +156,13 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
         if recursive:
             # Also see if this key has any children, and read those.
             read_result.children = []
-            keylen = len(key) + 1
             for k in self.etcd_data.keys():
                 if k[:keylen] == key + '/':
                     child = mock.Mock()
                     child.key = k
                     child.value = self.etcd_data[k]
+                    child.dir = False
+                    child.modifiedIndex = self.etcd_modified_indices[k]
                     read_result.children.append(child)
             print "children: %s" % [child.key
                                     for child in read_result.children]
@@ -145,6 +187,12 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
 
         # Start with an empty etcd database.
         self.etcd_data = {}
+        self.etcd_modified_indices = {}
+        self.etcd_index = 0
+
+        # Track which etcd writes are made while holding a DB transaction.
+        self.in_transaction = False
+        self.writes_in_transaction = set()
 
         # Start with an empty set of recent writes and deletes.
         self.recent_writes = {}
@@ -266,23 +314,9 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
                  "ipv4_gateway": "10.65.0.1",
                  "ipv4_nets": ["10.65.0.2/32"],
                  "state": "active",
-                 "ipv6_nets": []},
-            '/calico/v1/policy/profile/SGID-default/rules':
-                {"outbound_rules": [{"dst_ports": ["1:65535"],
-                                     "dst_net": "0.0.0.0/0",
-                                     "ip_version": 4},
-                                    {"dst_ports": ["1:65535"],
-                                     "dst_net": "::/0",
-                                     "ip_version": 6}],
-                 "inbound_rules": [{"dst_ports": ["1:65535"],
-                                    "src_tag": "SGID-default",
-                                    "ip_version": 4},
-                                   {"dst_ports": ["1:65535"],
-                                    "src_tag": "SGID-default",
-                                    "ip_version": 6}]},
-            '/calico/v1/policy/profile/SGID-default/tags':
-                ["SGID-default"]
+                 "ipv6_nets": []}
         }
+        # The profile is unchanged, so it isn't rewritten.
         self.assertEtcdWrites(expected_writes)
         self.assertEtcdDeletes(set())
         self.check_update_port_status_called(context)
@@ -339,23 +373,9 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
                  "ipv6_gateway": "2001:db8:a41:2::1",
                  "ipv6_nets": ["2001:db8:a41:2::12/128"],
                  "state": "active",
-                 "ipv4_nets": []},
-            '/calico/v1/policy/profile/SGID-default/rules':
-                {"outbound_rules": [{"dst_ports": ["1:65535"],
-                                     "dst_net": "0.0.0.0/0",
-                                     "ip_version": 4},
-                                    {"dst_ports": ["1:65535"],
-                                     "dst_net": "::/0",
-                                     "ip_version": 6}],
-                 "inbound_rules": [{"dst_ports": ["1:65535"],
-                                    "src_tag": "SGID-default",
-                                    "ip_version": 4},
-                                   {"dst_ports": ["1:65535"],
-                                    "src_tag": "SGID-default",
-                                    "ip_version": 6}]},
-            '/calico/v1/policy/profile/SGID-default/tags':
-                ["SGID-default"]
+                 "ipv4_nets": []}
         }
+        # The profile is unchanged, so it isn't rewritten.
         self.assertEtcdWrites(expected_writes)
         self.assertEtcdDeletes(set())
         self.check_update_port_status_called(context)
@@ -363,7 +383,7 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
 
         # Create a new security group.
         # Update what the DB's queries should now return.
-        self.db.get_security_groups.return_value = [
+        self.security_groups = [
             {'id': 'SGID-default',
              'security_group_rules': [
                  {'remote_group_id': 'SGID-default',
@@ -483,15 +503,9 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
                  "ipv6_gateway": "2001:db8:a41:2::1",
                  "ipv6_nets": ["2001:db8:a41:2::12/128"],
                  "state": "active",
-                 "ipv4_nets": []},
-            '/calico/v1/policy/profile/SG-1/rules':
-                {"outbound_rules": [],
-                 "inbound_rules": [{"dst_ports": ["5060:5061"],
-                                    "src_tag": "SGID-default",
-                                    "ip_version": 4}]},
-            '/calico/v1/policy/profile/SG-1/tags':
-                ["SG-1"]
+                 "ipv4_nets": []}
         }
+        # SG-1 was written when it was created.
         self.assertEtcdWrites(expected_writes)
         self.check_update_port_status_called(context)
 
@@ -503,7 +517,7 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
         self.assertEtcdDeletes(set([]))
 
         # Change SG-1 to allow only port 5060.
-        self.db.get_security_groups.return_value[-1] = {
+        self.security_groups[-1] = {
             'id': 'SG-1',
             'security_group_rules': [
                 {'remote_group_id': 'SGID-default',
@@ -562,6 +576,585 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
             '/calico/v1/host/felix-host-1/workload/openstack/instance-2/endpoint/FACEBEEF-1234-5678'
         ]))
 
+    def test_profile_changed_in_etcd(self):
+        """Profiles that change in etcd are rewritten after a resync.
+        """
+        self.osdb_ports = [lib.port1, lib.port2]
+        self.give_way()
+        self.simulated_time_advance(31)
+        self.recent_writes = {}
+
+        # Someone else overwrites the profile's rules.
+        rules_key = '/calico/v1/policy/profile/SGID-default/rules'
+        self.check_etcd_write(rules_key, '{}')
+        self.recent_writes = {}
+
+        # Until we resync, we think that etcd has the right profile.
+        context = mock.MagicMock()
+        context._port = lib.port1
+        self.driver.create_port_postcommit(context)
+        self.assertFalse(rules_key in self.recent_writes)
+        self.check_update_port_status_called(context)
+
+        # The resync notices that the profile has changed, so the next port
+        # event rewrites it.
+        self.simulated_time_advance(mech_calico.RESYNC_INTERVAL_SECS)
+        self.driver.create_port_postcommit(context)
+        self.assertEqual(self.recent_writes[rules_key]["inbound_rules"][0],
+                         {"dst_ports": ["1:65535"],
+                          "src_tag": "SGID-default",
+                          "ip_version": 4})
+        self.check_update_port_status_called(context)
+
+    def test_resync_repairs_stale_data(self):
+        """The resync rewrites endpoints and profiles with the wrong data.
+        """
+        self.osdb_ports = [lib.port1]
+        self.give_way()
+        self.simulated_time_advance(31)
+        self.recent_writes = {}
+
+        # Someone else overwrites the endpoint and the profile's rules.
+        ep_key = ('/calico/v1/host/felix-host-1/workload/openstack/'
+                  'instance-1/endpoint/DEADBEEF-1234-5678')
+        rules_key = '/calico/v1/policy/profile/SGID-default/rules'
+        endpoint = json.loads(self.etcd_data[ep_key])
+        rules = json.loads(self.etcd_data[rules_key])
+        self.check_etcd_write(ep_key, json.dumps(dict(endpoint, mac='00')))
+        self.check_etcd_write(rules_key, 'garbage')
+        self.recent_writes = {}
+
+        self.simulated_time_advance(mech_calico.RESYNC_INTERVAL_SECS)
+        self.assertEtcdWrites({
+            ep_key: endpoint,
+            rules_key: rules,
+            '/calico/v1/policy/profile/SGID-default/tags': ['SGID-default'],
+        })
+        self.assertEtcdDeletes(set())
+
+        # Nothing more to repair.
+        self.simulated_time_advance(mech_calico.RESYNC_INTERVAL_SECS)
+        self.assertEtcdWrites({})
+        self.assertEtcdDeletes(set())
+
+    def test_resync_chunks(self):
+        """The resync reads the DB a chunk at a time, pausing in between.
+        """
+        self.osdb_ports = [lib.port2, lib.port1]
+        self.db.get_ports.reset_mock()
+        with mock.patch.object(mech_calico, 'RESYNC_CHUNK_SIZE', 1):
+            self.give_way()
+            # The first resync has no idea how big it will be, so its pauses
+            # are zero length.
+            self.simulated_time_advance(31)
+            self.assertEqual(
+                [c[1]['marker'] for c in self.db.get_ports.call_args_list],
+                [None, 'DEADBEEF-1234-5678', 'FACEBEEF-1234-5678']
+            )
+            # Both ports have been written.
+            self.assertEqual(len([k for k in self.recent_writes
+                                  if '/endpoint/' in k]), 2)
+
+            # Having paused three times (twice between the chunks of ports
+            # and once for the security groups), the next resync spreads its
+            # pauses over half the interval.
+            self.assertEqual(self.driver._resync_pause_secs,
+                             mech_calico.RESYNC_INTERVAL_SECS *
+                             mech_calico.RESYNC_SPREAD_FRACTION / 3)
+
+    def test_resync_bulk_port_info(self):
+        """The resync reads subnets and bindings for many ports at once.
+        """
+        self.osdb_ports = [lib.port1, lib.port2, lib.port3]
+        self.db.get_subnet.reset_mock()
+        self.db.get_subnets.reset_mock()
+        self.db._get_port_security_group_bindings.reset_mock()
+        self.give_way()
+        self.simulated_time_advance(31)
+        self.assertEqual(len([k for k in self.recent_writes
+                              if '/endpoint/' in k]), 3)
+        self.assertFalse(self.db.get_subnet.called)
+        self.assertEqual(self.db.get_subnets.call_count, 1)
+        self.assertEqual(
+            sorted(self.db.get_subnets.call_args[1]['filters']['id']),
+            ['10.65.0/24', '2001:db8:a41:2::/64']
+        )
+        self.assertEqual(
+            self.db._get_port_security_group_bindings.call_count, 1
+        )
+
+        # The next resync reads the subnets again, rather than trusting what
+        # it read last time.
+        self.simulated_time_advance(mech_calico.RESYNC_INTERVAL_SECS)
+        self.assertEqual(self.db.get_subnets.call_count, 2)
+
+    def test_missing_subnet(self):
+        """A missing subnet fails a port write, but not the resync.
+        """
+        class SubnetNotFound(Exception):
+            pass
+        self.osdb_ports = [lib.port1]
+        self.db.get_subnets.side_effect = lambda *args, **kwargs: []
+        self.db.get_subnet.side_effect = SubnetNotFound()
+
+        self.give_way()
+        self.simulated_time_advance(31)
+        ep_key = ('/calico/v1/host/felix-host-1/workload/openstack/'
+                  'instance-1/endpoint/DEADBEEF-1234-5678')
+        self.assertNotIn('ipv4_gateway', self.recent_writes[ep_key])
+        self.assertEqual(self.recent_writes[ep_key]['ipv4_nets'],
+                         ['10.65.0.2/32'])
+
+        port = copy.deepcopy(lib.port1)
+        self.assertRaises(SubnetNotFound,
+                          self.driver.add_port_gateways, port, mock.Mock())
+
+    def test_writer_pool(self):
+        """Writes for one key are made in order, others concurrently.
+        """
+        stats.reset()
+        pool = t_etcd.EtcdWriterPool(3)
+        calls = []
+        gate = Event()
+
+        def write(name, wait_for=None):
+            calls.append(('start', name))
+            if wait_for is not None:
+                wait_for.wait()
+            calls.append(('end', name))
+
+        batch = pool.batch()
+        batch.submit('a', write, 'a1', gate)
+        batch.submit('a', write, 'a2')
+        batch.submit('b', write, 'b1')
+        self.give_way()
+        # a2 is held up behind a1, but b1 isn't.
+        self.assertEqual(calls, [('start', 'a1'),
+                                 ('start', 'b1'),
+                                 ('end', 'b1')])
+        self.assertEqual(pool.in_flight, 2)
+
+        gate.send()
+        batch.wait()
+        self.assertEqual(calls[3:], [('end', 'a1'),
+                                     ('start', 'a2'),
+                                     ('end', 'a2')])
+        self.assertEqual(pool.in_flight, 0)
+        self.assertEqual(stats.histogram("etcd_writer.latency").count, 3)
+
+        # Failures are raised by wait(), once all the writes have been made.
+        batch.submit('a', mock.Mock(side_effect=ValueError()))
+        batch.submit('a', write, 'a3')
+        self.assertRaises(ValueError, batch.wait)
+        self.assertEqual(calls[-1], ('end', 'a3'))
+        batch.wait()
+
+    def test_writer_pool_batches(self):
+        """Each batch waits only for, and sees only, its own writes.
+        """
+        pool = t_etcd.EtcdWriterPool(3)
+        calls = []
+        gate = Event()
+
+        def write(name, wait_for=None):
+            if wait_for is not None:
+                wait_for.wait()
+            calls.append(name)
+
+        slow = pool.batch()
+        slow.submit('a', write, 'a1', gate)
+        failing = pool.batch()
+        failing.submit('b', mock.Mock(side_effect=ValueError()))
+        # Writes for the same key are still ordered across batches.
+        failing.submit('a', write, 'a2')
+        failing.submit('c', write, 'c1')
+        self.give_way()
+        self.assertEqual(calls, ['c1'])
+
+        # The failing batch waits for a2, which is behind a1, but then
+        # raises its own error.
+        def wait():
+            try:
+                failing.wait()
+            except ValueError as e:
+                return e
+        waiter = eventlet.spawn(wait)
+        self.give_way()
+        self.assertFalse(waiter.dead)
+        gate.send()
+        self.assertIsInstance(waiter.wait(), ValueError)
+        self.assertEqual(calls, ['c1', 'a1', 'a2'])
+
+        # The slow batch doesn't see the other batch's error.
+        slow.wait()
+
+    def test_resync_and_sg_update_concurrently(self):
+        """A failed security group update doesn't wait for, or fail, a
+        resync that is running at the same time.
+        """
+        self.osdb_ports = [lib.port1]
+        self.give_way()
+        self.simulated_time_advance(31)
+
+        # Make the endpoint stale, so that the resync rewrites it, and hold
+        # up that write.  Writes for SG-1 fail.
+        ep_key = ('/calico/v1/host/felix-host-1/workload/openstack/'
+                  'instance-1/endpoint/DEADBEEF-1234-5678')
+        endpoint = json.loads(self.etcd_data[ep_key])
+        self.check_etcd_write(ep_key, json.dumps(dict(endpoint, mac='00')))
+        gate = Event()
+
+        def write(key, value, **kwargs):
+            if key == ep_key:
+                gate.wait()
+            elif key.startswith('/calico/v1/policy/profile/SG-1/'):
+                raise EtcdException()
+            return self.check_etcd_write(key, value, **kwargs)
+        self.client.write.side_effect = write
+
+        resync = eventlet.spawn(self.driver.resync_endpoints,
+                                mock.MagicMock())
+        self.give_way()
+
+        # The security group update fails and is queued to be retried,
+        # without waiting for the resync's write.
+        self.driver.queue_sg_updates(set(['SG-1']))
+        self.give_way()
+        self.simulated_time_advance(lib.SG_UPDATE_DELAY)
+        self.assertEqual(self.driver._pending_sgids, set(['SG-1']))
+        self.assertTrue(self.driver._sg_updates_scheduled)
+        self.assertFalse(resync.dead)
+
+        # The resync finishes its write, and doesn't see the failure.
+        gate.send()
+        resync.wait()
+        self.assertEqual(json.loads(self.etcd_data[ep_key]), endpoint)
+
+    def test_stats_reported(self):
+        """The etcd writer stats are logged periodically.
+        """
+        stats.reset()
+        with mock.patch.object(stats, 'log_report') as m_log_report:
+            self.give_way()
+            # Nothing to report before the first resync has written anything.
+            self.simulated_time_advance(30)
+            self.assertFalse(m_log_report.called)
+            self.simulated_time_advance(60)
+            m_log_report.assert_called_once_with(mech_calico.LOG)
+        self.assertTrue(stats.histogram("etcd_writer.latency").count)
+
+    def port_context(self, port):
+        """Returns a port context whose DB transactions we track."""
+        context = mock.MagicMock()
+        context._port = port
+        context._plugin_context = self.tracked_db_context()
+        return context
+
+    def tracked_db_context(self):
+        """Returns a DB context whose transactions we track."""
+        context = mock.MagicMock()
+        transaction = context.session.begin.return_value
+
+        def enter():
+            self.in_transaction = True
+
+        def exit(*args):
+            self.in_transaction = False
+            return False
+
+        transaction.__enter__.side_effect = enter
+        transaction.__exit__.side_effect = exit
+        return context
+
+    def other_worker_write(self, key):
+        """Simulates another Neutron worker writing to etcd."""
+        in_transaction, self.in_transaction = self.in_transaction, False
+        self.check_etcd_write(key, '{}')
+        self.in_transaction = in_transaction
+
+    def test_cas_port_writes(self):
+        """With cas_port_writes, etcd writes happen outside the transaction.
+        """
+        lib.m_oslo.config.cfg.CONF.calico.cas_port_writes = True
+        self.osdb_ports = [copy.deepcopy(lib.port1)]
+        ep_key = ('/calico/v1/host/felix-host-1/workload/openstack/'
+                  'instance-1/endpoint/DEADBEEF-1234-5678')
+
+        # Create the port; the endpoint didn't exist.
+        context = self.port_context(lib.port1)
+        self.driver.create_port_postcommit(context)
+        self.assertEqual(self.recent_writes[ep_key]['mac'],
+                         '00:11:22:33:44:55')
+        self.assertEqual(self.writes_in_transaction, set())
+        self.check_update_port_status_called(context)
+
+        # Another worker writes the endpoint while we're reading the port,
+        # so we go round again.
+        self.osdb_ports[0]['mac_address'] = '00:11:22:33:44:66'
+        real_get_port = self.get_port
+
+        def get_port(context, port_id):
+            if self.db.get_port.call_count == 1:
+                self.other_worker_write(ep_key)
+            return real_get_port(context, port_id)
+        self.db.get_port.side_effect = get_port
+        self.db.get_port.reset_mock()
+        self.recent_writes = {}
+        context = self.port_context(self.osdb_ports[0])
+        context.original = lib.port1
+        self.driver.update_port_postcommit(context)
+        self.assertEqual(self.db.get_port.call_count, 2)
+        self.assertEqual(json.loads(self.etcd_data[ep_key])['mac'],
+                         '00:11:22:33:44:66')
+        self.assertEqual(self.writes_in_transaction, set())
+        self.check_update_port_status_called(context)
+
+    def test_cas_port_writes_fall_back(self):
+        """If compare-and-swap keeps failing, we hold the transaction.
+        """
+        lib.m_oslo.config.cfg.CONF.calico.cas_port_writes = True
+        self.osdb_ports = [lib.port1]
+        ep_key = ('/calico/v1/host/felix-host-1/workload/openstack/'
+                  'instance-1/endpoint/DEADBEEF-1234-5678')
+        real_get_port = self.get_port
+
+        def get_port(context, port_id):
+            self.other_worker_write(ep_key)
+            return real_get_port(context, port_id)
+        self.db.get_port.side_effect = get_port
+        self.db.get_port.reset_mock()
+
+        context = self.port_context(lib.port1)
+        self.driver.create_port_postcommit(context)
+        self.assertEqual(self.db.get_port.call_count,
+                         mech_calico.MAX_PORT_CAS_ATTEMPTS + 1)
+        self.assertEqual(json.loads(self.etcd_data[ep_key])['mac'],
+                         '00:11:22:33:44:55')
+        self.assertTrue(ep_key in self.writes_in_transaction)
+        self.check_update_port_status_called(context)
+
+    def test_port_unbound_before_write(self):
+        """A port that is unbound before we re-read it isn't written.
+        """
+        for cas_port_writes in (False, True):
+            lib.m_oslo.config.cfg.CONF.calico.cas_port_writes = cas_port_writes
+            self.osdb_ports = [copy.deepcopy(lib.port1)]
+            real_get_port = self.get_port
+
+            def get_port(context, port_id):
+                port = copy.deepcopy(real_get_port(context, port_id))
+                if self.db.get_port.call_count == 1:
+                    # Another worker unbinds the port after we've decided
+                    # to write it.
+                    self.osdb_ports[0]['binding:vif_type'] = 'unbound'
+                    self.osdb_ports[0]['binding:host_id'] = ''
+                return port
+            self.db.get_port.side_effect = get_port
+            self.db.get_port.reset_mock()
+            self.recent_writes = {}
+
+            context = self.port_context(copy.deepcopy(lib.port1))
+            context.original = copy.deepcopy(lib.port1)
+            context._port['mac_address'] = '00:11:22:33:44:66'
+            self.driver.update_port_postcommit(context)
+            self.assertEqual(self.db.get_port.call_count, 2)
+            self.assertEtcdWrites({})
+            self.assertFalse(self.db.update_port_status.called)
+
+    def test_resync_writes_outside_transaction(self):
+        """The resync reads each chunk's data in a transaction, but makes
+        its etcd writes after leaving it.
+        """
+        self.osdb_ports = [lib.port1]
+        self.give_way()
+        self.simulated_time_advance(31)
+
+        # Make the endpoint and the profile stale, so that they're rewritten.
+        ep_key = ('/calico/v1/host/felix-host-1/workload/openstack/'
+                  'instance-1/endpoint/DEADBEEF-1234-5678')
+        rules_key = '/calico/v1/policy/profile/SGID-default/rules'
+        self.check_etcd_write(ep_key, '{}')
+        self.check_etcd_write(rules_key, '{}')
+        self.recent_writes = {}
+
+        reads = []
+
+        def track(name, fn):
+            def read(*args, **kwargs):
+                reads.append((name, self.in_transaction))
+                return fn(*args, **kwargs)
+            return read
+        rules = self.db.get_security_group_rules.return_value
+        with mock.patch.multiple(
+                self.db,
+                get_subnets=track('subnets', self.get_subnets),
+                _get_port_security_group_bindings=track(
+                    'bindings', self.get_port_security_group_bindings
+                ),
+                get_security_group_rules=track('rules',
+                                               lambda *a, **kw: rules)):
+            context = self.tracked_db_context()
+            self.driver.resync_endpoints(context)
+            self.driver.resync_profiles(context)
+
+        self.assertEqual(reads, [('subnets', True),
+                                 ('bindings', True),
+                                 ('rules', True)])
+        self.assertIn(ep_key, self.recent_writes)
+        self.assertIn(rules_key, self.recent_writes)
+        self.assertEqual(self.writes_in_transaction, set())
+
+    def test_scan_reads_subtrees(self):
+        """Endpoints and profiles are read a host or profile at a time.
+        """
+        self.osdb_ports = [lib.port1, lib.port2, lib.port3]
+        self.give_way()
+        self.simulated_time_advance(31)
+        self.client.read.reset_mock()
+
+        transport = self.driver.transport
+        endpoints = list(transport.get_endpoints())
+        self.assertEqual(sorted(ep.id for ep in endpoints),
+                         ['DEADBEEF-1234-5678', 'FACEBEEF-1234-5678',
+                          'HELLO-1234-5678'])
+        profiles = list(transport.get_profiles())
+        self.assertEqual([p.id for p in profiles], ['SGID-default'])
+
+        self.assertEqual(
+            sorted((c[0][0], c[1].get('recursive', False))
+                   for c in self.client.read.call_args_list),
+            [('/calico/v1/host', False),
+             ('/calico/v1/host/felix-host-1/workload', True),
+             ('/calico/v1/host/felix-host-2/workload', True),
+             ('/calico/v1/policy/profile', False),
+             ('/calico/v1/policy/profile/SGID-default', True)]
+        )
+
+    def test_unchanged_port_update(self):
+        """Port updates that don't change the endpoint data aren't written.
+        """
+        self.osdb_ports = [copy.deepcopy(lib.port1)]
+        self.give_way()
+        self.simulated_time_advance(31)
+        self.recent_writes = {}
+
+        context = mock.MagicMock()
+        context.original = copy.deepcopy(lib.port1)
+        context._port = copy.deepcopy(lib.port1)
+        context._port['name'] = 'renamed'
+        self.driver.update_port_postcommit(context)
+        self.assertEtcdWrites({})
+        self.check_update_port_status_called(context)
+
+        # A change that Felix cares about is written.
+        self.osdb_ports[0]['mac_address'] = '00:11:22:33:44:77'
+        self.driver.update_port_postcommit(context)
+        key = ('/calico/v1/host/felix-host-1/workload/openstack/instance-1/'
+               'endpoint/DEADBEEF-1234-5678')
+        self.assertEqual(self.recent_writes[key]['mac'], '00:11:22:33:44:77')
+        self.check_update_port_status_called(context)
+
+    def test_sg_updates_coalesced(self):
+        """A burst of security group changes is written in one go.
+        """
+        self.give_way()
+        self.simulated_time_advance(31)
+        self.recent_writes = {}
+        self.db.get_security_group_rules.reset_mock()
+
+        for sgid in ['SGID-default', 'SG-1', 'SGID-default']:
+            self.db.notifier.security_groups_rule_updated(
+                mock.MagicMock(), [sgid]
+            )
+        self.give_way()
+        self.assertFalse(self.db.get_security_group_rules.called)
+
+        self.simulated_time_advance(lib.SG_UPDATE_DELAY)
+        self.assertEqual(self.db.get_security_group_rules.call_count, 1)
+        filters = self.db.get_security_group_rules.call_args[1]['filters']
+        self.assertEqual(sorted(filters['security_group_id']),
+                         ['SG-1', 'SGID-default'])
+        # SGID-default is unchanged, so only SG-1 is written.
+        self.assertEtcdWrites({
+            '/calico/v1/policy/profile/SG-1/rules':
+                {"outbound_rules": [], "inbound_rules": []},
+            '/calico/v1/policy/profile/SG-1/tags': ["SG-1"]
+        })
+
+    def test_sg_update_retry_backoff(self):
+        """Failed security group updates are retried with back-off, then
+        left to the resync, counting the failures of each group separately.
+        """
+        self.give_way()
+        self.simulated_time_advance(31)
+        failing = set(['SG-1', 'SG-2'])
+        attempts = []
+
+        def write(key, value, **kwargs):
+            if key.startswith('/calico/v1/policy/profile/'):
+                sgid = key.split('/')[5]
+                if sgid in failing:
+                    attempts.append(sgid)
+                    raise EtcdException()
+            return self.check_etcd_write(key, value, **kwargs)
+        self.client.write.side_effect = write
+
+        # Record the delays before each write of the pending groups.
+        delays = []
+        simulated_spawn_after = eventlet.spawn_after
+
+        def spawn_after(secs, fn, *args):
+            delays.append(secs)
+            return simulated_spawn_after(secs, fn, *args)
+
+        def run_until(condition):
+            for _ in xrange(100):
+                if condition():
+                    return
+                self.give_way()
+                self.simulated_time_advance(0.5)
+            self.fail("Timed out waiting for security group updates")
+
+        failures = self.driver._sg_update_failures
+        with mock.patch.object(eventlet, 'spawn_after', spawn_after):
+            # The delay doubles after each failure, and we give up after
+            # MAX_SG_UPDATE_ATTEMPTS.
+            self.driver.queue_sg_updates(set(['SG-1']))
+            run_until(lambda: len(attempts) == 5 and not failures)
+            self.assertEqual(delays, [0.5, 1, 2, 4, 8])
+            self.assertEqual(self.driver._pending_sgids, set())
+            self.assertFalse(self.driver._sg_updates_scheduled)
+
+            # The delay is capped.
+            attempts[:] = []
+            delays[:] = []
+            with mock.patch.object(mech_calico,
+                                   'MAX_SG_UPDATE_RETRY_DELAY_SECS', 2):
+                self.driver.queue_sg_updates(set(['SG-1']))
+                run_until(lambda: len(attempts) == 5 and not failures)
+            self.assertEqual(delays, [0.5, 1, 2, 2, 2])
+
+            # A group queued while another is being retried gets its own
+            # attempts.
+            attempts[:] = []
+            self.driver.queue_sg_updates(set(['SG-1']))
+            run_until(lambda: len(attempts) == 3)
+            self.driver.queue_sg_updates(set(['SG-2']))
+            run_until(lambda: (attempts.count('SG-1') == 5 and
+                               'SG-1' not in failures))
+            self.assertEqual(failures, {'SG-2': 2})
+            self.assertEqual(self.driver._pending_sgids, set(['SG-2']))
+
+            # Once etcd recovers, SG-2 is written.
+            failing.clear()
+            self.recent_writes = {}
+            run_until(lambda: not failures)
+        self.assertEtcdWrites({
+            '/calico/v1/policy/profile/SG-2/rules':
+                {"outbound_rules": [], "inbound_rules": []},
+            '/calico/v1/policy/profile/SG-2/tags': ["SG-2"]
+        })
+
     def test_noop_entry_points(self):
         """Call the mechanism driver entry points that are currently
         implemented as no-ops (because Calico function does not need
@@ -593,6 +1186,28 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
             mech_calico.constants.AGENT_TYPE_DHCP
         ))
 
+    def test_profiles_from_neutron_rules(self):
+        rules = [
+            {'security_group_id': 'SG-1', 'direction': 'ingress', 'n': 1},
+            {'security_group_id': 'SG-2', 'direction': 'egress', 'n': 2},
+            {'security_group_id': 'SG-3', 'direction': 'ingress', 'n': 3},
+            {'security_group_id': 'SG-1', 'direction': 'egress', 'n': 4},
+            {'security_group_id': 'SG-1', 'direction': 'ingress', 'n': 5},
+        ]
+        profiles = mech_calico.profiles_from_neutron_rules(
+            ['SG-2', 'SG-1', 'SG-4'], rules
+        )
+        self.assertEqual(profiles, [
+            mech_calico.SecurityProfile('SG-2', [], [rules[1]]),
+            mech_calico.SecurityProfile('SG-1', [rules[0], rules[4]],
+                                        [rules[3]]),
+            mech_calico.SecurityProfile('SG-4', [], []),
+        ])
+        self.assertEqual(
+            mech_calico.profile_from_neutron_rules('SG-1', rules),
+            profiles[1]
+        )
+
     def test_neutron_rule_to_etcd_rule_icmp(self):
         # No type/code specified
         self.assertNeutronToEtcd(_neutron_rule_from_dict({
@@ -654,6 +1269,25 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
         self.simulated_time_advance(31)
         self.assertEtcdWrites({})
 
+    def test_import_without_gevent(self):
+        """The plugin doesn't need gevent, which controllers don't have.
+        """
+        modules = ['calico.stats', 'calico.lru', 'calico.openstack.t_etcd']
+        saved = {}
+        for name in modules:
+            saved[name] = sys.modules.pop(name)
+            package, _, attr = name.rpartition('.')
+            delattr(sys.modules[package], attr)
+        try:
+            with mock.patch.dict(sys.modules, {'gevent': None}):
+                __import__('calico.openstack.t_etcd')
+        finally:
+            # Put back the modules that the other tests use.
+            sys.modules.update(saved)
+            for name, module in saved.iteritems():
+                package, _, attr = name.rpartition('.')
+                setattr(sys.modules[package], attr, module)
+
     def assertNeutronToEtcd(self, neutron_rule, exp_etcd_rule):
         etcd_rule = t_etcd._neutron_rule_to_etcd_rule(neutron_rule)
         self.assertEqual(etcd_rule, exp_etcd_rule)
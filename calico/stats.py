@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Metaswitch Networks
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+calico.stats
+~~~~~~~~~~~~
+
+In-process counters and latency histograms.
+
+Stats are created on first use and live for the life of the process::
+
+    stats.increment("etcd_events")
+    stats.histogram("update_latency.endpoint").record(0.023)
+
+and are exported either as a dict, via snapshot(), or by logging a
+summary, via log_report(), which each process calls periodically from its
+own event loop.  Histograms use power-of-two buckets so recording is
+cheap and memory is fixed; the percentiles they report are upper bounds
+accurate to within a factor of two.
+
+This module is shared by Felix, which uses gevent, and the OpenStack
+plugin, which uses eventlet, so it must not import either.
+"""
+import logging
+import math
+
+_log = logging.getLogger(__name__)
+
+# Lower bound of the first histogram bucket, in the units being recorded
+# (normally seconds).  Bucket i holds values in [MIN * 2^(i-1), MIN * 2^i).
+HISTOGRAM_MIN = 0.0001
+NUM_BUCKETS = 32
+
+
+class Histogram(object):
+    """
+    Fixed-size histogram with exponentially-sized buckets.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.min = None
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value < HISTOGRAM_MIN:
+            index = 0
+        else:
+            index = int(math.log(value / HISTOGRAM_MIN, 2)) + 1
+        self.buckets[min(index, NUM_BUCKETS - 1)] += 1
+
+    def percentile(self, percent):
+        """
+        :returns: an upper bound on the given percentile of the recorded
+            values, or None if nothing has been recorded.
+        """
+        if not self.count:
+            return None
+        threshold = percent / 100.0 * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= threshold and bucket_count:
+                if index == NUM_BUCKETS - 1:
+                    # Overflow bucket has no upper bound.
+                    return self.max
+                return min(HISTOGRAM_MIN * 2 ** index, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        :returns dict: summary of the histogram.
+        """
+        summary = {"count": self.count}
+        if self.count:
+            summary.update({
+                "mean": self.total / self.count,
+                "min": self.min,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "max": self.max,
+            })
+        return summary
+
+
+_counters = {}
+_histograms = {}
+
+
+def increment(name, delta=1):
+    _counters[name] = _counters.get(name, 0) + delta
+
+
+def counter(name):
+    return _counters.get(name, 0)
+
+
+def histogram(name):
+    """
+    :returns Histogram: the named histogram, creating it if needed.
+    """
+    hist = _histograms.get(name)
+    if hist is None:
+        hist = Histogram(name)
+        _histograms[name] = hist
+    return hist
+
+
+def snapshot():
+    """
+    :returns dict: the current value of every counter and a summary of
+        every histogram, by name.
+    """
+    result = dict(_counters)
+    for name, hist in _histograms.iteritems():
+        result[name] = hist.snapshot()
+    return result
+
+
+def reset():
+    """
+    Discards all stats.  Mainly for UTs.
+    """
+    _counters.clear()
+    _histograms.clear()
+
+
+def log_report(log=_log):
+    """
+    Logs the current stats at INFO level, one line per stat.
+    """
+    for name in sorted(_counters):
+        log.info("Stat %s: %s", name, _counters[name])
+    for name in sorted(_histograms):
+        summary = _histograms[name].snapshot()
+        if summary["count"]:
+            log.info("Stat %s: count=%d p50=%.4f p90=%.4f p99=%.4f "
+                     "max=%.4f", name, summary["count"], summary["p50"],
+                     summary["p90"], summary["p99"], summary["max"])
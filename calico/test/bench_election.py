@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test.bench_election
+~~~~~~~~~~~~~~~~~~~
+
+Benchmark for leader failover with calico.election.Elector.
+
+Runs a master and a standby Elector against an in-memory stand-in for
+etcd, which supports the reads, watches, compare-and-swap writes, deletes
+and TTLs that the Elector uses, and measures how long it takes the standby
+to become master after the master:
+
+- clean: is stopped, and so deletes its key;
+- crash: stops talking to etcd, so its key has to expire.
+
+Run with, for example::
+
+    python -m calico.test.bench_election --interval 0.5 --ttl 2 --trials 5
+
+The benchmark reports the minimum, mean and maximum failover time for each
+case.
+"""
+import json
+import logging
+import optparse
+import sys
+import time
+from socket import timeout as SocketTimeout
+
+import etcd
+import eventlet
+from eventlet.event import Event
+
+from calico import election
+
+_log = logging.getLogger(__name__)
+
+ELECTION_KEY = "/calico/v1/bench_election"
+
+
+class _Result(object):
+    def __init__(self, key, value, action, index):
+        self.key = key
+        self.value = value
+        self.action = action
+        self.etcd_index = index
+
+
+class LocalEtcd(object):
+    """
+    In-memory stand-in for an etcd server with a single key.
+    """
+    def __init__(self):
+        self.value = None
+        self.index = 0
+        # Every change to the key, as _Results, in index order.
+        self.history = []
+        self._changed = Event()
+        self._expiry = None
+
+    def _change(self, key, value, action, ttl=None):
+        self.index += 1
+        self.value = value
+        self.history.append(_Result(key, value, action, self.index))
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        if ttl is not None:
+            self._expiry = eventlet.spawn_after(ttl, self._change, key, None,
+                                                "expire")
+        changed, self._changed = self._changed, Event()
+        changed.send()
+
+    def read(self, key, wait=False, waitIndex=None):
+        if not wait:
+            if self.value is None:
+                raise etcd.EtcdKeyNotFound()
+            return _Result(key, self.value, "get", self.index)
+        while True:
+            for result in self.history:
+                if result.etcd_index >= waitIndex:
+                    return result
+            self._changed.wait()
+
+    def write(self, key, value, ttl=None, prevExist=None, prevValue=None):
+        if prevExist is False and self.value is not None:
+            raise etcd.EtcdAlreadyExist()
+        if prevValue is not None:
+            if self.value is None:
+                raise etcd.EtcdKeyNotFound()
+            if self.value != prevValue:
+                raise etcd.EtcdCompareFailed()
+        action = "create" if self.value is None else "compareAndSwap"
+        self._change(key, value, action, ttl)
+
+    def delete(self, key, prevValue=None):
+        if self.value is None:
+            raise etcd.EtcdKeyNotFound()
+        if prevValue is not None and self.value != prevValue:
+            raise etcd.EtcdCompareFailed()
+        self._change(key, None, "compareAndDelete")
+
+
+class LocalClient(object):
+    """
+    etcd client for one server, talking to a LocalEtcd.  Setting crashed
+    makes all its requests fail.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.crashed = False
+
+    def _check(self):
+        if self.crashed:
+            raise SocketTimeout()
+
+    def read(self, key, wait=False, waitIndex=None, timeout=None):
+        self._check()
+        return self.server.read(key, wait=wait, waitIndex=waitIndex)
+
+    def write(self, key, value, ttl=None, prevExist=None, prevValue=None,
+              timeout=None):
+        self._check()
+        return self.server.write(key, value, ttl=ttl, prevExist=prevExist,
+                                 prevValue=prevValue)
+
+    def delete(self, key, prevValue=None, timeout=None):
+        self._check()
+        return self.server.delete(key, prevValue=prevValue)
+
+
+def wait_for_master(elector, poll_interval=0.001):
+    while not elector.master():
+        eventlet.sleep(poll_interval)
+
+
+def measure_failover(case, options):
+    """
+    :returns: the time, in seconds, for the standby to take over.
+    """
+    server = LocalEtcd()
+    master_client = LocalClient(server)
+    master = election.Elector(master_client, "master", ELECTION_KEY,
+                              interval=options.interval, ttl=options.ttl)
+    wait_for_master(master)
+    standby = election.Elector(LocalClient(server), "standby", ELECTION_KEY,
+                               interval=options.interval, ttl=options.ttl)
+    # Let the standby start watching the key.
+    eventlet.sleep(options.interval)
+    assert not standby.master()
+
+    start_time = time.time()
+    if case == "crash":
+        master_client.crashed = True
+    master.stop()
+    wait_for_master(standby)
+    elapsed = time.time() - start_time
+    standby.stop()
+    return elapsed
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--interval", type="float", default=0.5,
+                      help="election interval in seconds "
+                           "(default: %default)")
+    parser.add_option("--ttl", type="int", default=2,
+                      help="election key TTL in seconds (default: %default)")
+    parser.add_option("--trials", type="int", default=5,
+                      help="number of failovers of each kind "
+                           "(default: %default)")
+    options, _ = parser.parse_args(argv)
+    # The crashed master logs a stack trace when it fails to step down.
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = {
+        "interval": options.interval,
+        "ttl": options.ttl,
+    }
+    for case in ("clean", "crash"):
+        times = [measure_failover(case, options)
+                 for _ in xrange(options.trials)]
+        results[case] = {
+            "min": min(times),
+            "mean": sum(times) / len(times),
+            "max": max(times),
+        }
+    print json.dumps(results, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
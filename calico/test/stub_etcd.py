@@ -37,6 +37,9 @@ class EtcdClusterIdChanged(EtcdException):
 class EtcdEventIndexCleared(EtcdException):
     pass
 
+class EtcdAlreadyExist(EtcdException):
+    pass
+
 class NoMoreResults(Exception):
     pass
 
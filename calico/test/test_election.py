@@ -210,3 +210,50 @@ class TestElection(unittest.TestCase):
 
         # We are no longer the master, after error.
         self.assertFalse(elector.master())
+
+    def test_invalid_jitter(self):
+        with self.assertRaises(ValueError):
+            client = stub_etcd.Client()
+            election.Elector(client, "test_basic", "/bloop", interval=5,
+                             ttl=15, jitter=1)
+
+    def test_fractional_interval(self):
+        client = stub_etcd.Client()
+        client.add_read_result(key="/bloop", value="value")
+        elector = election.Elector(client, "test_basic", "/bloop",
+                                   interval=0.5, ttl=1.5)
+        # etcd TTLs are whole seconds.
+        self.assertEqual(elector._ttl, 2)
+        self._wait_and_stop(client, elector)
+
+    def test_lost_race_retries_immediately(self):
+        sleeps = []
+        eventlet.sleep = sleeps.append
+        client = stub_etcd.Client()
+        client.add_read_exception(stub_etcd.EtcdKeyNotFound())
+        # Someone else becomes master first.
+        client.add_write_exception(stub_etcd.EtcdAlreadyExist())
+        client.add_read_result(key="/bloop", value="value")
+        elector = election.Elector(client, "test_basic", "/bloop",
+                                   interval=5, ttl=15)
+        self._wait_and_stop(client, elector)
+        self.assertFalse(elector.master())
+        self.assertEqual(sleeps, [])
+
+    def test_replaced_master_retries_immediately(self):
+        sleeps = []
+        eventlet.sleep = sleeps.append
+        client = stub_etcd.Client()
+        client.add_read_exception(stub_etcd.EtcdKeyNotFound())
+        client.add_write_exception(None)
+        client.add_write_exception(None)
+        # Our key has been replaced by the time that we next renew it.
+        client.add_write_exception(ValueError("Compare failed"))
+        client.add_read_result(key="/bloop", value="value")
+        elector = election.Elector(client, "test_basic", "/bloop",
+                                   interval=5, ttl=15)
+        self._wait_and_stop(client, elector)
+        self.assertFalse(elector.master())
+        # Only the sleep before renewing, which is jittered.
+        self.assertEqual(len(sleeps), 1)
+        self.assertTrue(4.5 <= sleeps[0] <= 5, sleeps)
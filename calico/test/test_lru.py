@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test_lru
+~~~~~~~~
+
+Tests for the LRU cache.
+"""
+import logging
+import unittest
+
+from calico import stats
+from calico.lru import LRUCache
+
+_log = logging.getLogger(__name__)
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        stats.reset()
+        self.cache = LRUCache("cache", 10)
+
+    def tearDown(self):
+        stats.reset()
+
+    def test_get_put(self):
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.get("a", "dflt"), "dflt")
+        self.cache.put("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.cache.put("a", 2, weight=3)
+        self.assertEqual(self.cache.get("a"), 2)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.weight, 3)
+        self.assertEqual(stats.counter("cache.hits"), 2)
+        self.assertEqual(stats.counter("cache.misses"), 2)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put("a", 1, weight=4)
+        self.cache.put("b", 2, weight=4)
+        # Using "a" makes "b" the least recently used.
+        self.cache.get("a")
+        self.cache.put("c", 3, weight=4)
+        self.assertTrue("a" in self.cache)
+        self.assertFalse("b" in self.cache)
+        self.assertTrue("c" in self.cache)
+        self.assertEqual(self.cache.weight, 8)
+        self.assertEqual(stats.counter("cache.evictions"), 1)
+        # A big entry can evict several.
+        self.cache.put("d", 4, weight=9)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.weight, 9)
+
+    def test_too_heavy(self):
+        self.cache.put("a", 1, weight=4)
+        self.cache.put("b", 2, weight=11)
+        self.assertFalse("b" in self.cache)
+        self.assertTrue("a" in self.cache)
+        # Replacing a value with one that's too heavy removes it.
+        self.cache.put("a", 3, weight=11)
+        self.assertFalse("a" in self.cache)
+        self.assertEqual(self.cache.weight, 0)
+
+    def test_discard_clear(self):
+        self.cache.put("a", 1, weight=4)
+        self.cache.put("b", 2, weight=4)
+        self.assertEqual(self.cache.items(), [("a", 1), ("b", 2)])
+        self.cache.discard("a")
+        self.cache.discard("missing")
+        self.assertEqual(self.cache.weight, 4)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.weight, 0)
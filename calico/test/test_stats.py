@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test_stats
+~~~~~~~~~~
+
+Tests for the in-process stats.
+"""
+import logging
+import unittest
+
+import mock
+
+from calico import stats
+
+_log = logging.getLogger(__name__)
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        stats.reset()
+
+    def tearDown(self):
+        stats.reset()
+
+    def test_histogram(self):
+        hist = stats.histogram("lat")
+        self.assertTrue(stats.histogram("lat") is hist)
+        self.assertEqual(hist.percentile(50), None)
+        for _ in xrange(90):
+            hist.record(0.001)
+        for _ in xrange(10):
+            hist.record(1.0)
+        summary = hist.snapshot()
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["max"], 1.0)
+        self.assertEqual(summary["min"], 0.001)
+        # Percentiles are upper bounds, accurate to a factor of two.
+        self.assertTrue(0.001 <= summary["p50"] <= 0.002)
+        self.assertTrue(0.001 <= summary["p90"] <= 0.002)
+        self.assertEqual(summary["p99"], 1.0)
+
+    def test_extreme_values(self):
+        hist = stats.histogram("lat")
+        hist.record(0)
+        hist.record(1e9)
+        self.assertEqual(hist.buckets[0], 1)
+        self.assertEqual(hist.buckets[-1], 1)
+        self.assertEqual(hist.percentile(100), 1e9)
+
+    def test_counters_and_snapshot(self):
+        stats.increment("a")
+        stats.increment("a", 2)
+        stats.histogram("h").record(0.5)
+        self.assertEqual(stats.counter("a"), 3)
+        self.assertEqual(stats.counter("b"), 0)
+        snap = stats.snapshot()
+        self.assertEqual(snap["a"], 3)
+        self.assertEqual(snap["h"]["count"], 1)
+
+    def test_log_report(self):
+        stats.increment("a")
+        stats.histogram("h").record(0.5)
+        stats.histogram("empty")
+        m_log = mock.Mock()
+        stats.log_report(m_log)
+        self.assertEqual(m_log.info.call_count, 2)